@@ -0,0 +1,216 @@
+"""
+Analytics Rollups
+Tablas pre-agregadas para /analytics, mantenidas por el scheduler.
+
+- message_rollup_hourly: una fila por (hora local Argentina, dirección, tipo, último estado)
+  con la cantidad de mensajes y cuántos llegaron a sent / delivered / read.
+- message_rollup_phone: total de mensajes por teléfono (top contactos).
+- rollup_watermarks: hasta qué row_version de whatsapp_messages está aplicado.
+
+refresh_rollups() corre cada minuto: toma los mensajes insertados o modificados
+(estado, media, etc.) entre el watermark y la versión asentada —row_version,
+ver message_versions.py: nada que commitee después puede quedar por debajo— y
+recalcula solo las horas y teléfonos que tocan.
+
+Si no hay watermark (deploy nuevo) hace el backfill completo por tramos de días.
+`python backfill_analytics_rollups.py` lo fuerza a mano.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from message_versions import settled_version
+
+logger = logging.getLogger(__name__)
+
+ARGENTINA_TZ = 'America/Argentina/Buenos_Aires'
+LOCK_KEY = 71006
+WATERMARK_NAME = 'messages'
+BACKFILL_DAYS_PER_CHUNK = 7
+
+# Hora local (naive) de un timestamp UTC naive, y su inversa
+LOCAL_HOUR_SQL = f"date_trunc('hour', {{col}} AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}')"
+LOCAL_TO_UTC_SQL = f"(({{col}}) AT TIME ZONE '{ARGENTINA_TZ}' AT TIME ZONE 'UTC')"
+
+# Agregado por hora para las filas de whatsapp_messages ya filtradas (alias m)
+_AGGREGATE_SELECT = f"""
+    SELECT {LOCAL_HOUR_SQL.format(col='m.timestamp')} AS bucket,
+           m.direction,
+           m.message_type,
+           COALESCE(m.status, '') AS status,
+           COUNT(*) AS messages,
+           COUNT(m.sent_at) AS sent_count,
+           COUNT(m.delivered_at) AS delivered_count,
+           COUNT(m.read_at_recipient) AS read_count
+    FROM whatsapp_messages m
+"""
+_AGGREGATE_GROUP = "GROUP BY 1, 2, 3, 4"
+
+INSERT_HOURLY_SQL = """
+    INSERT INTO message_rollup_hourly
+        (bucket, direction, message_type, status, messages, sent_count, delivered_count, read_count)
+"""
+
+
+# Tablas (también declaradas en models.py / create_database.sql), para el comando de backfill
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS message_rollup_hourly (
+    bucket TIMESTAMP NOT NULL,
+    direction VARCHAR(10) NOT NULL,
+    message_type VARCHAR(20) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT '',
+    messages INTEGER NOT NULL DEFAULT 0,
+    sent_count INTEGER NOT NULL DEFAULT 0,
+    delivered_count INTEGER NOT NULL DEFAULT 0,
+    read_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, direction, message_type, status)
+);
+CREATE TABLE IF NOT EXISTS message_rollup_phone (
+    phone_number VARCHAR(20) PRIMARY KEY,
+    messages INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS ix_message_rollup_phone_messages ON message_rollup_phone(messages);
+CREATE TABLE IF NOT EXISTS rollup_watermarks (
+    name VARCHAR(50) PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def refresh_rollups(app_context):
+    """Aplica los cambios pendientes a las tablas de rollup (llamado desde el scheduler)."""
+    with app_context:
+        from models import db
+        with db.engine.connect() as conn:
+            # Un solo proceso a la vez (p. ej. durante un failover del líder del scheduler)
+            if not conn.execute(text(f"SELECT pg_try_advisory_lock({LOCK_KEY})")).scalar():
+                conn.rollback()
+                return
+            conn.commit()
+            try:
+                watermark = conn.execute(
+                    text("SELECT value FROM rollup_watermarks WHERE name = :name"), {'name': WATERMARK_NAME}
+                ).scalar()
+                conn.commit()
+                if watermark is None:
+                    _backfill(conn)
+                else:
+                    _apply_since(conn, watermark)
+            finally:
+                conn.rollback()  # Si algo falló, salir de la transacción abortada antes de soltar el lock
+                conn.execute(text(f"SELECT pg_advisory_unlock({LOCK_KEY})"))
+                conn.commit()
+
+
+def backfill_rollups(engine):
+    """Reconstruye todos los rollups desde cero (comando de backfill). Espera si el scheduler está corriendo."""
+    with engine.connect() as conn:
+        conn.exec_driver_sql(SCHEMA_SQL)
+        conn.commit()
+        conn.execute(text(f"SELECT pg_advisory_lock({LOCK_KEY})"))
+        conn.commit()
+        try:
+            _backfill(conn)
+        finally:
+            conn.rollback()  # Si algo falló, salir de la transacción abortada antes de soltar el lock
+            conn.execute(text(f"SELECT pg_advisory_unlock({LOCK_KEY})"))
+            conn.commit()
+
+
+def _apply_since(conn, watermark):
+    """Recalcula las horas y teléfonos con mensajes cuyo row_version es posterior al watermark."""
+    high = settled_version(conn)
+    if high <= watermark:
+        conn.rollback()
+        return
+    params = {'low': watermark, 'high': high}
+
+    conn.execute(text(f"""
+        CREATE TEMP TABLE _rollup_buckets ON COMMIT DROP AS
+        SELECT DISTINCT {LOCAL_HOUR_SQL.format(col='timestamp')} AS bucket
+        FROM whatsapp_messages
+        WHERE row_version > :low AND row_version <= :high AND timestamp IS NOT NULL
+    """), params)
+    conn.execute(text("DELETE FROM message_rollup_hourly h USING _rollup_buckets b WHERE h.bucket = b.bucket"))
+    hours = conn.execute(text(f"""
+        {INSERT_HOURLY_SQL}
+        {_AGGREGATE_SELECT}
+        JOIN _rollup_buckets b
+          ON m.timestamp >= {LOCAL_TO_UTC_SQL.format(col='b.bucket')}
+         AND m.timestamp < {LOCAL_TO_UTC_SQL.format(col="b.bucket + interval '1 hour'")}
+        {_AGGREGATE_GROUP}
+    """)).rowcount
+
+    phones = conn.execute(text("""
+        INSERT INTO message_rollup_phone (phone_number, messages, updated_at)
+        SELECT m.phone_number, COUNT(*), (now() AT TIME ZONE 'utc')
+        FROM whatsapp_messages m
+        WHERE m.phone_number IN (
+            SELECT DISTINCT phone_number FROM whatsapp_messages
+            WHERE row_version > :low AND row_version <= :high
+        )
+        GROUP BY m.phone_number
+        ON CONFLICT (phone_number) DO UPDATE SET
+            messages = EXCLUDED.messages,
+            updated_at = EXCLUDED.updated_at
+    """), params).rowcount
+
+    _set_watermark(conn, high)
+    conn.commit()
+    logger.info(f"📊 [ROLLUPS] Versiones {watermark}→{high}: {hours} fila(s) horarias, {phones} teléfono(s)")
+
+
+def _backfill(conn):
+    """Backfill completo por tramos de BACKFILL_DAYS_PER_CHUNK días (un commit por tramo)."""
+    # El watermark se toma antes de empezar: lo que cambie durante el backfill se re-aplica después
+    high = settled_version(conn)
+    bounds = conn.execute(text("SELECT MIN(timestamp), MAX(timestamp) FROM whatsapp_messages")).first()
+    conn.commit()
+    logger.info(f"📊 [ROLLUPS] Backfill de rollups desde {bounds[0]} hasta {bounds[1]}")
+
+    conn.execute(text("TRUNCATE message_rollup_hourly"))
+    conn.commit()
+    if bounds[0] is not None:
+        chunk_start = bounds[0].replace(minute=0, second=0, microsecond=0)
+        end = bounds[1] + timedelta(hours=1)
+        while chunk_start < end:
+            chunk_end = chunk_start + timedelta(days=BACKFILL_DAYS_PER_CHUNK)
+            # Los tramos se cortan en horas UTC; con offsets de hora entera coinciden con horas locales
+            conn.execute(text(f"""
+                {INSERT_HOURLY_SQL}
+                {_AGGREGATE_SELECT}
+                WHERE m.timestamp >= :start AND m.timestamp < :end
+                {_AGGREGATE_GROUP}
+            """), {'start': chunk_start, 'end': chunk_end})
+            conn.commit()
+            chunk_start = chunk_end
+
+    conn.execute(text("TRUNCATE message_rollup_phone"))
+    conn.execute(text("""
+        INSERT INTO message_rollup_phone (phone_number, messages, updated_at)
+        SELECT phone_number, COUNT(*), (now() AT TIME ZONE 'utc')
+        FROM whatsapp_messages
+        GROUP BY phone_number
+    """))
+    _set_watermark(conn, high)
+    conn.commit()
+    logger.info(f"📊 [ROLLUPS] Backfill completo (watermark {high})")
+
+
+def _set_watermark(conn, value):
+    conn.execute(text("""
+        INSERT INTO rollup_watermarks (name, value, updated_at)
+        VALUES (:name, :value, :now)
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+    """), {'name': WATERMARK_NAME, 'value': value, 'now': datetime.utcnow()})
+
+
+def local_since(since_utc):
+    """Hora local (naive) desde la que filtrar los buckets para un instante UTC naive."""
+    if since_utc is None:
+        return None
+    import pytz
+    return pytz.utc.localize(since_utc).astimezone(pytz.timezone(ARGENTINA_TZ)).replace(tzinfo=None)
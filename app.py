@@ -3,14 +3,26 @@ import json
 import requests
 import io
 import os
+import base64
 import pandas as pd
 import re
-from flask import Flask, request, jsonify, render_template, send_file, session, redirect, url_for, abort, g
+from flask import Flask, request, jsonify, render_template, send_file, session, redirect, url_for, abort, g, Response, stream_with_context
 from config import Config
-from models import db, Message, MessageStatus, Contact, Tag, contact_tags, Campaign, CampaignLog, ConversationTopic, ConversationSession, RagDocument, ChatbotConfig, ConversationNote, AutoTagRule, AutoTagLog, FollowUpSequence, FollowUpStep, FollowUpEnrollment, CrmUserTagVisibility, CatalogProduct, Order, OrderItem, PushSubscription
+from models import db, Message, MessageStatus, Contact, Tag, contact_tags, Campaign, CampaignLog, ConversationTopic, ConversationSession, RagDocument, ChatbotConfig, ConversationNote, AutoTagRule, AutoTagLog, FollowUpSequence, FollowUpStep, FollowUpEnrollment, CrmUserTagVisibility, CatalogProduct, Order, OrderItem, PushSubscription, Conversation, CampaignResponseMetrics, CampaignCounters
 import threading
 import time as time_module
-from event_handlers import process_event
+from webhook_inbox import enqueue as enqueue_webhook, start_inbox_consumers
+import message_search
+from message_versions import SETTLED_VERSION_EXPR
+import visibility
+import auth_cache
+from analytics_rollups import local_since
+from campaign_metrics import metrics_to_dict
+from campaign_counters import get_counters as get_campaign_counters
+from campaign_sender import start_sender as start_campaign_sender, cancel_pending_logs, resume_orphaned_campaigns
+from scheduler import register_job as register_scheduler_job, start_scheduler, get_status as get_scheduler_status
+import llm_client
+from types import SimpleNamespace
 from sqlalchemy import func, or_, and_, text
 from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta, timezone
@@ -122,6 +134,14 @@ with app.app_context():
         db.session.rollback()
         logger.warning(f"Could not ensure system tag (run migrate_human_assistance.py first): {e}")
 
+# Contadores por campaña (triggers sobre whatsapp_campaign_logs + backfill si es un deploy nuevo)
+with app.app_context():
+    try:
+        from campaign_counters import ensure_campaign_counters
+        ensure_campaign_counters(db.engine)
+    except Exception as e:
+        logger.warning(f"Could not ensure campaign counters (run migrate_campaign_counters.py): {e}")
+
 # Rutas públicas que no requieren autenticación
 PUBLIC_PATHS = {'/', '/login', '/logout', '/webhook', '/chatwoot-webhook', '/api/minio/diagnose', '/sw.js', '/static/manifest.json', '/api/whatsapp/send-text', '/api/whatsapp/send-media', '/api/bot/catalog', '/api/bot/audios', '/api/bot/send-audio'}
 
@@ -179,9 +199,8 @@ def check_auth():
             return jsonify({'error': 'Unauthorized'}), 401
         return redirect(url_for('login'))
 
-    # Verificar permiso para la ruta actual
-    from models import CrmUser
-    user = CrmUser.query.get(session['user_id'])
+    # Verificar permiso para la ruta actual (usuario + permisos cacheados, ver auth_cache.py)
+    user = auth_cache.get_user(session['user_id'])
     if not user or not user.is_active:
         session.clear()
         return redirect(url_for('login'))
@@ -213,14 +232,11 @@ def service_worker():
 
 @app.context_processor
 def inject_current_user():
-    """Inyecta el usuario actual en todos los templates."""
-    from models import CrmUser
-    user_id = session.get('user_id')
-    if user_id:
-        user = CrmUser.query.get(user_id)
-        if user:
-            return {'current_user': user}
-    return {'current_user': None}
+    """Inyecta el usuario actual en todos los templates (el mismo que resolvió check_auth)."""
+    user = getattr(g, 'current_user', None)
+    if user is None and session.get('user_id'):
+        user = auth_cache.get_user(session['user_id'])
+    return {'current_user': user}
 
 @app.route("/", methods=["GET"])
 def index():
@@ -329,6 +345,7 @@ def api_retry_media_download(message_id):
 
         # Actualizar la URL en la BD
         msg.media_url = new_url
+        msg.media_status = 'ready'
         db.session.commit()
 
         return jsonify({
@@ -715,15 +732,16 @@ def api_minio_diagnose():
 def webhook_handler():
     """
     Endpoint principal para recibir eventos de WhatsApp.
+    Solo persiste el payload en la inbox durable y responde; los consumidores
+    de webhook_inbox lo procesan en background (ver webhook_inbox.py).
     """
     try:
         data = request.json
         if not data:
             return "No data received", 400
-            
-        # Procesar el evento (loguear, guardar, reenviar)
-        process_event(data)
-        
+
+        enqueue_webhook(data)
+
         return "EVENT_RECEIVED", 200
         
     except Exception as e:
@@ -742,35 +760,22 @@ def dashboard():
     CONTACTS_LIMIT = 25
     from sqlalchemy import text
 
-    # Query optimizada: un solo JOIN entre mensajes y contactos (con sus tags).
-    # Usa lateral join para obtener el último mensaje por teléfono sin doble sort.
-    # El índice ix_messages_phone_ts (phone_number, timestamp) hace esto muy rápido.
-    # Las conversaciones con tag "Asistencia Humana" se muestran primero.
-    vis_sql, vis_params = build_visibility_sql(g.current_user)
+    # La bandeja sale de la tabla resumen `conversations` (una fila por teléfono,
+    # mantenida por triggers): range scan sobre idx_conversations_inbox, sin recorrer
+    # whatsapp_messages. Las conversaciones con tag "Asistencia Humana" van primero.
+    vis_sql, vis_params = build_visibility_sql(g.current_user, 'cv.phone_number')
     combined_query = text(f"""
         SELECT
-            m.phone_number,
-            m.content        AS last_message,
-            m.timestamp      AS last_timestamp,
+            cv.phone_number,
+            cv.last_message,
+            cv.last_timestamp,
             c.id             AS contact_id,
             c.name           AS contact_name,
-            CASE WHEN ha.contact_id IS NOT NULL THEN 1 ELSE 0 END AS has_human
-        FROM (
-            SELECT DISTINCT ON (phone_number) phone_number, content, timestamp
-            FROM whatsapp_messages
-            WHERE phone_number NOT IN ('unknown', 'outbound', '')
-            ORDER BY phone_number, timestamp DESC
-        ) m
-        LEFT JOIN whatsapp_contacts c ON c.phone_number = m.phone_number
-        LEFT JOIN LATERAL (
-            SELECT ct.contact_id
-            FROM whatsapp_contact_tags ct
-            JOIN whatsapp_tags t ON t.id = ct.tag_id
-            WHERE ct.contact_id = c.id AND t.name = 'Asistencia Humana'
-            LIMIT 1
-        ) ha ON true
+            cv.has_human
+        FROM conversations cv
+        LEFT JOIN whatsapp_contacts c ON c.id = cv.contact_id
         WHERE 1=1 {vis_sql}
-        ORDER BY has_human DESC, m.timestamp DESC
+        ORDER BY cv.has_human DESC, cv.last_timestamp DESC, cv.phone_number DESC
         LIMIT :lim
     """)
 
@@ -778,6 +783,7 @@ def dashboard():
 
     has_more_contacts = len(rows) > CONTACTS_LIMIT
     rows = rows[:CONTACTS_LIMIT]
+    next_contacts_cursor = encode_inbox_cursor(rows[-1]) if has_more_contacts else None
 
     # Cargar tags solo para los contactos encontrados (una sola query con IN)
     contact_ids = [r.contact_id for r in rows if r.contact_id]
@@ -825,22 +831,15 @@ def dashboard():
     if selected_phone:
         selected_contact = selected_phone
 
-        # Query raw: trae mensajes + latest_status en una sola pasada sin JOIN pesado.
-        # Usa DISTINCT ON en statuses para traer solo el último estado por mensaje.
+        # Query raw: el último estado está desnormalizado en whatsapp_messages.status,
+        # así que no hace falta tocar whatsapp_message_statuses.
         msg_query = text("""
             SELECT
                 m.id, m.wa_message_id, m.phone_number, m.direction,
                 m.message_type, m.content, m.media_url, m.caption,
                 m.timestamp, m.media_id,
-                s.status AS latest_status
+                m.status AS latest_status
             FROM whatsapp_messages m
-            LEFT JOIN LATERAL (
-                SELECT status
-                FROM whatsapp_message_statuses
-                WHERE wa_message_id = m.wa_message_id
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ) s ON true
             WHERE m.phone_number = :phone
             ORDER BY m.timestamp DESC
             LIMIT :lim
@@ -926,6 +925,7 @@ def dashboard():
                          templates=templates,
                          whatsapp_configured=whatsapp_configured,
                          has_more_contacts=has_more_contacts,
+                         next_contacts_cursor=next_contacts_cursor,
                          bot_paused=bot_paused,
                          available_tags=available_tags,
                          has_no_visibility=has_no_visibility,
@@ -934,9 +934,6 @@ def dashboard():
 @app.route("/analytics")
 def analytics():
     """Página de analytics con estadísticas detalladas - OPTIMIZADO."""
-    # Zona horaria de Argentina
-    ARGENTINA_TZ = 'America/Argentina/Buenos_Aires'
-
     # Período de análisis configurable (default: 30 días)
     period = request.args.get('period', 30, type=int)
 
@@ -946,36 +943,28 @@ def analytics():
     else:
         since_date = None  # Sin filtro = todo el historial
 
-    # OPTIMIZACIÓN: Una sola query para stats de mensajes con GROUP BY
-    msg_query = db.session.query(
-        Message.direction,
-        func.count(Message.id).label('count')
-    )
-    if since_date:
-        msg_query = msg_query.filter(Message.timestamp >= since_date)
-    message_stats = msg_query.group_by(Message.direction).all()
-
-    # Convertir a dict
-    direction_counts = {row.direction: row.count for row in message_stats}
-    outbound = direction_counts.get('outbound', 0)
-    inbound = direction_counts.get('inbound', 0)
-    total_messages = outbound + inbound
+    # Rollups por hora local (ver analytics_rollups.py): el costo no depende del tamaño del historial
+    rollup_since = local_since(since_date) or datetime(1970, 1, 1)
 
-    # OPTIMIZACIÓN: Una sola query para todos los estados con GROUP BY
-    status_query = db.session.query(
-        MessageStatus.status,
-        func.count(MessageStatus.id).label('count')
-    )
-    if since_date:
-        status_query = status_query.filter(MessageStatus.timestamp >= since_date)
-    status_stats = status_query.group_by(MessageStatus.status).all()
-
-    # Convertir a dict
-    status_counts = {row.status: row.count for row in status_stats}
-    read = status_counts.get('read', 0)
-    delivered = status_counts.get('delivered', 0)
-    sent = status_counts.get('sent', 0)
-    failed = status_counts.get('failed', 0)
+    totals = db.session.execute(text("""
+        SELECT
+            COALESCE(SUM(messages) FILTER (WHERE direction = 'outbound'), 0) AS outbound,
+            COALESCE(SUM(messages) FILTER (WHERE direction = 'inbound'), 0) AS inbound,
+            COALESCE(SUM(sent_count) FILTER (WHERE direction = 'outbound'), 0) AS sent,
+            COALESCE(SUM(delivered_count) FILTER (WHERE direction = 'outbound'), 0) AS delivered,
+            COALESCE(SUM(read_count) FILTER (WHERE direction = 'outbound'), 0) AS read,
+            COALESCE(SUM(messages) FILTER (WHERE direction = 'outbound' AND status = 'failed'), 0) AS failed
+        FROM message_rollup_hourly
+        WHERE bucket >= :since
+    """), {'since': rollup_since}).one()
+
+    outbound = totals.outbound
+    inbound = totals.inbound
+    total_messages = outbound + inbound
+    read = totals.read
+    delivered = totals.delivered
+    sent = totals.sent
+    failed = totals.failed
 
     stats = {
         'total_messages': total_messages,
@@ -987,19 +976,16 @@ def analytics():
         'failed': failed
     }
 
-    # Fecha para gráficos (usa el mismo período seleccionado)
+    # Fecha para la sección de templates (usa el mismo período seleccionado)
     chart_since = since_date if since_date else datetime.utcnow() - timedelta(days=365 * 10)  # 10 años si es "todo"
-    
+
     # Mensajes por día (hora Argentina) - usa período seleccionado
-    messages_by_day = db.session.execute(db.text(f"""
-        SELECT
-            DATE(timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}') as date,
-            direction,
-            COUNT(*) as count
-        FROM whatsapp_messages
-        WHERE timestamp >= :since
-        GROUP BY DATE(timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}'), direction
-    """), {'since': chart_since}).fetchall()
+    messages_by_day = db.session.execute(text("""
+        SELECT CAST(bucket AS date) AS date, direction, SUM(messages) AS count
+        FROM message_rollup_hourly
+        WHERE bucket >= :since
+        GROUP BY 1, 2
+    """), {'since': rollup_since}).fetchall()
 
     # Formatear datos por día
     day_data = {}
@@ -1012,41 +998,27 @@ def analytics():
         else:
             day_data[date_str]['outbound'] = row.count
 
-    # Mensajes enviados por hora (hora Argentina) - usa período seleccionado
-    sent_by_hour = db.session.execute(db.text(f"""
-        SELECT
-            EXTRACT(HOUR FROM timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}')::int as hour,
-            COUNT(*) as count
-        FROM whatsapp_messages
-        WHERE direction = 'outbound' AND timestamp >= :since
-        GROUP BY EXTRACT(HOUR FROM timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}')
-        ORDER BY hour
-    """), {'since': chart_since}).fetchall()
-
-    # Mensajes leídos por hora - cuenta mensajes ENVIADOS en esa hora que fueron leídos (en cualquier momento)
-    # Corrige el problema de tasas > 100% comparando mensajes con sus estados correctamente
-    read_by_hour = db.session.execute(db.text(f"""
-        SELECT
-            EXTRACT(HOUR FROM m.timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}')::int as hour,
-            COUNT(DISTINCT m.id) as count
-        FROM whatsapp_messages m
-        INNER JOIN whatsapp_message_statuses s ON m.wa_message_id = s.wa_message_id
-        WHERE m.direction = 'outbound'
-          AND m.timestamp >= :since
-          AND s.status = 'read'
-        GROUP BY EXTRACT(HOUR FROM m.timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}')
-        ORDER BY hour
-    """), {'since': chart_since}).fetchall()
+    # Enviados y leídos por hora (hora Argentina). "Leídos" = mensajes ENVIADOS en esa hora
+    # que fueron leídos en cualquier momento, así la tasa nunca supera el 100%
+    by_hour = db.session.execute(text("""
+        SELECT EXTRACT(HOUR FROM bucket)::int AS hour,
+               SUM(messages) AS sent,
+               SUM(read_count) AS read
+        FROM message_rollup_hourly
+        WHERE direction = 'outbound' AND bucket >= :since
+        GROUP BY 1
+        ORDER BY 1
+    """), {'since': rollup_since}).fetchall()
+    sent_by_hour = [SimpleNamespace(hour=row.hour, count=row.sent) for row in by_hour]
+    read_by_hour = [SimpleNamespace(hour=row.hour, count=row.read) for row in by_hour if row.read]
 
     # Mensajes por día de la semana (hora Argentina) - usa período seleccionado
-    by_day_of_week = db.session.execute(db.text(f"""
-        SELECT
-            EXTRACT(DOW FROM timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}')::int as dow,
-            COUNT(*) as count
-        FROM whatsapp_messages
-        WHERE timestamp >= :since
-        GROUP BY EXTRACT(DOW FROM timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{ARGENTINA_TZ}')
-    """), {'since': chart_since}).fetchall()
+    by_day_of_week = db.session.execute(text("""
+        SELECT EXTRACT(DOW FROM bucket)::int AS dow, SUM(messages) AS count
+        FROM message_rollup_hourly
+        WHERE bucket >= :since
+        GROUP BY 1
+    """), {'since': rollup_since}).fetchall()
     
     dow_counts = [0] * 7
     for row in by_day_of_week:
@@ -1056,13 +1028,14 @@ def analytics():
             idx = (idx - 1) % 7
             dow_counts[idx] = row.count
     
-    # Top contactos
-    top_contacts = db.session.query(
-        Message.phone_number,
-        func.count(Message.id).label('count')
-    ).filter(
-        Message.phone_number.notin_(['unknown', 'outbound', ''])
-    ).group_by(Message.phone_number).order_by(func.count(Message.id).desc()).limit(5).all()
+    # Top contactos (todo el historial, desde el total por teléfono)
+    top_contacts = db.session.execute(text("""
+        SELECT phone_number, messages AS count
+        FROM message_rollup_phone
+        WHERE phone_number NOT IN ('unknown', 'outbound', '')
+        ORDER BY messages DESC
+        LIMIT 5
+    """)).fetchall()
     
     chart_data = {
         'messages_by_day': sorted(day_data.values(), key=lambda x: x['date']),
@@ -1075,85 +1048,46 @@ def analytics():
     }
     
     # ========== ESTADÍSTICAS DE TEMPLATES ==========
-    # Obtener mensajes salientes del período seleccionado
-    outbound_messages = Message.query.filter(
+    # template_name se guarda al enviar (campañas, seguimientos, send-template, Chatwoot);
+    # el histórico lo clasificó una vez migrate_message_template.py
+    template_rows = db.session.query(
+        Message.template_name,
+        func.count(Message.id).label('sent'),
+        func.count(Message.read_at_recipient).label('read')
+    ).filter(
         Message.direction == 'outbound',
+        Message.template_name.isnot(None),
         Message.timestamp >= chart_since
-    ).all()
-    
-    # Obtener templates de la API para mapeo
-    templates_info = whatsapp_api.get_templates().get("templates", [])
-    
-    # Agrupar por "nombre" de template
-    stats_by_template = {} # key: template_name, value: {sent: 0, read: 0}
-    
-    import re
-    # Pre-calcular patrones de templates para mayor velocidad
-    template_patterns = []
-    for t in templates_info:
-        for comp in t.get("components", []):
-            if comp.get("type") == "BODY":
-                body = comp.get("text", "").strip()
-                if not body: continue
-                # Limpiar el escape de re.escape para que sea más flexible
-                # En lugar de re.escape completo, escapamos solo caracteres especiales pero no espacios
-                pattern = re.escape(body)
-                # Reemplazar variables {{n}} por un comodín
-                pattern = re.sub(r'\\\{\\\{\d+\\\}\\\}', '.*?', pattern)
-                # Permitir cualquier cantidad de espacios/newslines donde haya uno
-                pattern = re.sub(r'\\ ', r'\\s+', pattern)
-                pattern = re.sub(r'\\n', r'\\s*', pattern)
-                
-                template_patterns.append({
-                    'name': t.get("name"), 
-                    'regex': f".*{pattern}.*" # Permitir que esté contenido (por si hay Header/Footer)
-                })
-    
-    for msg in outbound_messages:
-        t_name = None
-        content = (msg.content or "").strip()
-        if not content: continue
-        
-        # 1. Prioridad: Mensajes ya marcados con [Template: nombre]
-        match_name = re.match(r'^\[Template: ([^\]]+)\]', content)
-        if match_name:
-            t_name = match_name.group(1)
-        
-        # 2. Si no, intentar por coincidencia de patrones (independiente de message_type)
-        if not t_name:
-            for tp in template_patterns:
-                try:
-                    if re.match(tp['regex'], content, re.DOTALL | re.IGNORECASE):
-                        t_name = tp['name']
-                        break
-                except: continue
-        
-        # 3. Si aún no hay nombre pero es tipo template, usar contenido truncado
-        if not t_name and msg.message_type == 'template':
-            t_name = content[:50] + "..." if len(content) > 50 else content
-        
-        # Si detectamos que es un template, sumar a stats
-        if t_name:
-            if t_name not in stats_by_template:
-                stats_by_template[t_name] = {'sent': 0, 'read': 0}
-            
-            stats_by_template[t_name]['sent'] += 1
-            is_read = any(s.status == 'read' for s in msg.statuses)
-            if is_read:
-                stats_by_template[t_name]['read'] += 1
-
-    # Convertir a lista para el template
-    template_performance = []
-    for name, s in stats_by_template.items():
-        read_rate = round((s['read'] / s['sent'] * 100) if s['sent'] > 0 else 0, 1)
-        template_performance.append({
-            'name': name,
-            'sent': s['sent'],
-            'read': s['read'],
-            'read_rate': read_rate
-        })
-    
-    # Ordenar por más enviados
+    ).group_by(Message.template_name).order_by(func.count(Message.id).desc()).limit(10).all()
+
+    # Mensajes tipo template cuyo template no se pudo identificar: se agrupan por el
+    # contenido truncado, como antes (no entran en el índice parcial, son pocos)
+    unknown_label = func.left(func.trim(Message.content), 50)
+    unknown_rows = db.session.query(
+        unknown_label.label('template_name'),
+        func.max(func.length(func.trim(Message.content))).label('content_len'),
+        func.count(Message.id).label('sent'),
+        func.count(Message.read_at_recipient).label('read')
+    ).filter(
+        Message.direction == 'outbound',
+        Message.template_name.is_(None),
+        Message.message_type == 'template',
+        func.coalesce(func.trim(Message.content), '') != '',
+        Message.timestamp >= chart_since
+    ).group_by(unknown_label).order_by(func.count(Message.id).desc()).limit(10).all()
+
+    template_performance = [{
+        'name': r.template_name,
+        'sent': r.sent,
+        'read': r.read,
+        'read_rate': round((r.read / r.sent * 100) if r.sent > 0 else 0, 1)
+    } for r in template_rows]
+    template_performance += [{
+        'name': r.template_name + "..." if r.content_len > 50 else r.template_name,
+        'sent': r.sent,
+        'read': r.read,
+        'read_rate': round((r.read / r.sent * 100) if r.sent > 0 else 0, 1)
+    } for r in unknown_rows]
     template_performance = sorted(template_performance, key=lambda x: x['sent'], reverse=True)[:10]
     
     # ========== MEJORES HORARIOS PARA LECTURA ==========
@@ -1278,25 +1212,20 @@ def api_stats():
     
     total = Message.query.filter(Message.timestamp >= twenty_four_hours_ago).count()
     
-    sent = db.session.query(func.count(MessageStatus.id)).filter(
-        MessageStatus.status == 'sent',
-        MessageStatus.timestamp >= twenty_four_hours_ago
-    ).scalar() or 0
-    
-    delivered = db.session.query(func.count(MessageStatus.id)).filter(
-        MessageStatus.status == 'delivered',
-        MessageStatus.timestamp >= twenty_four_hours_ago
-    ).scalar() or 0
-    
-    read = db.session.query(func.count(MessageStatus.id)).filter(
-        MessageStatus.status == 'read',
-        MessageStatus.timestamp >= twenty_four_hours_ago
-    ).scalar() or 0
-    
-    failed = db.session.query(func.count(MessageStatus.id)).filter(
-        MessageStatus.status == 'failed',
-        MessageStatus.timestamp >= twenty_four_hours_ago
-    ).scalar() or 0
+    # Una sola query sobre las columnas de estado desnormalizadas de whatsapp_messages
+    counts = db.session.query(
+        func.count(Message.id).filter(Message.sent_at >= twenty_four_hours_ago).label('sent'),
+        func.count(Message.id).filter(Message.delivered_at >= twenty_four_hours_ago).label('delivered'),
+        func.count(Message.id).filter(Message.read_at_recipient >= twenty_four_hours_ago).label('read'),
+        func.count(Message.id).filter(Message.status == 'failed').label('failed')
+    ).filter(
+        Message.direction == 'outbound',
+        Message.timestamp >= twenty_four_hours_ago
+    ).one()
+    sent = counts.sent or 0
+    delivered = counts.delivered or 0
+    read = counts.read or 0
+    failed = counts.failed or 0
     
     total_attempts = sent + delivered + read + failed
     success_rate = round(((delivered + read) / total_attempts * 100) if total_attempts > 0 else 100, 1)
@@ -1317,61 +1246,68 @@ def get_visible_tag_ids(user):
     """
     if user.is_admin:
         return None
-    return [v.tag_id for v in user.tag_visibility]
+    return list(user.visible_tag_ids)
 
 
 def user_can_access_phone(user, phone):
     """
     Verifica si el usuario tiene acceso a un contacto por su número de teléfono.
     Retorna True si tiene acceso, False si no.
+    Usa el índice phone_visibility + cache en memoria con TTL corto (ver visibility.py).
     """
     vis_tag_ids = get_visible_tag_ids(user)
     if vis_tag_ids is None:
         return True  # admin → acceso total
-    contact = Contact.query.filter_by(phone_number=phone).first()
-    if contact:
-        contact_tag_ids = {t.id for t in contact.tags}
-        if contact_tag_ids & set(vis_tag_ids):
-            return True
-        if user.can_see_untagged and not contact_tag_ids:
-            return True
+    if not vis_tag_ids and not user.can_see_untagged:
         return False
-    else:
-        return bool(user.can_see_untagged)
+    return visibility.can_access_phone(user.id, vis_tag_ids, user.can_see_untagged, phone)
 
 
 def build_visibility_sql(user, phone_alias='m.phone_number'):
     """
     Retorna (sql_fragment, params) para filtrar conversaciones por visibilidad de etiquetas.
     sql_fragment empieza con AND y se puede concatenar directamente al WHERE.
+    Es una búsqueda por PK en phone_visibility (sin EXISTS correlacionados sobre contactos).
     """
     if user.is_admin:
         return '', {}
 
     tag_ids = get_visible_tag_ids(user)
 
-    if not tag_ids:
+    if not tag_ids and not user.can_see_untagged:
         return 'AND 1=0', {}  # Sin etiquetas → no ve nada
 
-    conditions = [f"""
-        EXISTS (
-            SELECT 1 FROM whatsapp_contacts _vc
-            JOIN whatsapp_contact_tags _vct ON _vct.contact_id = _vc.id
-            WHERE _vc.phone_number = {phone_alias} AND _vct.tag_id = ANY(:_vis_ids)
-        )
-    """]
-
-    if user.can_see_untagged:
-        conditions.append(f"""(
-            NOT EXISTS (SELECT 1 FROM whatsapp_contacts _vc2 WHERE _vc2.phone_number = {phone_alias})
-            OR EXISTS (
-                SELECT 1 FROM whatsapp_contacts _vc3
-                WHERE _vc3.phone_number = {phone_alias}
-                AND NOT EXISTS (SELECT 1 FROM whatsapp_contact_tags _vct3 WHERE _vct3.contact_id = _vc3.id)
-            )
-        )""")
+    return f'AND {visibility.visibility_predicate(phone_alias)}', {
+        '_vis_ids': tag_ids,
+        '_vis_untagged': bool(user.can_see_untagged),
+    }
+
+
+def encode_inbox_cursor(row):
+    """Cursor opaco de la bandeja: posición (has_human, last_timestamp, phone_number) de la última fila."""
+    ts = row.last_timestamp
+    payload = [1 if row.has_human else 0, ts.isoformat() if ts else None, row.phone_number]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
 
-    return f'AND ({" OR ".join(conditions)})', {'_vis_ids': tag_ids}
+
+def decode_inbox_cursor(token):
+    """Inversa de encode_inbox_cursor. Retorna dict de parámetros SQL o lanza ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        has_human, ts, phone = json.loads(raw)
+        return {
+            'cur_human': bool(has_human),
+            # Conversaciones sin timestamp quedan primero en el orden DESC: el cursor arranca después de ellas
+            'cur_ts': datetime.fromisoformat(ts) if ts else datetime(1970, 1, 1),
+            'cur_phone': str(phone),
+        }
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+
+# Keyset sobre el mismo orden de la bandeja (has_human DESC, last_timestamp DESC, phone_number DESC):
+# comparación de filas → range scan sobre idx_conversations_inbox, costo constante en cualquier página.
+INBOX_CURSOR_SQL = "AND (cv.has_human, cv.last_timestamp, cv.phone_number) < (:cur_human, :cur_ts, :cur_phone)"
 
 
 def format_utc_iso(dt):
@@ -1433,10 +1369,14 @@ def register_contact_if_new(phone_number, name=None):
 
 @app.route("/api/dashboard/contacts", methods=["GET"])
 def api_dashboard_contacts():
-    """API para obtener contactos del dashboard con paginación, búsqueda y filtro de etiqueta."""
+    """
+    API para obtener contactos del dashboard con paginación, búsqueda y filtro de etiqueta.
+    Paginación por cursor: la respuesta trae `next_cursor`, que se manda como `cursor`
+    para la página siguiente (también en modo búsqueda / etiqueta).
+    """
     search = request.args.get('search', '').strip()
     tag_filter = request.args.get('tag', '').strip()
-    offset = request.args.get('offset', 0, type=int)
+    cursor = request.args.get('cursor', '').strip()
     limit = request.args.get('limit', 30, type=int)
 
     # Limitar el máximo de resultados por request
@@ -1445,80 +1385,71 @@ def api_dashboard_contacts():
     from sqlalchemy import text
 
     # Filtro de etiqueta explícito (barra lateral)
-    tag_join = ""
+    tag_sql = ""
     tag_params = {}
     if tag_filter:
-        tag_join = """
-            JOIN whatsapp_contacts c_tag ON c_tag.phone_number = m.phone_number
-            JOIN whatsapp_contact_tags ct_tag ON ct_tag.contact_id = c_tag.id
-            JOIN whatsapp_tags t_tag ON t_tag.id = ct_tag.tag_id AND t_tag.name = :tag_filter
+        tag_sql = """
+            AND EXISTS (
+                SELECT 1 FROM whatsapp_contacts c_tag
+                JOIN whatsapp_contact_tags ct_tag ON ct_tag.contact_id = c_tag.id
+                JOIN whatsapp_tags t_tag ON t_tag.id = ct_tag.tag_id AND t_tag.name = :tag_filter
+                WHERE c_tag.phone_number = cv.phone_number
+            )
         """
         tag_params['tag_filter'] = tag_filter
 
     # Filtro de visibilidad por usuario
-    vis_sql, vis_params = build_visibility_sql(g.current_user)
+    vis_sql, vis_params = build_visibility_sql(g.current_user, 'cv.phone_number')
 
+    # Búsqueda: teléfono, contacto (nombre / ID) o contenido de algún mensaje.
+    # Todos los predicados usan índices FTS / trigram (ver message_search.py).
+    search = message_search.normalize_term(search)
+    search_sql = ""
+    search_params = {}
     if search:
-        search_query = text(f"""
-            SELECT sub.phone_number, sub.last_message, sub.last_timestamp
-            FROM (
-                SELECT DISTINCT ON (m.phone_number) m.phone_number, m.content AS last_message, m.timestamp AS last_timestamp
-                FROM whatsapp_messages m
-                {tag_join}
-                WHERE m.phone_number NOT IN ('unknown', 'outbound', '')
-                  AND (
-                    m.phone_number ILIKE :pattern
-                    OR m.phone_number IN (
-                        SELECT c.phone_number FROM whatsapp_contacts c
-                        WHERE c.name ILIKE :pattern OR c.phone_number ILIKE :pattern
-                    )
-                    OR m.phone_number IN (
-                        SELECT DISTINCT m2.phone_number FROM whatsapp_messages m2
-                        WHERE m2.content ILIKE :pattern
-                          AND m2.phone_number NOT IN ('unknown', 'outbound', '')
-                    )
-                  )
-                  {vis_sql}
-                ORDER BY m.phone_number, m.timestamp DESC
-            ) sub
-            LEFT JOIN whatsapp_contacts c2 ON c2.phone_number = sub.phone_number
-            LEFT JOIN LATERAL (
-                SELECT ct.contact_id FROM whatsapp_contact_tags ct
-                JOIN whatsapp_tags t ON t.id = ct.tag_id
-                WHERE ct.contact_id = c2.id AND t.name = 'Asistencia Humana' LIMIT 1
-            ) ha ON true
-            ORDER BY CASE WHEN ha.contact_id IS NOT NULL THEN 1 ELSE 0 END DESC, sub.last_timestamp DESC
-            OFFSET :off LIMIT :lim
-        """)
-        results = db.session.execute(search_query, {
-            'pattern': f'%{search}%', 'off': offset, 'lim': limit + 1, **tag_params, **vis_params
-        }).fetchall()
-    else:
-        distinct_query = text(f"""
-            SELECT sub.phone_number, sub.last_message, sub.last_timestamp
-            FROM (
-                SELECT DISTINCT ON (m.phone_number) m.phone_number, m.content AS last_message, m.timestamp AS last_timestamp
-                FROM whatsapp_messages m
-                {tag_join}
-                WHERE m.phone_number NOT IN ('unknown', 'outbound', '')
-                {vis_sql}
-                ORDER BY m.phone_number, m.timestamp DESC
-            ) sub
-            LEFT JOIN whatsapp_contacts c ON c.phone_number = sub.phone_number
-            LEFT JOIN LATERAL (
-                SELECT ct.contact_id FROM whatsapp_contact_tags ct
-                JOIN whatsapp_tags t ON t.id = ct.tag_id
-                WHERE ct.contact_id = c.id AND t.name = 'Asistencia Humana' LIMIT 1
-            ) ha ON true
-            ORDER BY CASE WHEN ha.contact_id IS NOT NULL THEN 1 ELSE 0 END DESC, sub.last_timestamp DESC
-            OFFSET :off LIMIT :lim
-        """)
-        results = db.session.execute(distinct_query, {
-            'off': offset, 'lim': limit + 1, **tag_params, **vis_params
-        }).fetchall()
+        search_sql = f"""
+            AND (
+                cv.phone_number ILIKE :pattern
+                OR cv.phone_number IN (
+                    SELECT c.phone_number FROM whatsapp_contacts c
+                    WHERE {message_search.contact_match_sql('c')}
+                )
+                OR cv.phone_number IN (
+                    SELECT m2.phone_number FROM whatsapp_messages m2
+                    WHERE {message_search.message_match_sql(search, 'm2')}
+                )
+            )
+        """
+        search_params = message_search.search_params(search)
+
+    cursor_sql = ""
+    cursor_params = {}
+    if cursor:
+        try:
+            cursor_params = decode_inbox_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        cursor_sql = INBOX_CURSOR_SQL
+
+    # Lectura de la tabla resumen `conversations` (ver conversations.py)
+    contacts_query = text(f"""
+        SELECT cv.phone_number, cv.last_message, cv.last_timestamp, cv.has_human
+        FROM conversations cv
+        WHERE 1=1
+        {cursor_sql}
+        {tag_sql}
+        {search_sql}
+        {vis_sql}
+        ORDER BY cv.has_human DESC, cv.last_timestamp DESC, cv.phone_number DESC
+        LIMIT :lim
+    """)
+    results = db.session.execute(contacts_query, {
+        'lim': limit + 1, **cursor_params, **tag_params, **search_params, **vis_params
+    }).fetchall()
 
     has_more = len(results) > limit
     results = results[:limit]
+    next_cursor = encode_inbox_cursor(results[-1]) if has_more else None
 
     # Obtener nombres de contactos
     phones = [r.phone_number for r in results]
@@ -1527,6 +1458,25 @@ def api_dashboard_contacts():
         found_contacts = Contact.query.filter(Contact.phone_number.in_(phones)).all()
         contacts_map = {c.phone_number: c for c in found_contacts}
 
+    # En modo búsqueda: mejor mensaje coincidente de cada conversación de la página, resaltado
+    snippets = {}
+    if search and phones:
+        snippet_rows = db.session.execute(text(f"""
+            SELECT best.phone_number, best.id, best.content,
+                   {message_search.headline_sql('best')} AS headline
+            FROM (
+                SELECT DISTINCT ON (m.phone_number) m.phone_number, m.id, m.content
+                FROM whatsapp_messages m
+                WHERE m.phone_number = ANY(:phones)
+                  AND {message_search.message_match_sql(search, 'm')}
+                ORDER BY m.phone_number, {message_search.rank_sql('m')} DESC, m.timestamp DESC
+            ) best
+        """), {'phones': phones, **search_params}).fetchall()
+        snippets = {
+            r.phone_number: {'message_id': r.id, 'html': message_search.highlight(r.content, r.headline, search)}
+            for r in snippet_rows
+        }
+
     # Formatear respuesta
     contacts = []
     for r in results:
@@ -1538,22 +1488,114 @@ def api_dashboard_contacts():
             ts_str = ts.isoformat() if hasattr(ts, 'isoformat') else str(ts)
         else:
             ts_str = None
-        has_human = any(t.name == 'Asistencia Humana' for t in contact.tags) if contact else False
+        has_human = bool(r.has_human)
         contacts.append({
             'phone_number': r.phone_number,
             'last_timestamp': ts_str,
             'last_message': (last_msg[:50] + '...') if last_msg and len(last_msg) > 50 else last_msg,
             'name': contact.name if contact else None,
             'tags': [t.name for t in contact.tags] if contact else [],
-            'has_human_assistance': has_human
+            'has_human_assistance': has_human,
+            'match_snippet': snippets.get(r.phone_number, {}).get('html'),
+            'match_message_id': snippets.get(r.phone_number, {}).get('message_id')
         })
 
     return jsonify({
         'contacts': contacts,
-        'total': offset + len(contacts) + (1 if has_more else 0),
-        'offset': offset,
         'limit': limit,
-        'has_more': has_more
+        'has_more': has_more,
+        'next_cursor': next_cursor
+    })
+
+
+# ==========================================
+# API BÚSQUEDA DE MENSAJES
+# ==========================================
+
+@app.route("/api/search/messages", methods=["GET"])
+def api_search_messages():
+    """
+    Búsqueda global de mensajes, ordenada por relevancia (FTS en español + substring).
+    Devuelve snippets con las coincidencias en <mark>.
+    """
+    q = message_search.normalize_term(request.args.get('q', ''))
+    limit = min(request.args.get('limit', 30, type=int), 100)
+    if not q:
+        return jsonify({'results': [], 'query': q})
+
+    vis_sql, vis_params = build_visibility_sql(g.current_user, 'm.phone_number')
+    params = message_search.search_params(q)
+
+    # Se rankean solo los candidatos que devuelve el índice (ya filtrados por
+    # visibilidad, así el LIMIT no se llena con mensajes que el agente no ve);
+    # el headline se arma después del LIMIT para no calcularlo sobre todas las coincidencias.
+    rows = db.session.execute(text(f"""
+        SELECT hits.id, hits.phone_number, hits.direction, hits.timestamp, hits.content, hits.rank,
+               {message_search.headline_sql('hits')} AS headline,
+               c.name AS contact_name
+        FROM (
+            SELECT m.id, m.phone_number, m.direction, m.timestamp, m.content,
+                   {message_search.rank_sql('m')} AS rank
+            FROM whatsapp_messages m
+            WHERE {message_search.message_match_sql(q, 'm')}
+              AND m.phone_number NOT IN ('unknown', 'outbound', '')
+              {vis_sql}
+            ORDER BY rank DESC, m.timestamp DESC
+            LIMIT :lim
+        ) hits
+        LEFT JOIN conversations cv ON cv.phone_number = hits.phone_number
+        LEFT JOIN whatsapp_contacts c ON c.id = cv.contact_id
+        ORDER BY hits.rank DESC, hits.timestamp DESC
+    """), {'lim': limit, **params, **vis_params}).fetchall()
+
+    return jsonify({
+        'query': q,
+        'results': [{
+            'id': r.id,
+            'phone_number': r.phone_number,
+            'contact_name': r.contact_name,
+            'direction': r.direction,
+            'timestamp': format_utc_iso(r.timestamp),
+            'rank': round(float(r.rank or 0), 4),
+            'snippet': message_search.highlight(r.content, r.headline, q)
+        } for r in rows]
+    })
+
+
+@app.route("/api/messages/<phone>/search", methods=["GET"])
+def api_search_in_conversation(phone):
+    """Busca dentro de una conversación. Devuelve las coincidencias de la más nueva a la más vieja."""
+    if not user_can_access_phone(g.current_user, phone):
+        return jsonify({'error': 'Sin acceso'}), 403
+
+    q = message_search.normalize_term(request.args.get('q', ''))
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    if not q:
+        return jsonify({'results': [], 'query': q, 'total': 0})
+
+    params = message_search.search_params(q)
+    rows = db.session.execute(text(f"""
+        SELECT m.id, m.wa_message_id, m.direction, m.timestamp, m.content,
+               {message_search.rank_sql('m')} AS rank,
+               {message_search.headline_sql('m')} AS headline
+        FROM whatsapp_messages m
+        WHERE m.phone_number = :phone
+          AND {message_search.message_match_sql(q, 'm')}
+        ORDER BY m.timestamp DESC
+        LIMIT :lim
+    """), {'phone': phone, 'lim': limit, **params}).fetchall()
+
+    return jsonify({
+        'query': q,
+        'total': len(rows),
+        'results': [{
+            'id': r.id,
+            'wa_message_id': r.wa_message_id,
+            'direction': r.direction,
+            'timestamp': format_utc_iso(r.timestamp),
+            'rank': round(float(r.rank or 0), 4),
+            'snippet': message_search.highlight(r.content, r.headline, q)
+        } for r in rows]
     })
 
 
@@ -2182,29 +2224,179 @@ def api_contacts_template():
         logger.error(f"Error generando plantilla: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Carga incremental del chat (/api/messages/<phone>)
+CHAT_PAGE_SIZE = 100
+
+
+def chat_version(phone):
+    """
+    Token de versión del chat: versión asentada de whatsapp_messages (ver
+    message_versions.settled_version, tomada antes de leer los mensajes) +
+    bot pausado + ventana de 24h abierta.
+    """
+    row = db.session.execute(text(f"""
+        SELECT
+            {SETTLED_VERSION_EXPR} AS settled,
+            cv.has_human,
+            cv.last_inbound_at
+        FROM (SELECT 1) AS one
+        LEFT JOIN conversations cv ON cv.phone_number = :phone
+    """), {'phone': phone}).first()
+    window_open = bool(row.last_inbound_at and row.last_inbound_at >= datetime.utcnow() - timedelta(hours=24))
+    bot_paused = bool(row.has_human)
+    token = f"{row.settled}.{int(bot_paused)}.{int(window_open)}"
+    return token, row.settled, bot_paused, window_open
+
+
+def parse_chat_version(token):
+    """row_version contenido en un token de chat_version (ValueError si es inválido)."""
+    return int((token or '').split('.')[0])
+
+
+def chat_unchanged(phone, token, bot_paused, window_open):
+    """
+    True si nada del chat cambió desde el token del cliente: mismas banderas y
+    ningún mensaje del teléfono con row_version posterior a su versión asentada.
+    """
+    parts = (token or '').split('.')
+    if len(parts) != 3 or parts[1:] != [str(int(bot_paused)), str(int(window_open))]:
+        return False
+    try:
+        since = int(parts[0])
+    except ValueError:
+        return False
+    changed = db.session.execute(text("""
+        SELECT EXISTS (
+            SELECT 1 FROM whatsapp_messages
+            WHERE phone_number = :phone AND row_version > :since
+        )
+    """), {'phone': phone, 'since': since}).scalar()
+    return not changed
+
+
+def serialize_chat_messages(messages):
+    """Serializa mensajes para el chat (con order_id para los mensajes de pedido)."""
+    order_msg_ids = [m.wa_message_id for m in messages if m.message_type == 'order' and m.wa_message_id]
+    order_id_by_wamid = {}
+    if order_msg_ids:
+        order_rows = Order.query.filter(Order.wa_message_id.in_(order_msg_ids)).with_entities(Order.wa_message_id, Order.id).all()
+        order_id_by_wamid = {row[0]: row[1] for row in order_rows}
+
+    messages_data = []
+    for m in messages:
+        # Convertir a hora argentina
+        dt_arg = to_argentina_filter(m.timestamp)
+        messages_data.append({
+            'id': m.id,
+            'content': m.content,
+            'direction': m.direction,
+            'time': dt_arg.strftime('%H:%M') if dt_arg else '',
+            'date': dt_arg.strftime('%d/%m/%Y') if dt_arg else '',
+            'status': m.latest_status,
+            'message_type': m.message_type,
+            'media_url': m.media_url,
+            'media_status': m.media_status,
+            'caption': m.caption,
+            'sent_by': m.sent_by,
+            'order_id': order_id_by_wamid.get(m.wa_message_id) if m.message_type == 'order' else None,
+        })
+    return messages_data
+
+
 @app.route("/api/messages/<phone>")
 def api_get_messages(phone):
-    """API para obtener mensajes de un contacto (optimizado para AJAX)."""
+    """
+    API para obtener mensajes de un contacto (optimizado para AJAX).
+
+    Modos:
+    - sin parámetros: últimos CHAT_PAGE_SIZE mensajes + contacto (carga inicial).
+    - ?since_id=<id>&version=<token>: solo mensajes nuevos (id > since_id) y los ya
+      mostrados que cambiaron (estado, media) desde `version`.
+    - ?before_id=<id>: página de historial anterior a ese mensaje.
+    Con `version` (o If-None-Match) igual a la versión actual responde 304.
+    """
     try:
         # Validar visibilidad
         if not user_can_access_phone(g.current_user, phone):
             return jsonify({'error': 'Sin acceso'}), 403
 
-        # Límite de mensajes
-        MESSAGE_LIMIT = 100
+        try:
+            since_id = request.args.get('since_id', type=int)
+            before_id = request.args.get('before_id', type=int)
+            client_version = request.args.get('version')
+            since_version = parse_chat_version(client_version) if client_version else None
+        except ValueError:
+            return jsonify({'error': 'Parámetros inválidos'}), 400
+
+        # ── Historial anterior (paginado por (timestamp, id)) ─────────────
+        if before_id is not None:
+            from sqlalchemy import tuple_
+            anchor = db.session.query(Message.timestamp, Message.id)\
+                .filter(Message.id == before_id, Message.phone_number == phone).first()
+            if not anchor:
+                return jsonify({'error': 'before_id inválido'}), 400
+            older = Message.query.filter(
+                Message.phone_number == phone,
+                tuple_(Message.timestamp, Message.id) < tuple_(anchor.timestamp, anchor.id)
+            ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(CHAT_PAGE_SIZE + 1).all()
+            has_more = len(older) > CHAT_PAGE_SIZE
+            messages = older[:CHAT_PAGE_SIZE][::-1]
+            return jsonify({
+                'success': True,
+                'mode': 'older',
+                'messages': serialize_chat_messages(messages),
+                'has_more': has_more
+            })
+
+        version, settled, bot_paused, can_send_free_text = chat_version(phone)
+        # El 304 conserva el token del cliente: su versión asentada sigue siendo válida
+        known = [client_version] if client_version else []
+        known += list(request.if_none_match.as_set(include_weak=True))
+        unchanged = next((t for t in known if chat_unchanged(phone, t, bot_paused, can_send_free_text)), None)
+        if unchanged:
+            response = Response(status=304)
+            response.set_etag(unchanged, weak=True)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
 
-        # Obtener mensajes recientes
+        whatsapp_configured = whatsapp_api.is_configured()
+
+        # ── Delta: nuevos + modificados desde la versión del cliente ──────
+        if since_id is not None and since_version is not None:
+            changed = Message.query.filter(
+                Message.phone_number == phone,
+                or_(Message.id > since_id,
+                    Message.row_version > since_version)
+            ).order_by(Message.timestamp, Message.id).all()
+            new_msgs = [m for m in changed if m.id > since_id]
+            updated_msgs = [m for m in changed if m.id <= since_id]
+            response = jsonify({
+                'success': True,
+                'mode': 'delta',
+                'messages': serialize_chat_messages(new_msgs),
+                'updated': serialize_chat_messages(updated_msgs),
+                'version': version,
+                'can_send_free_text': can_send_free_text and whatsapp_configured,
+                'whatsapp_configured': whatsapp_configured,
+                'bot_paused': bot_paused
+            })
+            response.set_etag(version, weak=True)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        # ── Carga completa ────────────────────────────────────────────────
         recent_messages = Message.query.filter_by(phone_number=phone)\
-            .order_by(Message.timestamp.desc())\
-            .limit(MESSAGE_LIMIT).all()
-        
+            .order_by(Message.timestamp.desc(), Message.id.desc())\
+            .limit(CHAT_PAGE_SIZE + 1).all()
+        has_more = len(recent_messages) > CHAT_PAGE_SIZE
+
         # Invertir para orden cronológico (O(n) vs O(n log n) de sorted)
-        messages = recent_messages[::-1]
-        
+        messages = recent_messages[:CHAT_PAGE_SIZE][::-1]
+
         # Obtener info de contacto
         contact = Contact.query.filter_by(phone_number=phone).first()
         contact_dict = contact.to_dict() if contact else None
-        
+
         # Calcular stats básicos
         outbound_msgs = [m for m in messages if m.direction == 'outbound']
         stats = {
@@ -2212,81 +2404,23 @@ def api_get_messages(phone):
             'delivered': sum(1 for m in outbound_msgs if m.latest_status in ['delivered', 'read']),
             'read': sum(1 for m in outbound_msgs if m.latest_status == 'read')
         }
-        
-        # Verificar ventana de 24hs
-        can_send_free_text = False
-        last_inbound_msg = None
-        
-        whatsapp_configured = whatsapp_api.is_configured()
-        if whatsapp_configured:
-            twenty_four_hours_ago = datetime.utcnow() - timedelta(hours=24)
-            # Solo buscamos en lo que ya trajimos para ser rápidos, 
-            # o hacemos query específica si no hay inbound recientes en los últimos 100
-            
-            # Buscar en los mensajes cargados primero
-            inbound_loaded = [m for m in messages if m.direction == 'inbound']
-            if inbound_loaded:
-                last_msg = inbound_loaded[-1] # El más reciente de los cargados
-                if last_msg.timestamp >= twenty_four_hours_ago:
-                    can_send_free_text = True
-                    last_inbound_msg = last_msg.timestamp
-            
-            # Si no encontramos en los últimos 100, quizás hay uno anterior pero dentro de 24h
-            if not can_send_free_text:
-                # Query específica rápida
-                last_inbound = Message.query.filter_by(
-                    phone_number=phone,
-                    direction='inbound'
-                ).filter(Message.timestamp >= twenty_four_hours_ago).order_by(Message.timestamp.desc()).first()
-                
-                if last_inbound:
-                    can_send_free_text = True
-                    last_inbound_msg = last_inbound.timestamp
-
-        # Pre-cargar order_ids para mensajes de tipo order
-        order_msg_ids = [m.wa_message_id for m in messages if m.message_type == 'order' and m.wa_message_id]
-        order_id_by_wamid = {}
-        if order_msg_ids:
-            from models import Order as _Order
-            order_rows = _Order.query.filter(_Order.wa_message_id.in_(order_msg_ids)).with_entities(_Order.wa_message_id, _Order.id).all()
-            order_id_by_wamid = {row[0]: row[1] for row in order_rows}
-
-        # Serializar mensajes
-        messages_data = []
-        for m in messages:
-            # Convertir a hora argentina
-            dt_arg = to_argentina_filter(m.timestamp)
-            time_str = dt_arg.strftime('%H:%M') if dt_arg else ''
-            date_str = dt_arg.strftime('%d/%m/%Y') if dt_arg else ''
-
-            messages_data.append({
-                'id': m.id,
-                'content': m.content,
-                'direction': m.direction,
-                'time': time_str,
-                'date': date_str,
-                'status': m.latest_status,
-                'message_type': m.message_type,
-                'media_url': m.media_url,
-                'caption': m.caption,
-                'sent_by': m.sent_by,
-                'order_id': order_id_by_wamid.get(m.wa_message_id) if m.message_type == 'order' else None,
-            })
 
-        # Verificar si el bot está pausado para este contacto
-        bot_paused = False
-        if contact:
-            bot_paused = any(t.name == 'Asistencia Humana' for t in contact.tags)
-
-        return jsonify({
+        # Ventana de 24hs y bot pausado salen de la tabla conversations (chat_version)
+        response = jsonify({
             'success': True,
+            'mode': 'full',
             'contact': contact_dict,
-            'messages': messages_data,
+            'messages': serialize_chat_messages(messages),
+            'has_more': has_more,
+            'version': version,
             'stats': stats,
-            'can_send_free_text': can_send_free_text,
+            'can_send_free_text': can_send_free_text and whatsapp_configured,
             'whatsapp_configured': whatsapp_configured,
             'bot_paused': bot_paused
         })
+        response.set_etag(version, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     except Exception as e:
         logger.error(f"Error fetching messages API: {e}")
@@ -2306,15 +2440,10 @@ def api_mark_messages_read(phone):
 @app.route("/api/unread-counts")
 def api_unread_counts():
     """Devuelve el conteo de mensajes inbound no leídos por contacto."""
-    from sqlalchemy import func
-    rows = db.session.query(
-        Message.phone_number,
-        func.count(Message.id).label('unread')
-    ).filter(
-        Message.direction == 'inbound',
-        Message.read_at == None
-    ).group_by(Message.phone_number).all()
-    return jsonify({row.phone_number: row.unread for row in rows})
+    rows = Conversation.query.with_entities(
+        Conversation.phone_number, Conversation.unread_count
+    ).filter(Conversation.unread_count > 0).all()
+    return jsonify({row.phone_number: row.unread_count for row in rows})
 
 
 @app.route("/api/push/vapid-public-key")
@@ -2381,6 +2510,89 @@ def api_inbox_pulse():
     })
 
 
+@app.route("/api/events/stream")
+def api_events_stream():
+    """
+    Canal SSE de eventos en tiempo real (message, status, tag, human_escalation, order).
+    Reemplaza el polling de /api/inbox-pulse y de órdenes. El navegador reconecta solo
+    y manda Last-Event-ID; los eventos perdidos se reenvían desde realtime_events.
+    """
+    import realtime
+    from queue import Empty
+
+    user = g.current_user
+    user_id = user.id
+    is_admin = bool(user.is_admin)
+    can_orders = user.has_permission('orders')
+
+    # Last-Event-ID es una posición (xid, id) asentada, no un id (ver realtime.py)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    position = realtime.parse_token(last_event_id) if last_event_id else None
+
+    # Suscribirse antes del replay para no perder eventos entre ambos
+    sub = realtime.subscribe()
+    replay, reset = ([], False)
+    if position is not None:
+        replay, reset = realtime.replay_since(position)
+    elif last_event_id:
+        reset = True  # Formato viejo (id solo): no se puede reanudar sin perder eventos
+    db.session.rollback()  # No retener la conexión del pool durante el stream
+
+    HEARTBEAT_SECONDS = 15
+    VISIBILITY_TTL = 60
+
+    def generate():
+        visible_cache = {}  # phone -> (visible, expira)
+
+        def can_see(event):
+            if event['type'] == 'order':
+                return can_orders
+            phone = event.get('phone_number')
+            if is_admin or not phone:
+                return True
+            now = time_module.time()
+            if event['type'] in ('tag', 'human_escalation'):
+                visible_cache.pop(phone, None)  # Cambió el etiquetado: la visibilidad puede cambiar
+                visibility.invalidate_phone(phone)
+            cached = visible_cache.get(phone)
+            if cached and cached[1] > now:
+                return cached[0]
+            try:
+                user = auth_cache.get_user(user_id)
+                visible = bool(user and user.is_active) and user_can_access_phone(user, phone)
+            finally:
+                db.session.rollback()
+            visible_cache[phone] = (visible, now + VISIBILITY_TTL)
+            return visible
+
+        try:
+            yield "retry: 3000\n\n"
+            if reset:
+                yield "event: reset\ndata: {}\n\n"
+            for ev in replay:
+                if can_see(ev):
+                    yield realtime.format_sse(ev)
+
+            replayed_ids = {ev['id'] for ev in replay}
+            while not sub.overflowed:
+                try:
+                    ev = sub.queue.get(timeout=HEARTBEAT_SECONDS)
+                except Empty:
+                    yield ": ping\n\n"
+                    continue
+                if ev['id'] in replayed_ids:
+                    continue  # Ya salió en el replay
+                if can_see(ev):
+                    yield realtime.format_sse(ev)
+        finally:
+            realtime.unsubscribe(sub)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Sin buffering en proxies nginx
+    })
+
+
 @app.route("/contacts")
 def contacts_page():
     """Página para ver listado de contactos con paginación y búsqueda."""
@@ -3073,24 +3285,20 @@ def api_tags_bulk_action():
 @app.route("/failed-messages")
 def failed_messages_page():
     """Página para ver mensajes fallidos."""
-    # Buscar mensajes con estado 'failed' en su último status
-    # Hacemos un join con MessageStatus
-    
-    # Subquery para obtener el último status de cada mensaje
-    last_status_subquery = db.session.query(
-        MessageStatus.wa_message_id,
-        func.max(MessageStatus.timestamp).label('max_timestamp')
-    ).group_by(MessageStatus.wa_message_id).subquery()
-    
-    failed_msgs = db.session.query(Message, MessageStatus).join(
-        MessageStatus, Message.wa_message_id == MessageStatus.wa_message_id
-    ).join(
-        last_status_subquery, 
-        (MessageStatus.wa_message_id == last_status_subquery.c.wa_message_id) & 
-        (MessageStatus.timestamp == last_status_subquery.c.max_timestamp)
-    ).filter(
-        MessageStatus.status == 'failed'
-    ).order_by(Message.timestamp.desc()).all()
+    # Mensajes cuyo último estado es 'failed' (columna desnormalizada + índice parcial)
+    failed_only = Message.query.filter(Message.status == 'failed')\
+        .order_by(Message.timestamp.desc()).all()
+
+    # Detalle del error: solo los estados 'failed' de esos mensajes (índice wa_message_id, status)
+    failed_ids = [m.wa_message_id for m in failed_only]
+    status_by_wamid = {}
+    if failed_ids:
+        for st in MessageStatus.query.filter(
+            MessageStatus.wa_message_id.in_(failed_ids),
+            MessageStatus.status == 'failed'
+        ).order_by(MessageStatus.timestamp).all():
+            status_by_wamid[st.wa_message_id] = st
+    failed_msgs = [(m, status_by_wamid[m.wa_message_id]) for m in failed_only if m.wa_message_id in status_by_wamid]
     
     # Batch load contactos para evitar N+1 queries
     phones = list({msg.phone_number for msg, _ in failed_msgs})
@@ -3182,28 +3390,16 @@ def chatwoot_webhook():
                     # Usar source_id si está disponible, sino usar cw_id
                     msg_id = source_id if source_id else cw_id_str
                     
-                    # Intentar detectar si el contenido es un template
+                    # Intentar detectar si el contenido es un template (matcher precompilado)
                     detected_type = "text"
                     final_content = content
-                    
+                    tpl_name, tpl_language = None, None
+
                     try:
-                        templates_result = whatsapp_api.get_templates()
-                        for t in templates_result.get("templates", []):
-                            if t.get("status") == "APPROVED":
-                                for comp in t.get("components", []):
-                                    if comp.get("type") == "BODY":
-                                        template_body = comp.get("text", "")
-                                        # Limpieza básica para comparación (quitar variables {{1}}, etc)
-                                        import re
-                                        pattern = re.escape(template_body)
-                                        pattern = re.sub(r'\\\{\\\{\d+\\\}\\\}', '.*', pattern)
-                                        
-                                        if re.match(f"^{pattern}$", content, re.DOTALL):
-                                            detected_type = "template"
-                                            # Opcional: podríamos normalizar el contenido al template original
-                                            # pero mejor dejar el texto real enviado.
-                                            break
-                                if detected_type == "template": break
+                        from template_matcher import get_matcher
+                        tpl_name, tpl_language = get_matcher().match(content)
+                        if tpl_name:
+                            detected_type = "template"
                     except Exception as te:
                         logger.error(f"Error detecting template in webhook: {te}")
 
@@ -3213,6 +3409,8 @@ def chatwoot_webhook():
                         direction="outbound",
                         message_type=detected_type,
                         content=final_content,
+                        template_name=tpl_name,
+                        template_language=tpl_language,
                         timestamp=datetime.utcnow()
                     )
                     db.session.add(new_msg)
@@ -3309,7 +3507,9 @@ def api_admin_update_user(user_id):
             if tid is not None:
                 db.session.add(CrmUserTagVisibility(user_id=user.id, tag_id=int(tid)))
 
+    user.auth_version = (user.auth_version or 0) + 1  # Los demás procesos recargan al vencer su cache
     db.session.commit()
+    auth_cache.invalidate_user(user.id)
     return jsonify({'success': True, 'user': user.to_dict()})
 
 @app.route("/api/admin/users/<int:user_id>", methods=["DELETE"])
@@ -3321,6 +3521,54 @@ def api_admin_delete_user(user_id):
         return jsonify({'error': 'No podés eliminar el único administrador activo'}), 400
     db.session.delete(user)
     db.session.commit()
+    auth_cache.invalidate_user(user_id)
+    return jsonify({'success': True})
+
+@app.route("/api/admin/scheduler", methods=["GET"])
+def api_admin_scheduler_status():
+    """Liderazgo y métricas de los jobs del scheduler en el proceso que atiende el request."""
+    if not g.current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(get_scheduler_status())
+
+@app.route("/api/admin/llm", methods=["GET"])
+def api_admin_llm_metrics():
+    """Límites y métricas de las llamadas a OpenAI (categorizador / auto tagger) y del clasificador local en este proceso."""
+    if not g.current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    import local_classifier
+    return jsonify(dict(llm_client.get_metrics(), local_classifier=local_classifier.get_stats()))
+
+@app.route("/api/admin/n8n/dead-letters", methods=["GET"])
+def api_admin_n8n_dead_letters():
+    """Payloads que no se pudieron entregar al chatbot en n8n (más recientes primero)."""
+    if not g.current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    from models import N8nDeadLetter
+    from n8n_forwarder import stats as n8n_stats
+    limit = min(request.args.get('limit', 100, type=int), 500)
+    rows = N8nDeadLetter.query.order_by(N8nDeadLetter.id.desc()).limit(limit).all()
+    return jsonify({
+        'dead_letters': [r.to_dict() for r in rows],
+        'total': N8nDeadLetter.query.count(),
+        'stats': n8n_stats,
+    })
+
+@app.route("/api/admin/n8n/dead-letters/<int:dead_letter_id>/replay", methods=["POST"])
+def api_admin_n8n_replay_dead_letter(dead_letter_id):
+    """Re-encola un dead-letter hacia n8n (se borra de la tabla al encolarlo)."""
+    if not g.current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    import queue
+    from models import N8nDeadLetter
+    from n8n_forwarder import replay_dead_letter
+    dead_letter = db.session.get(N8nDeadLetter, dead_letter_id)
+    if dead_letter is None:
+        return jsonify({'error': 'Dead-letter no encontrado'}), 404
+    try:
+        replay_dead_letter(dead_letter)
+    except queue.Full:
+        return jsonify({'error': 'Cola de envío a n8n llena, reintentar más tarde'}), 503
     return jsonify({'success': True})
 
 # ==================== WhatsApp Settings ====================
@@ -3632,6 +3880,8 @@ def api_send_template():
             if existing:
                 existing.content = template_content
                 existing.message_type = "template"
+                existing.template_name = template_name
+                existing.template_language = language
                 existing.phone_number = to_phone
                 logger.info(f"✅ Mensaje existente actualizado con contenido del template: {wa_id}")
             else:
@@ -3641,6 +3891,8 @@ def api_send_template():
                     direction="outbound",
                     message_type="template",
                     content=template_content,
+                    template_name=template_name,
+                    template_language=language,
                     timestamp=datetime.utcnow()
                 )
                 db.session.add(new_msg)
@@ -3841,25 +4093,19 @@ def api_send_media():
 
 @app.route("/campaigns")
 def campaigns_page():
-    """Página de campañas — OPTIMIZADO: stats en SQL + templates cargados async."""
-    from sqlalchemy import case
-
+    """Página de campañas — OPTIMIZADO: stats desde campaign_counters + templates cargados async."""
     # Filtro de visibilidad por usuario
     vis_tag_ids = get_visible_tag_ids(g.current_user)
 
-    # Stats en SQL — GROUP BY solo sobre Campaign.id (joinedload rompe GROUP BY en Postgres)
+    # Stats desde los contadores mantenidos por triggers (sin recorrer logs)
     campaigns_q = db.session.query(
         Campaign,
-        func.count(CampaignLog.id).label('total'),
-        func.count(case(
-            (CampaignLog.status.in_(['sent', 'delivered', 'read']), 1)
-        )).label('sent'),
-        func.count(case(
-            (CampaignLog.status == 'failed', 1)
-        )).label('failed')
+        func.coalesce(CampaignCounters.total, 0).label('total'),
+        func.coalesce(CampaignCounters.sent + CampaignCounters.delivered + CampaignCounters.read, 0).label('sent'),
+        func.coalesce(CampaignCounters.failed, 0).label('failed')
     ).outerjoin(
-        CampaignLog, Campaign.id == CampaignLog.campaign_id
-    ).group_by(Campaign.id)
+        CampaignCounters, Campaign.id == CampaignCounters.campaign_id
+    )
 
     if vis_tag_ids is not None:
         if vis_tag_ids:
@@ -4259,11 +4505,14 @@ def api_list_campaigns():
         logger.warning(f"Error obteniendo templates para preview: {e}")
         # Continuar sin previews de mensajes
 
+    counters = get_campaign_counters([c.id for c in campaigns])
+
     result = []
     for c in campaigns:
-        total = len(c.logs)
-        sent = sum(1 for l in c.logs if l.status in ('sent', 'delivered', 'read'))
-        failed = sum(1 for l in c.logs if l.status == 'failed')
+        cnt = counters[c.id]
+        total = cnt['total']
+        sent = cnt['sent'] + cnt['delivered'] + cnt['read']
+        failed = cnt['failed']
 
         # Obtener preview del mensaje
         message_preview = templates_map.get(c.template_name, "")
@@ -4377,6 +4626,47 @@ def api_delete_campaign(campaign_id):
     db.session.commit()
     return jsonify({'success': True})
 
+@app.route("/api/campaigns/<int:campaign_id>/pause", methods=["POST"])
+def api_pause_campaign(campaign_id):
+    """Pausa una campaña en envío: los workers se detienen al terminar el tramo en curso."""
+    updated = db.session.execute(text("""
+        UPDATE whatsapp_campaigns SET status = 'paused' WHERE id = :cid AND status = 'sending'
+    """), {'cid': campaign_id}).rowcount
+    db.session.commit()
+    if not updated:
+        return jsonify({'error': 'Solo se puede pausar una campaña en envío'}), 400
+    logger.info(f"⏸️ Campaña {campaign_id} pausada por {g.current_user.username}")
+    return jsonify({'success': True, 'status': 'paused'})
+
+@app.route("/api/campaigns/<int:campaign_id>/resume", methods=["POST"])
+def api_resume_campaign(campaign_id):
+    """Reanuda una campaña pausada."""
+    updated = db.session.execute(text("""
+        UPDATE whatsapp_campaigns SET status = 'sending' WHERE id = :cid AND status = 'paused'
+    """), {'cid': campaign_id}).rowcount
+    db.session.commit()
+    if not updated:
+        return jsonify({'error': 'Solo se puede reanudar una campaña pausada'}), 400
+    start_campaign_sender(app, campaign_id)
+    logger.info(f"▶️ Campaña {campaign_id} reanudada por {g.current_user.username}")
+    return jsonify({'success': True, 'status': 'sending'})
+
+@app.route("/api/campaigns/<int:campaign_id>/cancel", methods=["POST"])
+def api_cancel_campaign(campaign_id):
+    """Cancela una campaña en envío o pausada: los logs que no salieron quedan 'cancelled'."""
+    updated = db.session.execute(text("""
+        UPDATE whatsapp_campaigns SET status = 'cancelled', completed_at = :now
+        WHERE id = :cid AND status IN ('sending', 'paused')
+    """), {'cid': campaign_id, 'now': datetime.utcnow()}).rowcount
+    if not updated:
+        db.session.rollback()
+        return jsonify({'error': 'Solo se puede cancelar una campaña en envío o pausada'}), 400
+    # Los tramos en vuelo terminan y registran lo enviado; el worker marca el resto al salir
+    cancelled = cancel_pending_logs(db, campaign_id)
+    db.session.commit()
+    logger.info(f"⏹️ Campaña {campaign_id} cancelada por {g.current_user.username} ({cancelled} envíos descartados)")
+    return jsonify({'success': True, 'status': 'cancelled', 'cancelled': cancelled})
+
 @app.route("/api/campaigns/<int:campaign_id>/send", methods=["POST"])
 def api_send_campaign(campaign_id):
     """Inicia el envío de una campaña en background."""
@@ -4440,10 +4730,7 @@ def api_send_campaign(campaign_id):
             db.session.rollback()
             logger.error(f"❌ Error creando logs con fallback para campaña {campaign.id}: {e2}")
 
-    ctx = app.app_context()
-    t = threading.Thread(target=send_campaign_bg, args=(ctx, campaign.id))
-    t.daemon = True
-    t.start()
+    start_campaign_sender(app, campaign.id)
 
     return jsonify({
         'success': True,
@@ -4451,294 +4738,133 @@ def api_send_campaign(campaign_id):
         'total_contacts': contact_count
     })
 
-def send_campaign_bg(app_context, cid):
-    """Función de envío en background con procesamiento por lotes."""
-    with app_context:
-        camp = Campaign.query.get(cid)
-        if not camp: return
+def launch_scheduled_campaigns():
+    """Job del scheduler: lanza las campañas programadas cuya hora ya pasó."""
+    with app.app_context():
+        now = datetime.utcnow()
+        # Buscar campañas programadas que ya deberían salir
+        # skip_locked=True evita que el scheduler intente procesar algo que ya está bloqueado por el usuario
+        # Primero obtener IDs con lock (sin joins que causen error con FOR UPDATE)
+        pending_ids = db.session.query(Campaign.id).filter(
+            Campaign.status == 'scheduled',
+            Campaign.scheduled_at <= now
+        ).with_for_update(skip_locked=True).all()
+        pending_ids = [pid for (pid,) in pending_ids]
+        pending = Campaign.query.filter(Campaign.id.in_(pending_ids)).all() if pending_ids else []
         
-        BATCH_SIZE = 100  # Procesar en lotes para no saturar memoria
-        total_sent = 0
-        total_failed = 0
-        
-        # Pre-cargar el texto del template para usarlo en el historial de cada contacto
-        template_body_text = None
-        template_header_format = None
-        try:
-            templates_result = whatsapp_api.get_templates()
-            for t in templates_result.get("templates", []):
-                if t.get("name") == camp.template_name and t.get("language") == camp.template_language:
-                    for comp in t.get("components", []):
-                        if comp.get("type") == "BODY":
-                            template_body_text = comp.get("text", "")
-                        elif comp.get("type") == "HEADER":
-                            template_header_format = comp.get("format")
-                    break
-        except Exception as e:
-            logger.warning(f"No se pudo obtener texto del template para campaña {cid}: {e}")
-
-        while True:
-            # Cargar solo un lote de logs pendientes a la vez
-            logs = CampaignLog.query.filter_by(
-                campaign_id=cid, 
-                status='pending'
-            ).limit(BATCH_SIZE).all()
-            
-            if not logs:
-                break  # No hay más logs pendientes
+        for camp in pending:
+            logger.info(f"🚀 Ejecutando campaña programada: {camp.name}")
             
-            for log in logs:
-                try:
-                    # Construir componentes con variables dinámicas
-                    components = None
-                    if camp.variables:
-                        # Usar contact_id para obtener el contacto (o la relación directa)
-                        contact = log.contact or Contact.query.get(log.contact_id)
-
-                        # Separar variables por componente (body vs header)
-                        body_vars = {}
-                        header_vars = {}
-                        
-                        for key, field in camp.variables.items():
-                            if '-' in key:
-                                # New format: "body-1", "header-1"
-                                comp, idx = key.split('-', 1)
-                                if comp == 'header':
-                                    header_vars[int(idx)] = field
-                                else:
-                                    body_vars[int(idx)] = field
-                            else:
-                                # Old format: "1", "2" (backwards compat, treat as body)
-                                body_vars[int(key)] = field
-                        
-                        components = []
-                        
-                        # Build header parameters
-                        if header_vars:
-                            header_params = []
-                            for idx in sorted(header_vars.keys()):
-                                field = header_vars[idx]
-                                
-                                if template_header_format in ('IMAGE', 'VIDEO', 'DOCUMENT'):
-                                    # It is a media URL!
-                                    header_params.append({
-                                        "type": template_header_format.lower(),
-                                        template_header_format.lower(): {"link": field}
-                                    })
-                                else:
-                                    # It is a text variable
-                                    value = "-"
-                                    if field == 'phone_number':
-                                        value = contact.phone_number if contact else log.contact_phone
-                                    elif contact:
-                                        val = getattr(contact, field, None)
-                                        if val:
-                                            value = str(val)
-                                    header_params.append({"type": "text", "text": value})
-                            components.append({"type": "header", "parameters": header_params})
-                        
-                        # Build body parameters
-                        if body_vars:
-                            body_params = []
-                            for idx in sorted(body_vars.keys()):
-                                field = body_vars[idx]
-                                value = "-"
-                                if field == 'phone_number':
-                                    value = contact.phone_number if contact else log.contact_phone
-                                elif contact:
-                                    val = getattr(contact, field, None)
-                                    if val:
-                                        value = str(val)
-                                body_params.append({"type": "text", "text": value})
-                            components.append({"type": "body", "parameters": body_params})
-                        
-                        if not components:
-                            components = None
-
-                    result = whatsapp_api.send_template_message(
-                        log.contact_phone,
-                        camp.template_name,
-                        camp.template_language,
-                        components=components
-                    )
-                    
-                    if result.get('success'):
-                        log.status = 'sent'
-                        log.message_id = result.get('message_id')
-                        total_sent += 1
-                        wa_id = result.get('message_id')
-                        if wa_id:
-                            # Resolver el contenido real del template con las variables del contacto
-                            content_preview = template_body_text or f'[Template: {camp.template_name}]'
-                            if template_body_text and camp.variables:
-                                # Reemplazar {{1}}, {{2}}, etc. con los valores reales
-                                resolved_text = template_body_text
-                                # Recoger body_vars del contacto actual
-                                body_vars_local = {}
-                                for key, field in camp.variables.items():
-                                    if '-' in key:
-                                        comp_name, idx = key.split('-', 1)
-                                        if comp_name == 'body':
-                                            body_vars_local[int(idx)] = field
-                                    else:
-                                        body_vars_local[int(key)] = field
-                                
-                                contact_for_preview = log.contact or Contact.query.get(log.contact_id)
-                                for idx, field in body_vars_local.items():
-                                    value = "-"
-                                    if field == 'phone_number':
-                                        value = contact_for_preview.phone_number if contact_for_preview else log.contact_phone
-                                    elif contact_for_preview:
-                                        val = getattr(contact_for_preview, field, None)
-                                        if val:
-                                            value = str(val)
-                                    resolved_text = resolved_text.replace(f'{{{{{idx}}}}}', value)
-                                content_preview = resolved_text
-                            
-                            new_msg = Message(
-                                wa_message_id=wa_id,
-                                phone_number=log.contact_phone,
-                                direction='outbound',
-                                message_type='template',
-                                content=content_preview,
-                                timestamp=datetime.utcnow()
-                            )
-                            db.session.add(new_msg)
-                    else:
-                        log.status = 'failed'
-                        log.error_detail = str(result.get('error') or result)
-                        total_failed += 1
-                except Exception as e:
-                    log.status = 'failed'
-                    log.error_detail = str(e)
-                    total_failed += 1
-
+            # Contar contactos DISTINTOS con alguna de las etiquetas
+            tids = [t.id for t in camp.tags]
+            if not tids:
+                camp.status = 'failed'
+                camp.completed_at = now
+                logger.warning(f"Campaña {camp.name} fallida: Sin etiquetas asignadas")
                 db.session.commit()
-                time_module.sleep(1)  # Rate limiting
-            
-            # Log de progreso cada lote
-            logger.info(f"📊 Campaña {cid}: Lote procesado. Enviados: {total_sent}, Fallidos: {total_failed}")
+                continue
 
-        camp.status = 'completed'
-        camp.completed_at = datetime.utcnow()
-        db.session.commit()
-        logger.info(f"✅ Campaña {cid} completada. Total enviados: {total_sent}, fallidos: {total_failed}")
+            contact_count = db.session.query(func.count(func.distinct(Contact.id))).filter(
+                Contact.tags.any(Tag.id.in_(tids))
+            ).scalar()
 
-def run_scheduler():
-    """Scheduler para verificar campañas programadas, categorizar conversaciones, auto-taggear y enviar follow-ups."""
-    from conversation_categorizer import run_categorization
-    from auto_tagger import run_auto_tagger
-    from followup_sender import run_followup_sender
-    categorize_counter = 0
+            if contact_count == 0:
+                camp.status = 'failed'
+                camp.completed_at = now
+                logger.warning(f"Campaña {camp.name} fallida: Sin contactos")
+                db.session.commit()
+                continue
 
-    while True:
-        try:
-            with app.app_context():
-                now = datetime.utcnow()
-                # Buscar campañas programadas que ya deberían salir
-                # skip_locked=True evita que el scheduler intente procesar algo que ya está bloqueado por el usuario
-                # Primero obtener IDs con lock (sin joins que causen error con FOR UPDATE)
-                pending_ids = db.session.query(Campaign.id).filter(
-                    Campaign.status == 'scheduled',
-                    Campaign.scheduled_at <= now
-                ).with_for_update(skip_locked=True).all()
-                pending_ids = [pid for (pid,) in pending_ids]
-                pending = Campaign.query.filter(Campaign.id.in_(pending_ids)).all() if pending_ids else []
-                
-                for camp in pending:
-                    logger.info(f"🚀 Ejecutando campaña programada: {camp.name}")
-                    
-                    # Contar contactos DISTINTOS con alguna de las etiquetas
-                    tids = [t.id for t in camp.tags]
-                    if not tids:
-                        camp.status = 'failed'
-                        camp.completed_at = now
-                        logger.warning(f"Campaña {camp.name} fallida: Sin etiquetas asignadas")
-                        db.session.commit()
-                        continue
+            # Pasar a sending
+            camp.status = 'sending'
+            camp.started_at = now
+            db.session.commit()
 
-                    contact_count = db.session.query(func.count(func.distinct(Contact.id))).filter(
-                        Contact.tags.any(Tag.id.in_(tids))
-                    ).scalar()
+            # Crear logs — SQL directo con DISTINCT para evitar duplicados entre etiquetas
+            try:
+                db.session.execute(text("""
+                    INSERT INTO whatsapp_campaign_logs (campaign_id, contact_id, contact_phone, status, created_at)
+                    SELECT DISTINCT :cid, c.id, c.phone_number, 'pending', :now
+                    FROM whatsapp_contacts c
+                    JOIN whatsapp_contact_tags ct ON c.id = ct.contact_id
+                    WHERE ct.tag_id = ANY(:tids)
+                    ON CONFLICT (campaign_id, contact_id) DO NOTHING
+                """), {'cid': camp.id, 'tids': tids, 'now': now})
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error con ON CONFLICT en scheduler: {e}")
+                # Fallback sin ON CONFLICT
+                db.session.execute(text("""
+                    INSERT INTO whatsapp_campaign_logs (campaign_id, contact_id, contact_phone, status, created_at)
+                    SELECT DISTINCT :cid, c.id, c.phone_number, 'pending', :now
+                    FROM whatsapp_contacts c
+                    JOIN whatsapp_contact_tags ct ON c.id = ct.contact_id
+                    WHERE ct.tag_id IN :tids
+                    AND NOT EXISTS (
+                        SELECT 1 FROM whatsapp_campaign_logs cl
+                        WHERE cl.campaign_id = :cid AND cl.contact_id = c.id
+                    )
+                """), {'cid': camp.id, 'tids': tuple(tids), 'now': now})
+                db.session.commit()
+            
+            # Lanzar thread de envío
+            start_campaign_sender(app, camp.id)
 
-                    if contact_count == 0:
-                        camp.status = 'failed'
-                        camp.completed_at = now
-                        logger.warning(f"Campaña {camp.name} fallida: Sin contactos")
-                        db.session.commit()
-                        continue
 
-                    # Pasar a sending
-                    camp.status = 'sending'
-                    camp.started_at = now
-                    db.session.commit()
+def _categorizer_enabled():
+    with app.app_context():
+        return ChatbotConfig.get('categorizer_enabled', 'true') == 'true'
 
-                    # Crear logs — SQL directo con DISTINCT para evitar duplicados entre etiquetas
-                    try:
-                        db.session.execute(text("""
-                            INSERT INTO whatsapp_campaign_logs (campaign_id, contact_id, contact_phone, status, created_at)
-                            SELECT DISTINCT :cid, c.id, c.phone_number, 'pending', :now
-                            FROM whatsapp_contacts c
-                            JOIN whatsapp_contact_tags ct ON c.id = ct.contact_id
-                            WHERE ct.tag_id = ANY(:tids)
-                            ON CONFLICT (campaign_id, contact_id) DO NOTHING
-                        """), {'cid': camp.id, 'tids': tids, 'now': now})
-                        db.session.commit()
-                    except Exception as e:
-                        db.session.rollback()
-                        logger.error(f"Error con ON CONFLICT en scheduler: {e}")
-                        # Fallback sin ON CONFLICT
-                        db.session.execute(text("""
-                            INSERT INTO whatsapp_campaign_logs (campaign_id, contact_id, contact_phone, status, created_at)
-                            SELECT DISTINCT :cid, c.id, c.phone_number, 'pending', :now
-                            FROM whatsapp_contacts c
-                            JOIN whatsapp_contact_tags ct ON c.id = ct.contact_id
-                            WHERE ct.tag_id IN :tids
-                            AND NOT EXISTS (
-                                SELECT 1 FROM whatsapp_campaign_logs cl
-                                WHERE cl.campaign_id = :cid AND cl.contact_id = c.id
-                            )
-                        """), {'cid': camp.id, 'tids': tuple(tids), 'now': now})
-                        db.session.commit()
-                    
-                    # Lanzar thread de envío
-                    t = threading.Thread(target=send_campaign_bg, args=(app.app_context(), camp.id))
-                    t.daemon = True
-                    t.start()
-                    
-        except Exception as e:
-            logger.error(f"Error en scheduler: {e}")
-        
-        # Run conversation categorization every 5 minutes (every 5 loops)
-        categorize_counter += 1
-        if categorize_counter >= 5:
-            categorize_counter = 0
-            with app.app_context():
-                categorizer_on = ChatbotConfig.get('categorizer_enabled', 'true') == 'true'
-            if categorizer_on:
-                try:
-                    run_categorization(app.app_context())
-                except Exception as e:
-                    logger.error(f"Error en categorización: {e}")
-                try:
-                    run_auto_tagger(app.app_context())
-                except Exception as e:
-                    logger.error(f"Error en auto tagger: {e}")
-            else:
-                logger.debug("Categorizador desactivado, saltando.")
-
-        # Follow-up sender: corre cada minuto
-        try:
-            run_followup_sender(app.app_context())
-        except Exception as e:
-            logger.error(f"Error en follow-up sender: {e}")
-
-        time_module.sleep(60) # Revisar cada minuto
 
-# Iniciar scheduler
-scheduler_thread = threading.Thread(target=run_scheduler)
-scheduler_thread.daemon = True
-scheduler_thread.start()
+def register_scheduler_jobs():
+    """Jobs periódicos (ver scheduler.py): cada uno con su intervalo, corren solo en el proceso líder."""
+    from conversation_categorizer import run_categorization
+    from auto_tagger import run_auto_tagger, purge_old_evaluations
+    from followup_sender import run_followup_sender
+    from media_pipeline import requeue_stale_media
+    from realtime import purge_old_events
+    from webhook_inbox import purge_processed as purge_webhook_inbox
+    from n8n_forwarder import recover_outbox as recover_n8n_outbox
+    from analytics_rollups import refresh_rollups
+    from campaign_metrics import refresh_campaign_metrics
+    from campaign_counters import reconcile_campaign_counters, RECONCILE_INTERVAL_SECONDS
+
+    # Campañas programadas y follow-ups: cada minuto, sin depender de los jobs lentos
+    register_scheduler_job('scheduled_campaigns', launch_scheduled_campaigns, 60, jitter=2)
+    register_scheduler_job('followup_sender', lambda: run_followup_sender(app.app_context()), 60, jitter=2)
+    # Campañas 'sending' sin worker (ej: proceso reiniciado): sumarse al envío
+    register_scheduler_job('resume_campaigns', lambda: resume_orphaned_campaigns(app), 60)
+    # Categorización y auto tagger: cada 5 minutos (si el categorizador está activo)
+    register_scheduler_job('categorizer', lambda: run_categorization(app.app_context()), 300, jitter=15,
+                           enabled=_categorizer_enabled)
+    register_scheduler_job('auto_tagger', lambda: run_auto_tagger(app.app_context()), 300, jitter=15,
+                           enabled=_categorizer_enabled)
+    # Decisiones del auto tagger más viejas que la retención
+    register_scheduler_job('purge_auto_tag_evaluations', lambda: purge_old_evaluations(app.app_context()), 3600, jitter=120)
+    # Re-encolar descargas de media que quedaron colgadas (ej: worker reiniciado)
+    register_scheduler_job('requeue_media', lambda: requeue_stale_media(app.app_context()), 60)
+    # Mensajes para n8n cuyo proceso murió antes de entregarlos: retomarlos
+    register_scheduler_job('recover_n8n_outbox', lambda: recover_n8n_outbox(app.app_context()), 60)
+    # Purgar eventos de la inbox del webhook ya procesados (todas las particiones)
+    register_scheduler_job('purge_webhook_inbox', lambda: purge_webhook_inbox(app.app_context()), 3600, jitter=120)
+    # Purgar eventos en tiempo real viejos
+    register_scheduler_job('purge_realtime_events', lambda: purge_old_events(app.app_context()), 300, jitter=30)
+    # Rollups de analytics: aplicar mensajes nuevos / modificados desde el watermark
+    register_scheduler_job('analytics_rollups', lambda: refresh_rollups(app.app_context()), 60)
+    # Respuestas a campañas: atribuir los mensajes entrantes nuevos
+    register_scheduler_job('campaign_metrics', lambda: refresh_campaign_metrics(app.app_context()), 60)
+    # Contadores de campañas: corregir diferencias con los logs
+    register_scheduler_job('campaign_counters', lambda: reconcile_campaign_counters(app.app_context()),
+                           RECONCILE_INTERVAL_SECONDS, jitter=60)
+
+
+# Iniciar scheduler (un solo líder entre todos los workers)
+register_scheduler_jobs()
+start_scheduler(app)
+
+# Iniciar consumidores de la inbox del webhook
+start_inbox_consumers(app)
 
 
 
@@ -4749,11 +4875,11 @@ def api_campaign_status(campaign_id):
     if not campaign:
         return jsonify({'error': 'Campaña no encontrada'}), 404
 
-    logs = CampaignLog.query.filter_by(campaign_id=campaign_id).all()
-    total = len(logs)
-    sent = sum(1 for l in logs if l.status in ('sent', 'delivered', 'read'))
-    failed = sum(1 for l in logs if l.status == 'failed')
-    pending = sum(1 for l in logs if l.status == 'pending')
+    cnt = get_campaign_counters([campaign_id])[campaign_id]
+    total = cnt['total']
+    sent = cnt['sent'] + cnt['delivered'] + cnt['read']
+    failed = cnt['failed']
+    pending = cnt['pending']
 
     return jsonify({
         'id': campaign.id,
@@ -4773,19 +4899,26 @@ def api_get_campaign_stats_preview(campaign_id):
     if not campaign:
         return jsonify({'error': 'Campaña no encontrada'}), 404
 
-    logs = CampaignLog.query.filter_by(campaign_id=campaign_id).all()
-    total = len(logs)
-    sent = sum(1 for l in logs if l.status in ('sent', 'delivered', 'read'))
-    read = sum(1 for l in logs if l.status == 'read')
-    failed = sum(1 for l in logs if l.status == 'failed')
+    cnt = get_campaign_counters([campaign_id])[campaign_id]
+    total = cnt['total']
+    sent = cnt['sent'] + cnt['delivered'] + cnt['read']
+    read = cnt['read']
+    failed = cnt['failed']
     
     # Preview de logs (últimos 50)
+    last_logs = db.session.query(
+        CampaignLog, Contact.name
+    ).outerjoin(
+        Contact, CampaignLog.contact_id == Contact.id
+    ).filter(
+        CampaignLog.campaign_id == campaign_id
+    ).order_by(CampaignLog.id.desc()).limit(50).all()
+
     preview_logs = []
-    for l in logs[-50:]:
-        contact = l.contact or Contact.query.get(l.contact_id)
+    for l, contact_name in reversed(last_logs):
         preview_logs.append({
             'phone': l.contact_phone,
-            'name': contact.name if contact else '',
+            'name': contact_name or '',
             'status': l.status,
             'error': l.error_detail
         })
@@ -4816,63 +4949,26 @@ def api_campaign_details(campaign_id):
     try:
         campaign = Campaign.query.get_or_404(campaign_id)
 
-        # Estadísticas agregadas
-        total_logs = CampaignLog.query.filter_by(campaign_id=campaign_id).count()
-
-        # Contar por estados
-        logs_stats = db.session.query(
-            CampaignLog.status, func.count(CampaignLog.id)
-        ).filter(
-            CampaignLog.campaign_id == campaign_id
-        ).group_by(CampaignLog.status).all()
-
-        stats_map = {s: c for s, c in logs_stats}
-        sent_count = stats_map.get('sent', 0)
-        delivered_count = stats_map.get('delivered', 0)
-        read_count = stats_map.get('read', 0)
-        failed_count = stats_map.get('failed', 0)
+        # Estadísticas agregadas (contadores mantenidos por triggers)
+        cnt = get_campaign_counters([campaign_id])[campaign_id]
+        total_logs = cnt['total']
+        sent_count = cnt['sent']
+        delivered_count = cnt['delivered']
+        read_count = cnt['read']
+        failed_count = cnt['failed']
 
         # 'Enviados' para la UI incluye todo lo que salió exitosamente (sent, delivered, read)
         total_successful = sent_count + delivered_count + read_count
 
-        # ========== CALCULAR RESPUESTAS A LA CAMPAÑA ==========
-        # Respuestas = mensajes inbound recibidos después del envío de la campaña
-        # Ventana de tiempo: 48 horas después del envío del mensaje de campaña
-        response_window_hours = 48
-
-        # Obtener todos los logs exitosos con sus teléfonos y timestamps
-        successful_logs = db.session.query(
-            CampaignLog.contact_phone,
-            CampaignLog.created_at
-        ).filter(
-            CampaignLog.campaign_id == campaign_id,
-            CampaignLog.status.in_(['sent', 'delivered', 'read']),
-            CampaignLog.created_at.isnot(None)
-        ).all()
-
-        # Para cada contacto, buscar si respondió dentro de la ventana de tiempo
-        responded_phones = set()
-        total_responses = 0
-
-        for phone, sent_time in successful_logs:
-            if not sent_time:
-                continue
-
-            # Buscar mensajes inbound de este teléfono después del envío
-            response_cutoff = sent_time + timedelta(hours=response_window_hours)
+        # ========== RESPUESTAS A LA CAMPAÑA ==========
+        # Respuestas = mensajes inbound dentro de las 48h posteriores al envío.
+        # Materializadas por el scheduler (ver campaign_metrics.py), que recalcula la
+        # campaña cuando cambian sus estados; hasta entonces se muestran en cero.
+        metrics = db.session.get(CampaignResponseMetrics, campaign_id)
+        response_stats = metrics_to_dict(metrics)
 
-            response_count = Message.query.filter(
-                Message.phone_number == phone,
-                Message.direction == 'inbound',
-                Message.timestamp > sent_time,
-                Message.timestamp <= response_cutoff
-            ).count()
-
-            if response_count > 0:
-                responded_phones.add(phone)
-                total_responses += response_count
-
-        unique_responders = len(responded_phones)
+        unique_responders = response_stats['unique_responders']
+        total_responses = response_stats['total_responses']
         response_rate = round((unique_responders / total_successful * 100) if total_successful > 0 else 0, 1)
 
         # Logs preview (últimos 50)
@@ -4957,6 +5053,9 @@ def api_campaign_details(campaign_id):
                 'total_responses': total_responses,
                 'response_rate': response_rate,
                 'avg_responses_per_contact': avg_responses_per_contact,
+                'first_response_p50_seconds': response_stats['latency_p50_seconds'],
+                'first_response_p90_seconds': response_stats['latency_p90_seconds'],
+                'first_response_distribution': response_stats['latency_buckets'],
                 'effectiveness_score': effectiveness_score,
                 'delivery_rate': round(delivery_rate, 1),
                 'read_rate': round(read_rate, 1)
@@ -5408,17 +5507,19 @@ def api_force_categorize():
     data = request.get_json(silent=True) or {}
     phone = data.get('phone')
 
+    # El ciclo no espera el lock: si ya hay uno corriendo, avisar en vez de encolar otro
+    if conversation_categorizer.is_running(db):
+        return jsonify({'success': False, 'busy': True,
+                        'error': 'Ya hay una clasificación en curso, reintentá en unos minutos'}), 409
+
     def run_force():
-        # Guardar valor original y restaurar después
-        original_inactivity = conversation_categorizer.INACTIVITY_MINUTES
-        conversation_categorizer.INACTIVITY_MINUTES = 0
-        try:
-            conversation_categorizer.run_categorization(
-                app.app_context(),
-                force_phone=phone
-            )
-        finally:
-            conversation_categorizer.INACTIVITY_MINUTES = original_inactivity
+        result = conversation_categorizer.run_categorization(
+            app.app_context(),
+            force_phone=phone,
+            inactivity_minutes=0
+        )
+        if result == "busy":
+            logger.warning("⏭️ [CATEGORIZER] Clasificación forzada descartada: ya había un ciclo en curso")
 
     t = threading.Thread(target=run_force)
     t.daemon = True
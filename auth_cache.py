@@ -0,0 +1,86 @@
+"""
+Auth Cache
+Cache en memoria del usuario autenticado, sus permisos y sus etiquetas visibles.
+
+check_auth resolvía el CrmUser (con JOIN a permisos y visibilidad) en cada request,
+incluidos los endpoints de polling. Ahora se guarda un snapshot inmutable por
+usuario (AuthUser) durante Config.AUTH_CACHE_TTL segundos:
+
+- Dentro del TTL no hay ninguna query.
+- Al vencer, se compara crm_users.auth_version (una lectura por PK): si no cambió
+  se reutiliza el snapshot; si cambió (o el usuario ya no existe) se recarga.
+- Los endpoints de admin incrementan auth_version al modificar / borrar un usuario
+  e invalidan el cache local con invalidate_user(). Los demás procesos lo ven al
+  vencer su TTL.
+"""
+import threading
+import time
+
+from config import Config
+
+_lock = threading.Lock()
+_cache = {}  # user_id -> (AuthUser, expires_at)
+
+
+class AuthUser:
+    """Snapshot de solo lectura de un CrmUser (lo que usan check_auth, vistas y templates)."""
+
+    __slots__ = ('id', 'username', 'display_name', 'is_admin', 'is_active', 'can_see_untagged',
+                 'permissions', 'visible_tag_ids', 'auth_version')
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.display_name = user.display_name
+        self.is_admin = bool(user.is_admin)
+        self.is_active = bool(user.is_active)
+        self.can_see_untagged = bool(user.can_see_untagged)
+        self.permissions = frozenset(p.permission for p in user.permissions)
+        self.visible_tag_ids = tuple(sorted(v.tag_id for v in user.tag_visibility))
+        self.auth_version = user.auth_version or 0
+
+    def has_permission(self, permission):
+        if self.is_admin:
+            return True
+        return permission in self.permissions
+
+    def get_permissions(self):
+        return sorted(self.permissions)
+
+
+def get_user(user_id):
+    """AuthUser del id dado (None si no existe). Usa el cache mientras auth_version no cambie."""
+    from models import db, CrmUser
+    from sqlalchemy import text
+
+    if not user_id:
+        return None
+    now = time.monotonic()
+    with _lock:
+        cached = _cache.get(user_id)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    if cached:
+        version = db.session.execute(
+            text("SELECT auth_version FROM crm_users WHERE id = :id"), {'id': user_id}
+        ).scalar()
+        if version is not None and version == cached[0].auth_version:
+            with _lock:
+                _cache[user_id] = (cached[0], now + Config.AUTH_CACHE_TTL)
+            return cached[0]
+
+    user = db.session.get(CrmUser, user_id)
+    if user is None:
+        invalidate_user(user_id)
+        return None
+    snapshot = AuthUser(user)
+    with _lock:
+        _cache[user_id] = (snapshot, now + Config.AUTH_CACHE_TTL)
+    return snapshot
+
+
+def invalidate_user(user_id):
+    """Descarta el snapshot cacheado de un usuario en este proceso."""
+    with _lock:
+        _cache.pop(user_id, None)
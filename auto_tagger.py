@@ -2,22 +2,85 @@
 Auto Tagger Service
 Analiza conversaciones inactivas y asigna etiquetas automáticamente
 basándose en reglas configuradas (prompt SÍ/NO + IA).
+
+Los candidatos se arman en el thread del job (lecturas de BD y prompt), las
+llamadas a la IA salen en paralelo por llm_client (hasta LLM_MAX_CONCURRENCY)
+y los resultados se aplican de a uno en el thread del job.
+
+Las decisiones se guardan en auto_tag_evaluations (regla × teléfono × último
+mensaje entrante) y los pendientes salen de una sola consulta (CANDIDATES_SQL).
+purge_old_evaluations() las borra pasados AUTO_TAG_EVALUATION_RETENTION_DAYS.
 """
-import os
+import json
 import logging
 import threading
 from datetime import datetime, timedelta
-from openai import OpenAI
+
+from sqlalchemy import text
+
+import llm_client
 
 logger = logging.getLogger(__name__)
 
-client = None
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+PARALLEL_CHUNK = 50  # Contactos preparados por ronda de llamadas en paralelo
+
+# La sesión abierta que contiene el mensaje está pendiente en el categorizador
+_DEFER_TO_CATEGORIZER_SQL = """
+          AND NOT (COALESCE(r.inactivity_minutes, 30) <= :defer_wait AND EXISTS (
+              SELECT 1 FROM categorizer_state s
+              WHERE s.phone_number = li.phone_number AND s.tail_dirty AND li.timestamp >= s.tail_started_at
+          ))"""
+
+
+def find_candidates(db, now, earliest, phones=None, defer_wait=None):
+    """
+    (regla, teléfono) a evaluar en un solo statement: último mensaje entrante por teléfono
+    (DISTINCT ON), su contacto, las reglas activas con la inactividad cumplida, sin el tag
+    de la regla y sin decisión guardada para ese mensaje.
+    phones: limitar a esos teléfonos (pasada combinada del categorizador).
+    defer_wait: dejar afuera las reglas con inactividad <= defer_wait cuyo mensaje está en
+    una sesión abierta pendiente del categorizador (las responde su llamada combinada).
+    """
+    rows = db.session.execute(text(f"""
+        WITH last_inbound AS (
+            SELECT DISTINCT ON (m.phone_number) m.phone_number, m.id AS message_id, m.timestamp
+            FROM whatsapp_messages m
+            WHERE m.direction = 'inbound'
+              AND m.timestamp >= :earliest
+              AND m.phone_number NOT IN ('unknown', 'outbound', '')
+              {'AND m.phone_number = ANY(:phones)' if phones is not None else ''}
+            ORDER BY m.phone_number, m.timestamp DESC, m.id DESC
+        )
+        SELECT li.phone_number, li.message_id, li.timestamp, c.id AS contact_id, r.id AS rule_id
+        FROM last_inbound li
+        CROSS JOIN LATERAL (
+            SELECT id FROM whatsapp_contacts WHERE phone_number = li.phone_number ORDER BY id LIMIT 1
+        ) c
+        JOIN auto_tag_rules r ON r.is_active
+        WHERE li.timestamp < :now - make_interval(mins => COALESCE(r.inactivity_minutes, 30))
+          AND (r.activated_at IS NULL OR li.timestamp >= r.activated_at)
+          AND NOT EXISTS (
+              SELECT 1 FROM whatsapp_contact_tags ct WHERE ct.contact_id = c.id AND ct.tag_id = r.tag_id
+          )
+          AND NOT EXISTS (
+              SELECT 1 FROM auto_tag_evaluations e
+              WHERE e.rule_id = r.id AND e.phone_number = li.phone_number AND e.message_id = li.message_id
+          )
+          {_DEFER_TO_CATEGORIZER_SQL if defer_wait is not None else ''}
+        ORDER BY li.timestamp, li.phone_number, r.id
+    """), {'earliest': earliest, 'now': now, 'phones': list(phones or []), 'defer_wait': defer_wait}).fetchall()
+    return rows
+
+
+def earliest_message_at(rules, now):
+    """Desde cuándo buscar mensajes para estas reglas."""
+    from config import Config
+
+    _epoch = datetime(2000, 1, 1)
+    # Mensajes más viejos que la retención no se evalúan: su decisión ya pudo purgarse
+    retention_start = now - timedelta(days=Config.AUTO_TAG_EVALUATION_RETENTION_DAYS)
+    return max(min(r.activated_at or _epoch for r in rules), retention_start)
 
-if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
-else:
-    logger.warning("OPENAI_API_KEY not set - auto tagger disabled")
 
 _running_lock = threading.Lock()
 
@@ -36,12 +99,12 @@ def run_auto_tagger(app_context):
 def _run_auto_tagger_inner(app_context):
     logger.info("🔄 [AUTO_TAGGER] ========== INICIO DE CICLO ==========")
 
-    if not client:
-        logger.warning("⚠️ [AUTO_TAGGER] OpenAI client no inicializado — falta OPENAI_API_KEY")
+    if not llm_client.is_configured():
+        logger.warning("⚠️ [AUTO_TAGGER] Falta OPENAI_API_KEY — saltando")
         return
 
     with app_context:
-        from models import db, Message, Contact, AutoTagRule, AutoTagLog, FollowUpSequence, FollowUpEnrollment, ChatbotConfig, Tag, ContactTagHistory
+        from models import db, Message, Contact, AutoTagRule, ChatbotConfig
 
         try:
             enabled = ChatbotConfig.get('auto_tagger_enabled', 'true')
@@ -59,140 +122,176 @@ def _run_auto_tagger_inner(app_context):
                 logger.info(f"   → Regla #{r.id} | inactividad: {r.inactivity_minutes}min | tag_id: {r.tag_id} | condición: {r.prompt_condition[:60]}")
 
             now = datetime.utcnow()
+            earliest_start = earliest_message_at(rules, now)
 
-            _epoch = datetime(2000, 1, 1)
-            earliest_start = min(r.activated_at or _epoch for r in rules)
-
-            phones_q = db.session.query(Message.phone_number).filter(
-                Message.phone_number.notin_(['unknown', 'outbound', '']),
-                Message.timestamp >= earliest_start,
-                Message.direction == 'inbound'
-            ).distinct().all()
-
-            logger.info(f"👥 [AUTO_TAGGER] {len(phones_q)} contacto(s) candidato(s) con mensajes desde {earliest_start.strftime('%Y-%m-%d %H:%M')}")
-
-            evaluados = 0
-            saltados = 0
-
-            for (phone,) in phones_q:
-                last_msg = Message.query.filter(
-                    Message.phone_number == phone,
-                    Message.direction == 'inbound'
-                ).order_by(Message.timestamp.desc()).first()
-
-                if not last_msg:
-                    continue
-
-                contact = Contact.query.filter_by(phone_number=phone).first()
-                if not contact:
-                    logger.info(f"   ⏩ {phone}: sin contacto en BD — saltando")
-                    continue
-
-                # Filtrar solo las reglas que aplican a este contacto en este momento
-                pending_rules = []
-                for rule in rules:
-                    cutoff = now - timedelta(minutes=rule.inactivity_minutes)
-                    minutos_inactivo = int((now - last_msg.timestamp).total_seconds() / 60)
-
-                    if last_msg.timestamp >= cutoff:
-                        logger.info(f"   ⏩ {phone} | Regla #{rule.id}: activo hace {minutos_inactivo}min, necesita {rule.inactivity_minutes}min — NO listo")
-                        saltados += 1
-                        continue
-                    if rule.activated_at and last_msg.timestamp < rule.activated_at:
-                        logger.info(f"   ⏩ {phone} | Regla #{rule.id}: último msg ({last_msg.timestamp}) antes de activated_at ({rule.activated_at}) — saltando")
-                        saltados += 1
-                        continue
-                    if any(t.id == rule.tag_id for t in contact.tags):
-                        logger.info(f"   ⏩ {phone} | Regla #{rule.id}: ya tiene el tag #{rule.tag_id} — saltando")
-                        saltados += 1
-                        continue
-                    cache_key = f"auto_tag_{rule.id}_{phone}_{last_msg.id}"
-                    if ChatbotConfig.query.filter_by(key=cache_key).first():
-                        logger.info(f"   ⏩ {phone} | Regla #{rule.id}: ya analizado anteriormente (cache) — saltando")
-                        saltados += 1
-                        continue
-                    pending_rules.append(rule)
-
-                if not pending_rules:
-                    continue
+            # Pasada combinada: las reglas que entran en la llamada del categorizador se le dejan a él
+            from conversation_categorizer import combined_analysis_active, combined_wait_minutes
+            defer_wait = combined_wait_minutes(rules) if combined_analysis_active() else None
+
+            rows = find_candidates(db, now, earliest_start, defer_wait=defer_wait)
+            db.session.commit()
+
+            by_phone = {}
+            for row in rows:
+                by_phone.setdefault(row.phone_number, []).append(row)
+            logger.info(f"👥 [AUTO_TAGGER] {len(by_phone)} contacto(s) con {len(rows)} regla(s) pendiente(s) desde {earliest_start.strftime('%Y-%m-%d %H:%M')}")
+
+            rules_by_id = {r.id: r for r in rules}
+            stats = {'evaluados': 0}
+            candidates = []
+
+            for phone, phone_rows in by_phone.items():
+                contact = Contact.query.get(phone_rows[0].contact_id)
+                pending_rules = [rules_by_id[r.rule_id] for r in phone_rows]
+                last_msg_at = phone_rows[0].timestamp
 
                 contact_name = contact.name or phone
-                logger.info(f"🔍 [AUTO_TAGGER] Analizando: {contact_name} ({phone}) | {len(pending_rules)} regla(s) pendiente(s) | inactivo hace {int((now - last_msg.timestamp).total_seconds() / 60)}min")
+                logger.info(f"🔍 [AUTO_TAGGER] Analizando: {contact_name} ({phone}) | {len(pending_rules)} regla(s) pendiente(s) | inactivo hace {int((now - last_msg_at).total_seconds() / 60)}min")
 
-                # Obtener los últimos 20 mensajes una sola vez
+                # Obtener los últimos 15 mensajes una sola vez
                 messages = Message.query.filter(
                     Message.phone_number == phone
                 ).order_by(Message.timestamp.desc()).limit(15).all()
                 messages = list(reversed(messages))
 
-                logger.info(f"   → Enviando {len(messages)} mensajes a la IA con {len(pending_rules)} condición(es)...")
+                logger.info(f"   → {len(messages)} mensajes a la IA con {len(pending_rules)} condición(es)...")
 
                 # UNA sola llamada a la IA con todas las condiciones pendientes
                 conditions = {str(rule.id): rule.prompt_condition for rule in pending_rules}
-                try:
-                    results = analyze_conversation_batch(messages, conditions)
-                    logger.info(f"   → Respuesta IA: {results}")
-                except Exception as e:
-                    logger.error(f"❌ [AUTO_TAGGER] Error llamando a IA para {phone}: {e}", exc_info=True)
-                    for rule in pending_rules:
-                        _write_log(db, AutoTagLog, rule, contact, phone, 'error')
-                    continue
+                candidates.append({
+                    'phone': phone,
+                    'contact': contact,
+                    'contact_name': contact_name,
+                    'last_msg_id': phone_rows[0].message_id,
+                    'rules': pending_rules,
+                    'conditions': conditions,
+                    'chat_messages': build_batch_prompt(messages, conditions),
+                })
+
+                if len(candidates) >= PARALLEL_CHUNK:
+                    _evaluate_candidates(db, candidates, stats)
+                    candidates = []
+
+            _evaluate_candidates(db, candidates, stats)
+            evaluados = stats['evaluados']
+
+            logger.info(f"✅ [AUTO_TAGGER] Ciclo terminado — evaluados: {evaluados} contacto(s)")
+            logger.info("🔄 [AUTO_TAGGER] ========== FIN DE CICLO ==========")
 
-                evaluados += 1
+        except Exception as e:
+            logger.error(f"❌ [AUTO_TAGGER] Error general: {e}", exc_info=True)
 
-                for rule in pending_rules:
-                    rule_result = results.get(str(rule.id), False)
 
-                    # Marcar como analizado
-                    cache_key = f"auto_tag_{rule.id}_{phone}_{last_msg.id}"
-                    db.session.add(ChatbotConfig(key=cache_key, value=str(rule_result)))
-                    try:
-                        db.session.commit()
-                    except Exception:
-                        db.session.rollback()
-
-                    if rule_result:
-                        tag = Tag.query.get(rule.tag_id)
-                        if tag and tag not in contact.tags:
-                            try:
-                                contact.tags.append(tag)
-                                db.session.flush()
-                                history = ContactTagHistory(
-                                    contact_id=contact.id,
-                                    tag_id=tag.id,
-                                    tag_name_snapshot=tag.name,
-                                    action='added',
-                                    source='auto_tagger',
-                                    created_by='auto_tagger'
-                                )
-                                db.session.add(history)
-                                db.session.commit()
-                                logger.info(f"🏷️ =============================================")
-                                logger.info(f"🏷️ ETIQUETA ASIGNADA")
-                                logger.info(f"🏷️   Persona  : {contact_name} ({phone})")
-                                logger.info(f"🏷️   Etiqueta : {tag.name}")
-                                logger.info(f"🏷️   Regla    : #{rule.id} — {rule.prompt_condition[:60]}")
-                                logger.info(f"🏷️ =============================================")
-                                _write_log(db, AutoTagLog, rule, contact, phone, 'tagged')
-                                enroll_in_sequences(db, contact, rule.tag_id, FollowUpSequence, FollowUpEnrollment)
-                            except Exception as e:
-                                db.session.rollback()
-                                logger.warning(f"   ⚠️ No se pudo asignar '{tag.name}' a {contact_name} (ya existe o error de BD): {e}")
-                        elif tag and tag in contact.tags:
-                            logger.info(f"   → IA dijo SI para Regla #{rule.id} pero {contact_name} ya tiene el tag '{tag.name}'")
-                    else:
-                        logger.info(f"   → IA dijo NO para Regla #{rule.id} ({rule.prompt_condition[:50]}) — sin tag")
-                        _write_log(db, AutoTagLog, rule, contact, phone, 'skipped')
-
-            logger.info(f"✅ [AUTO_TAGGER] Ciclo terminado — evaluados: {evaluados} | saltados: {saltados}")
-            logger.info("🔄 [AUTO_TAGGER] ========== FIN DE CICLO ==========")
+def purge_old_evaluations(app_context):
+    """Borra las decisiones más viejas que la retención (llamado desde el scheduler)."""
+    from models import db
+    from config import Config
 
+    with app_context:
+        try:
+            cutoff = datetime.utcnow() - timedelta(days=Config.AUTO_TAG_EVALUATION_RETENTION_DAYS)
+            result = db.session.execute(text("DELETE FROM auto_tag_evaluations WHERE evaluated_at < :cutoff"), {'cutoff': cutoff})
+            db.session.commit()
+            if result.rowcount:
+                logger.info(f"🧹 [AUTO_TAGGER] {result.rowcount} evaluación(es) purgadas")
         except Exception as e:
-            logger.error(f"❌ [AUTO_TAGGER] Error general: {e}", exc_info=True)
+            db.session.rollback()
+            logger.warning(f"No se pudo purgar auto_tag_evaluations: {e}")
+
+
+def _evaluate_candidates(db, candidates, stats):
+    """Llama a la IA en paralelo para los candidatos y aplica cada resultado en este thread."""
+    from models import AutoTagLog
+
+    if not candidates:
+        return
+    db.session.commit()  # No retener la transacción de lectura durante las llamadas a la IA
+
+    for job, results, error in llm_client.run_parallel(
+            lambda c: request_batch_decisions(c['chat_messages'], c['conditions']), candidates):
+        if error is not None:
+            logger.error(f"❌ [AUTO_TAGGER] Error llamando a IA para {job['phone']}: {error}")
+            for rule in job['rules']:
+                _write_log(db, AutoTagLog, rule, job['contact'], job['phone'], 'error')
+            continue
+        logger.info(f"   → Respuesta IA ({job['phone']}): {results}")
+        stats['evaluados'] += 1
+        apply_decisions(db, job, results)
+
+
+def apply_decisions(db, job, results, commit=True):
+    """
+    Guarda las decisiones de la IA para un candidato: evaluaciones, tags, historial,
+    logs y enrollments. commit=False (pasada combinada del categorizador): no commitea
+    ni se traga errores, todo queda en la transacción del que llama.
+    """
+    from models import AutoTagLog, FollowUpSequence, FollowUpEnrollment, Tag, ContactTagHistory
+
+    phone = job['phone']
+    contact = job['contact']
+    contact_name = job['contact_name']
+    for rule in job['rules']:
+        rule_result = results.get(str(rule.id), False)
 
+        # Marcar como analizado (hasta que llegue otro mensaje entrante)
+        try:
+            db.session.execute(text("""
+                INSERT INTO auto_tag_evaluations (rule_id, phone_number, message_id, result, evaluated_at)
+                VALUES (:rule_id, :phone, :message_id, :result, :now)
+                ON CONFLICT (rule_id, phone_number, message_id) DO NOTHING
+            """), {'rule_id': rule.id, 'phone': phone, 'message_id': job['last_msg_id'],
+                   'result': bool(rule_result), 'now': datetime.utcnow()})
+            if commit:
+                db.session.commit()
+        except Exception as e:
+            if not commit:
+                raise
+            db.session.rollback()
+            logger.warning(f"No se pudo guardar la evaluación de la regla #{rule.id} para {phone}: {e}")
+
+        if rule_result:
+            tag = Tag.query.get(rule.tag_id)
+            if tag and tag not in contact.tags:
+                try:
+                    contact.tags.append(tag)
+                    db.session.flush()
+                    history = ContactTagHistory(
+                        contact_id=contact.id,
+                        tag_id=tag.id,
+                        tag_name_snapshot=tag.name,
+                        action='added',
+                        source='auto_tagger',
+                        created_by='auto_tagger'
+                    )
+                    db.session.add(history)
+                    if commit:
+                        db.session.commit()
+                    logger.info(f"🏷️ =============================================")
+                    logger.info(f"🏷️ ETIQUETA ASIGNADA")
+                    logger.info(f"🏷️   Persona  : {contact_name} ({phone})")
+                    logger.info(f"🏷️   Etiqueta : {tag.name}")
+                    logger.info(f"🏷️   Regla    : #{rule.id} — {rule.prompt_condition[:60]}")
+                    logger.info(f"🏷️ =============================================")
+                    _write_log(db, AutoTagLog, rule, contact, phone, 'tagged', commit=commit)
+                    enroll_in_sequences(db, contact, rule.tag_id, FollowUpSequence, FollowUpEnrollment, commit=commit)
+                except Exception as e:
+                    if not commit:
+                        raise
+                    db.session.rollback()
+                    logger.warning(f"   ⚠️ No se pudo asignar '{tag.name}' a {contact_name} (ya existe o error de BD): {e}")
+            elif tag and tag in contact.tags:
+                logger.info(f"   → IA dijo SI para Regla #{rule.id} pero {contact_name} ya tiene el tag '{tag.name}'")
+        else:
+            logger.info(f"   → IA dijo NO para Regla #{rule.id} ({rule.prompt_condition[:50]}) — sin tag")
+            _write_log(db, AutoTagLog, rule, contact, phone, 'skipped', commit=commit)
 
-def _write_log(db, AutoTagLog, rule, contact, phone, result):
-    """Guarda un registro de análisis en la BD."""
+
+def _write_log(db, AutoTagLog, rule, contact, phone, result, commit=True):
+    """Guarda un registro de análisis en la BD (commit=False: en la transacción del que llama)."""
+    if not commit:
+        db.session.add(AutoTagLog(rule_id=rule.id, contact_id=contact.id if contact else None,
+                                  phone_number=phone, tag_id=rule.tag_id, result=result))
+        return
     try:
         log = AutoTagLog(
             rule_id=rule.id,
@@ -214,6 +313,11 @@ def analyze_conversation_batch(messages, conditions):
     conditions: dict {rule_id_str: prompt_condition}
     Retorna: dict {rule_id_str: True/False}
     """
+    return request_batch_decisions(build_batch_prompt(messages, conditions), conditions)
+
+
+def build_batch_prompt(messages, conditions, verbose=True):
+    """Mensajes (system + user) para la llamada. Se arma en el thread del job (lee objetos ORM)."""
     conv_lines = []
     for msg in messages:
         role = "Usuario" if msg.direction == "inbound" else "Bot"
@@ -222,20 +326,14 @@ def analyze_conversation_batch(messages, conditions):
 
     conversation_text = "\n".join(conv_lines)
 
-    logger.info(f"   --- CONVERSACIÓN ENVIADA A IA ({len(messages)} msgs) ---")
-    for line in conv_lines:
-        logger.info(f"   {line[:120]}")
-    logger.info(f"   --- FIN CONVERSACIÓN ---")
+    if verbose:
+        logger.info(f"   --- CONVERSACIÓN ENVIADA A IA ({len(messages)} msgs) ---")
+        for line in conv_lines:
+            logger.info(f"   {line[:120]}")
+        logger.info(f"   --- FIN CONVERSACIÓN ---")
 
-    escalated = any(
-        msg.direction == 'outbound' and msg.content and '[ESCALAR_HUMANO]' in msg.content
-        for msg in messages
-    )
-    escalation_note = "\n\n[NOTA]: En esta conversación el cliente fue derivado a un humano." if escalated else ""
-
-    conditions_text = "\n".join(
-        f'- "{rule_id}": {condition}' for rule_id, condition in conditions.items()
-    )
+    escalation_note = escalation_note_for(messages)
+    conditions_text = format_conditions(conditions)
 
     prompt = f"""Analizá la siguiente conversación de WhatsApp y respondé cada pregunta con SÍ o NO. Es importante que analices bien la conversacion ya que segun eso seran etiquetados las personas.
 
@@ -248,28 +346,56 @@ PREGUNTAS (respondé cada una con SÍ o NO):
 Respondé ÚNICAMENTE con un JSON válido con el mismo ID como clave y "SI" o "NO" como valor. Ejemplo:
 {{"123": "SI", "456": "NO"}}"""
 
-    response = client.chat.completions.create(
+    return [
+        {"role": "system", "content": "Eres un analizador de conversaciones. Respondés únicamente con un JSON de SI/NO por cada pregunta."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def escalation_note_for(messages):
+    escalated = any(
+        msg.direction == 'outbound' and msg.content and '[ESCALAR_HUMANO]' in msg.content
+        for msg in messages
+    )
+    return "\n\n[NOTA]: En esta conversación el cliente fue derivado a un humano." if escalated else ""
+
+
+def format_conditions(conditions):
+    return "\n".join(
+        f'- "{rule_id}": {condition}' for rule_id, condition in conditions.items()
+    )
+
+
+def parse_decisions(parsed, conditions):
+    """{rule_id_str: "SI"/"NO"} → {rule_id_str: bool}; las condiciones sin respuesta quedan en False."""
+    decisions = {k: False for k in conditions}
+    if isinstance(parsed, dict):
+        decisions.update({str(k): str(v).upper().startswith("S") for k, v in parsed.items() if str(k) in conditions})
+    return decisions
+
+
+def request_batch_decisions(chat_messages, conditions):
+    """Llamada a la IA por llm_client (sin acceso a la BD: corre en los workers de run_parallel)."""
+    response = llm_client.chat(
+        'auto_tagger', chat_messages,
         model="gpt-5.4-mini",
-        messages=[
-            {"role": "system", "content": "Eres un analizador de conversaciones. Respondés únicamente con un JSON de SI/NO por cada pregunta."},
-            {"role": "user", "content": prompt}
-        ],
         max_tokens=800,
         response_format={"type": "json_object"}
     )
 
-    import json
     raw = (response.choices[0].message.content or "").strip()
     try:
-        parsed = json.loads(raw)
-        return {k: (str(v).upper().startswith("S")) for k, v in parsed.items()}
+        return parse_decisions(json.loads(raw), conditions)
     except Exception:
         logger.warning(f"[AUTO_TAGGER] No se pudo parsear respuesta batch: {repr(raw)}")
         return {k: False for k in conditions}
 
 
-def enroll_in_sequences(db, contact, tag_id, FollowUpSequence, FollowUpEnrollment):
-    """Enrola al contacto en todas las secuencias activas que usen el tag dado (legacy o trigger_tags)."""
+def enroll_in_sequences(db, contact, tag_id, FollowUpSequence, FollowUpEnrollment, commit=True):
+    """
+    Enrola al contacto en todas las secuencias activas que usen el tag dado (legacy o trigger_tags).
+    commit=False: solo flush, los errores suben al que llama (que maneja la transacción).
+    """
     from models import followup_sequence_tags
     # Secuencias que tienen este tag en la tabla many-to-many
     seq_by_trigger = FollowUpSequence.query.join(
@@ -298,13 +424,15 @@ def enroll_in_sequences(db, contact, tag_id, FollowUpSequence, FollowUpEnrollmen
             sequence_id=seq.id
         ).first()
         if existing:
-            if existing.status == 'pending':
+            if existing.status in ('pending', 'processing'):
                 continue  # Ya tiene un enrollment activo, no duplicar
             # Eliminar enrollment finalizado/cancelado para permitir re-enrollment
             db.session.delete(existing)
             try:
                 db.session.flush()
             except Exception:
+                if not commit:
+                    raise
                 db.session.rollback()
                 continue
 
@@ -324,6 +452,10 @@ def enroll_in_sequences(db, contact, tag_id, FollowUpSequence, FollowUpEnrollmen
             next_send_at=next_send_at
         )
         db.session.add(enrollment)
+        if not commit:
+            db.session.flush()
+            logger.info(f"📋 [AUTO_TAGGER] {contact.phone_number} enrollado en '{seq.name}' (paso 1 → {next_send_at})")
+            continue
         try:
             db.session.commit()
             logger.info(f"📋 [AUTO_TAGGER] {contact.phone_number} enrollado en '{seq.name}' (paso 1 → {next_send_at})")
@@ -0,0 +1,37 @@
+"""
+Backfill de los rollups de /analytics (ver analytics_rollups.py).
+- Crea el índice idx_messages_row_version (CONCURRENTLY) si falta
+- Crea las tablas de rollup y las reconstruye desde whatsapp_messages
+Idempotente: se puede correr con la app andando (espera el lock del scheduler).
+"""
+import logging
+import psycopg2
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+from analytics_rollups import backfill_rollups
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Creando índice idx_messages_row_version...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_row_version
+    ON whatsapp_messages(row_version);
+""")
+print("✅ Índice creado.")
+cur.close()
+conn.close()
+
+print("Reconstruyendo rollups...")
+engine = create_engine(DATABASE_URL)
+backfill_rollups(engine)
+engine.dispose()
+print("✅ Backfill completado.")
@@ -0,0 +1,242 @@
+"""
+Campaign Counters
+Contadores por campaña (total, pending, sent, delivered, read, failed) en la tabla
+`campaign_counters`, para que las listas y el polling de estado no carguen logs.
+
+Los mantiene un trigger por sentencia sobre whatsapp_campaign_logs: la creación
+de logs al lanzar una campaña, el sender (pending → sent / failed) y la ingesta
+de estados (sent → delivered → read, UPDATE ... FROM en save_statuses) aplican
+su delta en la misma transacción, sea ORM o SQL crudo. Las filas se tocan en
+orden de campaign_id para no generar deadlocks entre lotes concurrentes.
+
+reconcile_campaign_counters() (scheduler, cada RECONCILE_INTERVAL_SECONDS)
+recalcula desde los logs y corrige cualquier diferencia: bloquea la fila del
+contador antes de contar, así no pisa deltas de transacciones en curso.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 71008
+RECONCILE_INTERVAL_SECONDS = 1800
+
+COUNTER_COLUMNS = ('total', 'pending', 'sent', 'delivered', 'read', 'failed')
+
+# Estado de cada log afectado con su signo: +1 filas nuevas, -1 filas viejas
+_DELTA_SOURCES = {
+    'INSERT': "SELECT campaign_id, status, 1 AS sign FROM new_rows",
+    'DELETE': "SELECT campaign_id, status, -1 AS sign FROM old_rows",
+    'UPDATE': ("SELECT campaign_id, status, 1 AS sign FROM new_rows "
+               "UNION ALL SELECT campaign_id, status, -1 AS sign FROM old_rows"),
+}
+
+
+def _apply_delta_sql(source):
+    """Upsert de los deltas por campaña, en orden de campaign_id (los lotes concurrentes bloquean en el mismo orden)."""
+    return f"""
+        INSERT INTO campaign_counters AS cc (campaign_id, total, pending, sent, delivered, read, failed, updated_at, status_xid)
+        SELECT t.* FROM (
+            SELECT d.campaign_id,
+                   SUM(d.sign) AS total,
+                   COALESCE(SUM(d.sign) FILTER (WHERE d.status = 'pending'), 0) AS pending,
+                   COALESCE(SUM(d.sign) FILTER (WHERE d.status = 'sent'), 0) AS sent,
+                   COALESCE(SUM(d.sign) FILTER (WHERE d.status = 'delivered'), 0) AS delivered,
+                   COALESCE(SUM(d.sign) FILTER (WHERE d.status = 'read'), 0) AS read,
+                   COALESCE(SUM(d.sign) FILTER (WHERE d.status = 'failed'), 0) AS failed,
+                   (now() AT TIME ZONE 'utc') AS updated_at,
+                   -- Logs que entraron o salieron de sent/delivered/read: campaign_metrics recalcula
+                   CASE WHEN COALESCE(SUM(d.sign) FILTER (WHERE d.status IN ('sent', 'delivered', 'read')), 0) <> 0
+                        THEN txid_current() END AS status_xid
+            FROM ({source}) d
+            -- Con la campaña ya borrada (DELETE en cascada) no hay contador que mantener
+            WHERE EXISTS (SELECT 1 FROM whatsapp_campaigns c WHERE c.id = d.campaign_id)
+            GROUP BY d.campaign_id
+        ) t
+        -- Un UPDATE que no cambia estados (message_id, respuestas) no toca el contador
+        WHERE t.total <> 0 OR t.pending <> 0 OR t.sent <> 0 OR t.delivered <> 0 OR t.read <> 0 OR t.failed <> 0
+        ORDER BY t.campaign_id
+        ON CONFLICT (campaign_id) DO UPDATE SET
+            total = cc.total + EXCLUDED.total,
+            pending = cc.pending + EXCLUDED.pending,
+            sent = cc.sent + EXCLUDED.sent,
+            delivered = cc.delivered + EXCLUDED.delivered,
+            read = cc.read + EXCLUDED.read,
+            failed = cc.failed + EXCLUDED.failed,
+            updated_at = EXCLUDED.updated_at,
+            status_xid = COALESCE(EXCLUDED.status_xid, cc.status_xid);
+    """
+
+
+# Sin parámetros ni '%': se ejecuta tal cual con exec_driver_sql / cursor psycopg2
+SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS campaign_counters (
+    campaign_id INTEGER PRIMARY KEY REFERENCES whatsapp_campaigns(id) ON DELETE CASCADE,
+    total INTEGER NOT NULL DEFAULT 0,
+    pending INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    read INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status_xid BIGINT
+);
+ALTER TABLE campaign_counters ADD COLUMN IF NOT EXISTS status_xid BIGINT;
+
+CREATE OR REPLACE FUNCTION campaign_counters_on_logs_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {_apply_delta_sql(_DELTA_SOURCES['INSERT'])}
+    ELSIF TG_OP = 'DELETE' THEN
+        {_apply_delta_sql(_DELTA_SOURCES['DELETE'])}
+    ELSE
+        {_apply_delta_sql(_DELTA_SOURCES['UPDATE'])}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_campaign_counters_insert ON whatsapp_campaign_logs;
+CREATE TRIGGER trg_campaign_counters_insert
+    AFTER INSERT ON whatsapp_campaign_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE campaign_counters_on_logs_change();
+
+DROP TRIGGER IF EXISTS trg_campaign_counters_update ON whatsapp_campaign_logs;
+CREATE TRIGGER trg_campaign_counters_update
+    AFTER UPDATE ON whatsapp_campaign_logs
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE campaign_counters_on_logs_change();
+
+DROP TRIGGER IF EXISTS trg_campaign_counters_delete ON whatsapp_campaign_logs;
+CREATE TRIGGER trg_campaign_counters_delete
+    AFTER DELETE ON whatsapp_campaign_logs
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE campaign_counters_on_logs_change();
+"""
+
+# Reconstrucción completa (backfill). Idempotente.
+REBUILD_SQL = """
+INSERT INTO campaign_counters (campaign_id, total, pending, sent, delivered, read, failed, updated_at)
+SELECT c.id,
+       COUNT(l.id),
+       COUNT(l.id) FILTER (WHERE l.status = 'pending'),
+       COUNT(l.id) FILTER (WHERE l.status = 'sent'),
+       COUNT(l.id) FILTER (WHERE l.status = 'delivered'),
+       COUNT(l.id) FILTER (WHERE l.status = 'read'),
+       COUNT(l.id) FILTER (WHERE l.status = 'failed'),
+       (now() AT TIME ZONE 'utc')
+FROM whatsapp_campaigns c
+LEFT JOIN whatsapp_campaign_logs l ON l.campaign_id = c.id
+GROUP BY c.id
+ON CONFLICT (campaign_id) DO UPDATE SET
+    total = EXCLUDED.total,
+    pending = EXCLUDED.pending,
+    sent = EXCLUDED.sent,
+    delivered = EXCLUDED.delivered,
+    read = EXCLUDED.read,
+    failed = EXCLUDED.failed,
+    updated_at = EXCLUDED.updated_at;
+"""
+
+TRIGGER_CHECK_SQL = """
+SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_campaign_counters_update')
+"""
+
+
+def install(cursor, rebuild=True):
+    """Instala tabla, función y triggers (y reconstruye) usando un cursor DBAPI."""
+    cursor.execute(f"SELECT pg_advisory_xact_lock({LOCK_KEY})")
+    cursor.execute(SCHEMA_SQL)
+    if rebuild:
+        cursor.execute(REBUILD_SQL)
+
+
+def ensure_campaign_counters(engine):
+    """Al arrancar: si faltan los triggers (deploy nuevo), instalarlos y hacer el backfill."""
+    with engine.begin() as conn:
+        if conn.exec_driver_sql(TRIGGER_CHECK_SQL).scalar():
+            return False
+        # Otro worker pudo instalarlos mientras tanto: volver a chequear con el lock tomado
+        conn.exec_driver_sql(f"SELECT pg_advisory_xact_lock({LOCK_KEY})")
+        if conn.exec_driver_sql(TRIGGER_CHECK_SQL).scalar():
+            return False
+        cursor = conn.connection.cursor()
+        install(cursor)
+        cursor.close()
+    logger.info("📣 [CAMPAIGNS] Triggers de contadores instalados y contadores reconstruidos")
+    return True
+
+
+def get_counters(campaign_ids):
+    """{campaign_id: dict de contadores} (ceros si la campaña todavía no tiene fila)."""
+    from models import CampaignCounters
+
+    result = {cid: dict.fromkeys(COUNTER_COLUMNS, 0) for cid in campaign_ids}
+    if not campaign_ids:
+        return result
+    for row in CampaignCounters.query.filter(CampaignCounters.campaign_id.in_(list(campaign_ids))).all():
+        result[row.campaign_id] = {col: getattr(row, col) for col in COUNTER_COLUMNS}
+    return result
+
+
+def reconcile_campaign_counters(app_context):
+    """Recalcula los contadores desde los logs y corrige las diferencias (llamado desde el scheduler)."""
+    with app_context:
+        from models import db
+        with db.engine.connect() as conn:
+            # Un solo proceso a la vez (p. ej. durante un failover del líder del scheduler)
+            if not conn.execute(text(f"SELECT pg_try_advisory_lock({LOCK_KEY})")).scalar():
+                conn.rollback()
+                return
+            conn.commit()
+            try:
+                campaign_ids = [r[0] for r in conn.execute(text("SELECT id FROM whatsapp_campaigns ORDER BY id"))]
+                conn.commit()
+                repaired = 0
+                for cid in campaign_ids:
+                    repaired += _reconcile_one(conn, cid)
+                if repaired:
+                    logger.warning(f"📣 [CAMPAIGNS] Contadores corregidos en {repaired} campaña(s)")
+            finally:
+                conn.rollback()  # Si algo falló, salir de la transacción abortada antes de soltar el lock
+                conn.execute(text(f"SELECT pg_advisory_unlock({LOCK_KEY})"))
+                conn.commit()
+
+
+def _reconcile_one(conn, campaign_id):
+    """Corrige los contadores de una campaña. Devuelve 1 si había diferencia."""
+    params = {'cid': campaign_id, 'now': datetime.utcnow()}
+    # Crear la fila si falta y bloquearla: las transacciones que escriben logs de esta
+    # campaña esperan en el trigger, y las que ya aplicaron su delta commitean antes
+    conn.execute(text("""
+        INSERT INTO campaign_counters (campaign_id, updated_at) VALUES (:cid, :now)
+        ON CONFLICT (campaign_id) DO NOTHING
+    """), params)
+    current = conn.execute(text(
+        "SELECT total, pending, sent, delivered, read, failed FROM campaign_counters WHERE campaign_id = :cid FOR UPDATE"
+    ), params).first()
+    # READ COMMITTED: esta sentencia ve todo lo commiteado hasta tomar el lock
+    actual = conn.execute(text("""
+        SELECT COUNT(*),
+               COUNT(*) FILTER (WHERE status = 'pending'),
+               COUNT(*) FILTER (WHERE status = 'sent'),
+               COUNT(*) FILTER (WHERE status = 'delivered'),
+               COUNT(*) FILTER (WHERE status = 'read'),
+               COUNT(*) FILTER (WHERE status = 'failed')
+        FROM whatsapp_campaign_logs WHERE campaign_id = :cid
+    """), params).first()
+    if current is not None and tuple(current) == tuple(actual):
+        conn.commit()
+        return 0
+    conn.execute(text("""
+        UPDATE campaign_counters
+        SET total = :total, pending = :pending, sent = :sent, delivered = :delivered,
+            read = :read, failed = :failed, updated_at = :now
+        WHERE campaign_id = :cid
+    """), dict(params, **dict(zip(COUNTER_COLUMNS, actual))))
+    conn.commit()
+    logger.info(f"📣 [CAMPAIGNS] Campaña {campaign_id}: contadores {tuple(current) if current else None} → {tuple(actual)}")
+    return 1
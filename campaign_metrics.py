@@ -0,0 +1,238 @@
+"""
+Campaign Metrics
+Atribución de respuestas a campañas, materializada y mantenida por el scheduler.
+
+Una respuesta es un mensaje inbound del contacto dentro de las RESPONSE_WINDOW_HOURS
+posteriores al envío (created_at del log). Se guarda en dos niveles:
+
+- whatsapp_campaign_logs.response_count / first_response_at: por destinatario.
+- campaign_response_metrics: por campaña (respondedores, respuestas totales y
+  distribución de la latencia de la primera respuesta). Es lo que leen las páginas
+  de detalle y comparación, sin recorrer los logs.
+
+refresh_campaign_metrics() corre cada minuto:
+- toma los mensajes inbound con row_version entre el watermark y la versión
+  asentada (message_versions.settled_version: nada que commitee después puede
+  quedar por debajo), recalcula solo los logs de esos teléfonos cuya ventana los
+  incluye y re-agrega sus campañas;
+- recalcula las campañas cuyos logs entraron o salieron de los estados exitosos
+  (campaign_counters.status_xid, que marcan los triggers de contadores) desde el
+  xmin del snapshot de la corrida anterior.
+
+Si no hay watermark (deploy nuevo) recalcula todas las campañas, una por transacción.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import text
+
+from message_versions import settled_version
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 71007
+WATERMARK_NAME = 'campaign_responses'
+STATUS_WATERMARK_NAME = 'campaign_statuses'  # xid, no row_version
+RESPONSE_WINDOW_HOURS = 48
+SUCCESS_STATUSES_SQL = "('sent', 'delivered', 'read')"
+
+# Tramos de la distribución de latencia (segundos, etiqueta)
+LATENCY_BUCKETS = [(3600, '<1h'), (6 * 3600, '1-6h'), (24 * 3600, '6-24h'), (RESPONSE_WINDOW_HOURS * 3600, '24-48h')]
+
+# Recalcula response_count / first_response_at de los logs que cumplen {where} (alias l2)
+_REFRESH_LOGS_SQL = f"""
+    UPDATE whatsapp_campaign_logs l
+    SET response_count = r.responses, first_response_at = r.first_at
+    FROM (
+        SELECT l2.id, COUNT(m.id) AS responses, MIN(m.timestamp) AS first_at
+        FROM whatsapp_campaign_logs l2
+        LEFT JOIN whatsapp_messages m
+          ON m.phone_number = l2.contact_phone
+         AND m.direction = 'inbound'
+         AND m.timestamp > l2.created_at
+         AND m.timestamp <= l2.created_at + interval '{RESPONSE_WINDOW_HOURS} hours'
+        WHERE l2.status IN {SUCCESS_STATUSES_SQL}
+          AND l2.created_at IS NOT NULL
+          AND {{where}}
+        GROUP BY l2.id
+    ) r
+    WHERE l.id = r.id
+      AND (l.response_count IS DISTINCT FROM r.responses OR l.first_response_at IS DISTINCT FROM r.first_at)
+"""
+
+_LATENCY_SQL = "EXTRACT(EPOCH FROM (l.first_response_at - l.created_at))"
+
+
+def _buckets_sql():
+    parts, low = [], 0
+    for high, label in LATENCY_BUCKETS:
+        parts.append(f"'{label}', COUNT(*) FILTER (WHERE {_LATENCY_SQL} > {low} AND {_LATENCY_SQL} <= {high})")
+        low = high
+    return "json_build_object(" + ", ".join(parts) + ")"
+
+
+# Re-agrega las campañas indicadas (:ids) desde sus logs
+_REFRESH_CAMPAIGNS_SQL = f"""
+    INSERT INTO campaign_response_metrics
+        (campaign_id, responders, total_responses, latency_p50_seconds, latency_p90_seconds, latency_buckets, updated_at)
+    SELECT c.id,
+           COUNT(l.id) FILTER (WHERE l.response_count > 0),
+           COALESCE(SUM(l.response_count), 0),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY {_LATENCY_SQL}),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY {_LATENCY_SQL}),
+           {_buckets_sql()},
+           :now
+    FROM whatsapp_campaigns c
+    LEFT JOIN whatsapp_campaign_logs l
+      ON l.campaign_id = c.id AND l.status IN {SUCCESS_STATUSES_SQL}
+    WHERE c.id = ANY(:ids)
+    GROUP BY c.id
+    ON CONFLICT (campaign_id) DO UPDATE SET
+        responders = EXCLUDED.responders,
+        total_responses = EXCLUDED.total_responses,
+        latency_p50_seconds = EXCLUDED.latency_p50_seconds,
+        latency_p90_seconds = EXCLUDED.latency_p90_seconds,
+        latency_buckets = EXCLUDED.latency_buckets,
+        updated_at = EXCLUDED.updated_at
+"""
+
+
+def refresh_campaign(campaign_id):
+    """
+    Recalcula por completo las respuestas de una campaña (al terminar de enviarla).
+    Se llama dentro de un app context; usa db.session.
+    """
+    from models import db
+    db.session.execute(text(_REFRESH_LOGS_SQL.format(where="l2.campaign_id = :cid")), {'cid': campaign_id})
+    db.session.execute(text(_REFRESH_CAMPAIGNS_SQL), {'ids': [campaign_id], 'now': datetime.utcnow()})
+    db.session.commit()
+
+
+def refresh_campaign_metrics(app_context):
+    """Aplica las respuestas nuevas a los logs y métricas de campaña (llamado desde el scheduler)."""
+    with app_context:
+        from models import db
+        with db.engine.connect() as conn:
+            # Un solo proceso a la vez (p. ej. durante un failover del líder del scheduler)
+            if not conn.execute(text(f"SELECT pg_try_advisory_lock({LOCK_KEY})")).scalar():
+                conn.rollback()
+                return
+            conn.commit()
+            try:
+                watermark = _get_watermark(conn, WATERMARK_NAME)
+                status_watermark = _get_watermark(conn, STATUS_WATERMARK_NAME)
+                conn.commit()
+                if watermark is None:
+                    _backfill(conn)
+                else:
+                    _apply_since(conn, watermark)
+                    _apply_status_changes(conn, status_watermark)
+            finally:
+                conn.rollback()  # Si algo falló, salir de la transacción abortada antes de soltar el lock
+                conn.execute(text(f"SELECT pg_advisory_unlock({LOCK_KEY})"))
+                conn.commit()
+
+
+def _horizon(conn):
+    """xmin del snapshot: toda transacción con xid menor ya terminó."""
+    return conn.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+
+
+def _apply_since(conn, watermark):
+    """Recalcula los logs alcanzados por mensajes inbound con row_version posterior al watermark."""
+    high = settled_version(conn)
+    if high <= watermark:
+        conn.rollback()
+        return
+    low = watermark
+
+    conn.execute(text("""
+        CREATE TEMP TABLE _new_responses ON COMMIT DROP AS
+        SELECT phone_number, MIN(timestamp) AS min_ts, MAX(timestamp) AS max_ts
+        FROM whatsapp_messages
+        WHERE row_version > :low AND row_version <= :high
+          AND direction = 'inbound' AND timestamp IS NOT NULL
+        GROUP BY phone_number
+    """), {'low': low, 'high': high})
+    conn.execute(text(f"""
+        CREATE TEMP TABLE _touched_logs ON COMMIT DROP AS
+        SELECT l.id, l.campaign_id
+        FROM whatsapp_campaign_logs l
+        JOIN _new_responses n ON n.phone_number = l.contact_phone
+        WHERE l.status IN {SUCCESS_STATUSES_SQL}
+          AND l.created_at < n.max_ts
+          AND l.created_at >= n.min_ts - interval '{RESPONSE_WINDOW_HOURS} hours'
+    """))
+    logs = conn.execute(text(_REFRESH_LOGS_SQL.format(where="l2.id IN (SELECT id FROM _touched_logs)"))).rowcount
+    campaign_ids = [r[0] for r in conn.execute(text("SELECT DISTINCT campaign_id FROM _touched_logs"))]
+    if campaign_ids:
+        conn.execute(text(_REFRESH_CAMPAIGNS_SQL), {'ids': campaign_ids, 'now': datetime.utcnow()})
+
+    _set_watermark(conn, high)
+    conn.commit()
+    if campaign_ids:
+        logger.info(f"📣 [CAMPAIGN METRICS] Versiones {watermark}→{high}: {logs} log(s) actualizados en {len(campaign_ids)} campaña(s)")
+
+
+def _apply_status_changes(conn, status_watermark):
+    """Recalcula las campañas con logs que cambiaron de estado exitoso desde la corrida anterior."""
+    # Tomado antes de leer: lo que commitee después queda con status_xid >= horizon
+    horizon = _horizon(conn)
+    if status_watermark is not None:
+        campaign_ids = [r[0] for r in conn.execute(
+            text("SELECT campaign_id FROM campaign_counters WHERE status_xid >= :since ORDER BY campaign_id"),
+            {'since': status_watermark}
+        )]
+        if campaign_ids:
+            logs = conn.execute(text(_REFRESH_LOGS_SQL.format(where="l2.campaign_id = ANY(:ids)")),
+                                {'ids': campaign_ids}).rowcount
+            conn.execute(text(_REFRESH_CAMPAIGNS_SQL), {'ids': campaign_ids, 'now': datetime.utcnow()})
+            logger.info(f"📣 [CAMPAIGN METRICS] Cambios de estado: {logs} log(s) actualizados en {len(campaign_ids)} campaña(s)")
+    _set_watermark(conn, horizon, STATUS_WATERMARK_NAME)
+    conn.commit()
+
+
+def _backfill(conn):
+    """Recalcula todas las campañas (una transacción por campaña)."""
+    # Los watermarks se toman antes de empezar: lo que llegue durante el backfill se re-aplica después
+    high = settled_version(conn)
+    horizon = _horizon(conn)
+    campaign_ids = [r[0] for r in conn.execute(text("SELECT id FROM whatsapp_campaigns ORDER BY id"))]
+    conn.commit()
+    logger.info(f"📣 [CAMPAIGN METRICS] Backfill de respuestas para {len(campaign_ids)} campaña(s)")
+
+    for cid in campaign_ids:
+        conn.execute(text(_REFRESH_LOGS_SQL.format(where="l2.campaign_id = :cid")), {'cid': cid})
+        conn.execute(text(_REFRESH_CAMPAIGNS_SQL), {'ids': [cid], 'now': datetime.utcnow()})
+        conn.commit()
+
+    _set_watermark(conn, high)
+    _set_watermark(conn, horizon, STATUS_WATERMARK_NAME)
+    conn.commit()
+    logger.info(f"📣 [CAMPAIGN METRICS] Backfill completo (watermark {high})")
+
+
+def _get_watermark(conn, name):
+    return conn.execute(text("SELECT value FROM rollup_watermarks WHERE name = :name"), {'name': name}).scalar()
+
+
+def _set_watermark(conn, value, name=WATERMARK_NAME):
+    conn.execute(text("""
+        INSERT INTO rollup_watermarks (name, value, updated_at)
+        VALUES (:name, :value, :now)
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+    """), {'name': name, 'value': value, 'now': datetime.utcnow()})
+
+
+def metrics_to_dict(metrics):
+    """Serializa una fila de CampaignResponseMetrics (o None) para las APIs de campañas."""
+    if metrics is None:
+        return {'unique_responders': 0, 'total_responses': 0, 'latency_p50_seconds': None,
+                'latency_p90_seconds': None, 'latency_buckets': {label: 0 for _, label in LATENCY_BUCKETS}}
+    return {
+        'unique_responders': metrics.responders,
+        'total_responses': metrics.total_responses,
+        'latency_p50_seconds': int(metrics.latency_p50_seconds) if metrics.latency_p50_seconds is not None else None,
+        'latency_p90_seconds': int(metrics.latency_p90_seconds) if metrics.latency_p90_seconds is not None else None,
+        'latency_buckets': metrics.latency_buckets or {label: 0 for _, label in LATENCY_BUCKETS},
+    }
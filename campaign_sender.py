@@ -0,0 +1,617 @@
+"""
+Campaign Sender
+Motor de envío de campañas: pool de workers + token bucket configurable.
+
+- Los templates se envían desde CAMPAIGN_SEND_WORKERS threads que comparten una
+  sesión HTTP con pool de conexiones (whatsapp_service); cada envío consume un
+  token del bucket, así la tasa total no supera CAMPAIGN_SEND_RATE mensajes/s.
+- Los logs se reclaman por tramos de CAMPAIGN_CHUNK_SIZE: los workers no tocan la
+  BD; el thread del sender escribe cada resultado apenas vuelve su envío (log +
+  mensaje del historial, con UPDATE ... FROM unnest / INSERT ... ON CONFLICT), así
+  un proceso que muere a mitad de tramo no deja envíos hechos sin registrar.
+- Si Meta responde con throttling de la cuenta (THROTTLE_CODES) la tasa baja a la
+  mitad, el bucket se pausa unos segundos y el log queda pending para reintentarse;
+  tras un rato sin throttling la tasa vuelve a subir de a poco hasta el máximo.
+- 131056 (PAIR_RATE_LIMIT_CODE) es un límite por destinatario: no toca la tasa
+  global, solo ese log espera (next_attempt_at, backoff exponencial).
+- Progreso: un log por tramo con enviados / fallidos / tasa real / ETA. Los
+  contadores de la campaña (campaign_counters.py) se actualizan en cada tramo.
+
+Los tramos se reclaman con FOR UPDATE SKIP LOCKED y un lease (claimed_by +
+lease_expires_at) que el sender renueva mientras envía, así varios procesos pueden
+enviar la misma campaña y, si un worker muere, sus logs vuelven a estar
+disponibles al vencer el lease; el scheduler libera los leases vencidos (en
+cualquier estado de campaña) y retoma las campañas 'sending' sin nadie enviándolas.
+Pausar / cancelar cambian el estado de la campaña: el envío se corta en el
+próximo tramo (lo que ya está en vuelo termina y se registra).
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 130429: throughput de la cuenta, 80007: rate limit de la WABA. No son errores del
+# mensaje: se reintenta con la tasa global más baja.
+THROTTLE_CODES = {130429, 80007}
+# 131056: demasiados mensajes al mismo destinatario. Solo ese destinatario espera.
+PAIR_RATE_LIMIT_CODE = 131056
+MAX_THROTTLE_RETRIES = 3          # reintentos por log antes de marcarlo failed
+RECOVERY_SECONDS = 30             # tiempo sin throttling para volver a subir la tasa
+
+
+class TokenBucket:
+    """Token bucket thread-safe: acquire() bloquea hasta que hay un token disponible."""
+
+    def __init__(self, rate, capacity=None):
+        self._lock = threading.Lock()
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now):
+        if now <= self._updated:
+            return  # Pausado: el reloj del bucket arranca al terminar la pausa
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+            self.capacity = max(self.rate, 1.0)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds):
+        """Nadie toma tokens durante `seconds` (y se descarta la ráfaga acumulada)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._paused_until
+
+
+class AdaptiveRate:
+    """Ajusta la tasa del bucket: mitad ante throttling, +25% tras RECOVERY_SECONDS sin throttling."""
+
+    def __init__(self, bucket, max_rate, min_rate):
+        self._lock = threading.Lock()
+        self.bucket = bucket
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self._last_throttle = 0.0
+        self._last_change = time.monotonic()
+        self.throttled = 0
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            self._last_throttle = now
+            # Los workers en vuelo reportan el mismo throttling: una sola baja por ráfaga
+            if now - self._last_change < 2:
+                return
+            self._last_change = now
+            new_rate = max(self.min_rate, self.bucket.rate / 2)
+            logger.warning(f"🐢 [CAMPAIGN] Throttling de Meta: tasa {self.bucket.rate:.1f} → {new_rate:.1f} msg/s")
+            self.bucket.set_rate(new_rate)
+        self.bucket.pause(Config.CAMPAIGN_THROTTLE_PAUSE_SECONDS)
+
+    def set_max_rate(self, max_rate):
+        """Nuevo techo (p. ej. al sumarse otro proceso a la campaña); baja la tasa actual si lo supera."""
+        with self._lock:
+            self.max_rate = max(float(max_rate), self.min_rate)
+            if self.bucket.rate > self.max_rate:
+                self.bucket.set_rate(self.max_rate)
+
+    def on_success(self):
+        if self.bucket.rate >= self.max_rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_throttle < RECOVERY_SECONDS or now - self._last_change < RECOVERY_SECONDS:
+                return
+            self._last_change = now
+            new_rate = min(self.max_rate, self.bucket.rate * 1.25)
+            logger.info(f"🐇 [CAMPAIGN] Sin throttling: tasa {self.bucket.rate:.1f} → {new_rate:.1f} msg/s")
+            self.bucket.set_rate(new_rate)
+
+
+# ── Armado de componentes y preview ──────────────────────────────────────
+
+def load_template(camp):
+    """(body_text, header_format) del template de la campaña, o (None, None) si no se encuentra."""
+    from whatsapp_service import whatsapp_api
+
+    body_text, header_format = None, None
+    try:
+        for t in whatsapp_api.get_templates().get("templates", []):
+            if t.get("name") == camp.template_name and t.get("language") == camp.template_language:
+                for comp in t.get("components", []):
+                    if comp.get("type") == "BODY":
+                        body_text = comp.get("text", "")
+                    elif comp.get("type") == "HEADER":
+                        header_format = comp.get("format")
+                break
+    except Exception as e:
+        logger.warning(f"No se pudo obtener texto del template para campaña {camp.id}: {e}")
+    return body_text, header_format
+
+
+def parse_variables(variables):
+    """Separa el mapeo de variables de la campaña en ({idx: campo} header, {idx: campo} body)."""
+    header_vars, body_vars = {}, {}
+    for key, field in (variables or {}).items():
+        if '-' in key:
+            # Formato nuevo: "body-1", "header-1"
+            comp, idx = key.split('-', 1)
+            if comp == 'header':
+                header_vars[int(idx)] = field
+            else:
+                body_vars[int(idx)] = field
+        else:
+            # Formato viejo: "1", "2" (se trata como body)
+            body_vars[int(key)] = field
+    return header_vars, body_vars
+
+
+def _field_value(field, contact, phone):
+    if field == 'phone_number':
+        return contact.phone_number if contact else phone
+    if contact:
+        val = getattr(contact, field, None)
+        if val:
+            return str(val)
+    return "-"
+
+
+def build_components(header_vars, body_vars, header_format, contact, phone):
+    """Componentes del template para un contacto (None si la campaña no usa variables)."""
+    components = []
+    if header_vars:
+        header_params = []
+        for idx in sorted(header_vars):
+            field = header_vars[idx]
+            if header_format in ('IMAGE', 'VIDEO', 'DOCUMENT'):
+                # El "campo" es la URL del archivo
+                header_params.append({"type": header_format.lower(), header_format.lower(): {"link": field}})
+            else:
+                header_params.append({"type": "text", "text": _field_value(field, contact, phone)})
+        components.append({"type": "header", "parameters": header_params})
+    if body_vars:
+        body_params = [{"type": "text", "text": _field_value(body_vars[idx], contact, phone)} for idx in sorted(body_vars)]
+        components.append({"type": "body", "parameters": body_params})
+    return components or None
+
+
+def render_preview(body_text, body_vars, contact, phone, template_name):
+    """Texto del template con las variables del contacto, para el historial del chat."""
+    if not body_text:
+        return f'[Template: {template_name}]'
+    for idx, field in body_vars.items():
+        body_text = body_text.replace(f'{{{{{idx}}}}}', _field_value(field, contact, phone))
+    return body_text
+
+
+def error_code(result):
+    """Código de error de Meta de una respuesta fallida de send_template_message (o None)."""
+    code = result.get('code')
+    if code is None and isinstance(result.get('detail'), dict):
+        code = (result['detail'].get('error') or {}).get('code')
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+# ── Claim de tramos (varios procesos por campaña) ──────────────────────
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_running_lock = threading.Lock()
+_running = set()  # campañas con un sender activo en este proceso
+
+
+def _claim_chunk(db, cid, now):
+    """
+    Reclama hasta CAMPAIGN_CHUNK_SIZE logs pending sin lease vigente (nunca tomados,
+    o de un worker que murió) y fuera de su backoff, con FOR UPDATE SKIP LOCKED. Solo si
+    la campaña está 'sending': pausar / cancelar corta el envío en el próximo tramo.
+    """
+    rows = db.session.execute(text("""
+        UPDATE whatsapp_campaign_logs l
+        SET claimed_by = :worker, lease_expires_at = :lease
+        WHERE l.id IN (
+            SELECT cl.id FROM whatsapp_campaign_logs cl
+            WHERE cl.campaign_id = :cid
+              AND cl.status = 'pending'
+              AND (cl.lease_expires_at IS NULL OR cl.lease_expires_at < :now)
+              AND (cl.next_attempt_at IS NULL OR cl.next_attempt_at <= :now)
+              AND EXISTS (SELECT 1 FROM whatsapp_campaigns c WHERE c.id = :cid AND c.status = 'sending')
+            ORDER BY cl.id
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING l.id
+    """), {
+        'cid': cid, 'now': now, 'worker': WORKER_ID, 'limit': Config.CAMPAIGN_CHUNK_SIZE,
+        'lease': now + timedelta(seconds=Config.CAMPAIGN_LEASE_SECONDS),
+    }).fetchall()
+    db.session.commit()
+    return [r[0] for r in rows]
+
+
+def _renew_lease(db, log_ids):
+    """Extiende el lease de los logs del tramo que este worker todavía tiene tomados."""
+    db.session.execute(text("""
+        UPDATE whatsapp_campaign_logs SET lease_expires_at = :lease
+        WHERE id = ANY(:ids) AND status = 'pending' AND claimed_by = :worker
+    """), {
+        'ids': log_ids, 'worker': WORKER_ID,
+        'lease': datetime.utcnow() + timedelta(seconds=Config.CAMPAIGN_LEASE_SECONDS),
+    })
+    db.session.commit()
+
+
+def _next_retry_at(db, cid, now):
+    """Próximo next_attempt_at de un log pending en backoff (None si no hay o la campaña no está 'sending')."""
+    return db.session.execute(text("""
+        SELECT MIN(cl.next_attempt_at) FROM whatsapp_campaign_logs cl
+        WHERE cl.campaign_id = :cid AND cl.status = 'pending' AND cl.next_attempt_at > :now
+          AND EXISTS (SELECT 1 FROM whatsapp_campaigns c WHERE c.id = :cid AND c.status = 'sending')
+    """), {'cid': cid, 'now': now}).scalar()
+
+
+def _active_senders(db, cid, now):
+    """Procesos con un tramo en curso de esta campaña (incluido este): la tasa se reparte entre ellos."""
+    others = db.session.execute(text("""
+        SELECT COUNT(DISTINCT claimed_by) FROM whatsapp_campaign_logs
+        WHERE campaign_id = :cid AND status = 'pending'
+          AND lease_expires_at >= :now AND claimed_by <> :worker
+    """), {'cid': cid, 'now': now, 'worker': WORKER_ID}).scalar()
+    return (others or 0) + 1
+
+
+def _finish_campaign(db, cid):
+    """
+    Sin logs para reclamar: si la campaña está 'sending' y no queda nada pending, completarla;
+    si fue cancelada, marcar 'cancelled' lo que nadie tiene tomado.
+    Devuelve el estado final de la campaña.
+    """
+    now = datetime.utcnow()
+    status = db.session.execute(text("SELECT status FROM whatsapp_campaigns WHERE id = :cid"), {'cid': cid}).scalar()
+    if status == 'cancelled':
+        cancel_pending_logs(db, cid)
+    elif status == 'sending':
+        db.session.execute(text("""
+            UPDATE whatsapp_campaigns SET status = 'completed', completed_at = :now
+            WHERE id = :cid AND status = 'sending'
+              AND NOT EXISTS (
+                  SELECT 1 FROM whatsapp_campaign_logs WHERE campaign_id = :cid AND status = 'pending'
+              )
+        """), {'cid': cid, 'now': now})
+        status = db.session.execute(text("SELECT status FROM whatsapp_campaigns WHERE id = :cid"), {'cid': cid}).scalar()
+    db.session.commit()
+    return status
+
+
+def cancel_pending_logs(db, cid):
+    """Marca 'cancelled' los logs pending que ningún worker tiene tomados (los tramos en vuelo terminan solos)."""
+    now = datetime.utcnow()
+    return db.session.execute(text("""
+        UPDATE whatsapp_campaign_logs
+        SET status = 'cancelled', claimed_by = NULL, lease_expires_at = NULL
+        WHERE campaign_id = :cid AND status = 'pending'
+          AND (lease_expires_at IS NULL OR lease_expires_at < :now)
+    """), {'cid': cid, 'now': now}).rowcount
+
+
+def start_sender(app, cid):
+    """Lanza el sender de la campaña en un thread de este proceso, si no hay uno corriendo ya."""
+    with _running_lock:
+        if cid in _running:
+            return False
+        _running.add(cid)
+
+    def _run():
+        try:
+            send_campaign(app.app_context(), cid)
+        except Exception as e:
+            logger.error(f"❌ [CAMPAIGN] Sender de la campaña {cid} terminó con error: {e}")
+        finally:
+            with _running_lock:
+                _running.discard(cid)
+
+    t = threading.Thread(target=_run, name=f"campaign-sender-{cid}")
+    t.daemon = True
+    t.start()
+    return True
+
+
+def release_stale_leases(db, now):
+    """
+    Libera los leases vencidos de logs pending en cualquier estado de campaña (un worker
+    murió con el tramo tomado); en campañas canceladas esos logs pasan a 'cancelled'.
+    """
+    cancelled = db.session.execute(text("""
+        UPDATE whatsapp_campaign_logs cl
+        SET status = 'cancelled', claimed_by = NULL, lease_expires_at = NULL
+        FROM whatsapp_campaigns c
+        WHERE c.id = cl.campaign_id AND c.status = 'cancelled'
+          AND cl.status = 'pending' AND (cl.lease_expires_at IS NULL OR cl.lease_expires_at < :now)
+    """), {'now': now}).rowcount
+    released = db.session.execute(text("""
+        UPDATE whatsapp_campaign_logs SET claimed_by = NULL, lease_expires_at = NULL
+        WHERE status = 'pending' AND lease_expires_at < :now
+    """), {'now': now}).rowcount
+    db.session.commit()
+    if cancelled or released:
+        logger.info(f"🧹 [CAMPAIGN] Leases vencidos: {released} logs liberados, {cancelled} cancelados")
+
+
+def resume_orphaned_campaigns(app):
+    """
+    Scheduler: libera leases vencidos y retoma las campañas 'sending' con logs pending
+    sin lease vigente y fuera de su backoff (nadie las está enviando, p. ej. el worker
+    se reinició). Este proceso se suma al envío.
+    """
+    with app.app_context():
+        from models import db
+        release_stale_leases(db, datetime.utcnow())
+        cids = [r[0] for r in db.session.execute(text("""
+            SELECT c.id FROM whatsapp_campaigns c
+            WHERE c.status = 'sending'
+              AND EXISTS (
+                  SELECT 1 FROM whatsapp_campaign_logs cl
+                  WHERE cl.campaign_id = c.id AND cl.status = 'pending'
+                    AND (cl.lease_expires_at IS NULL OR cl.lease_expires_at < :now)
+                    AND (cl.next_attempt_at IS NULL OR cl.next_attempt_at <= :now)
+              )
+        """), {'now': datetime.utcnow()})]
+        db.session.rollback()
+    for cid in cids:
+        if start_sender(app, cid):
+            logger.info(f"♻️ [CAMPAIGN] Retomando campaña {cid} (logs pending sin worker)")
+
+
+# ── Envío ────────────────────────────────────────────────────────────────
+
+def _send_one(job, camp_template, bucket, limiter):
+    """Corre en un worker: espera un token y envía (sin tocar la BD)."""
+    from whatsapp_service import whatsapp_api
+
+    bucket.acquire()
+    try:
+        result = whatsapp_api.send_template_message(
+            job['phone'], camp_template[0], camp_template[1], components=job['components']
+        )
+    except Exception as e:
+        result = {'error': str(e)}
+    if result.get('success'):
+        limiter.on_success()
+    elif error_code(result) in THROTTLE_CODES:
+        limiter.on_throttle()
+    return job, result
+
+
+def insert_template_messages(db, messages):
+    """
+    Inserta en el historial los templates enviados (dicts wa_id, phone, content,
+    template_name, template_language) con un solo INSERT. Sin commit.
+    """
+    if not messages:
+        return
+    # Puede existir un placeholder creado por un estado que llegó antes (save_statuses)
+    db.session.execute(text("""
+        INSERT INTO whatsapp_messages
+            (wa_message_id, phone_number, direction, message_type, content, template_name, template_language, timestamp)
+        SELECT v.wa_id, v.phone, 'outbound', 'template', v.content, v.tpl_name, v.tpl_lang, :now
+        FROM unnest(CAST(:ids AS varchar[]), CAST(:phones AS varchar[]), CAST(:contents AS text[]),
+                    CAST(:tpl_names AS varchar[]), CAST(:tpl_langs AS varchar[]))
+             AS v(wa_id, phone, content, tpl_name, tpl_lang)
+        ON CONFLICT (wa_message_id) DO UPDATE SET
+            message_type = 'template',
+            content = EXCLUDED.content,
+            template_name = EXCLUDED.template_name,
+            template_language = EXCLUDED.template_language,
+            phone_number = CASE WHEN whatsapp_messages.phone_number IN ('outbound', 'unknown')
+                                THEN EXCLUDED.phone_number ELSE whatsapp_messages.phone_number END
+    """), {
+        'ids': [m['wa_id'] for m in messages],
+        'phones': [m['phone'] for m in messages],
+        'contents': [m['content'] for m in messages],
+        'tpl_names': [m['template_name'] for m in messages],
+        'tpl_langs': [m['template_language'] for m in messages],
+        'now': datetime.utcnow(),
+    })
+
+
+def _write_results(db, camp, log_results, messages, released):
+    """
+    Persiste en una transacción los envíos que acaban de volver: historial de mensajes,
+    resultado de cada log y liberación del lease de los que quedan pending por
+    throttling (dicts id, next_attempt_at) para reintentarlos.
+    """
+    insert_template_messages(db, [
+        dict(m, template_name=camp.template_name, template_language=camp.template_language) for m in messages
+    ])
+
+    if log_results:
+        # Si el webhook ya trajo delivered / read / failed para el mensaje, el log arranca ahí
+        updated = db.session.execute(text("""
+            UPDATE whatsapp_campaign_logs cl
+            SET status = CASE WHEN v.status = 'sent' AND m.status IN ('delivered', 'read', 'failed')
+                              THEN m.status ELSE v.status END,
+                message_id = v.message_id,
+                error_detail = v.error_detail,
+                claimed_by = NULL,
+                lease_expires_at = NULL
+            FROM unnest(CAST(:ids AS integer[]), CAST(:statuses AS varchar[]),
+                        CAST(:message_ids AS varchar[]), CAST(:errors AS text[]))
+                 AS v(id, status, message_id, error_detail)
+            LEFT JOIN whatsapp_messages m ON m.wa_message_id = v.message_id
+            WHERE cl.id = v.id AND cl.status = 'pending' AND cl.claimed_by = :worker
+        """), {
+            'ids': [r['id'] for r in log_results],
+            'statuses': [r['status'] for r in log_results],
+            'message_ids': [r['message_id'] for r in log_results],
+            'errors': [r['error_detail'] for r in log_results],
+            'worker': WORKER_ID,
+        }).rowcount
+        if updated < len(log_results):
+            # El lease venció y otro worker (o la cancelación) tomó esos logs: no se pisan
+            logger.warning(f"⚠️ [CAMPAIGN] Campaña {camp.id}: {len(log_results) - updated} logs ya no son de "
+                           f"este worker, no se actualizan")
+
+    if released:
+        db.session.execute(text("""
+            UPDATE whatsapp_campaign_logs cl
+            SET claimed_by = NULL, lease_expires_at = NULL,
+                retry_count = cl.retry_count + 1, next_attempt_at = v.next_attempt_at
+            FROM unnest(CAST(:ids AS integer[]), CAST(:next_attempts AS timestamp[]))
+                 AS v(id, next_attempt_at)
+            WHERE cl.id = v.id AND cl.status = 'pending' AND cl.claimed_by = :worker
+        """), {
+            'ids': [r['id'] for r in released],
+            'next_attempts': [r['next_attempt_at'] for r in released],
+            'worker': WORKER_ID,
+        })
+    db.session.commit()
+
+
+def send_campaign(app_context, cid):
+    """
+    Envía logs pending de una campaña reclamándolos por tramos. Pueden correr varios
+    procesos sobre la misma campaña; el último en quedarse sin logs la completa.
+    """
+    with app_context:
+        from models import db, Campaign, CampaignLog, Contact
+
+        camp = db.session.get(Campaign, cid)
+        if not camp:
+            return
+
+        body_text, header_format = load_template(camp)
+        header_vars, body_vars = parse_variables(camp.variables)
+        camp_template = (camp.template_name, camp.template_language)
+
+        bucket = TokenBucket(Config.CAMPAIGN_SEND_RATE)
+        limiter = AdaptiveRate(bucket, Config.CAMPAIGN_SEND_RATE, Config.CAMPAIGN_MIN_SEND_RATE)
+        total_sent = total_failed = 0
+        started = time.monotonic()
+        remaining = CampaignLog.query.filter_by(campaign_id=cid, status='pending').count()
+        db.session.rollback()
+        logger.info(f"🚀 [CAMPAIGN] Campaña {cid}: {remaining} envíos pendientes, worker {WORKER_ID}, "
+                    f"hasta {bucket.rate:.0f} msg/s con {Config.CAMPAIGN_SEND_WORKERS} workers")
+
+        with ThreadPoolExecutor(max_workers=Config.CAMPAIGN_SEND_WORKERS,
+                                thread_name_prefix=f"campaign-{cid}") as pool:
+            while True:
+                now = datetime.utcnow()
+                log_ids = _claim_chunk(db, cid, now)
+                if not log_ids:
+                    # Quedan destinatarios en backoff (131056): esperarlos en vez de abandonar la campaña
+                    retry_at = _next_retry_at(db, cid, now)
+                    db.session.rollback()
+                    if retry_at is None:
+                        break
+                    time.sleep(min(max((retry_at - now).total_seconds(), 1), 30))
+                    continue
+
+                # La tasa de la campaña se reparte entre los procesos que la están enviando
+                limiter.set_max_rate(Config.CAMPAIGN_SEND_RATE / _active_senders(db, cid, now))
+
+                rows = db.session.query(CampaignLog, Contact).outerjoin(
+                    Contact, CampaignLog.contact_id == Contact.id
+                ).filter(CampaignLog.id.in_(log_ids)).order_by(CampaignLog.id).all()
+
+                # Armar los envíos en este thread: los workers no usan la sesión de SQLAlchemy
+                jobs = []
+                for log, contact in rows:
+                    jobs.append({
+                        'log_id': log.id,
+                        'retries': log.retry_count or 0,
+                        'phone': log.contact_phone,
+                        'components': build_components(header_vars, body_vars, header_format, contact, log.contact_phone),
+                        'content': render_preview(body_text, body_vars if camp.variables else {}, contact,
+                                                  log.contact_phone, camp.template_name),
+                    })
+                db.session.rollback()  # No retener la transacción de lectura mientras se envía
+
+                # Cada resultado se escribe apenas vuelve su envío (no al cerrar el tramo)
+                pending = {pool.submit(_send_one, job, camp_template, bucket, limiter) for job in jobs}
+                renew_every = Config.CAMPAIGN_LEASE_SECONDS / 3
+                renewed = time.monotonic()
+                while pending:
+                    done, pending = wait(pending, timeout=renew_every, return_when=FIRST_COMPLETED)
+                    if pending and time.monotonic() - renewed >= renew_every:
+                        # Throttling / pausas pueden estirar el tramo más allá del lease
+                        _renew_lease(db, log_ids)
+                        renewed = time.monotonic()
+                    log_results, messages, released = [], [], []
+                    for future in done:
+                        job, result = future.result()
+                        if result.get('success'):
+                            total_sent += 1
+                            wa_id = result.get('message_id')
+                            log_results.append({'id': job['log_id'], 'status': 'sent', 'message_id': wa_id, 'error_detail': None})
+                            if wa_id:
+                                messages.append({'wa_id': wa_id, 'phone': job['phone'], 'content': job['content']})
+                            continue
+                        code = error_code(result)
+                        if (code in THROTTLE_CODES or code == PAIR_RATE_LIMIT_CODE) and job['retries'] < MAX_THROTTLE_RETRIES:
+                            # Queda pending: se reintenta en otro tramo; ante 131056 solo ese destinatario espera
+                            next_attempt_at = None
+                            if code == PAIR_RATE_LIMIT_CODE:
+                                backoff = Config.CAMPAIGN_PAIR_BACKOFF_SECONDS * (2 ** job['retries'])
+                                next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff)
+                            released.append({'id': job['log_id'], 'next_attempt_at': next_attempt_at})
+                            continue
+                        total_failed += 1
+                        log_results.append({'id': job['log_id'], 'status': 'failed', 'message_id': None,
+                                            'error_detail': str(result.get('error') or result)})
+                    if done:
+                        _write_results(db, camp, log_results, messages, released)
+
+                elapsed = time.monotonic() - started
+                done = total_sent + total_failed
+                rate = done / elapsed if elapsed > 0 else 0
+                left = max(remaining - done, 0)
+                eta = f"{left / rate / 60:.1f} min" if rate > 0 else "?"
+                logger.info(f"📊 Campaña {cid}: Tramo procesado. Enviados: {total_sent}, Fallidos: {total_failed}, "
+                            f"Throttling: {limiter.throttled} — {rate:.1f} msg/s, restan ~{left} (ETA {eta})")
+
+        status = _finish_campaign(db, cid)
+        if status == 'completed':
+            try:
+                from campaign_metrics import refresh_campaign
+                refresh_campaign(cid)
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"No se pudieron calcular las respuestas de la campaña {cid}: {e}")
+        elapsed = time.monotonic() - started
+        logger.info(f"✅ Campaña {cid}: worker {WORKER_ID} terminó ({status}). Enviados: {total_sent}, "
+                    f"fallidos: {total_failed} en {elapsed / 60:.1f} min")
@@ -40,3 +40,67 @@ class Config:
     VAPID_PUBLIC_KEY = os.getenv("VAPID_PUBLIC_KEY")
     VAPID_PRIVATE_KEY = os.getenv("VAPID_PRIVATE_KEY")  # base64url raw scalar
     VAPID_EMAIL = os.getenv("VAPID_EMAIL", "admin@example.com")
+
+    # Webhook inbox (cola durable de eventos de Meta)
+    WEBHOOK_INBOX_PARTITIONS = int(os.getenv("WEBHOOK_INBOX_PARTITIONS", 4))   # consumidores en paralelo (por hash de teléfono)
+    WEBHOOK_INBOX_BATCH = int(os.getenv("WEBHOOK_INBOX_BATCH", 50))            # filas reclamadas por vuelta
+    WEBHOOK_INBOX_POLL_SECONDS = float(os.getenv("WEBHOOK_INBOX_POLL_SECONDS", 1.0))
+    WEBHOOK_INBOX_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_INBOX_MAX_ATTEMPTS", 5))
+    WEBHOOK_INBOX_RETENTION_DAYS = int(os.getenv("WEBHOOK_INBOX_RETENTION_DAYS", 7))
+    WEBHOOK_INBOX_FAILED_RETENTION_DAYS = int(os.getenv("WEBHOOK_INBOX_FAILED_RETENTION_DAYS", 30))  # eventos descartados (para diagnóstico)
+
+    # Pipeline de media entrante
+    MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", 4))       # descargas simultáneas por proceso
+    MEDIA_DOWNLOAD_MAX_RETRIES = int(os.getenv("MEDIA_DOWNLOAD_MAX_RETRIES", 4))
+    MEDIA_CHUNK_SIZE_MB = int(os.getenv("MEDIA_CHUNK_SIZE_MB", 8))             # tamaño de parte del multipart (mín. 5)
+
+    # Reenvío al chatbot de n8n
+    N8N_DEBOUNCE_SECONDS = float(os.getenv("N8N_DEBOUNCE_SECONDS", 4))          # silencio que cierra una ráfaga de mensajes
+    N8N_DEBOUNCE_MAX_SECONDS = float(os.getenv("N8N_DEBOUNCE_MAX_SECONDS", 15))  # espera máxima desde el primer mensaje
+    N8N_MEDIA_HOLD_SECONDS = float(os.getenv("N8N_MEDIA_HOLD_SECONDS", 60))      # cuánto se espera un adjunto en descarga
+    N8N_FORWARD_WORKERS = int(os.getenv("N8N_FORWARD_WORKERS", 2))
+    N8N_FORWARD_QUEUE_SIZE = int(os.getenv("N8N_FORWARD_QUEUE_SIZE", 1000))
+    N8N_FORWARD_MAX_RETRIES = int(os.getenv("N8N_FORWARD_MAX_RETRIES", 5))
+
+    # Visibilidad por etiquetas (agentes restringidos)
+    VISIBILITY_CACHE_TTL = float(os.getenv("VISIBILITY_CACHE_TTL", 15))        # segundos que se recuerda "usuario X ve el teléfono Y"
+    AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 30))                    # segundos sin re-validar usuario/permisos en cada request
+
+    # Envío de campañas
+    CAMPAIGN_SEND_RATE = float(os.getenv("CAMPAIGN_SEND_RATE", 20))             # mensajes/s máximos (según el tier de Meta)
+    CAMPAIGN_MIN_SEND_RATE = float(os.getenv("CAMPAIGN_MIN_SEND_RATE", 1))      # piso al bajar la tasa por throttling
+    CAMPAIGN_SEND_WORKERS = int(os.getenv("CAMPAIGN_SEND_WORKERS", 8))          # envíos HTTP simultáneos
+    CAMPAIGN_CHUNK_SIZE = int(os.getenv("CAMPAIGN_CHUNK_SIZE", 200))            # logs reclamados por tramo
+    CAMPAIGN_THROTTLE_PAUSE_SECONDS = float(os.getenv("CAMPAIGN_THROTTLE_PAUSE_SECONDS", 5))  # pausa global ante 130429 / 80007
+    CAMPAIGN_PAIR_BACKOFF_SECONDS = float(os.getenv("CAMPAIGN_PAIR_BACKOFF_SECONDS", 60))     # espera del destinatario ante 131056 (se duplica por reintento)
+    CAMPAIGN_LEASE_SECONDS = int(os.getenv("CAMPAIGN_LEASE_SECONDS", 120))      # se renueva mientras se envía; vencido, otro worker retoma el tramo
+
+    # Scheduler (jobs periódicos con un solo líder entre procesos, ver scheduler.py)
+    SCHEDULER_ENABLED = str(os.getenv("SCHEDULER_ENABLED", "true")).lower() == "true"   # false: este proceso no compite por el liderazgo
+    SCHEDULER_HEARTBEAT_SECONDS = float(os.getenv("SCHEDULER_HEARTBEAT_SECONDS", 10))   # chequeo de la conexión del lock del líder
+    SCHEDULER_STANDBY_SECONDS = float(os.getenv("SCHEDULER_STANDBY_SECONDS", 15))       # cada cuánto reintenta un proceso que no es líder
+    SCHEDULER_JITTER_SECONDS = float(os.getenv("SCHEDULER_JITTER_SECONDS", 5))          # jitter por defecto de cada job
+
+    # Envío de seguimientos (follow-ups)
+    FOLLOWUP_BATCH_SIZE = int(os.getenv("FOLLOWUP_BATCH_SIZE", 200))            # enrollments reclamados por lote
+    FOLLOWUP_SEND_WORKERS = int(os.getenv("FOLLOWUP_SEND_WORKERS", 8))          # envíos HTTP simultáneos
+    FOLLOWUP_SEND_RATE = float(os.getenv("FOLLOWUP_SEND_RATE", 10))             # mensajes/s máximos (se suma a las campañas)
+    FOLLOWUP_LEASE_SECONDS = int(os.getenv("FOLLOWUP_LEASE_SECONDS", 600))      # vencido, un enrollment 'processing' se retoma
+
+    # Llamadas a OpenAI del categorizador y el auto tagger (ver llm_client.py)
+    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")                             # servidor compatible (ej: stub local); vacío = OpenAI
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4))              # llamadas en vuelo por proceso
+    LLM_RPM = int(os.getenv("LLM_RPM", 300))                                    # requests por minuto (0 = sin límite)
+    LLM_TPM = int(os.getenv("LLM_TPM", 150000))                                 # tokens por minuto (0 = sin límite)
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 4))                      # reintentos ante 429 / 5xx / timeout
+    LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 60))
+
+    # Auto tagger: decisiones guardadas en auto_tag_evaluations
+    AUTO_TAG_EVALUATION_RETENTION_DAYS = int(os.getenv("AUTO_TAG_EVALUATION_RETENTION_DAYS", 90))  # se purgan y no se re-evalúan mensajes más viejos
+    COMBINED_ANALYSIS_ENABLED = str(os.getenv("COMBINED_ANALYSIS_ENABLED", "true")).lower() == "true"  # reglas del auto tagger en la llamada del categorizador
+
+    # Clasificador local antes de OpenAI (ver local_classifier.py)
+    LOCAL_CLASSIFIER_ENABLED = str(os.getenv("LOCAL_CLASSIFIER_ENABLED", "true")).lower() == "true"
+    LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", 0.85))   # confianza mínima para no llamar a la IA
+    LOCAL_CLASSIFIER_RETRAIN_HOURS = float(os.getenv("LOCAL_CLASSIFIER_RETRAIN_HOURS", 24))
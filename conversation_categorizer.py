@@ -2,132 +2,555 @@
 Conversation Categorizer Service
 Detects inactive conversations and categorizes them using OpenAI.
 Sessions are separated by 30+ minute gaps between messages.
+
+Incremental: categorizer_state keeps, per phone, the last message seen and the
+start of the open session ("tail"). Each cycle reads only the messages whose
+row_version is past the 'categorizer' watermark and at most the settled version
+(see message_versions.py; nothing below it can still appear) and applies them in order: a gap closes the tail (categorized right away if it had
+new messages), otherwise the tail grows. Idle tails with new messages are then
+categorized loading only [tail_started_at, last_message_at]. Work per cycle
+depends on what changed, not on the size of the history.
+
+A closed session whose call came back empty is kept in categorizer_pending_ranges
+(the state and watermark still move on) and retried every cycle until it is
+resolved, the same way dirty tails are.
+
+The first run (no watermark) builds the state from CATEGORIZATION_START_DATE.
+
+OpenAI calls go through llm_client: sessions are prepared (DB reads, prompt) in
+the job thread, sent in parallel up to LLM_MAX_CONCURRENCY, and results are
+written back sequentially in the job thread.
+
+Combined pass (COMBINED_ANALYSIS_ENABLED): when a session contains the contact's
+last inbound message and active AutoTagRules are pending for it, their yes/no
+questions go in the same call ('analysis'). The session, tags, AutoTagLog rows,
+evaluations and follow-up enrollments are written in one transaction. To make
+this the common case, idle tails wait for the longest rule inactivity that fits
+in a session (<= SESSION_GAP_MINUTES); the auto tagger leaves those rules to us
+while the tail is pending. Saved calls/tokens are reported in llm_client metrics.
+
+Before the call, local_classifier settles trivial sessions (greetings, thanks,
+a short reply to a campaign) whose topic it predicts with enough confidence.
 """
-import os
 import logging
 import json
+import re
 from datetime import datetime, timedelta
-from openai import OpenAI
-
-logger = logging.getLogger(__name__)
+from sqlalchemy import text
 
-# Initialize OpenAI client
-client = None
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+import llm_client
+import local_classifier
+from message_versions import settled_version
 
-if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    logger.info("OpenAI client initialized for conversation categorization")
-else:
-    logger.warning("OPENAI_API_KEY not set - conversation categorization disabled")
+logger = logging.getLogger(__name__)
 
 # Configuration
 INACTIVITY_MINUTES = 15  # Wait time before categorizing
 SESSION_GAP_MINUTES = 30  # Gap between messages to consider separate sessions
 CATEGORIZATION_START_DATE = datetime(2026, 2, 3, 23, 0, 0)  # Only categorize from this date onwards
+LOCK_KEY = 71010
+WATERMARK_NAME = 'categorizer'
+INGEST_BATCH = 5000  # Messages read per batch
+PENDING_RANGES_LIMIT = 500  # Closed sessions retried per cycle
+CATEGORIZE_CHUNK = 50  # Sessions prepared (messages loaded) per parallel round
+BOOTSTRAP_PHONES_CHUNK = 100  # Phones per batch in the first run
+
+SYSTEM_PROMPT = ("Eres un analizador experto de conversaciones de atención al cliente. "
+                 "Tu trabajo es clasificar conversaciones con alta precisión, evitando falsos positivos. "
+                 "Sé muy selectivo al marcar conversaciones que requieren asistencia humana. "
+                 "Responde siempre en JSON válido.")
+
+
+def combined_analysis_active():
+    """La pasada combinada corre si está habilitada y hay temas (sin temas el categorizador no corre)."""
+    from config import Config
+    from models import ConversationTopic
 
+    return Config.COMBINED_ANALYSIS_ENABLED and ConversationTopic.query.first() is not None
 
-def run_categorization(app_context, force_phone=None):
+
+def combined_wait_minutes(rules, inactivity_minutes=INACTIVITY_MINUTES):
+    """Inactividad con la que se analizan las colas abiertas: cubre las reglas que caben en una sesión."""
+    fitting = [r.inactivity_minutes or 30 for r in rules if (r.inactivity_minutes or 30) <= SESSION_GAP_MINUTES]
+    return max([inactivity_minutes] + fitting)
+
+
+def is_running(db):
+    """True si algún proceso tiene el lock del categorizador (hay un ciclo en curso)."""
+    return db.session.execute(text("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_locks
+            WHERE locktype = 'advisory' AND granted AND classid = 0 AND objid = :key AND objsubid = 1
+        )
+    """), {'key': LOCK_KEY}).scalar()
+
+
+def run_categorization(app_context, force_phone=None, inactivity_minutes=INACTIVITY_MINUTES):
     """Main categorization job - runs periodically.
     Args:
         app_context: Flask app context
         force_phone: If set, only categorize this phone number
+        inactivity_minutes: Idle time before a tail is categorized (0 when forced from the panel)
+    Returns:
+        "busy" if another cycle holds the lock, "skipped" without API key, otherwise "done"
     """
-    if not client:
-        logger.warning("⚠️ [CATEGORIZER] OpenAI client not initialized - skipping")
-        return
-    
+    if not llm_client.is_configured():
+        logger.warning("⚠️ [CATEGORIZER] OPENAI_API_KEY not set - skipping")
+        return "skipped"
+
     with app_context:
-        from models import db, Message, ConversationTopic, ConversationSession
-        
-        try:
-            logger.info(f"🔄 [CATEGORIZER] Job started (inactivity={INACTIVITY_MINUTES}min, session_gap={SESSION_GAP_MINUTES}min, start_date={CATEGORIZATION_START_DATE})")
-            
-            # Find all topics for prompt
-            topics = ConversationTopic.query.all()
-            if not topics:
-                logger.warning("⚠️ [CATEGORIZER] No topics configured - skipping")
-                return
-            
-            logger.info(f"📋 [CATEGORIZER] {len(topics)} topics loaded: {[t.name for t in topics]}")
-            
-            cutoff_time = datetime.utcnow() - timedelta(minutes=INACTIVITY_MINUTES)
-            
-            # Get distinct phone numbers with activity since start date
-            phones_q = db.session.query(
-                Message.phone_number
-            ).filter(
-                Message.phone_number.notin_(['unknown', 'outbound', '']),
-                Message.timestamp >= CATEGORIZATION_START_DATE
-            )
-            if force_phone:
-                phones_q = phones_q.filter(Message.phone_number == force_phone)
-            phones_query = phones_q.distinct().all()
-            
-            total_phones = len(phones_query)
-            total_categorized = 0
-            total_skipped_active = 0
-            total_skipped_existing = 0
-            total_skipped_few_msgs = 0
-            
-            logger.info(f"📱 [CATEGORIZER] Found {total_phones} phones with activity since {CATEGORIZATION_START_DATE}")
-            
-            for (phone,) in phones_query:
-                # Get all messages for this phone since start date
-                messages = Message.query.filter(
-                    Message.phone_number == phone,
-                    Message.timestamp >= CATEGORIZATION_START_DATE
-                ).order_by(Message.timestamp).all()
-                
-                if len(messages) < 2:
-                    total_skipped_few_msgs += 1
-                    logger.debug(f"  ⏭️ [CATEGORIZER] {phone}: only {len(messages)} msg(s) - skipping")
-                    continue
-                
-                # Split into sessions based on time gaps
-                sessions = split_into_sessions(messages)
-                logger.debug(f"  📞 [CATEGORIZER] {phone}: {len(messages)} msgs → {len(sessions)} session(s)")
-                
-                for idx, session_msgs in enumerate(sessions):
-                    # Permitir sesiones de 1 mensaje si tiene al menos un inbound
-                    # (ej: respuesta solitaria a una campaña que quedó en sesión separada)
-                    has_inbound = any(m.direction == 'inbound' for m in session_msgs)
-                    if len(session_msgs) < 2 and not has_inbound:
-                        total_skipped_few_msgs += 1
-                        continue
-                    
-                    session_start = session_msgs[0].timestamp
-                    session_end = session_msgs[-1].timestamp
-                    
-                    # Only categorize if session ended >15 min ago (inactive)
-                    if session_end >= cutoff_time:
-                        total_skipped_active += 1
-                        logger.debug(f"  ⏳ [CATEGORIZER] {phone} session {idx+1}: still active (last msg {session_end}) - skipping")
-                        continue
-                    
-                    # Check if this session was already categorized
-                    existing = ConversationSession.query.filter(
-                        ConversationSession.phone_number == phone,
-                        ConversationSession.started_at == session_start,
-                        ConversationSession.ended_at == session_end
-                    ).first()
-                    
-                    if existing:
-                        total_skipped_existing += 1
-                        continue
-                    
-                    # Categorize this session
-                    logger.info(f"  🤖 [CATEGORIZER] {phone} session {idx+1}: categorizing {len(session_msgs)} msgs ({session_start} → {session_end})")
-                    categorize_conversation(
-                        db, phone, session_msgs, topics,
-                        session_start, session_end
-                    )
-                    total_categorized += 1
-            
-            logger.info(f"✅ [CATEGORIZER] Job complete: {total_phones} phones | {total_categorized} categorized | {total_skipped_existing} already done | {total_skipped_active} still active | {total_skipped_few_msgs} too few msgs")
-                
-        except Exception as e:
-            logger.error(f"❌ [CATEGORIZER] Error in categorization job: {e}", exc_info=True)
+        from models import db
+
+        with db.engine.connect() as lock_conn:
+            # Scheduler y clasificación forzada desde el panel no corren a la vez: el que llega segundo no espera
+            acquired = lock_conn.execute(text(f"SELECT pg_try_advisory_lock({LOCK_KEY})")).scalar()
+            lock_conn.commit()
+            if not acquired:
+                logger.info("⏭️ [CATEGORIZER] Another cycle is running - skipping")
+                return "busy"
+            try:
+                _run_cycle(app_context.app, db, force_phone, inactivity_minutes)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"❌ [CATEGORIZER] Error in categorization job: {e}", exc_info=True)
+            finally:
+                lock_conn.rollback()
+                lock_conn.execute(text(f"SELECT pg_advisory_unlock({LOCK_KEY})"))
+                lock_conn.commit()
+        return "done"
+
+
+def _run_cycle(app, db, force_phone, inactivity_minutes):
+    from config import Config
+    from models import ConversationTopic, AutoTagRule
+
+    topics = ConversationTopic.query.all()
+    if not topics:
+        logger.warning("⚠️ [CATEGORIZER] No topics configured - skipping")
+        return
+    rules = AutoTagRule.query.filter_by(is_active=True).all() if Config.COMBINED_ANALYSIS_ENABLED else []
+
+    stats = {'categorized': 0, 'existing': 0, 'few_msgs': 0, 'combined': 0, 'local': 0}
+    if Config.LOCAL_CLASSIFIER_ENABLED:
+        # Entrena en otro thread si hace falta; este ciclo sigue con el modelo que haya
+        local_classifier.ensure_model(app)
+    watermark = db.session.execute(
+        text("SELECT value FROM rollup_watermarks WHERE name = :name"), {'name': WATERMARK_NAME}
+    ).scalar()
+    db.session.commit()
+    if watermark is None:
+        phones = _bootstrap(db, topics, rules, stats)
+    else:
+        phones = _ingest(db, watermark, topics, rules, stats)
+
+    # Sesiones cerradas que quedaron sin categorizar (respuesta vacía) en ciclos anteriores
+    retried = _retry_pending_ranges(db, topics, rules, stats, force_phone)
+
+    # Colas abiertas con cambios y sin actividad hace inactivity_minutes (o lo que pidan las reglas)
+    cutoff_time = datetime.utcnow() - timedelta(minutes=combined_wait_minutes(rules, inactivity_minutes))
+    due = db.session.execute(text(f"""
+        SELECT phone_number, tail_started_at, last_message_at FROM categorizer_state
+        WHERE tail_dirty AND last_message_at < :cutoff
+          {'AND phone_number = :phone' if force_phone else ''}
+        ORDER BY last_message_at
+    """), {'cutoff': cutoff_time, 'phone': force_phone}).fetchall()
+    db.session.commit()
+
+    for i in range(0, len(due), CATEGORIZE_CHUNK):
+        chunk = [tuple(r) for r in due[i:i + CATEGORIZE_CHUNK]]
+        done = _categorize_ranges(db, chunk, topics, rules, stats)
+        # Respuesta vacía del modelo → la cola queda sucia y se reintenta el próximo ciclo
+        settled = [r for r in chunk if r in done]
+        if settled:
+            db.session.execute(text("""
+                UPDATE categorizer_state AS s SET tail_dirty = FALSE, updated_at = :now
+                FROM unnest(CAST(:phones AS varchar[]), CAST(:ended AS timestamp[])) AS v(phone_number, ended_at)
+                WHERE s.phone_number = v.phone_number AND s.last_message_at = v.ended_at
+            """), {'phones': [r[0] for r in settled], 'ended': [r[2] for r in settled], 'now': datetime.utcnow()})
+            db.session.commit()
+
+    if phones or due or retried:
+        logger.info(f"✅ [CATEGORIZER] Cycle complete: {phones} phone(s) with new messages | {len(due)} idle tail(s) | "
+                    f"{retried} retried closed session(s) | "
+                    f"{stats['categorized']} categorized ({stats['combined']} with auto-tag rules) | {stats['local']} settled locally | "
+                    f"{stats['existing']} already done | "
+                    f"{stats['few_msgs']} too few msgs")
+
+
+def _categorize_ranges(db, ranges, topics, rules, stats):
+    """
+    Categoriza varias sesiones [(phone, started_at, ended_at)]: prepara cada una en este
+    thread, llama a OpenAI en paralelo (llm_client) y guarda los resultados acá a medida
+    que llegan. Devuelve el set de rangos resueltos (guardados, ya categorizados o con
+    muy pocos mensajes); los que tuvieron respuesta vacía quedan afuera.
+    """
+    rule_rows = _pending_rule_rows(db, {r[0] for r in ranges}, rules)
+    done = set()
+    jobs = []
+    for key in ranges:
+        job = _prepare_range(db, *key, topics, stats, rule_rows.get(key[0], []), rules)
+        if job is None:
+            done.add(key)
+        else:
+            jobs.append(job)
+    db.session.commit()  # No retener la transacción de lectura durante las llamadas a OpenAI
+    if not jobs:
+        return done
+
+    for job, result, error in llm_client.run_parallel(
+            lambda j: request_categorization(j['phone'], j['chat_messages'], j['tag_job'] is not None), jobs):
+        if error is not None:
+            logger.error(f"Error categorizing conversation for {job['phone']}: {error}")
+        elif result is None:
+            continue
+        # Error de la llamada o del JSON → fila de fallback para no reintentar para siempre
+        store_categorization(db, job['phone'], job['message_count'], topics, job['started_at'],
+                             job['ended_at'], job['existing'], result, tag_job=job['tag_job'])
+        stats['categorized'] += 1
+        done.add(job['key'])
+        if job['tag_job'] is not None and job['tag_job'].get('applied'):
+            stats['combined'] += 1
+            llm_client.record_savings('auto_tagger', calls=1, tokens=job['tag_job']['saved_tokens'])
+    return done
+
+
+def _categorize_closed(db, closed, topics, rules, stats):
+    """Categoriza sesiones cerradas y deja en categorizer_pending_ranges las no resueltas. Sin commit."""
+    unresolved = []
+    for i in range(0, len(closed), CATEGORIZE_CHUNK):
+        chunk = closed[i:i + CATEGORIZE_CHUNK]
+        done = _categorize_ranges(db, chunk, topics, rules, stats)
+        unresolved.extend(r for r in chunk if r not in done)
+    if unresolved:
+        db.session.execute(text("""
+            INSERT INTO categorizer_pending_ranges (phone_number, started_at, ended_at, attempts, created_at)
+            SELECT v.phone_number, v.started_at, v.ended_at, 1, :now
+            FROM unnest(CAST(:phones AS varchar[]), CAST(:starts AS timestamp[]), CAST(:ends AS timestamp[]))
+                 AS v(phone_number, started_at, ended_at)
+            ON CONFLICT (phone_number, started_at) DO UPDATE SET
+                ended_at = GREATEST(categorizer_pending_ranges.ended_at, EXCLUDED.ended_at)
+        """), {
+            'phones': [r[0] for r in unresolved],
+            'starts': [r[1] for r in unresolved],
+            'ends': [r[2] for r in unresolved],
+            'now': datetime.utcnow(),
+        })
+        logger.warning(f"⚠️ [CATEGORIZER] {len(unresolved)} closed session(s) without a result, retrying next cycle")
+
+
+def _retry_pending_ranges(db, topics, rules, stats, force_phone=None):
+    """Reintenta las sesiones cerradas pendientes; borra las resueltas. Devuelve cuántas se intentaron."""
+    pending = db.session.execute(text(f"""
+        SELECT phone_number, started_at, ended_at FROM categorizer_pending_ranges
+        {'WHERE phone_number = :phone' if force_phone else ''}
+        ORDER BY started_at
+        LIMIT :limit
+    """), {'phone': force_phone, 'limit': PENDING_RANGES_LIMIT}).fetchall()
+    db.session.commit()
+
+    for i in range(0, len(pending), CATEGORIZE_CHUNK):
+        chunk = [tuple(r) for r in pending[i:i + CATEGORIZE_CHUNK]]
+        done = _categorize_ranges(db, chunk, topics, rules, stats)
+        resolved = [r for r in chunk if r in done]
+        if resolved:
+            db.session.execute(text("""
+                DELETE FROM categorizer_pending_ranges p
+                USING unnest(CAST(:phones AS varchar[]), CAST(:starts AS timestamp[])) AS v(phone_number, started_at)
+                WHERE p.phone_number = v.phone_number AND p.started_at = v.started_at
+            """), {'phones': [r[0] for r in resolved], 'starts': [r[1] for r in resolved]})
+        failed = [r for r in chunk if r not in done]
+        if failed:
+            db.session.execute(text("""
+                UPDATE categorizer_pending_ranges p SET attempts = p.attempts + 1
+                FROM unnest(CAST(:phones AS varchar[]), CAST(:starts AS timestamp[])) AS v(phone_number, started_at)
+                WHERE p.phone_number = v.phone_number AND p.started_at = v.started_at
+            """), {'phones': [r[0] for r in failed], 'starts': [r[1] for r in failed]})
+        db.session.commit()
+    return len(pending)
+
+
+def _pending_rule_rows(db, phones, rules):
+    """{phone: filas de find_candidates} para la pasada combinada (vacío si no hay reglas activas)."""
+    from auto_tagger import find_candidates, earliest_message_at
+
+    if not rules or not phones:
+        return {}
+    now = datetime.utcnow()
+    by_phone = {}
+    for row in find_candidates(db, now, earliest_message_at(rules, now), phones=list(phones)):
+        by_phone.setdefault(row.phone_number, []).append(row)
+    return by_phone
+
+
+def _prepare_range(db, phone, started_at, ended_at, topics, stats, rule_rows=(), rules=()):
+    """
+    Carga solo los mensajes de la sesión [started_at, ended_at] y arma el prompt. None si no hay que categorizarla.
+    rule_rows: reglas del auto tagger pendientes para el teléfono; entran en la llamada si
+    el último mensaje entrante está en esta sesión.
+    """
+    from models import Message, ConversationSession, Contact
+
+    session_msgs = Message.query.filter(
+        Message.phone_number == phone,
+        Message.timestamp >= started_at,
+        Message.timestamp <= ended_at
+    ).order_by(Message.timestamp, Message.id).all()
+
+    # Permitir sesiones de 1 mensaje si tiene al menos un inbound
+    # (ej: respuesta solitaria a una campaña que quedó en sesión separada)
+    has_inbound = any(m.direction == 'inbound' for m in session_msgs)
+    if len(session_msgs) < 2 and not has_inbound:
+        stats['few_msgs'] += 1
+        return None
+
+    # La sesión pudo categorizarse antes con menos mensajes (la cola siguió creciendo): se actualiza esa fila
+    existing = ConversationSession.query.filter(
+        ConversationSession.phone_number == phone,
+        ConversationSession.started_at == started_at
+    ).order_by(ConversationSession.id.desc()).first()
+    if existing and (existing.ended_at == ended_at or not existing.auto_categorized):
+        stats['existing'] += 1
+        return None
+
+    tag_job = None
+    rows = [r for r in rule_rows if started_at <= r.timestamp <= ended_at]
+    if rows:
+        from auto_tagger import build_batch_prompt
+
+        rules_by_id = {r.id: r for r in rules}
+        pending_rules = [rules_by_id[r.rule_id] for r in rows if r.rule_id in rules_by_id]
+        contact = Contact.query.get(rows[0].contact_id)
+        conditions = {str(rule.id): rule.prompt_condition for rule in pending_rules}
+        tag_job = {
+            'phone': phone,
+            'contact': contact,
+            'contact_name': contact.name or phone,
+            'last_msg_id': rows[0].message_id,
+            'rules': pending_rules,
+            'conditions': conditions,
+        }
+
+    # Sesiones triviales con tema claro: se resuelven sin llamar a OpenAI
+    local_result = local_classifier.decide(session_msgs, topics, rules_pending=tag_job is not None)
+    if local_result is not None:
+        logger.info(f"  🧮 [CATEGORIZER] {phone}: settled locally ({local_result['topic']}, "
+                    f"confidence {local_result['confidence']}) — {len(session_msgs)} msgs")
+        store_categorization(db, phone, len(session_msgs), topics, started_at, ended_at, existing, local_result)
+        stats['local'] += 1
+        return None
+
+    chat_messages = build_prompt(session_msgs, topics, tag_job['conditions'] if tag_job else None)
+    if tag_job:
+        # Ahorro neto estimado: el prompt de la llamada propia del auto tagger menos lo que se
+        # agregó a este (las respuestas SI/NO cuestan lo mismo en una u otra llamada)
+        separate = llm_client.estimate_tokens(build_batch_prompt(session_msgs[-15:], tag_job['conditions'], verbose=False))
+        added = llm_client.estimate_tokens(chat_messages) - llm_client.estimate_tokens(build_prompt(session_msgs, topics))
+        tag_job['saved_tokens'] = max(separate - added, 0)
+        logger.info(f"  🤖 [CATEGORIZER] {phone}: analyzing {len(session_msgs)} msgs ({started_at} → {ended_at}) "
+                    f"+ {len(tag_job['conditions'])} auto-tag rule(s)")
+    else:
+        logger.info(f"  🤖 [CATEGORIZER] {phone}: categorizing {len(session_msgs)} msgs ({started_at} → {ended_at})")
+    return {
+        'key': (phone, started_at, ended_at),
+        'phone': phone,
+        'started_at': started_at,
+        'ended_at': ended_at,
+        'existing': existing,
+        'message_count': len(session_msgs),
+        'chat_messages': chat_messages,
+        'tag_job': tag_job,
+    }
+
+
+def _ingest(db, watermark, topics, rules, stats):
+    """
+    Aplica a categorizer_state los mensajes con row_version entre el watermark y la
+    versión asentada (por lotes, sin releer nada). Un hueco >= SESSION_GAP_MINUTES cierra la cola abierta: si tenía
+    cambios sin categorizar, se categoriza antes de guardar el estado del lote.
+    Devuelve cuántos teléfonos tuvieron mensajes nuevos.
+    """
+    # Tomada antes de leer: ninguna transacción puede escribir después una versión <= high
+    high = settled_version(db.session)
+    db.session.commit()
+    if high <= watermark:
+        return 0
+
+    after = watermark
+    touched = set()
+    while True:
+        rows = db.session.execute(text("""
+            SELECT id, phone_number, timestamp, direction, message_type, row_version
+            FROM whatsapp_messages
+            WHERE row_version > :after AND row_version <= :high
+              AND timestamp >= :start
+              AND phone_number NOT IN ('unknown', 'outbound', '')
+            ORDER BY row_version
+            LIMIT :limit
+        """), {'after': after, 'high': high, 'start': CATEGORIZATION_START_DATE, 'limit': INGEST_BATCH}).fetchall()
+        if not rows:
+            break
+        after = rows[-1].row_version
+
+        by_phone = {}
+        for r in rows:
+            by_phone.setdefault(r.phone_number, []).append(r)
+        states = _load_states(db, list(by_phone))
+        db.session.commit()  # No retener la transacción de lectura durante las llamadas a OpenAI
+
+        closed = []
+        for phone, msgs in by_phone.items():
+            state = states.get(phone)
+            for m in sorted(msgs, key=lambda r: (r.timestamp, r.id)):
+                state = _apply_message(state, m, closed, phone)
+            states[phone] = state
+            touched.add(phone)
+
+        _categorize_closed(db, closed, topics, rules, stats)
+        _save_states(db, {p: states[p] for p in by_phone})
+        _set_watermark(db, after if len(rows) == INGEST_BATCH else high)
+        db.session.commit()
+
+        if len(rows) < INGEST_BATCH:
+            break
+    return len(touched)
+
+
+def _apply_message(state, m, closed, phone):
+    """Avanza el estado de un teléfono con un mensaje (ordenados por timestamp). Los ya vistos se ignoran."""
+    if state is not None and (m.timestamp, m.id) <= (state['last_message_at'], state['last_message_id']):
+        return state
+    if state is None or state['tail_started_at'] is None:
+        tail_started_at = m.timestamp
+    else:
+        gap = (m.timestamp - state['last_message_at']).total_seconds() / 60
+        # Respuesta a un template/campaña: NO separar, sin importar cuánto tiempo pasó
+        is_campaign_response = (
+            state['last_direction'] == 'outbound'
+            and state['last_message_type'] == 'template'
+            and m.direction == 'inbound'
+        )
+        if gap >= SESSION_GAP_MINUTES and not is_campaign_response:
+            if state['tail_dirty']:
+                closed.append((phone, state['tail_started_at'], state['last_message_at']))
+            tail_started_at = m.timestamp
+        else:
+            tail_started_at = state['tail_started_at']
+    return {
+        'last_message_id': m.id,
+        'last_message_at': m.timestamp,
+        'last_direction': m.direction,
+        'last_message_type': m.message_type,
+        'tail_started_at': tail_started_at,
+        'tail_dirty': True,
+    }
+
+
+def _bootstrap(db, topics, rules, stats):
+    """
+    Primera corrida (sin watermark): arma el estado de cada teléfono desde
+    CATEGORIZATION_START_DATE con split_into_sessions y categoriza las sesiones
+    cerradas que falten. Después el job solo procesa lo nuevo.
+    """
+    high = settled_version(db.session)
+    phones = [r[0] for r in db.session.execute(text("""
+        SELECT DISTINCT phone_number FROM whatsapp_messages
+        WHERE timestamp >= :start AND phone_number NOT IN ('unknown', 'outbound', '')
+    """), {'start': CATEGORIZATION_START_DATE})]
+    db.session.commit()
+    logger.info(f"📱 [CATEGORIZER] Bootstrap: {len(phones)} phones with activity since {CATEGORIZATION_START_DATE}")
+
+    for i in range(0, len(phones), BOOTSTRAP_PHONES_CHUNK):
+        closed = []
+        states = {}
+        for phone in phones[i:i + BOOTSTRAP_PHONES_CHUNK]:
+            # Solo las columnas que necesita el corte de sesiones
+            msgs = db.session.execute(text("""
+                SELECT id, timestamp, direction, message_type FROM whatsapp_messages
+                WHERE phone_number = :phone AND timestamp >= :start
+                ORDER BY timestamp, id
+            """), {'phone': phone, 'start': CATEGORIZATION_START_DATE}).fetchall()
+            sessions = split_into_sessions(msgs)
+            if not sessions:
+                continue
+            for session_msgs in sessions[:-1]:
+                closed.append((phone, session_msgs[0].timestamp, session_msgs[-1].timestamp))
+            tail = sessions[-1]
+            states[phone] = {
+                'last_message_id': tail[-1].id,
+                'last_message_at': tail[-1].timestamp,
+                'last_direction': tail[-1].direction,
+                'last_message_type': tail[-1].message_type,
+                'tail_started_at': tail[0].timestamp,
+                'tail_dirty': True,  # Si ya estaba categorizada, _prepare_range la encuentra y no llama a OpenAI
+            }
+        db.session.commit()
+        _categorize_closed(db, closed, topics, rules, stats)
+        _save_states(db, states)
+        db.session.commit()
+
+    _set_watermark(db, high)
+    db.session.commit()
+    logger.info(f"📱 [CATEGORIZER] Bootstrap complete (watermark {high})")
+    return len(phones)
+
+
+def _load_states(db, phones):
+    rows = db.session.execute(text("""
+        SELECT phone_number, last_message_id, last_message_at, last_direction, last_message_type,
+               tail_started_at, tail_dirty
+        FROM categorizer_state WHERE phone_number = ANY(:phones)
+    """), {'phones': phones}).fetchall()
+    return {r.phone_number: {
+        'last_message_id': r.last_message_id,
+        'last_message_at': r.last_message_at,
+        'last_direction': r.last_direction,
+        'last_message_type': r.last_message_type,
+        'tail_started_at': r.tail_started_at,
+        'tail_dirty': r.tail_dirty,
+    } for r in rows}
+
+
+def _save_states(db, states):
+    """Upsert de los estados de varios teléfonos en un solo statement. Sin commit."""
+    if not states:
+        return
+    phones = list(states)
+    db.session.execute(text("""
+        INSERT INTO categorizer_state AS s
+            (phone_number, last_message_id, last_message_at, last_direction, last_message_type,
+             tail_started_at, tail_dirty, updated_at)
+        SELECT v.*, :now
+        FROM unnest(CAST(:phones AS varchar[]), CAST(:ids AS integer[]), CAST(:ats AS timestamp[]),
+                    CAST(:directions AS varchar[]), CAST(:types AS varchar[]),
+                    CAST(:starts AS timestamp[]), CAST(:dirty AS boolean[]))
+             AS v(phone_number, last_message_id, last_message_at, last_direction, last_message_type,
+                  tail_started_at, tail_dirty)
+        ON CONFLICT (phone_number) DO UPDATE SET
+            last_message_id = EXCLUDED.last_message_id,
+            last_message_at = EXCLUDED.last_message_at,
+            last_direction = EXCLUDED.last_direction,
+            last_message_type = EXCLUDED.last_message_type,
+            tail_started_at = EXCLUDED.tail_started_at,
+            tail_dirty = EXCLUDED.tail_dirty,
+            updated_at = EXCLUDED.updated_at
+    """), {
+        'phones': phones,
+        'ids': [states[p]['last_message_id'] for p in phones],
+        'ats': [states[p]['last_message_at'] for p in phones],
+        'directions': [states[p]['last_direction'] for p in phones],
+        'types': [states[p]['last_message_type'] for p in phones],
+        'starts': [states[p]['tail_started_at'] for p in phones],
+        'dirty': [states[p]['tail_dirty'] for p in phones],
+        'now': datetime.utcnow(),
+    })
+
+
+def _set_watermark(db, value):
+    db.session.execute(text("""
+        INSERT INTO rollup_watermarks (name, value, updated_at)
+        VALUES (:name, :value, :now)
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+    """), {'name': WATERMARK_NAME, 'value': value, 'now': datetime.utcnow()})
 
 
 def split_into_sessions(messages):
@@ -174,10 +597,28 @@ def split_into_sessions(messages):
     return sessions
 
 
-def categorize_conversation(db, phone, messages, topics, started_at, ended_at):
-    """Categorize a single conversation session using OpenAI."""
-    from models import ConversationSession
-    
+def categorize_conversation(db, phone, messages, topics, started_at, ended_at, existing=None):
+    """Categorize a single conversation session using OpenAI.
+    If `existing` is given (same session, categorized before it grew), it is updated in place.
+    """
+    try:
+        result = request_categorization(phone, build_prompt(messages, topics))
+    except Exception as e:
+        logger.error(f"Error categorizing conversation for {phone}: {e}")
+        result = None
+        failed = True
+    else:
+        failed = False
+        if result is None:
+            return False
+    return store_categorization(db, phone, len(messages), topics, started_at, ended_at, existing, None if failed else result)
+
+
+def build_prompt(messages, topics, conditions=None):
+    """
+    Chat messages (system + user) for one session. Runs in the caller thread (reads ORM objects).
+    conditions ({rule_id_str: prompt_condition}): auto-tag questions answered in the same call.
+    """
     # Build conversation text
     conv_lines = []
     has_bot_response = False
@@ -204,6 +645,18 @@ def categorize_conversation(db, phone, messages, topics, started_at, ended_at):
         keywords_str = ", ".join(t.keywords or [])
         topics_text += f"- {t.name}\n  Descripción: {t.description or 'Sin descripción'}\n  Palabras clave: {keywords_str}\n\n"
     
+    # Preguntas del auto tagger (pasada combinada)
+    tags_section = ""
+    tags_field = ""
+    if conditions:
+        from auto_tagger import escalation_note_for, format_conditions
+        conversation_text += escalation_note_for(messages)
+        tags_section = f"""
+PREGUNTAS PARA ETIQUETAR AL CONTACTO (respondé cada una con SÍ o NO; es importante analizarlas bien ya que según eso se etiqueta a la persona):
+{format_conditions(conditions)}
+"""
+        tags_field = ',\n  "tags": {"<id de la pregunta>": "SI|NO", ...} (una clave por cada pregunta de arriba)'
+
     # OpenAI prompt
     prompt = f"""Analiza esta conversación de WhatsApp entre un usuario y un bot de una caja de abogados y categorízala.
 
@@ -212,14 +665,14 @@ TEMAS DISPONIBLES:
 
 CONVERSACIÓN:
 {conversation_text}
-
+{tags_section}
 Responde SOLO con un JSON válido con este formato exacto:
 {{
   "topic": "nombre exacto del tema (debe coincidir exactamente con uno de los nombres de arriba) o 'Otro' si no encaja",
   "rating": "buena|neutral|mala",
   "summary": "resumen de 1-2 oraciones cortas",
   "has_unanswered_questions": true/false,
-  "needs_human_assistance": true/false
+  "needs_human_assistance": true/false{tags_field}
 }}
 
 Criterios para rating:
@@ -270,38 +723,81 @@ EJEMPLOS DE VERDADEROS POSITIVOS:
 ✅ "Necesito hablar con alguien urgente" → needs_human_assistance=true (solicitud explícita)
 ✅ "El bot no me ayuda, esto es urgente" → needs_human_assistance=true (frustración + urgencia)"""
 
-    try:
-        response = client.chat.completions.create(
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def request_categorization(phone, chat_messages, with_rules=False):
+    """
+    Calls the model through llm_client (safe to run in worker threads: no DB access).
+    Returns the parsed dict, or None if the model returned empty content (retried next cycle).
+    with_rules: combined call, on the auto tagger's model ('analysis' metrics).
+    """
+    if with_rules:
+        response = llm_client.chat(
+            'analysis', chat_messages,
+            model="gpt-5.4-mini",
+            max_completion_tokens=800,
+            response_format={"type": "json_object"}
+        )
+    else:
+        response = llm_client.chat(
+            'categorizer', chat_messages,
             model="gpt-5.4-nano",
-            messages=[
-                {"role": "system", "content": "Eres un analizador experto de conversaciones de atención al cliente. Tu trabajo es clasificar conversaciones con alta precisión, evitando falsos positivos. Sé muy selectivo al marcar conversaciones que requieren asistencia humana. Responde siempre en JSON válido."},
-                {"role": "user", "content": prompt}
-            ],
             max_completion_tokens=400,
             response_format={"type": "json_object"}
         )
 
-        result_text = (response.choices[0].message.content or "").strip()
+    result_text = (response.choices[0].message.content or "").strip()
 
-        if not result_text:
-            finish_reason = response.choices[0].finish_reason if response.choices else "unknown"
-            logger.warning(f"OpenAI returned empty content for {phone} (finish_reason={finish_reason}), skipping session")
-            return
+    if not result_text:
+        finish_reason = response.choices[0].finish_reason if response.choices else "unknown"
+        logger.warning(f"OpenAI returned empty content for {phone} (finish_reason={finish_reason}), skipping session")
+        return None
 
-        # Clean JSON if wrapped in markdown
-        import re
-        if "```" in result_text:
-            match = re.search(r"```(?:json)?\s*(.*?)\s*```", result_text, re.DOTALL | re.IGNORECASE)
-            if match:
-                result_text = match.group(1).strip()
-            else:
-                result_text = result_text.replace("```json", "").replace("```", "").strip()
+    # Clean JSON if wrapped in markdown
+    if "```" in result_text:
+        match = re.search(r"```(?:json)?\s*(.*?)\s*```", result_text, re.DOTALL | re.IGNORECASE)
+        if match:
+            result_text = match.group(1).strip()
+        else:
+            result_text = result_text.replace("```json", "").replace("```", "").strip()
 
-        if not result_text:
-            raise ValueError("Empty response after cleaning markdown")
+    if not result_text:
+        raise ValueError("Empty response after cleaning markdown")
 
-        result = json.loads(result_text)
-        
+    return json.loads(result_text)
+
+
+def store_categorization(db, phone, message_count, topics, started_at, ended_at, existing, result, tag_job=None):
+    """
+    Saves the session (result=None → fallback row so the session is not retried forever).
+    With tag_job (combined pass) the auto-tag decisions are applied in the same transaction;
+    if that fails, or the model did not answer a rule ("tags" missing or not an object),
+    nothing is persisted for those rules and they are left to the auto tagger.
+    Runs in the caller thread. Returns True when a row was written.
+    """
+    if result is None:
+        try:
+            db.session.rollback()
+            # Create a fallback session to prevent infinite retry loops
+            _store_session(db, existing, phone, started_at, ended_at, message_count,
+                           topic_id=None,
+                           rating="neutral",
+                           summary="Error en categorización automática",
+                           has_unanswered_questions=False,
+                           escalated_to_human=False)
+            db.session.commit()
+            logger.info(f"Saved fallback session for {phone} to prevent retry loop.")
+            return True
+        except Exception as db_e:
+            db.session.rollback()
+            logger.error(f"Failed to save fallback session for {phone}: {db_e}")
+            return False
+
+    try:
         # Find matching topic
         topic_id = None
         topic_name = result.get("topic", "Otro")
@@ -312,21 +808,13 @@ EJEMPLOS DE VERDADEROS POSITIVOS:
         
         needs_human = result.get("needs_human_assistance", False)
 
-        # Create session record
-        session = ConversationSession(
-            phone_number=phone,
-            topic_id=topic_id,
-            rating=result.get("rating", "neutral"),
-            started_at=started_at,
-            ended_at=ended_at,
-            message_count=len(messages),
-            summary=result.get("summary", ""),
-            auto_categorized=True,
-            has_unanswered_questions=result.get("has_unanswered_questions", False),
-            escalated_to_human=needs_human
-        )
-
-        db.session.add(session)
+        # Create (or update) session record
+        _store_session(db, existing, phone, started_at, ended_at, message_count,
+                       topic_id=topic_id,
+                       rating=result.get("rating", "neutral"),
+                       summary=result.get("summary", ""),
+                       has_unanswered_questions=result.get("has_unanswered_questions", False),
+                       escalated_to_human=needs_human)
 
         # Si necesita asistencia humana, asignar la etiqueta al contacto existente
         if needs_human:
@@ -345,30 +833,46 @@ EJEMPLOS DE VERDADEROS POSITIVOS:
             else:
                 logger.warning(f"Contact {phone_normalized} not found in DB — tag not assigned (contact will get tag when n8n calls escalate endpoint)")
 
+        applied = False
+        if tag_job is not None:
+            from auto_tagger import apply_decisions, parse_decisions
+            answers = result.get("tags")
+            # Solo las reglas que el modelo respondió: sin respuesta no se guarda un "NO"
+            answered = [r for r in tag_job['rules'] if isinstance(answers, dict) and str(r.id) in answers]
+            if answered:
+                decisions = parse_decisions(answers, tag_job['conditions'])
+                logger.info(f"   → Auto-tag rules for {phone}: {decisions}")
+                apply_decisions(db, dict(tag_job, rules=answered), decisions, commit=False)
+                applied = len(answered) == len(tag_job['rules'])
+            if not applied:
+                logger.warning(f"   → Auto-tag rules for {phone}: {len(tag_job['rules']) - len(answered)} "
+                               f"unanswered in the combined pass, left to the auto tagger")
+
         db.session.commit()
+        if applied:
+            tag_job['applied'] = True
 
-        logger.info(f"Categorized session for {phone}: {topic_name} / {result.get('rating')} ({len(messages)} msgs) | human={needs_human}")
-        
+        logger.info(f"Categorized session for {phone}: {topic_name} / {result.get('rating')} ({message_count} msgs) | human={needs_human}")
+        return True
     except Exception as e:
-        logger.error(f"Error categorizing conversation for {phone}: {e}")
-        try:
-            from models import ConversationSession
-            # Create a fallback session to prevent infinite retry loops
-            session = ConversationSession(
-                phone_number=phone,
-                topic_id=None,
-                rating="neutral",
-                started_at=started_at,
-                ended_at=ended_at,
-                message_count=len(messages),
-                summary="Error en categorización automática",
-                auto_categorized=True,
-                has_unanswered_questions=False,
-                escalated_to_human=False
-            )
-            db.session.add(session)
-            db.session.commit()
-            logger.info(f"Saved fallback session for {phone} to prevent retry loop.")
-        except Exception as db_e:
-            db.session.rollback()
-            logger.error(f"Failed to save fallback session for {phone}: {db_e}")
+        db.session.rollback()
+        if tag_job is not None:
+            logger.error(f"Error saving combined analysis for {phone}, saving the session alone: {e}")
+            return store_categorization(db, phone, message_count, topics, started_at, ended_at, existing, result)
+        logger.error(f"Error saving categorization for {phone}: {e}")
+        return store_categorization(db, phone, message_count, topics, started_at, ended_at, existing, None)
+
+
+def _store_session(db, existing, phone, started_at, ended_at, message_count, **fields):
+    """Inserta la sesión categorizada, o actualiza la fila previa de la misma sesión."""
+    from models import ConversationSession
+
+    session = existing or ConversationSession(phone_number=phone, started_at=started_at)
+    session.ended_at = ended_at
+    session.message_count = message_count
+    session.auto_categorized = True
+    for name, value in fields.items():
+        setattr(session, name, value)
+    if existing is None:
+        db.session.add(session)
+    return session
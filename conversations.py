@@ -0,0 +1,266 @@
+"""
+Conversations
+Tabla resumen `conversations` (una fila por teléfono) para la bandeja del dashboard.
+
+En vez de recorrer whatsapp_messages con DISTINCT ON en cada carga, la bandeja lee
+esta tabla con un range scan sobre idx_conversations_inbox. La mantienen triggers
+de Postgres, así cubren todos los caminos de escritura (ORM, SQL crudo, inserts
+masivos de campañas, placeholders de estados, cambios de etiquetas):
+
+- INSERT en whatsapp_messages: upsert incremental (último mensaje, último inbound,
+  +N no leídos) agregando todas las filas del statement de una vez.
+- UPDATE / DELETE en whatsapp_messages: recalcula solo los teléfonos afectados
+  (marcar como leído, placeholders 'outbound' que reciben su teléfono real).
+- Cambios en whatsapp_contact_tags / whatsapp_contacts: actualizan has_human y contact_id.
+
+Tabla, funciones y triggers se instalan con `python migrate_conversations.py`
+(también reconstruye todo); la app no toca el esquema al arrancar.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+HUMAN_TAG = 'Asistencia Humana'
+PREVIEW_CHARS = 200
+
+# Namespace del advisory lock para que un solo proceso instale / reconstruya
+LOCK_KEY = 71002
+
+# Sin parámetros ni '%': se ejecuta tal cual con exec_driver_sql / cursor psycopg2
+SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS conversations (
+    phone_number VARCHAR(20) PRIMARY KEY,
+    contact_id INTEGER,
+    last_message TEXT,
+    last_direction VARCHAR(10),
+    last_timestamp TIMESTAMP,
+    last_inbound_at TIMESTAMP,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    has_human BOOLEAN NOT NULL DEFAULT FALSE,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_inbox ON conversations(has_human, last_timestamp, phone_number);
+CREATE INDEX IF NOT EXISTS idx_conversations_contact ON conversations(contact_id);
+
+CREATE OR REPLACE FUNCTION conversations_has_human(p_phone TEXT) RETURNS BOOLEAN AS $$
+    SELECT EXISTS (
+        SELECT 1 FROM whatsapp_contacts c
+        JOIN whatsapp_contact_tags ct ON ct.contact_id = c.id
+        JOIN whatsapp_tags t ON t.id = ct.tag_id
+        WHERE c.phone_number = p_phone AND t.name = '{HUMAN_TAG}'
+    )
+$$ LANGUAGE sql STABLE;
+
+-- Recalcula desde cero las filas de los teléfonos indicados
+CREATE OR REPLACE FUNCTION conversations_refresh(p_phones TEXT[]) RETURNS VOID AS $$
+BEGIN
+    DELETE FROM conversations cv
+    WHERE cv.phone_number = ANY(p_phones)
+      AND NOT EXISTS (SELECT 1 FROM whatsapp_messages m WHERE m.phone_number = cv.phone_number);
+
+    INSERT INTO conversations AS cv (phone_number, contact_id, last_message, last_direction, last_timestamp,
+                                     last_inbound_at, unread_count, has_human, updated_at)
+    SELECT p.phone,
+           (SELECT c.id FROM whatsapp_contacts c WHERE c.phone_number = p.phone ORDER BY c.id LIMIT 1),
+           LEFT(lm.content, {PREVIEW_CHARS}), lm.direction, lm.timestamp,
+           (SELECT max(m.timestamp) FROM whatsapp_messages m
+             WHERE m.phone_number = p.phone AND m.direction = 'inbound'),
+           (SELECT count(*) FROM whatsapp_messages m
+             WHERE m.phone_number = p.phone AND m.direction = 'inbound' AND m.read_at IS NULL),
+           conversations_has_human(p.phone),
+           (now() AT TIME ZONE 'utc')
+    FROM unnest(p_phones) AS p(phone)
+    JOIN LATERAL (
+        SELECT m.content, m.direction, m.timestamp FROM whatsapp_messages m
+        WHERE m.phone_number = p.phone
+        ORDER BY m.timestamp DESC, m.id DESC LIMIT 1
+    ) lm ON true
+    WHERE p.phone NOT IN ('unknown', 'outbound', '')
+    ON CONFLICT (phone_number) DO UPDATE SET
+        contact_id = EXCLUDED.contact_id,
+        last_message = EXCLUDED.last_message,
+        last_direction = EXCLUDED.last_direction,
+        last_timestamp = EXCLUDED.last_timestamp,
+        last_inbound_at = EXCLUDED.last_inbound_at,
+        unread_count = EXCLUDED.unread_count,
+        has_human = EXCLUDED.has_human,
+        updated_at = EXCLUDED.updated_at;
+END;
+$$ LANGUAGE plpgsql;
+
+-- INSERT en mensajes: upsert incremental, una fila agregada por teléfono del statement
+CREATE OR REPLACE FUNCTION conversations_on_messages_insert() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO conversations AS cv (phone_number, contact_id, last_message, last_direction, last_timestamp,
+                                     last_inbound_at, unread_count, has_human, updated_at)
+    SELECT agg.phone_number,
+           (SELECT c.id FROM whatsapp_contacts c WHERE c.phone_number = agg.phone_number ORDER BY c.id LIMIT 1),
+           agg.last_message, agg.last_direction, agg.last_timestamp,
+           agg.last_inbound_at, agg.unread,
+           conversations_has_human(agg.phone_number),
+           (now() AT TIME ZONE 'utc')
+    FROM (
+        SELECT DISTINCT ON (n.phone_number)
+               n.phone_number,
+               LEFT(n.content, {PREVIEW_CHARS}) AS last_message,
+               n.direction AS last_direction,
+               n.timestamp AS last_timestamp,
+               max(n.timestamp) FILTER (WHERE n.direction = 'inbound') OVER w AS last_inbound_at,
+               count(*) FILTER (WHERE n.direction = 'inbound' AND n.read_at IS NULL) OVER w AS unread
+        FROM new_rows n
+        WHERE n.phone_number NOT IN ('unknown', 'outbound', '')
+        WINDOW w AS (PARTITION BY n.phone_number)
+        ORDER BY n.phone_number, n.timestamp DESC, n.id DESC
+    ) agg
+    ON CONFLICT (phone_number) DO UPDATE SET
+        last_message = CASE WHEN EXCLUDED.last_timestamp >= cv.last_timestamp
+                            THEN EXCLUDED.last_message ELSE cv.last_message END,
+        last_direction = CASE WHEN EXCLUDED.last_timestamp >= cv.last_timestamp
+                              THEN EXCLUDED.last_direction ELSE cv.last_direction END,
+        last_timestamp = GREATEST(cv.last_timestamp, EXCLUDED.last_timestamp),
+        last_inbound_at = GREATEST(cv.last_inbound_at, EXCLUDED.last_inbound_at),
+        unread_count = cv.unread_count + EXCLUDED.unread_count,
+        contact_id = COALESCE(cv.contact_id, EXCLUDED.contact_id),
+        updated_at = EXCLUDED.updated_at;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- UPDATE en mensajes: recalcular solo si cambió algo que afecta el resumen
+CREATE OR REPLACE FUNCTION conversations_on_messages_update() RETURNS TRIGGER AS $$
+DECLARE
+    phones TEXT[];
+BEGIN
+    SELECT array_agg(DISTINCT ph) INTO phones FROM (
+        SELECT unnest(ARRAY[o.phone_number, n.phone_number]) AS ph
+        FROM old_rows o JOIN new_rows n ON n.id = o.id
+        WHERE o.phone_number IS DISTINCT FROM n.phone_number
+           OR o.read_at IS DISTINCT FROM n.read_at
+           OR o.content IS DISTINCT FROM n.content
+           OR o.timestamp IS DISTINCT FROM n.timestamp
+           OR o.direction IS DISTINCT FROM n.direction
+    ) s;
+    IF phones IS NOT NULL THEN
+        PERFORM conversations_refresh(phones);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION conversations_on_messages_delete() RETURNS TRIGGER AS $$
+DECLARE
+    phones TEXT[];
+BEGIN
+    SELECT array_agg(DISTINCT o.phone_number) INTO phones FROM old_rows o;
+    IF phones IS NOT NULL THEN
+        PERFORM conversations_refresh(phones);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Alta / baja de etiquetas: recalcular has_human de los contactos tocados
+CREATE OR REPLACE FUNCTION conversations_on_contact_tags_change() RETURNS TRIGGER AS $$
+DECLARE
+    ids INTEGER[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT contact_id) INTO ids FROM new_rows;
+    ELSE
+        SELECT array_agg(DISTINCT contact_id) INTO ids FROM old_rows;
+    END IF;
+
+    UPDATE conversations cv
+    SET has_human = conversations_has_human(cv.phone_number),
+        updated_at = (now() AT TIME ZONE 'utc')
+    FROM whatsapp_contacts c
+    WHERE c.id = ANY(ids)
+      AND cv.phone_number = c.phone_number
+      AND cv.has_human IS DISTINCT FROM conversations_has_human(cv.phone_number);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Alta / cambio de teléfono / baja de contactos: mantener contact_id y has_human
+CREATE OR REPLACE FUNCTION conversations_on_contacts_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE conversations cv
+        SET contact_id = (SELECT c.id FROM whatsapp_contacts c WHERE c.phone_number = cv.phone_number ORDER BY c.id LIMIT 1),
+            has_human = conversations_has_human(cv.phone_number)
+        WHERE cv.phone_number = OLD.phone_number;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE conversations cv
+        SET contact_id = (SELECT c.id FROM whatsapp_contacts c WHERE c.phone_number = cv.phone_number ORDER BY c.id LIMIT 1),
+            has_human = conversations_has_human(cv.phone_number)
+        WHERE cv.phone_number = NEW.phone_number;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_conversations_messages_insert ON whatsapp_messages;
+CREATE TRIGGER trg_conversations_messages_insert
+    AFTER INSERT ON whatsapp_messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE conversations_on_messages_insert();
+
+DROP TRIGGER IF EXISTS trg_conversations_messages_update ON whatsapp_messages;
+CREATE TRIGGER trg_conversations_messages_update
+    AFTER UPDATE ON whatsapp_messages
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE conversations_on_messages_update();
+
+DROP TRIGGER IF EXISTS trg_conversations_messages_delete ON whatsapp_messages;
+CREATE TRIGGER trg_conversations_messages_delete
+    AFTER DELETE ON whatsapp_messages
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE conversations_on_messages_delete();
+
+DROP TRIGGER IF EXISTS trg_conversations_contact_tags_insert ON whatsapp_contact_tags;
+CREATE TRIGGER trg_conversations_contact_tags_insert
+    AFTER INSERT ON whatsapp_contact_tags
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE conversations_on_contact_tags_change();
+
+DROP TRIGGER IF EXISTS trg_conversations_contact_tags_delete ON whatsapp_contact_tags;
+CREATE TRIGGER trg_conversations_contact_tags_delete
+    AFTER DELETE ON whatsapp_contact_tags
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE conversations_on_contact_tags_change();
+
+DROP TRIGGER IF EXISTS trg_conversations_contacts ON whatsapp_contacts;
+CREATE TRIGGER trg_conversations_contacts
+    AFTER INSERT OR DELETE OR UPDATE OF phone_number ON whatsapp_contacts
+    FOR EACH ROW EXECUTE PROCEDURE conversations_on_contacts_change();
+"""
+
+# Reconstrucción completa (backfill). Idempotente: se puede correr con la app andando.
+REBUILD_SQL = """
+DELETE FROM conversations cv
+WHERE NOT EXISTS (SELECT 1 FROM whatsapp_messages m WHERE m.phone_number = cv.phone_number);
+
+SELECT conversations_refresh(ARRAY(
+    SELECT DISTINCT phone_number FROM whatsapp_messages
+    WHERE phone_number NOT IN ('unknown', 'outbound', '')
+));
+"""
+
+def install(cursor, rebuild=True):
+    """Instala tabla, funciones y triggers (y reconstruye) usando un cursor DBAPI."""
+    cursor.execute(f"SELECT pg_advisory_xact_lock({LOCK_KEY})")
+    cursor.execute(SCHEMA_SQL)
+    if rebuild:
+        cursor.execute(REBUILD_SQL)
+
+
+def rebuild_conversations(engine):
+    """Reconstruye la tabla resumen completa."""
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        cursor.execute(f"SELECT pg_advisory_xact_lock({LOCK_KEY})")
+        cursor.execute(REBUILD_SQL)
+        cursor.close()
+    logger.info("🗂️ [CONVERSATIONS] Tabla resumen reconstruida")
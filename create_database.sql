@@ -189,10 +189,19 @@ CREATE TABLE IF NOT EXISTS whatsapp_messages (
     content TEXT,
     media_id VARCHAR(100),
     media_url TEXT,
+    media_status VARCHAR(10),           -- NULL=sin media, 'pending', 'ready', 'failed'
     caption TEXT,
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     sent_by VARCHAR(100),
-    read_at TIMESTAMP DEFAULT NULL
+    read_at TIMESTAMP DEFAULT NULL,
+    status VARCHAR(20),                 -- Último estado de entrega (monótono): sent, failed, delivered, read
+    sent_at TIMESTAMP,
+    delivered_at TIMESTAMP,
+    read_at_recipient TIMESTAMP,        -- Leído por el destinatario (read_at es del agente)
+    failed_code VARCHAR(50),
+    template_name VARCHAR(100),         -- Template que generó el mensaje (guardado al enviar)
+    template_language VARCHAR(10),
+    row_version BIGINT                  -- Versión por fila (trigger: migrate_message_versions.py)
 );
 
 CREATE INDEX IF NOT EXISTS ix_messages_phone_ts ON whatsapp_messages(phone_number, timestamp);
@@ -200,6 +209,11 @@ CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON whatsapp_messages(timestamp
 CREATE INDEX IF NOT EXISTS idx_messages_phone ON whatsapp_messages(phone_number);
 CREATE INDEX IF NOT EXISTS idx_messages_direction ON whatsapp_messages(direction);
 CREATE INDEX IF NOT EXISTS idx_messages_read_at ON whatsapp_messages(read_at);
+CREATE INDEX IF NOT EXISTS idx_messages_media_pending ON whatsapp_messages(timestamp) WHERE media_status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_messages_failed ON whatsapp_messages(timestamp) WHERE status = 'failed';
+CREATE INDEX IF NOT EXISTS idx_messages_phone_row_version ON whatsapp_messages(phone_number, row_version);
+CREATE INDEX IF NOT EXISTS idx_messages_row_version ON whatsapp_messages(row_version);
+CREATE INDEX IF NOT EXISTS idx_messages_template ON whatsapp_messages(template_name, timestamp) WHERE template_name IS NOT NULL;
 
 -- ==========================================
 -- WHATSAPP MESSAGE STATUSES
@@ -215,6 +229,7 @@ CREATE TABLE IF NOT EXISTS whatsapp_message_statuses (
 );
 
 CREATE INDEX IF NOT EXISTS idx_statuses_wa_id ON whatsapp_message_statuses(wa_message_id);
+CREATE INDEX IF NOT EXISTS idx_statuses_wa_id_status ON whatsapp_message_statuses(wa_message_id, status);
 CREATE INDEX IF NOT EXISTS idx_statuses_status ON whatsapp_message_statuses(status);
 CREATE INDEX IF NOT EXISTS idx_statuses_timestamp ON whatsapp_message_statuses(timestamp);
 
@@ -260,11 +275,20 @@ CREATE TABLE IF NOT EXISTS whatsapp_campaign_logs (
     status VARCHAR(20) DEFAULT 'pending',
     error_detail TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    response_count INTEGER NOT NULL DEFAULT 0,  -- Respuestas dentro de la ventana (campaign_metrics.py)
+    first_response_at TIMESTAMP,
+    claimed_by VARCHAR(100),                    -- Worker que tiene el log tomado (campaign_sender.py)
+    lease_expires_at TIMESTAMP,
+    next_attempt_at TIMESTAMP,                  -- Backoff del destinatario tras un throttling (131056)
+    retry_count INTEGER NOT NULL DEFAULT 0,     -- Reintentos por throttling
     CONSTRAINT uq_campaign_contact_log UNIQUE (campaign_id, contact_id)
 );
 
 CREATE INDEX IF NOT EXISTS idx_campaign_logs_campaign_status ON whatsapp_campaign_logs(campaign_id, status);
 CREATE INDEX IF NOT EXISTS idx_campaign_logs_campaign_contact ON whatsapp_campaign_logs(campaign_id, contact_id);
+CREATE INDEX IF NOT EXISTS idx_campaign_logs_message_id ON whatsapp_campaign_logs(message_id);
+CREATE INDEX IF NOT EXISTS idx_campaign_logs_phone_created ON whatsapp_campaign_logs(contact_phone, created_at);
+CREATE INDEX IF NOT EXISTS idx_campaign_logs_pending ON whatsapp_campaign_logs(campaign_id, id) WHERE status = 'pending';
 
 -- ==========================================
 -- CONVERSATION NOTES (notas internas del equipo)
@@ -289,6 +313,7 @@ CREATE TABLE IF NOT EXISTS crm_users (
     is_admin BOOLEAN DEFAULT FALSE NOT NULL,
     is_active BOOLEAN DEFAULT TRUE NOT NULL,
     can_see_untagged BOOLEAN DEFAULT FALSE NOT NULL,
+    auth_version INTEGER DEFAULT 0 NOT NULL,    -- +1 al cambiar permisos/visibilidad (invalida auth_cache.py)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -339,6 +364,21 @@ CREATE TABLE IF NOT EXISTS auto_tag_logs (
 CREATE INDEX IF NOT EXISTS idx_auto_tag_logs_created ON auto_tag_logs(created_at);
 CREATE INDEX IF NOT EXISTS idx_auto_tag_logs_result ON auto_tag_logs(result);
 
+-- ==========================================
+-- AUTO TAG EVALUATIONS (decisiones por regla × teléfono × último mensaje entrante)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS auto_tag_evaluations (
+    id BIGSERIAL PRIMARY KEY,
+    rule_id INTEGER NOT NULL REFERENCES auto_tag_rules(id) ON DELETE CASCADE,
+    phone_number VARCHAR(20) NOT NULL,
+    message_id INTEGER NOT NULL,
+    result BOOLEAN NOT NULL,
+    evaluated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_auto_tag_evaluations_key ON auto_tag_evaluations(rule_id, phone_number, message_id);
+CREATE INDEX IF NOT EXISTS idx_auto_tag_evaluations_evaluated ON auto_tag_evaluations(evaluated_at);
+
 -- ==========================================
 -- FOLLOW-UP SEQUENCES
 -- ==========================================
@@ -505,6 +545,215 @@ CREATE TABLE IF NOT EXISTS bot_audios (
 );
 
 
+-- ==========================================
+-- WEBHOOK INBOX (cola durable de eventos de Meta)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS webhook_inbox (
+    id BIGSERIAL PRIMARY KEY,
+    partition INTEGER NOT NULL,             -- crc32(teléfono) % WEBHOOK_INBOX_PARTITIONS
+    phone_number VARCHAR(20),
+    payload JSON NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending, done, failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_webhook_inbox_partition_status ON webhook_inbox(partition, status, id);
+CREATE INDEX IF NOT EXISTS idx_webhook_inbox_processed ON webhook_inbox(processed_at);
+
+
+-- ==========================================
+-- N8N DEAD LETTERS (payloads no entregados al chatbot)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS n8n_dead_letters (
+    id SERIAL PRIMARY KEY,
+    phone_number VARCHAR(20) NOT NULL,
+    payload JSON NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_n8n_dead_letters_phone_number ON n8n_dead_letters(phone_number);
+
+
+-- ==========================================
+-- N8N OUTBOX (buffer de debounce hacia el chatbot, ver n8n_forwarder.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS n8n_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    phone_number VARCHAR(20) NOT NULL,
+    message_id VARCHAR(100) UNIQUE,             -- wa_message_id (deduplica re-entregas)
+    item JSON NOT NULL,                         -- mensaje normalizado (texto + adjunto)
+    wa_name VARCHAR(200),
+    pending BOOLEAN NOT NULL DEFAULT FALSE,     -- adjunto todavía descargándose
+    media_url TEXT,
+    claimed_by VARCHAR(100),                    -- proceso que lo tiene en memoria
+    lease_expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_n8n_outbox_lease ON n8n_outbox(lease_expires_at);
+
+
+-- ==========================================
+-- CONVERSATIONS (resumen por teléfono para la bandeja)
+-- Los triggers que la mantienen están en conversations.py
+-- (se instalan con migrate_conversations.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS conversations (
+    phone_number VARCHAR(20) PRIMARY KEY,
+    contact_id INTEGER,
+    last_message TEXT,                      -- preview (primeros 200 caracteres)
+    last_direction VARCHAR(10),
+    last_timestamp TIMESTAMP,
+    last_inbound_at TIMESTAMP,              -- ventana de 24h
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    has_human BOOLEAN NOT NULL DEFAULT FALSE,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_inbox ON conversations(has_human, last_timestamp, phone_number);
+CREATE INDEX IF NOT EXISTS idx_conversations_contact ON conversations(contact_id);
+
+
+-- ==========================================
+-- BÚSQUEDA (FTS en español + trigram) — ver message_search.py
+-- ==========================================
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_messages_content_fts ON whatsapp_messages USING GIN (to_tsvector('spanish', coalesce(content, '')));
+CREATE INDEX IF NOT EXISTS idx_messages_content_trgm ON whatsapp_messages USING GIN (content gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_contacts_name_trgm ON whatsapp_contacts USING GIN (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_contacts_phone_trgm ON whatsapp_contacts USING GIN (phone_number gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_contacts_contact_id_trgm ON whatsapp_contacts USING GIN (contact_id gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_conversations_phone_trgm ON conversations USING GIN (phone_number gin_trgm_ops);
+
+
+-- ==========================================
+-- REALTIME EVENTS (SSE /api/events/stream)
+-- Los triggers que la alimentan (+ NOTIFY crm_events) están en realtime.py
+-- (se instalan con migrate_realtime.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS realtime_events (
+    id BIGSERIAL PRIMARY KEY,
+    event_type VARCHAR(30) NOT NULL,        -- message, status, tag, human_escalation, order
+    phone_number VARCHAR(20),
+    payload JSON NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    xid BIGINT DEFAULT txid_current()       -- Transacción que escribió el evento (orden de commit)
+);
+
+CREATE INDEX IF NOT EXISTS idx_realtime_events_created ON realtime_events(created_at);
+CREATE INDEX IF NOT EXISTS idx_realtime_events_xid ON realtime_events(xid, id);
+
+
+-- ==========================================
+-- PHONE VISIBILITY (etiquetas visibles por teléfono para agentes restringidos)
+-- Los triggers que la mantienen están en visibility.py
+-- (se instalan con migrate_visibility.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS phone_visibility (
+    phone_number VARCHAR(20) PRIMARY KEY,
+    tag_ids INTEGER[] NOT NULL DEFAULT '{}',    -- unión de etiquetas de los contactos del teléfono
+    untagged BOOLEAN NOT NULL DEFAULT TRUE,     -- algún contacto del teléfono sin etiquetas
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_phone_visibility_tags ON phone_visibility USING GIN (tag_ids);
+
+
+-- ==========================================
+-- ANALYTICS ROLLUPS (los mantiene el scheduler, ver analytics_rollups.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS message_rollup_hourly (
+    bucket TIMESTAMP NOT NULL,                  -- hora local Argentina truncada
+    direction VARCHAR(10) NOT NULL,
+    message_type VARCHAR(20) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT '',     -- último estado ('' = sin estado)
+    messages INTEGER NOT NULL DEFAULT 0,
+    sent_count INTEGER NOT NULL DEFAULT 0,
+    delivered_count INTEGER NOT NULL DEFAULT 0,
+    read_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, direction, message_type, status)
+);
+
+CREATE TABLE IF NOT EXISTS message_rollup_phone (
+    phone_number VARCHAR(20) PRIMARY KEY,
+    messages INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_message_rollup_phone_messages ON message_rollup_phone(messages);
+
+CREATE TABLE IF NOT EXISTS rollup_watermarks (
+    name VARCHAR(50) PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0,            -- último row_version de whatsapp_messages aplicado
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+
+-- ==========================================
+-- CAMPAIGN COUNTERS (contadores de logs por estado)
+-- Los triggers que los mantienen están en campaign_counters.py
+-- (se instalan al arrancar o con migrate_campaign_counters.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS campaign_counters (
+    campaign_id INTEGER PRIMARY KEY REFERENCES whatsapp_campaigns(id) ON DELETE CASCADE,
+    total INTEGER NOT NULL DEFAULT 0,
+    pending INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,            -- solo 'sent' (sin delivered / read)
+    delivered INTEGER NOT NULL DEFAULT 0,
+    read INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status_xid BIGINT                           -- último xid que cambió logs exitosos (campaign_metrics.py)
+);
+
+
+-- ==========================================
+-- CAMPAIGN RESPONSE METRICS (las mantiene el scheduler, ver campaign_metrics.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS campaign_response_metrics (
+    campaign_id INTEGER PRIMARY KEY REFERENCES whatsapp_campaigns(id) ON DELETE CASCADE,
+    responders INTEGER NOT NULL DEFAULT 0,
+    total_responses INTEGER NOT NULL DEFAULT 0,
+    latency_p50_seconds DOUBLE PRECISION,       -- latencia de la primera respuesta
+    latency_p90_seconds DOUBLE PRECISION,
+    latency_buckets JSON,                       -- {"<1h": n, "1-6h": n, "6-24h": n, "24-48h": n}
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+
+-- ==========================================
+-- CATEGORIZER STATE (estado incremental del categorizador, ver conversation_categorizer.py)
+-- ==========================================
+CREATE TABLE IF NOT EXISTS categorizer_state (
+    phone_number VARCHAR(20) PRIMARY KEY,
+    last_message_id INTEGER NOT NULL,           -- último mensaje aplicado (orden timestamp, id)
+    last_message_at TIMESTAMP NOT NULL,
+    last_direction VARCHAR(10),
+    last_message_type VARCHAR(20),
+    tail_started_at TIMESTAMP,                  -- inicio de la sesión abierta
+    tail_dirty BOOLEAN NOT NULL DEFAULT TRUE,   -- la sesión abierta tiene mensajes sin categorizar
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_categorizer_state_dirty ON categorizer_state(last_message_at) WHERE tail_dirty;
+
+-- Sesiones cerradas sin resultado del modelo: se reintentan cada ciclo
+CREATE TABLE IF NOT EXISTS categorizer_pending_ranges (
+    phone_number VARCHAR(20) NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (phone_number, started_at)
+);
+
+
 -- ==========================================
 -- ADMIN INICIAL
 -- Contraseña por defecto: admin
@@ -0,0 +1,43 @@
+"""
+Evaluación offline del clasificador local (ver local_classifier.py).
+Entrena con las sesiones corregidas a mano y clasifica las últimas sesiones que
+categorizó la IA: por umbral muestra cuántas se habrían resuelto sin llamar a
+OpenAI y cuánto coinciden con lo que respondió la IA.
+Uso: python eval_local_classifier.py [cantidad_de_sesiones]
+"""
+import logging
+import os
+import sys
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+from local_classifier import evaluate
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+LIMIT = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+engine = create_engine(DATABASE_URL)
+with engine.connect() as conn:
+    report = evaluate(conn, limit=LIMIT)
+engine.dispose()
+
+print("=" * 60)
+print(f"🧮 Sesiones de la IA evaluadas: {report['evaluated_sessions']} | triviales: {report['trivial_sessions']}")
+model = report['model']
+print(f"📚 Modelo: {model['samples']} sesiones corregidas, {model['classes']} clases, {model['features']} features"
+      if model else "📚 Sin modelo (pocas sesiones corregidas) — solo keywords")
+print("=" * 60)
+print(f"{'Umbral':>7} {'Locales':>8} {'Cobertura':>10} {'Tema':>6} {'Rating':>7} {'Flags':>6} {'Todo':>6}")
+
+
+def pct(value):
+    return f"{value * 100:.0f}%" if value is not None else "-"
+
+
+for row in report['thresholds']:
+    print(f"{row['threshold']:>7} {row['local']:>8} {pct(row['coverage']):>10} {pct(row['topic_agreement']):>6} "
+          f"{pct(row['rating_agreement']):>7} {pct(row['flags_agreement']):>6} {pct(row['full_agreement']):>6}")
+print("=" * 60)
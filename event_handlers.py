@@ -1,6 +1,6 @@
-import requests
 import json
 import logging
+import time
 from datetime import datetime
 from config import Config
 
@@ -8,65 +8,25 @@ from config import Config
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Orden de los estados de entrega para mantener whatsapp_messages.status de forma monótona.
+# 'failed' supera a 'sent' pero no a 'delivered'/'read': si el mensaje llegó, no falló.
+STATUS_RANK_SQL = "(CASE {col} WHEN 'sent' THEN 1 WHEN 'failed' THEN 2 WHEN 'delivered' THEN 3 WHEN 'read' THEN 4 ELSE 0 END)"
+
 def forward_to_n8n(user_number, user_message, msg_type, media_url=None, media_data=None, message_id=None, wa_name=None):
     """
-    Envía el mensaje procesado directamente al webhook del chatbot en n8n.
+    Encola el mensaje para el webhook del chatbot en n8n.
+    El envío real (debounce por teléfono, reintentos, dead-letter) lo hace n8n_forwarder.
     """
-    if not Config.N8N_CHATBOT_WEBHOOK_URL:
-        logger.warning("N8N_CHATBOT_WEBHOOK_URL no está configurada. No se enviará el mensaje al chatbot.")
-        return
-
-    MEDIA_TYPES = {'image', 'audio', 'video', 'document', 'sticker'}
-    has_attachments = msg_type in MEDIA_TYPES
-
-    # Mapeo de content-type y extensión según tipo
-    CONTENT_TYPE_MAP = {
-        'image': 'image/jpeg', 'audio': 'audio/ogg',
-        'video': 'video/mp4', 'document': 'application/octet-stream', 'sticker': 'image/webp'
-    }
-    EXT_MAP = {'image': 'jpg', 'audio': 'ogg', 'video': 'mp4', 'sticker': 'webp'}
-
-    attachment_content_type = CONTENT_TYPE_MAP.get(msg_type, '') if has_attachments else ''
-    attachment_extension = EXT_MAP.get(msg_type, '') if has_attachments else ''
-
-    # Para documentos intentar extraer extensión del filename
-    if msg_type == 'document' and media_data:
-        filename = media_data.get('filename', '')
-        if '.' in filename:
-            attachment_extension = filename.rsplit('.', 1)[-1].lower()
-            if attachment_extension == 'pdf':
-                attachment_content_type = 'application/pdf'
-
-    payload = {
-        "user_number": user_number,
-        "message_type": 0,
-        "user_message": user_message or "",
-        "has_attachments": has_attachments,
-        "attachment_type": msg_type if has_attachments else "none",
-        "attachment_url": (Config.FLASK_BASE_URL.rstrip('/') + media_url if media_url and media_url.startswith('/') else media_url or ""),
-        "attachment_content_type": attachment_content_type,
-        "attachment_extension": attachment_extension,
-        "message_id": message_id or "",
-        "updated_at": datetime.utcnow().isoformat(),
-        "user_name": wa_name or ""
-    }
-
-    try:
-        response = requests.post(
-            Config.N8N_CHATBOT_WEBHOOK_URL,
-            json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=10
-        )
-        if response.status_code not in [200, 202]:
-            logger.error(f"Error al llamar n8n: {response.status_code} - {response.text}")
-        else:
-            logger.info(f"✅ Mensaje enviado a n8n para {user_number}")
-    except Exception as e:
-        logger.error(f"Excepción al conectar con n8n: {e}")
+    from n8n_forwarder import submit
+    submit(user_number, user_message, msg_type, media_url=media_url, media_data=media_data, message_id=message_id, wa_name=wa_name)
 
-def save_message(wa_message_id, phone_number, direction, message_type, content, media_id=None, media_url=None, caption=None, wa_name=None):
-    """Guarda un mensaje en la base de datos y registra el contacto."""
+def save_message(wa_message_id, phone_number, direction, message_type, content, media_id=None, media_url=None, caption=None, wa_name=None, media_status=None, template_name=None, template_language=None):
+    """
+    Guarda un mensaje en la base de datos y registra el contacto.
+    Retorna True si se guardó, False si ya existía (evento re-entregado).
+    Los errores de BD al guardar el mensaje se propagan: la inbox reintenta el evento
+    (y lo aparta como 'failed' tras WEBHOOK_INBOX_MAX_ATTEMPTS) en vez de darlo por hecho.
+    """
     from app import app
     from models import db, Message, Contact
     
@@ -78,7 +38,7 @@ def save_message(wa_message_id, phone_number, direction, message_type, content,
             existing = Message.query.filter_by(wa_message_id=wa_message_id).first()
             if existing:
                 logger.info(f"Mensaje {wa_message_id} ya existe, omitiendo...")
-                return
+                return False
             
             # --- AUTO REGISTRO DE CONTACTO (Con manejo de Race Condition) ---
             if phone_number and phone_number not in ['unknown', 'outbound', '']:
@@ -117,63 +77,233 @@ def save_message(wa_message_id, phone_number, direction, message_type, content,
                 content=content or "[Contenido no compatible]", # Fallback para evitar nulos confusos
                 media_id=media_id,
                 media_url=media_url,
+                media_status=media_status,
                 caption=caption,
+                template_name=template_name,
+                template_language=template_language,
                 timestamp=datetime.utcnow()
             )
             db.session.add(message)
             db.session.commit()
             logger.info(f"✅ Mensaje guardado en BD: {wa_message_id}")
+            return True
     except Exception as e:
+        from models import db
+        db.session.rollback()
         logger.error(f"Error guardando mensaje en BD: {e}")
+        raise
 
-def save_status(wa_message_id, status, recipient_id=None, error_code=None, error_title=None, error_details=None):
-    """Guarda un estado de mensaje en la base de datos."""
+def extract_statuses(data):
+    """
+    Extrae todos los estados (sent, delivered, read, failed) de un payload de Meta.
+    Retorna una lista de dicts listos para save_statuses.
+    """
+    statuses = []
+    for item in data.get("entry", []) or []:
+        for change in item.get("changes", []) or []:
+            value = change.get("value", {}) or {}
+            for status in value.get("statuses", []) or []:
+                logger.debug(f"📋 STATUS COMPLETO: {json.dumps(status)}")
+
+                recipient = status.get("recipient_id")
+                status_type = status.get("status")
+                msg_id = status.get("id")
+
+                error_code = None
+                error_title = None
+                error_details = None
+
+                if status_type == "failed":
+                    errors = status.get("errors", [])
+                    if errors:
+                        error_code = str(errors[0].get("code", ""))
+                        error_title = errors[0].get("title", "")
+                        error_details = json.dumps(errors)
+                    logger.error(f"❌ ERROR DE ENVÍO a {recipient}. Detalles: {errors}")
+
+                # Usar el timestamp de Meta (epoch UTC) para ordenar estados del mismo lote
+                ts = datetime.utcnow()
+                try:
+                    if status.get("timestamp"):
+                        ts = datetime.utcfromtimestamp(int(status["timestamp"]))
+                except (TypeError, ValueError):
+                    pass
+
+                statuses.append({
+                    "wa_message_id": msg_id,
+                    "status": status_type,
+                    "recipient_id": recipient,
+                    "error_code": error_code,
+                    "error_title": error_title,
+                    "error_details": error_details,
+                    "timestamp": ts,
+                })
+    return statuses
+
+
+def save_statuses(statuses):
+    """
+    Ingesta set-based de un lote de estados en UNA transacción:
+    1. Upsert de mensajes placeholder para los wa_message_id desconocidos.
+    2. Insert masivo en whatsapp_message_statuses, descartando duplicados exactos
+       (mismo wa_message_id + status) que Meta re-envía.
+    3. UPDATE monótono de las columnas desnormalizadas de whatsapp_messages
+       (status, sent_at, delivered_at, read_at_recipient, failed_code): un estado
+       que llega fuera de orden ("delivered" después de "read") no retrocede el status.
+    4. UPDATE ... FROM de whatsapp_campaign_logs por message_id (indexado), con el
+       mismo ranking: un log en 'read' no vuelve a 'delivered'.
+    Retorna la cantidad de estados nuevos insertados.
+    """
     from app import app
-    from models import db, Message, MessageStatus
-    
+    from models import db
+    from sqlalchemy import text
+
+    # Deduplicar dentro del lote conservando el orden de llegada
+    seen = set()
+    rows = []
+    for st in statuses:
+        key = (st.get("wa_message_id"), st.get("status"))
+        if not key[0] or not key[1] or key in seen:
+            continue
+        seen.add(key)
+        rows.append(st)
+    if not rows:
+        return 0
+
+    params = {
+        'ids': [r["wa_message_id"] for r in rows],
+        'statuses': [r["status"] for r in rows],
+        'recipients': [r.get("recipient_id") for r in rows],
+        'codes': [r.get("error_code") for r in rows],
+        'titles': [r.get("error_title") for r in rows],
+        'details': [r.get("error_details") for r in rows],
+        'ts': [r.get("timestamp") or datetime.utcnow() for r in rows],
+    }
+    batch_sql = """
+        unnest(
+            CAST(:ids AS varchar[]), CAST(:statuses AS varchar[]), CAST(:recipients AS varchar[]),
+            CAST(:codes AS varchar[]), CAST(:titles AS varchar[]), CAST(:details AS text[]),
+            CAST(:ts AS timestamp[])
+        ) WITH ORDINALITY AS v(wa_id, status, recipient, code, title, details, ts, ord)
+    """
+
+    m_rank = STATUS_RANK_SQL.format(col='m.status')
+    v_rank = STATUS_RANK_SQL.format(col='v.status')
+
+    started = time.perf_counter()
     try:
         with app.app_context():
-            # Verificar si el mensaje existe, si no, crear uno placeholder
-            message = Message.query.filter_by(wa_message_id=wa_message_id).first()
-            if not message:
-                # Crear mensaje placeholder para mensajes salientes
-                message = Message(
-                    wa_message_id=wa_message_id,
-                    phone_number=recipient_id or "unknown",
-                    direction="outbound",
-                    message_type="text",
-                    timestamp=datetime.utcnow()
-                )
-                db.session.add(message)
-                db.session.commit()
-            elif message.phone_number in ["outbound", "unknown"] and recipient_id:
-                # Actualizar el número si antes era placeholder
-                message.phone_number = recipient_id
+            try:
+                # 1. Placeholders para mensajes salientes que todavía no conocemos
+                db.session.execute(text(f"""
+                    INSERT INTO whatsapp_messages (wa_message_id, phone_number, direction, message_type, timestamp)
+                    SELECT DISTINCT ON (v.wa_id) v.wa_id, COALESCE(v.recipient, 'unknown'), 'outbound', 'text', v.ts
+                    FROM {batch_sql}
+                    ORDER BY v.wa_id, v.ord
+                    ON CONFLICT (wa_message_id) DO NOTHING
+                """), params)
+
+                # Completar el número si el mensaje existente era placeholder
+                db.session.execute(text(f"""
+                    UPDATE whatsapp_messages m
+                    SET phone_number = v.recipient
+                    FROM (
+                        SELECT DISTINCT ON (v.wa_id) v.wa_id, v.recipient
+                        FROM {batch_sql}
+                        WHERE v.recipient IS NOT NULL
+                        ORDER BY v.wa_id, v.ord
+                    ) v
+                    WHERE m.wa_message_id = v.wa_id
+                      AND m.phone_number IN ('outbound', 'unknown')
+                """), params)
+
+                # 2. Estados nuevos (los re-envíos de Meta ya existen y se descartan)
+                inserted = db.session.execute(text(f"""
+                    INSERT INTO whatsapp_message_statuses
+                        (wa_message_id, status, error_code, error_title, error_details, timestamp)
+                    SELECT v.wa_id, v.status, v.code, v.title, v.details, v.ts
+                    FROM {batch_sql}
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM whatsapp_message_statuses s
+                        WHERE s.wa_message_id = v.wa_id AND s.status = v.status
+                    )
+                    ORDER BY v.ord
+                """), params).rowcount
+
+                # 3. Último estado en el propio mensaje (sin retroceder) + timestamps de cada etapa.
+                #    LEAST ignora NULLs, así cada *_at queda con el primer evento recibido.
+                db.session.execute(text(f"""
+                    UPDATE whatsapp_messages m
+                    SET status = CASE WHEN v.rank > {m_rank} THEN v.status ELSE m.status END,
+                        sent_at = LEAST(m.sent_at, v.sent_at),
+                        delivered_at = LEAST(m.delivered_at, v.delivered_at),
+                        read_at_recipient = LEAST(m.read_at_recipient, v.read_at),
+                        failed_code = CASE WHEN v.rank > {m_rank} AND v.status = 'failed'
+                                           THEN COALESCE(v.failed_code, m.failed_code)
+                                           ELSE m.failed_code END
+                    FROM (
+                        SELECT v.wa_id,
+                               MAX({v_rank}) AS rank,
+                               (array_agg(v.status ORDER BY {v_rank} DESC, v.ord DESC))[1] AS status,
+                               MIN(v.ts) FILTER (WHERE v.status = 'sent') AS sent_at,
+                               MIN(v.ts) FILTER (WHERE v.status = 'delivered') AS delivered_at,
+                               MIN(v.ts) FILTER (WHERE v.status = 'read') AS read_at,
+                               (array_agg(v.code ORDER BY v.ord DESC) FILTER (WHERE v.status = 'failed'))[1] AS failed_code
+                        FROM {batch_sql}
+                        GROUP BY v.wa_id
+                    ) v
+                    WHERE m.wa_message_id = v.wa_id
+                      AND (v.rank > {m_rank}
+                           OR LEAST(m.sent_at, v.sent_at) IS DISTINCT FROM m.sent_at
+                           OR LEAST(m.delivered_at, v.delivered_at) IS DISTINCT FROM m.delivered_at
+                           OR LEAST(m.read_at_recipient, v.read_at) IS DISTINCT FROM m.read_at_recipient)
+                """), params)
+
+                # 4. Logs de campaña: estado de mayor rango del lote, sin retroceder (igual que 3.)
+                cl_rank = STATUS_RANK_SQL.format(col='cl.status')
+                updated_logs = db.session.execute(text(f"""
+                    UPDATE whatsapp_campaign_logs cl
+                    SET status = v.status,
+                        error_detail = COALESCE(v.details, cl.error_detail)
+                    FROM (
+                        SELECT DISTINCT ON (v.wa_id) v.wa_id, v.status, v.details, {v_rank} AS rank
+                        FROM {batch_sql}
+                        ORDER BY v.wa_id, {v_rank} DESC, v.ord DESC
+                    ) v
+                    WHERE cl.message_id = v.wa_id
+                      AND v.rank > {cl_rank}
+                """), params).rowcount
+
                 db.session.commit()
-            
-            msg_status = MessageStatus(
-                wa_message_id=wa_message_id,
-                status=status,
-                error_code=error_code,
-                error_title=error_title,
-                error_details=error_details,
-                timestamp=datetime.utcnow()
-            )
-            db.session.add(msg_status)
-            
-            # --- ACTUALIZAR ESTADO DE CAMPAÑA SI CORRESPONDE ---
-            from models import CampaignLog
-            campaign_log = CampaignLog.query.filter_by(message_id=wa_message_id).first()
-            if campaign_log:
-                campaign_log.status = status
-                if error_details:
-                    campaign_log.error_detail = error_details
-                logger.info(f"📊 Actualizado log de campaña {campaign_log.id} a '{status}'")
-            
-            db.session.commit()
-            logger.info(f"✅ Estado '{status}' guardado para mensaje: {wa_message_id}")
+            except Exception:
+                db.session.rollback()
+                raise
+
+        elapsed = time.perf_counter() - started
+        rate = len(rows) / elapsed if elapsed > 0 else float(len(rows))
+        logger.info(f"✅ {len(rows)} estado(s) procesados ({inserted} nuevos, {updated_logs} logs de campaña) "
+                    f"en {elapsed * 1000:.1f} ms — {rate:.0f} estados/s")
+        return inserted
     except Exception as e:
-        logger.error(f"Error guardando estado en BD: {e}")
+        logger.error(f"Error guardando lote de estados en BD: {e}")
+        raise
+
+
+def save_status(wa_message_id, status, recipient_id=None, error_code=None, error_title=None, error_details=None):
+    """
+    Guarda un estado de mensaje en la base de datos (atajo de save_statuses para un solo estado).
+    Si falla, save_statuses ya lo logueó y la excepción se propaga al llamador.
+    """
+    return save_statuses([{
+        "wa_message_id": wa_message_id,
+        "status": status,
+        "recipient_id": recipient_id,
+        "error_code": error_code,
+        "error_title": error_title,
+        "error_details": error_details,
+        "timestamp": datetime.utcnow(),
+    }])
+
 
 def _save_whatsapp_order(wa_message_id, phone_number, order_data, catalog_id, wa_name=None):
     """Crea una Order en BD a partir de un mensaje de tipo 'order' de WhatsApp."""
@@ -181,6 +311,11 @@ def _save_whatsapp_order(wa_message_id, phone_number, order_data, catalog_id, wa
     from models import db, Contact, Order, OrderItem, CatalogProduct, ChatbotConfig
     try:
         with app.app_context():
+            # Evento re-entregado: la orden ya fue creada
+            if wa_message_id and Order.query.filter_by(wa_message_id=wa_message_id).first():
+                logger.info(f"Orden de mensaje {wa_message_id} ya existe, omitiendo...")
+                return
+
             # Auto-guardar catalog_id si no estaba
             if catalog_id and not ChatbotConfig.get("catalog_id"):
                 ChatbotConfig.set("catalog_id", catalog_id)
@@ -284,11 +419,8 @@ def process_event(data):
                         media_id = media_data.get("id")
                         caption = media_data.get("caption") if msg_type in ["image", "video", "document"] else None
                         content = f"[{msg_type.capitalize()}] {caption or ''}".strip()
-                        
-                        # Descargar media
-                        from whatsapp_service import whatsapp_api
-                        media_url = whatsapp_api.download_media(media_id)
-                        
+                        # La descarga la hace el media pipeline después de guardar el mensaje
+
                     elif msg_type == "location":
                         loc = message.get("location", {})
                         lat = loc.get("latitude", "")
@@ -357,10 +489,14 @@ def process_event(data):
 
                     logger.info(f"NUEVO MENSAJE de {sender} tipo {msg_type}: {message}")
 
-                    # Guardar mensaje en base de datos
-                    save_message(msg_id, sender, "inbound", msg_type, content,
+                    # Guardar mensaje en base de datos (media queda 'pending' hasta que termine la descarga)
+                    saved = save_message(msg_id, sender, "inbound", msg_type, content,
                                media_id=media_id, media_url=media_url, caption=caption,
-                               wa_name=wa_names.get(sender))
+                               wa_name=wa_names.get(sender),
+                               media_status='pending' if media_id else None)
+                    if saved is False:
+                        # Evento re-entregado (reintento de Meta o de la inbox): ya se procesó
+                        continue
 
                     # Cancelar follow-ups activos si el cliente responde
                     try:
@@ -389,37 +525,20 @@ def process_event(data):
 
                     # Enviar mensaje al chatbot n8n
                     media_data = message.get(msg_type, {}) if msg_type in {'image','audio','video','document','sticker'} else None
-                    forward_to_n8n(sender, content, msg_type, media_url=media_url, media_data=media_data, message_id=msg_id, wa_name=wa_names.get(sender))
-
-            # --- MANEJO DE ESTADOS (SENT, DELIVERED, READ, FAILED) ---
-            if "statuses" in value:
-                for status in value["statuses"]:
-                    # DEBUG: Ver todo el objeto status
-                    logger.info(f"📋 STATUS COMPLETO: {json.dumps(status, indent=2)}")
-                    
-                    recipient = status.get("recipient_id")
-                    status_type = status.get("status")  # sent, delivered, read, failed
-                    msg_id = status.get("id")
-                    
-                    logger.info(f"ACTUALIZACIÓN DE ESTADO: {status_type} para {recipient} (msg_id: {msg_id})")
-                    
-                    # Extraer errores si existen
-                    error_code = None
-                    error_title = None
-                    error_details = None
-                    
-                    if status_type == "failed":
-                        errors = status.get("errors", [])
-                        if errors:
-                            error_code = str(errors[0].get("code", ""))
-                            error_title = errors[0].get("title", "")
-                            error_details = json.dumps(errors)
-                        logger.error(f"❌ ERROR DE ENVÍO a {recipient}. Detalles: {errors}")
-                    
-                    if status_type == "read":
-                        logger.info(f"👁️‍🗨️ ¡El usuario {recipient} LEYÓ el mensaje!")
-                    
-                    # Guardar estado en base de datos
-                    save_status(msg_id, status_type, recipient, error_code, error_title, error_details)
-
+                    if media_id:
+                        # Con adjunto: reservar el lugar y completarlo cuando el media pipeline tenga la URL
+                        from media_pipeline import enqueue_media_download
+                        from n8n_forwarder import reserve, resolve
+                        reserve(sender, content, msg_type, media_data=media_data, message_id=msg_id, wa_name=wa_names.get(sender))
+                        enqueue_media_download(
+                            msg_id, media_id,
+                            on_done=lambda url, msg_id=msg_id: resolve(msg_id, url)
+                        )
+                    else:
+                        forward_to_n8n(sender, content, msg_type, media_url=media_url, media_data=media_data, message_id=msg_id, wa_name=wa_names.get(sender))
 
+    # --- MANEJO DE ESTADOS (SENT, DELIVERED, READ, FAILED) ---
+    # Todos los estados del payload se guardan en un solo lote / transacción
+    statuses = extract_statuses(data)
+    if statuses:
+        save_statuses(statuses)
@@ -2,34 +2,52 @@
 Follow-up Sender Service
 Procesa enrollments pendientes y envía templates de WhatsApp
 en los tiempos configurados.
+
+Motor por lotes: cada ciclo reclama hasta FOLLOWUP_BATCH_SIZE enrollments vencidos
+(UPDATE ... RETURNING con FOR UPDATE SKIP LOCKED), precarga secuencias, pasos,
+contactos y etiquetas en pocas queries, envía por un pool de FOLLOWUP_SEND_WORKERS
+threads con token bucket (FOLLOWUP_SEND_RATE msg/s) y escribe el resultado del lote
+en una sola transacción. Repite hasta que no quedan enrollments vencidos.
+
+Los errores se manejan por enrollment: uno que falla al prepararse se reprograma
+sin frenar al resto del lote. Lo enviado (historial + estado del enrollment) se
+escribe primero; las etiquetas se aplican después, solo a los enrollments cuya
+escritura ganó (siguen siendo de este lote y nadie los canceló mientras tanto).
 """
 import logging
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytz
+from sqlalchemy import text
+
+from config import Config
+from campaign_sender import PAIR_RATE_LIMIT_CODE, THROTTLE_CODES, error_code
 
 logger = logging.getLogger(__name__)
 
 TZ_AR = pytz.timezone('America/Argentina/Buenos_Aires')
+THROTTLE_RETRY_SECONDS = 120   # throttling de Meta: reintentar el mismo paso en 2 minutos
+ERROR_RETRY_SECONDS = 300      # error preparando un enrollment: reintentar en 5 minutos
 
 _running_lock = threading.Lock()
 
 
-def _maybe_add_seguimiento_enviado(db, contact, sequence, ContactTagHistory):
+def _maybe_add_seguimiento_enviado(db, contact, sequence, tag_cache):
     """Si la secuencia tiene add_tag_on_complete, agrega la etiqueta 'Seguimiento enviado'."""
-    logger.info(f"🔎 [FOLLOWUP] _maybe_add_seguimiento_enviado → secuencia='{sequence.name}' add_tag_on_complete={getattr(sequence, 'add_tag_on_complete', 'ATTR_MISSING')} contacto={contact.phone_number}")
     if not getattr(sequence, 'add_tag_on_complete', False):
-        logger.info(f"   ↳ add_tag_on_complete es False/None — no se agrega etiqueta")
         return
-    from models import Tag
-    tag = Tag.query.filter_by(name='Seguimiento enviado').first()
-    if not tag:
-        logger.info(f"   ↳ Etiqueta 'Seguimiento enviado' no existe — creando...")
-        tag = Tag(name='Seguimiento enviado', color='blue', is_active=True)
-        db.session.add(tag)
-        db.session.flush()
-    else:
-        logger.info(f"   ↳ Etiqueta 'Seguimiento enviado' existe (id={tag.id})")
+    from models import Tag, ContactTagHistory
+    tag = tag_cache.get('seguimiento')
+    if tag is None:
+        tag = Tag.query.filter_by(name='Seguimiento enviado').first()
+        if not tag:
+            logger.info(f"🏷️ [FOLLOWUP] Etiqueta 'Seguimiento enviado' no existe — creando...")
+            tag = Tag(name='Seguimiento enviado', color='blue', is_active=True)
+            db.session.add(tag)
+            db.session.flush()
+        tag_cache['seguimiento'] = tag
     if tag not in contact.tags:
         contact.tags.append(tag)
         db.session.add(ContactTagHistory(
@@ -41,8 +59,6 @@ def _maybe_add_seguimiento_enviado(db, contact, sequence, ContactTagHistory):
             created_by='followup_sender'
         ))
         logger.info(f"🏷️ [FOLLOWUP] Etiqueta 'Seguimiento enviado' agregada a {contact.phone_number}")
-    else:
-        logger.info(f"   ↳ Contacto ya tiene la etiqueta 'Seguimiento enviado' — nada que hacer")
 
 
 def _next_fixed_time(now_utc, weekday, time_str):
@@ -131,66 +147,103 @@ def run_followup_sender(app_context):
 
 
 def _run_followup_sender_inner(app_context):
+    """Reclama lotes de enrollments vencidos hasta vaciar la cola del momento."""
+    from campaign_sender import TokenBucket, AdaptiveRate
+
     with app_context:
-        from models import db, FollowUpEnrollment, FollowUpStep, FollowUpSequence, Contact
-        from whatsapp_service import whatsapp_api
+        from models import db
 
         try:
-            now = datetime.utcnow()
-
-            from sqlalchemy import func
-            # Deduplicar: si hay varios enrollments pending para el mismo (contact, sequence),
-            # procesar solo el más reciente para evitar envíos dobles por duplicados en DB
-            subq = db.session.query(
-                func.max(FollowUpEnrollment.id).label('max_id')
-            ).filter(
-                FollowUpEnrollment.status == 'pending',
-                FollowUpEnrollment.next_send_at <= now
-            ).group_by(
-                FollowUpEnrollment.contact_id,
-                FollowUpEnrollment.sequence_id
-            ).subquery()
-
-            pending = FollowUpEnrollment.query.filter(
-                FollowUpEnrollment.id == subq.c.max_id
-            ).all()
-
-            total_pending = FollowUpEnrollment.query.filter_by(status='pending').count()
-            logger.info(f"🔍 [FOLLOWUP] Ciclo — {len(pending)} listos para enviar / {total_pending} pendientes en total")
-
-            if not pending:
-                return
-
-            logger.info(f"📨 [FOLLOWUP] {len(pending)} enrollment(s) para procesar")
-
-            for enrollment in pending:
-                try:
-                    # Claim atómico: UPDATE en DB para que ningún otro proceso lo tome al mismo tiempo
-                    from sqlalchemy import text
-                    result = db.session.execute(
-                        text("UPDATE followup_enrollments SET status='processing' WHERE id=:id AND status='pending'"),
-                        {'id': enrollment.id}
-                    )
-                    db.session.commit()
-                    if result.rowcount == 0:
-                        logger.info(f"⏭️ [FOLLOWUP] Enrollment {enrollment.id} ya tomado por otro proceso — saltando")
-                        continue
-                    db.session.refresh(enrollment)
-                    _process_enrollment(db, enrollment, whatsapp_api, now)
-                except Exception as e:
-                    logger.error(f"❌ [FOLLOWUP] Error procesando enrollment {enrollment.id}: {e}", exc_info=True)
-                    # Evitar loop infinito: si crashea, resetear a pending y posponer 10 minutos
+            started = time.monotonic()
+            totals = {'sent': 0, 'failed': 0, 'throttled': 0, 'rescheduled': 0, 'finished': 0, 'cancelled': 0}
+            bucket = TokenBucket(Config.FOLLOWUP_SEND_RATE)
+            limiter = AdaptiveRate(bucket, Config.FOLLOWUP_SEND_RATE, Config.CAMPAIGN_MIN_SEND_RATE)
+            bodies = None  # Textos de los templates: se piden a Meta una vez por ciclo, recién si hay envíos
+
+            with ThreadPoolExecutor(max_workers=Config.FOLLOWUP_SEND_WORKERS, thread_name_prefix='followup') as pool:
+                while True:
+                    batch = _claim_batch(db, datetime.utcnow())
+                    if not batch:
+                        break
+                    if bodies is None:
+                        bodies = _load_template_bodies()
                     try:
-                        enrollment.status = 'pending'
-                        enrollment.next_send_at = now + timedelta(minutes=10)
-                        db.session.commit()
-                    except:
+                        stats = _process_batch(db, batch, bodies, pool, bucket, limiter)
+                    except Exception as e:
+                        # Último recurso (_process_batch maneja sus errores): lo que quede 'processing'
+                        # se reintenta al vencer el lease
                         db.session.rollback()
-
+                        logger.error(f"❌ [FOLLOWUP] Error procesando lote de {len(batch)} enrollment(s): {e}", exc_info=True)
+                        break
+                    for key, value in stats.items():
+                        totals[key] += value
+
+            if any(totals.values()):
+                elapsed = time.monotonic() - started
+                logger.info(f"📨 [FOLLOWUP] Ciclo en {elapsed:.1f}s — enviados: {totals['sent']}, fallidos: {totals['failed']}, "
+                            f"throttling: {totals['throttled']}, reprogramados: {totals['rescheduled']}, "
+                            f"finalizados: {totals['finished']}, cancelados: {totals['cancelled']}")
         except Exception as e:
             logger.error(f"❌ [FOLLOWUP] Error general: {e}", exc_info=True)
 
 
+def _claim_batch(db, now):
+    """
+    Reclama hasta FOLLOWUP_BATCH_SIZE enrollments vencidos con FOR UPDATE SKIP LOCKED.
+    Mientras están 'processing', next_send_at hace de lease: si el proceso muere a
+    mitad de camino, el enrollment vuelve a estar disponible al vencer. El valor del
+    lease (row.lease) identifica el claim: las escrituras del lote lo exigen.
+    """
+    rows = db.session.execute(text("""
+        UPDATE followup_enrollments e
+        SET status = 'processing', next_send_at = :lease
+        WHERE e.id IN (
+            SELECT id FROM followup_enrollments
+            WHERE status IN ('pending', 'processing') AND next_send_at <= :now
+            ORDER BY next_send_at
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING e.id, e.contact_id, e.sequence_id, e.current_step, e.next_send_at AS lease
+    """), {
+        'now': now, 'limit': Config.FOLLOWUP_BATCH_SIZE,
+        'lease': now + timedelta(seconds=Config.FOLLOWUP_LEASE_SECONDS),
+    }).fetchall()
+    db.session.commit()
+    return sorted(rows, key=lambda r: r.id)
+
+
+def _load_template_bodies():
+    """{(nombre, idioma): texto del BODY} de los templates de la cuenta."""
+    from whatsapp_service import whatsapp_api
+
+    bodies = {}
+    try:
+        for tpl in whatsapp_api.get_templates().get('templates', []):
+            body = next((c for c in tpl.get('components', []) if c.get('type', '').upper() == 'BODY'), None)
+            if body:
+                bodies[(tpl.get('name'), tpl.get('language'))] = body.get('text', '')
+    except Exception as e:
+        logger.warning(f"⚠️ [FOLLOWUP] No se pudieron obtener los templates: {e}")
+    return bodies
+
+
+def _render_content(bodies, step, language, components):
+    """Texto del template con los valores resueltos, para el historial del chat."""
+    body_text = bodies.get((step.template_name, language))
+    if body_text is None:
+        body_text = next((text_ for (name, _), text_ in bodies.items() if name == step.template_name), None)
+    if not body_text:
+        return f"[Template: {step.template_name}]"
+    body_params = []
+    for comp in (components or []):
+        if comp.get('type', '').lower() == 'body':
+            body_params = [p.get('text', '') for p in comp.get('parameters', [])]
+            break
+    for i, val in enumerate(body_params, 1):
+        body_text = body_text.replace(f'{{{{{i}}}}}', str(val))
+    return body_text
+
 
 def _resolve_components(template_params, contact):
     """
@@ -257,124 +310,209 @@ def _resolve_components(template_params, contact):
     return components if components else None
 
 
-def _process_enrollment(db, enrollment, whatsapp_api, now):
-    """Procesa un enrollment individual: envía el mensaje del paso actual."""
-    from models import db, FollowUpStep, FollowUpSequence
+def _send_one(job, bucket, limiter):
+    """Corre en un worker del pool: espera un token y envía (sin tocar la BD)."""
+    from whatsapp_service import whatsapp_api
 
-    sequence = enrollment.sequence
-    if not sequence or not sequence.is_active:
-        enrollment.status = 'cancelled'
-        enrollment.cancelled_at = now
-        db.session.commit()
-        return
+    bucket.acquire()
+    try:
+        result = whatsapp_api.send_template_message(
+            to_phone=job['phone'],
+            template_name=job['template_name'],
+            language_code=job['language'],
+            components=job['components']
+        ) or {}
+    except Exception as e:
+        result = {'error': str(e)}
+    if result.get('success'):
+        limiter.on_success()
+    elif error_code(result) in THROTTLE_CODES:
+        limiter.on_throttle()
+    return job, result
+
+
+def _process_batch(db, batch, bodies, pool, bucket, limiter):
+    """
+    Procesa un lote reclamado: precarga secuencias (con pasos y etiquetas) y contactos
+    (con etiquetas) en pocas queries, envía por el pool, escribe lo enviado y el estado
+    de los enrollments en una transacción y después aplica las etiquetas.
+    """
+    from models import FollowUpSequence, Contact
+    from sqlalchemy.orm import selectinload
+
+    now = datetime.utcnow()
+    stats = {'sent': 0, 'failed': 0, 'throttled': 0, 'rescheduled': 0, 'finished': 0, 'cancelled': 0}
+    updates = {}      # enrollment_id -> (status, current_step, next_send_at, cancelled_at)
+    tag_actions = {}  # enrollment_id -> acciones de etiquetas a aplicar si la escritura gana
+    targets = {}      # enrollment_id -> (contact, sequence)
+    leases = {row.id: row.lease for row in batch}
+
+    # Deduplicar: si hay varios enrollments para el mismo (contacto, secuencia) se procesa
+    # solo el más reciente y se cancelan los demás, para evitar envíos dobles
+    latest = {}
+    for row in batch:
+        previous = latest.get((row.contact_id, row.sequence_id))
+        if previous is not None:
+            updates[previous.id] = ('cancelled', previous.current_step, None, now)
+            stats['cancelled'] += 1
+        latest[(row.contact_id, row.sequence_id)] = row
 
-    # Chequear ventana horaria de la secuencia
-    next_open = _next_window_start(
-        now,
-        sequence.send_window_start,
-        sequence.send_window_end,
-        sequence.send_weekdays
-    )
-    if next_open is not None:
-        enrollment.status = 'pending'
-        enrollment.next_send_at = next_open
-        db.session.commit()
-        logger.info(f"🕐 [FOLLOWUP] Fuera de ventana — reprogramado para {next_open} UTC")
-        return
+    try:
+        sequences = {s.id: s for s in FollowUpSequence.query.options(
+            selectinload(FollowUpSequence.steps),
+            selectinload(FollowUpSequence.trigger_tags),
+            selectinload(FollowUpSequence.tag),
+        ).filter(FollowUpSequence.id.in_({r.sequence_id for r in latest.values()})).all()}
+        contacts = {c.id: c for c in Contact.query.options(selectinload(Contact.tags)).filter(
+            Contact.id.in_({r.contact_id for r in latest.values()})
+        ).all()}
+    except Exception as e:
+        # Todavía no se envió nada: devolver el lote a 'pending' en vez de esperar el lease
+        db.session.rollback()
+        logger.error(f"❌ [FOLLOWUP] Error precargando lote de {len(batch)} enrollment(s): {e}", exc_info=True)
+        retry_at = now + timedelta(seconds=ERROR_RETRY_SECONDS)
+        _write_batch(db, {row.id: ('pending', row.current_step, retry_at, None) for row in batch}, {}, leases)
+        stats['rescheduled'] += len(batch)
+        return stats
+
+    jobs = []
+    for row in latest.values():
+        try:
+            sequence = sequences.get(row.sequence_id)
+            if not sequence or not sequence.is_active:
+                updates[row.id] = ('cancelled', row.current_step, None, now)
+                stats['cancelled'] += 1
+                continue
+
+            # Chequear ventana horaria de la secuencia
+            next_open = _next_window_start(now, sequence.send_window_start, sequence.send_window_end, sequence.send_weekdays)
+            if next_open is not None:
+                updates[row.id] = ('pending', row.current_step, next_open, None)
+                stats['rescheduled'] += 1
+                continue
+
+            contact = contacts.get(row.contact_id)
+            if not contact:
+                updates[row.id] = ('cancelled', row.current_step, None, now)
+                stats['cancelled'] += 1
+                continue
+            targets[row.id] = (contact, sequence)
+
+            # Si el contacto tiene tag "Asistencia Humana", posponer 1 hora y no enviar
+            if any(t.name == 'Asistencia Humana' for t in contact.tags):
+                updates[row.id] = ('pending', row.current_step, now + timedelta(hours=1), None)
+                stats['rescheduled'] += 1
+                logger.info(f"⏸️ [FOLLOWUP] {contact.phone_number} tiene 'Asistencia Humana' — seguimiento pospuesto 1 hora")
+                continue
+
+            steps = {s.order: s for s in sequence.steps}
+            step = steps.get(row.current_step)
+            if not step:
+                _finish(row, contact, sequence, updates, tag_actions)
+                stats['finished'] += 1
+                continue
+
+            language = step.template_language or 'es_AR'
+            # Resolver variables del template con datos reales del contacto
+            components = _resolve_components(step.template_params, contact)
+            jobs.append({
+                'row': row, 'contact': contact, 'sequence': sequence, 'steps': steps, 'step': step,
+                'phone': contact.phone_number, 'template_name': step.template_name, 'language': language,
+                'components': components,
+                'content': _render_content(bodies, step, language, components),
+            })
+        except Exception as e:
+            # Solo este enrollment: se reprograma y el resto del lote sigue
+            logger.error(f"❌ [FOLLOWUP] Error preparando enrollment {row.id}: {e}", exc_info=True)
+            updates[row.id] = ('pending', row.current_step, now + timedelta(seconds=ERROR_RETRY_SECONDS), None)
+            tag_actions.pop(row.id, None)
+            stats['rescheduled'] += 1
+
+    messages = {}  # enrollment_id -> mensaje para el historial
+    for job, result in pool.map(lambda j: _send_one(j, bucket, limiter), jobs):
+        row, contact, step = job['row'], job['contact'], job['step']
+        sent_ok = result.get('messages') or result.get('message_id') or result.get('success')
+        if not sent_ok and (error_code(result) in THROTTLE_CODES or error_code(result) == PAIR_RATE_LIMIT_CODE):
+            # Throttling de Meta (de la cuenta o del destinatario): el paso no se pierde, se reintenta en un rato
+            updates[row.id] = ('pending', row.current_step, now + timedelta(seconds=THROTTLE_RETRY_SECONDS), None)
+            stats['throttled'] += 1
+            continue
 
-    contact = enrollment.contact
-    if not contact:
-        enrollment.status = 'cancelled'
-        db.session.commit()
-        return
+        if sent_ok:
+            stats['sent'] += 1
+            logger.info(f"📤 [FOLLOWUP] Paso {step.order} '{step.template_name}' → {contact.phone_number} "
+                        f"(secuencia '{job['sequence'].name}')")
+            if result.get('message_id'):
+                messages[row.id] = {
+                    'wa_id': result['message_id'], 'phone': contact.phone_number, 'content': job['content'],
+                    'template_name': step.template_name, 'template_language': job['language'],
+                }
+        else:
+            stats['failed'] += 1
+            logger.warning(f"⚠️ [FOLLOWUP] Falló paso {step.order} → {contact.phone_number}: {result}")
 
-    # Si el contacto tiene tag "Asistencia Humana", posponer 1 hora y no enviar
-    if any(t.name == 'Asistencia Humana' for t in contact.tags):
-        enrollment.status = 'pending'
-        enrollment.next_send_at = now + timedelta(hours=1)
-        db.session.commit()
-        logger.info(f"⏸️ [FOLLOWUP] {contact.phone_number} tiene 'Asistencia Humana' — seguimiento pospuesto 1 hora")
-        return
+        # Igual que antes: el paso se da por ejecutado aunque Meta lo rechace
+        try:
+            _advance(row, contact, job['sequence'], job['steps'], step, now, updates, tag_actions)
+        except Exception as e:
+            # El paso ya se ejecutó: no repetirlo, seguir con el próximo más tarde
+            logger.error(f"❌ [FOLLOWUP] Error programando el próximo paso del enrollment {row.id}: {e}", exc_info=True)
+            updates[row.id] = ('pending', row.current_step + 1, now + timedelta(seconds=ERROR_RETRY_SECONDS), None)
+            tag_actions.pop(row.id, None)
+        if updates[row.id][0] == 'finished':
+            stats['finished'] += 1
+
+    written = _write_batch(db, updates, messages, leases)
+
+    # Etiquetas: solo para enrollments cuya escritura ganó (no cancelados mientras se enviaba)
+    tag_cache = {}
+    for enrollment_id, actions in tag_actions.items():
+        if enrollment_id not in written:
+            continue
+        contact, sequence = targets[enrollment_id]
+        try:
+            _apply_tag_actions(db, contact, sequence, actions, tag_cache)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            tag_cache.clear()
+            logger.error(f"❌ [FOLLOWUP] Error aplicando etiquetas del enrollment {enrollment_id}: {e}", exc_info=True)
+    return stats
 
-    step = FollowUpStep.query.filter_by(
-        sequence_id=enrollment.sequence_id,
-        order=enrollment.current_step
-    ).first()
 
-    if not step:
-        from models import ContactTagHistory
-        contact = enrollment.contact
-        _maybe_add_seguimiento_enviado(db, contact, sequence, ContactTagHistory)
-        enrollment.status = 'finished'
-        db.session.commit()
-        logger.info(f"✅ [FOLLOWUP] Secuencia '{sequence.name}' finalizada para {contact.phone_number}")
+def _advance(row, contact, sequence, steps, step, now, updates, tag_actions):
+    """Después de ejecutar un paso: programar el siguiente o finalizar (y qué etiquetas tocar)."""
+    # Si el paso tiene remove_tag_on_execute, quitar la etiqueta y finalizar
+    if step.remove_tag_on_execute:
+        tag_actions.setdefault(row.id, []).append('remove_trigger_tags')
+        _finish(row, contact, sequence, updates, tag_actions)
         return
 
-    # Resolver variables del template con datos reales del contacto
-    components = _resolve_components(step.template_params, contact)
-
-    result = whatsapp_api.send_template_message(
-        to_phone=contact.phone_number,
-        template_name=step.template_name,
-        language_code=step.template_language or 'es_AR',
-        components=components
-    )
-
-    logger.info(f"📬 [FOLLOWUP] Resultado envío paso {step.order} → {contact.phone_number}: {result}")
-    sent_ok = result and (result.get('messages') or result.get('message_id') or result.get('success'))
-    if sent_ok:
-        logger.info(f"📤 =============================================")
-        logger.info(f"📤 MENSAJE DE SEGUIMIENTO ENVIADO")
-        logger.info(f"📤   Contacto  : {contact.name or contact.phone_number} ({contact.phone_number})")
-        logger.info(f"📤   Secuencia : {sequence.name}")
-        logger.info(f"📤   Paso      : {step.order} — template '{step.template_name}'")
-        logger.info(f"📤 =============================================")
-        # Guardar en DB para que aparezca en el dashboard
-        try:
-            from event_handlers import save_message
-            from whatsapp_service import whatsapp_api as _wa
-
-            # Intentar obtener el contenido real del template
-            content = f"[Template: {step.template_name}]"
-            try:
-                tpl_data = _wa.get_templates()
-                tpl = next((t for t in tpl_data.get('templates', []) if t['name'] == step.template_name), None)
-                if tpl:
-                    body_comp = next((c for c in tpl.get('components', []) if c.get('type', '').upper() == 'BODY'), None)
-                    if body_comp:
-                        body_text = body_comp.get('text', '')
-                        # Reemplazar {{1}}, {{2}}... con los valores resueltos
-                        body_params = []
-                        for comp in (components or []):
-                            if comp.get('type', '').lower() == 'body':
-                                body_params = [p.get('text', '') for p in comp.get('parameters', [])]
-                                break
-                        for i, val in enumerate(body_params, 1):
-                            body_text = body_text.replace(f'{{{{{i}}}}}', str(val))
-                        content = body_text
-            except Exception:
-                pass  # Fallback al nombre del template
-
-            wa_msg_id = result.get('message_id')
-            save_message(
-                wa_message_id=wa_msg_id,
-                phone_number=contact.phone_number,
-                direction='outbound',
-                message_type='template',
-                content=content,
-                wa_name=None
-            )
-        except Exception as e:
-            logger.warning(f"⚠️ [FOLLOWUP] No se pudo guardar mensaje en DB: {e}")
+    next_step = steps.get(row.current_step + 1)
+    if not next_step:
+        _finish(row, contact, sequence, updates, tag_actions)
+        return
+
+    if (next_step.schedule_type or 'delay') == 'fixed_time' and next_step.scheduled_weekday is not None and next_step.scheduled_time:
+        next_send_at = _next_fixed_time(now, next_step.scheduled_weekday, next_step.scheduled_time)
     else:
-        logger.warning(f"⚠️ [FOLLOWUP] sent_ok=False — result={result}")
+        next_send_at = now + timedelta(hours=next_step.delay_hours)
+    updates[row.id] = ('pending', row.current_step + 1, next_send_at, None)
 
-    # Si el paso tiene remove_tag_on_execute, quitar la etiqueta y finalizar
-    if step.remove_tag_on_execute:
-        from models import ContactTagHistory
-        tags_to_remove = sequence.get_trigger_tags()
-        
-        for tag_to_remove in tags_to_remove:
+
+def _finish(row, contact, sequence, updates, tag_actions):
+    if getattr(sequence, 'add_tag_on_complete', False):
+        tag_actions.setdefault(row.id, []).append('add_seguimiento')
+    updates[row.id] = ('finished', row.current_step, None, None)
+    logger.info(f"✅ [FOLLOWUP] Secuencia '{sequence.name}' finalizada para {contact.phone_number}")
+
+
+def _apply_tag_actions(db, contact, sequence, actions, tag_cache):
+    """Aplica en la sesión (sin commit) las etiquetas decididas para un enrollment."""
+    from models import ContactTagHistory
+
+    if 'remove_trigger_tags' in actions:
+        for tag_to_remove in sequence.get_trigger_tags():
             if tag_to_remove in contact.tags:
                 contact.tags.remove(tag_to_remove)
                 db.session.add(ContactTagHistory(
@@ -386,34 +524,68 @@ def _process_enrollment(db, enrollment, whatsapp_api, now):
                     created_by='followup_sender'
                 ))
                 logger.info(f"🏷️ [FOLLOWUP] Etiqueta '{tag_to_remove.name}' quitada de {contact.phone_number}")
+    if 'add_seguimiento' in actions:
+        _maybe_add_seguimiento_enviado(db, contact, sequence, tag_cache)
 
-        _maybe_add_seguimiento_enviado(db, contact, sequence, ContactTagHistory)
-        enrollment.status = 'finished'
-        logger.info(f"✅ [FOLLOWUP] Secuencia '{sequence.name}' finalizada (remove_tag) para {contact.phone_number}")
-        db.session.commit()
-        return
 
-    # Buscar siguiente paso
-    next_step = FollowUpStep.query.filter_by(
-        sequence_id=enrollment.sequence_id,
-        order=enrollment.current_step + 1
-    ).first()
-
-    if next_step:
-        enrollment.current_step += 1
-        enrollment.status = 'pending'
-        if (next_step.schedule_type or 'delay') == 'fixed_time' and next_step.scheduled_weekday is not None and next_step.scheduled_time:
-            enrollment.next_send_at = _next_fixed_time(now, next_step.scheduled_weekday, next_step.scheduled_time)
-        else:
-            enrollment.next_send_at = now + timedelta(hours=next_step.delay_hours)
-        logger.info(f"📅 [FOLLOWUP] Próximo paso ({next_step.order}) programado para {enrollment.next_send_at}")
-    else:
-        from models import ContactTagHistory
-        _maybe_add_seguimiento_enviado(db, contact, sequence, ContactTagHistory)
-        enrollment.status = 'finished'
-        logger.info(f"✅ [FOLLOWUP] Secuencia completa para {contact.phone_number}")
+def _write_batch(db, updates, messages, leases):
+    """
+    Una transacción por lote: historial de mensajes ({enrollment_id: mensaje}) y estado
+    de los enrollments. Solo se pisan los que siguen 'processing' con el lease de este
+    lote: si el contacto respondió mientras se enviaba, la cancelación gana, y si el
+    lease venció y otro proceso los retomó, no se pisa su claim.
+    Si la escritura del lote falla se reintenta de a un enrollment, para no perder lo
+    enviado por una fila con problemas. Devuelve los ids efectivamente actualizados.
+    """
+    try:
+        written = _write_updates(db, updates, messages, leases)
+        db.session.commit()
+        return written
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"❌ [FOLLOWUP] Error escribiendo el lote ({len(updates)} enrollment(s)), reintentando de a uno: {e}")
 
-    db.session.commit()
+    written = set()
+    for enrollment_id, update in updates.items():
+        try:
+            message = {enrollment_id: messages[enrollment_id]} if enrollment_id in messages else {}
+            written |= _write_updates(db, {enrollment_id: update}, message, leases)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"❌ [FOLLOWUP] No se pudo registrar el enrollment {enrollment_id}: {e}", exc_info=True)
+    return written
+
+
+def _write_updates(db, updates, messages, leases):
+    """Historial + UPDATE de enrollments (sin commit); devuelve los ids actualizados."""
+    from campaign_sender import insert_template_messages
+
+    insert_template_messages(db, list(messages.values()))
+    if not updates:
+        return set()
+    ids = list(updates)
+    rows = db.session.execute(text("""
+        UPDATE followup_enrollments e
+        SET status = v.status,
+            current_step = v.current_step,
+            next_send_at = v.next_send_at,
+            cancelled_at = COALESCE(v.cancelled_at, e.cancelled_at)
+        FROM unnest(CAST(:ids AS integer[]), CAST(:statuses AS varchar[]), CAST(:steps AS integer[]),
+                    CAST(:next_send_at AS timestamp[]), CAST(:cancelled_at AS timestamp[]),
+                    CAST(:leases AS timestamp[]))
+             AS v(id, status, current_step, next_send_at, cancelled_at, lease)
+        WHERE e.id = v.id AND e.status = 'processing' AND e.next_send_at = v.lease
+        RETURNING e.id
+    """), {
+        'ids': ids,
+        'statuses': [updates[i][0] for i in ids],
+        'steps': [updates[i][1] for i in ids],
+        'next_send_at': [updates[i][2] for i in ids],
+        'cancelled_at': [updates[i][3] for i in ids],
+        'leases': [leases[i] for i in ids],
+    }).fetchall()
+    return {r[0] for r in rows}
 
 
 def cancel_enrollment_on_reply(phone_number, app_context=None):
@@ -429,9 +601,10 @@ def cancel_enrollment_on_reply(phone_number, app_context=None):
         if not contact:
             return
 
-        active = FollowUpEnrollment.query.filter_by(
-            contact_id=contact.id,
-            status='pending'
+        # 'processing': el lote en curso ve la cancelación al escribir y no reprograma el enrollment
+        active = FollowUpEnrollment.query.filter(
+            FollowUpEnrollment.contact_id == contact.id,
+            FollowUpEnrollment.status.in_(['pending', 'processing'])
         ).all()
 
         if active:
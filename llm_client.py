@@ -0,0 +1,286 @@
+"""
+LLM Client
+Capa de ejecución para las llamadas a OpenAI del categorizador y el auto tagger.
+
+- Concurrencia acotada: hasta LLM_MAX_CONCURRENCY llamadas en vuelo por proceso.
+- Presupuestos por minuto: LLM_RPM requests y LLM_TPM tokens. Cada llamada reserva
+  1 request y una estimación de tokens (prompt / 4 + máximo de salida); al terminar
+  se ajusta con el uso real que devuelve la API.
+- Reintentos con backoff exponencial y jitter ante 429 / 5xx / timeouts / errores de
+  conexión (respeta Retry-After si viene). El SDK se crea con max_retries=0 para que
+  los reintentos no se dupliquen ni se salteen los presupuestos.
+- Métricas por propósito ('categorizer', 'auto_tagger', 'analysis'): llamadas,
+  errores, reintentos, latencia y tokens, en get_metrics() (expuestas en
+  /api/admin/llm). record_savings() anota las llamadas que se evitaron (p. ej.
+  reglas del auto tagger respondidas en la llamada combinada del categorizador)
+  y los tokens estimados que se ahorraron.
+
+OPENAI_BASE_URL permite apuntar a un servidor compatible con la API de OpenAI
+(p. ej. el stub local de test_llm_stub.py).
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from openai import OpenAI
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+CHARS_PER_TOKEN = 4  # Estimación gruesa para reservar el presupuesto de tokens antes de la llamada
+
+_client = None
+_client_lock = threading.Lock()
+_semaphore = threading.BoundedSemaphore(max(Config.LLM_MAX_CONCURRENCY, 1))
+
+
+class MinuteBudget:
+    """Presupuesto por minuto con recarga continua: acquire(n) bloquea hasta que alcanza."""
+
+    def __init__(self, per_minute):
+        self._lock = threading.Lock()
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self._available = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount):
+        if self.capacity <= 0:
+            return  # Sin límite
+        # Una llamada más grande que el presupuesto entero igual tiene que poder salir
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._available >= amount:
+                    self._available -= amount
+                    return
+                wait = (amount - self._available) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, delta):
+        """Devuelve (delta > 0) o descuenta (delta < 0) la diferencia entre lo reservado y lo usado."""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._available = min(self.capacity, self._available + delta)
+
+
+class CallMetrics:
+    """Métricas acumuladas de las llamadas de un propósito."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.in_flight = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.last_error = None
+        self.saved_calls = 0
+        self.saved_tokens = 0
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self, elapsed, prompt_tokens=0, completion_tokens=0, error=None, retried=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+            self.last_seconds = elapsed
+            if retried:
+                self.retries += 1
+            elif error is not None:
+                self.errors += 1
+            else:
+                self.calls += 1
+                self.prompt_tokens += prompt_tokens
+                self.completion_tokens += completion_tokens
+            if error is not None:
+                self.last_error = str(error)[:300]
+
+    def saved(self, calls, tokens):
+        with self._lock:
+            self.saved_calls += calls
+            self.saved_tokens += tokens
+
+    def to_dict(self):
+        with self._lock:
+            attempts = self.calls + self.errors + self.retries
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'retries': self.retries,
+                'in_flight': self.in_flight,
+                'avg_seconds': round(self.total_seconds / attempts, 3) if attempts else None,
+                'max_seconds': round(self.max_seconds, 3),
+                'last_seconds': round(self.last_seconds, 3) if self.last_seconds is not None else None,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'avg_tokens_per_call': round((self.prompt_tokens + self.completion_tokens) / self.calls) if self.calls else None,
+                'last_error': self.last_error,
+                'saved_calls': self.saved_calls,
+                'saved_tokens_estimate': self.saved_tokens,
+            }
+
+
+_rpm = MinuteBudget(Config.LLM_RPM)
+_tpm = MinuteBudget(Config.LLM_TPM)
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_client():
+    """Cliente OpenAI compartido (None si falta OPENAI_API_KEY)."""
+    global _client
+    if _client is None and Config.OPENAI_API_KEY:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=Config.OPENAI_API_KEY,
+                    base_url=Config.OPENAI_BASE_URL or None,
+                    timeout=Config.LLM_TIMEOUT_SECONDS,
+                    max_retries=0,
+                )
+    return _client
+
+
+def is_configured():
+    return get_client() is not None
+
+
+def _metrics_for(purpose):
+    with _metrics_lock:
+        if purpose not in _metrics:
+            _metrics[purpose] = CallMetrics()
+        return _metrics[purpose]
+
+
+def record_savings(purpose, calls=1, tokens=0):
+    """Anota llamadas de `purpose` evitadas y los tokens netos estimados que se ahorraron."""
+    _metrics_for(purpose).saved(calls, int(tokens))
+
+
+def estimate_tokens(messages, max_output=0):
+    """Tokens aproximados de una llamada (misma estimación que se reserva del presupuesto TPM)."""
+    return _estimate_tokens(messages, max_output)
+
+
+def _estimate_tokens(messages, max_output):
+    chars = sum(len(m.get('content') or '') for m in messages)
+    return chars // CHARS_PER_TOKEN + (max_output or 0)
+
+
+def _retry_delay(error, attempt):
+    """Segundos a esperar antes de reintentar, o None si el error no es reintentable."""
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, APIStatusError):
+        if error.status_code != 429 and error.status_code < 500:
+            return None
+    elif not isinstance(error, APIConnectionError):  # Incluye APITimeoutError
+        return None
+
+    # Full jitter: reparte los reintentos de las llamadas concurrentes que fallaron juntas
+    delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** attempt)))
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), RETRY_MAX_SECONDS))
+        except ValueError:
+            pass
+    return delay
+
+
+def chat(purpose, messages, model, **kwargs):
+    """
+    chat.completions.create con concurrencia acotada, presupuestos RPM / TPM y reintentos.
+    kwargs se pasan tal cual al SDK (max_tokens / max_completion_tokens, response_format...).
+    Devuelve la respuesta del SDK; si se agotan los reintentos relanza el último error.
+    """
+    client = get_client()
+    if client is None:
+        raise RuntimeError("OPENAI_API_KEY no configurada")
+
+    metrics = _metrics_for(purpose)
+    estimated = _estimate_tokens(messages, kwargs.get('max_completion_tokens') or kwargs.get('max_tokens'))
+    attempt = 0
+    while True:
+        _rpm.acquire(1)
+        _tpm.acquire(estimated)
+        with _semaphore:
+            metrics.started()
+            started = time.monotonic()
+            try:
+                response = client.chat.completions.create(model=model, messages=messages, **kwargs)
+            except Exception as e:
+                elapsed = time.monotonic() - started
+                delay = _retry_delay(e, attempt) if attempt < Config.LLM_MAX_RETRIES else None
+                metrics.finished(elapsed, error=e, retried=delay is not None)
+                if delay is None:
+                    raise
+                logger.warning(f"🔁 [LLM] {purpose}: {type(e).__name__} — reintento {attempt + 1}/{Config.LLM_MAX_RETRIES} en {delay:.1f}s")
+            else:
+                elapsed = time.monotonic() - started
+                usage = getattr(response, 'usage', None)
+                prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+                completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+                if usage is not None:
+                    _tpm.adjust(estimated - (prompt_tokens + completion_tokens))
+                metrics.finished(elapsed, prompt_tokens, completion_tokens)
+                logger.debug(f"[LLM] {purpose}: {elapsed:.2f}s, {prompt_tokens}+{completion_tokens} tokens")
+                return response
+        # Esperar fuera del semáforo: el slot queda libre para otras llamadas
+        time.sleep(delay)
+        attempt += 1
+
+
+def run_parallel(func, items):
+    """
+    Aplica func a cada item con hasta LLM_MAX_CONCURRENCY threads.
+    Genera (item, resultado, error) a medida que terminan, para que el thread que
+    llama escriba en la BD sin compartir la sesión de SQLAlchemy con los workers.
+    """
+    items = list(items)
+    if not items:
+        return
+    workers = min(max(Config.LLM_MAX_CONCURRENCY, 1), len(items))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='llm') as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+
+def get_metrics():
+    """Configuración de la capa y métricas por propósito (en este proceso)."""
+    with _metrics_lock:
+        purposes = dict(_metrics)
+    return {
+        'configured': is_configured(),
+        'max_concurrency': Config.LLM_MAX_CONCURRENCY,
+        'rpm': Config.LLM_RPM,
+        'tpm': Config.LLM_TPM,
+        'max_retries': Config.LLM_MAX_RETRIES,
+        'purposes': {name: m.to_dict() for name, m in purposes.items()},
+    }
@@ -0,0 +1,408 @@
+"""
+Local Classifier
+Etapa local del categorizador, antes de la llamada a OpenAI: resuelve acá las
+sesiones triviales (saludos, agradecimientos, confirmaciones, una respuesta
+corta a una campaña) cuando el tema sale con confianza, y manda a la IA solo
+las ambiguas.
+
+- Trivial: hay mensajes entrantes y todos son cortos, de texto, sin preguntas y
+  formados solo por palabras de TRIVIAL_WORDS (sin entrantes no hay nada que
+  confirme que la sesión es un saludo: va a la IA). Para esas
+  sesiones rating 'neutral', sin preguntas sin responder ni asistencia humana
+  es lo que devuelve la IA; lo único a decidir es el tema.
+- Tema: ConversationTopic.keywords sobre el texto de la sesión (incluye los
+  templates enviados) + un modelo TF-IDF / regresión logística multinomial en
+  NumPy entrenado con las sesiones corregidas a mano (auto_categorized=False).
+  Se reentrena cada LOCAL_CLASSIFIER_RETRAIN_HOURS en un thread aparte (el ciclo
+  del categorizador no lo espera: mientras tanto usa el modelo anterior). Sin
+  datos suficientes funciona solo con keywords; sin keyword ni modelo no hay
+  confianza y la sesión va a la IA.
+- Se decide localmente si la confianza >= LOCAL_CLASSIFIER_THRESHOLD.
+- Contadores local / remoto (con el motivo) en get_stats(), expuestos en
+  /api/admin/llm. evaluate() compara contra las etiquetas que puso la IA
+  (ver eval_local_classifier.py).
+"""
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import text
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+LOCAL_SUMMARY = "Clasificación local: saludo, agradecimiento o confirmación sin consulta."
+FALLBACK_SUMMARY = "Error en categorización automática"
+
+TRIVIAL_WORDS = {
+    'hola', 'holaa', 'buenas', 'buen', 'buenos', 'dia', 'dias', 'tarde', 'tardes', 'noche', 'noches',
+    'gracias', 'graciass', 'muchas', 'mil', 'muchisimas', 'ok', 'okey', 'oka', 'okk', 'dale', 'listo',
+    'perfecto', 'genial', 'excelente', 'bien', 'joya', 'barbaro', 'entendido', 'de', 'nada', 'igualmente',
+    'saludos', 'chau', 'adios', 'bueno', 'muy', 'amable', 'a', 'usted', 'vos', 'ti',
+}
+TRIVIAL_MAX_CHARS = 60  # Por mensaje entrante
+TRIVIAL_MAX_MESSAGES = 6
+KEYWORD_CONFIDENCE = 0.9  # Una sola keyword de tema en la sesión
+
+MIN_TRAINING_SESSIONS = 30
+TRAINING_LIMIT = 3000  # Sesiones corregidas más recientes
+MAX_FEATURES = 4000
+TRAIN_ITERATIONS = 300
+LEARNING_RATE = 2.0
+L2 = 1e-4
+OTHER_LABEL = 0  # Clase de las sesiones sin tema
+
+_model = None
+_model_lock = threading.Lock()
+_training = False  # Hay un entrenamiento en curso en este proceso
+_stats_lock = threading.Lock()
+_stats = Counter()
+
+
+def _normalize(value):
+    value = unicodedata.normalize('NFKD', (value or '').lower())
+    return ''.join(c for c in value if not unicodedata.combining(c))
+
+
+def _tokens(value):
+    return re.findall(r'[a-z0-9]+', _normalize(value))
+
+
+def session_text(messages):
+    return "\n".join(m.content or f"[{m.message_type}]" for m in messages)
+
+
+def is_trivial(messages):
+    """Sesión sin contenido propio del usuario (ver docstring del módulo)."""
+    if len(messages) > TRIVIAL_MAX_MESSAGES:
+        return False
+    inbound = 0
+    for m in messages:
+        if m.direction == 'outbound':
+            if m.content and '[ESCALAR_HUMANO]' in m.content:
+                return False
+            continue
+        inbound += 1
+        # Audio, imagen, documento, ubicación... pueden ser un comprobante o una consulta
+        if m.message_type not in (None, 'text') or not m.content:
+            return False
+        if len(m.content) > TRIVIAL_MAX_CHARS or '?' in m.content:
+            return False
+        if not set(_tokens(m.content)) <= TRIVIAL_WORDS:
+            return False
+    return inbound > 0
+
+
+def keyword_topics(messages, topics):
+    """Temas con al menos una keyword (palabra o frase completa) en el texto de la sesión."""
+    padded = f" {' '.join(_tokens(session_text(messages)))} "
+    matched = []
+    for t in topics:
+        for kw in t.keywords or []:
+            kw_tokens = _tokens(kw)
+            if kw_tokens and f" {' '.join(kw_tokens)} " in padded:
+                matched.append(t)
+                break
+    return matched
+
+
+# ==================== Modelo TF-IDF + softmax ====================
+
+class TopicModel:
+    """TF-IDF (unigramas + bigramas) + regresión logística multinomial entrenada con descenso de gradiente."""
+
+    def __init__(self, vocabulary, idf, weights, bias, labels, samples):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.labels = labels  # topic_id por columna (OTHER_LABEL = sin tema)
+        self.samples = samples
+        self.trained_at = datetime.utcnow()
+
+    @staticmethod
+    def features(value):
+        tokens = _tokens(value)
+        return tokens + [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+
+    @classmethod
+    def train(cls, texts, labels):
+        docs = [cls.features(t) for t in texts]
+        df = Counter(f for doc in docs for f in set(doc))
+        vocab_terms = [f for f, n in df.most_common(MAX_FEATURES) if n >= 2]
+        vocabulary = {f: i for i, f in enumerate(vocab_terms)}
+        idf = np.log((1 + len(docs)) / (1 + np.array([df[f] for f in vocab_terms], dtype=np.float32))) + 1
+
+        label_values = sorted(set(labels))
+        label_index = {v: i for i, v in enumerate(label_values)}
+        x = cls._matrix(docs, vocabulary, idf)
+        y = np.zeros((len(labels), len(label_values)), dtype=np.float32)
+        y[np.arange(len(labels)), [label_index[v] for v in labels]] = 1
+
+        weights = np.zeros((len(vocabulary), len(label_values)), dtype=np.float32)
+        bias = np.zeros(len(label_values), dtype=np.float32)
+        for _ in range(TRAIN_ITERATIONS):
+            grad = (_softmax(x @ weights + bias) - y) / len(labels)
+            weights -= LEARNING_RATE * (x.T @ grad + L2 * weights)
+            bias -= LEARNING_RATE * grad.sum(axis=0)
+        return cls(vocabulary, idf, weights, bias, label_values, len(labels))
+
+    @staticmethod
+    def _matrix(docs, vocabulary, idf):
+        x = np.zeros((len(docs), len(vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(docs):
+            for f, n in Counter(doc).items():
+                col = vocabulary.get(f)
+                if col is not None:
+                    x[row, col] = 1 + np.log(n)  # tf sublineal
+        x *= idf
+        norms = np.linalg.norm(x, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return x / norms
+
+    def predict(self, value):
+        """(topic_id u OTHER_LABEL, probabilidad)."""
+        x = self._matrix([self.features(value)], self.vocabulary, self.idf)
+        probs = _softmax(x @ self.weights + self.bias)[0]
+        best = int(np.argmax(probs))
+        return self.labels[best], float(probs[best])
+
+    def to_dict(self):
+        return {
+            'trained_at': self.trained_at.isoformat() + 'Z',
+            'samples': self.samples,
+            'classes': len(self.labels),
+            'features': len(self.vocabulary),
+        }
+
+
+def _softmax(z):
+    z = z - z.max(axis=1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def load_sessions(conn, manual, limit, exclude_summaries=()):
+    """
+    [(session_row, [mensajes])] de las sesiones más recientes corregidas a mano (manual=True)
+    o categorizadas por la IA (manual=False). conn: db.session o una conexión de SQLAlchemy.
+    """
+    rows = conn.execute(text("""
+        WITH s AS (
+            SELECT id, phone_number, started_at, ended_at, topic_id, rating, summary,
+                   has_unanswered_questions, escalated_to_human
+            FROM conversation_sessions
+            WHERE auto_categorized = :auto AND NOT (COALESCE(summary, '') = ANY(:exclude))
+            ORDER BY id DESC
+            LIMIT :limit
+        )
+        SELECT s.id, s.topic_id, s.rating, s.summary, s.has_unanswered_questions, s.escalated_to_human,
+               m.direction, m.content, m.message_type
+        FROM s
+        JOIN whatsapp_messages m ON m.phone_number = s.phone_number
+             AND m.timestamp >= s.started_at AND m.timestamp <= s.ended_at
+        ORDER BY s.id, m.timestamp, m.id
+    """), {'auto': not manual, 'limit': limit, 'exclude': list(exclude_summaries)}).fetchall()
+
+    sessions = {}
+    for r in rows:
+        if r.id not in sessions:
+            sessions[r.id] = (r, [])
+        sessions[r.id][1].append(r)
+    return list(sessions.values())
+
+
+def train(conn):
+    """Entrena con las sesiones corregidas a mano. None si no alcanzan los datos."""
+    sessions = load_sessions(conn, manual=True, limit=TRAINING_LIMIT)
+    labels = [s.topic_id or OTHER_LABEL for s, _ in sessions]
+    if len(sessions) < MIN_TRAINING_SESSIONS or len(set(labels)) < 2:
+        logger.info(f"🧮 [LOCAL_CLASSIFIER] {len(sessions)} sesión(es) corregidas — sin modelo, solo keywords")
+        return None
+    started = time.monotonic()
+    model = TopicModel.train([session_text(msgs) for _, msgs in sessions], labels)
+    logger.info(f"🧮 [LOCAL_CLASSIFIER] Modelo entrenado: {model.samples} sesiones, {len(model.labels)} clases, "
+                f"{len(model.vocabulary)} features ({time.monotonic() - started:.1f}s)")
+    return model
+
+
+def ensure_model(app):
+    """
+    Si el modelo no existe o venció, lanza el reentrenamiento en un thread aparte y
+    vuelve enseguida (llamado al inicio de cada ciclo del categorizador, que sigue
+    con el modelo anterior o solo con keywords hasta que termine).
+    """
+    global _training
+    with _model_lock:
+        if _training:
+            return False
+        if _model is not None and (datetime.utcnow() - _model.trained_at).total_seconds() < Config.LOCAL_CLASSIFIER_RETRAIN_HOURS * 3600:
+            return False
+        _training = True
+
+    t = threading.Thread(target=_train_in_background, args=(app,), name='local-classifier-train')
+    t.daemon = True
+    t.start()
+    return True
+
+
+def _train_in_background(app):
+    """Entrena con una conexión propia (no la sesión del categorizador) y publica el modelo."""
+    global _model, _training
+    try:
+        with app.app_context():
+            from models import db
+            with db.engine.connect() as conn:
+                model = train(conn) or _KeywordsOnly()
+    except Exception as e:
+        logger.error(f"❌ [LOCAL_CLASSIFIER] Error entrenando: {e}", exc_info=True)
+        model = _KeywordsOnly()
+    with _model_lock:
+        _model = model
+        _training = False
+
+
+class _KeywordsOnly:
+    """Marcador de 'sin modelo' con fecha, para no reintentar el entrenamiento en cada ciclo."""
+
+    def __init__(self):
+        self.trained_at = datetime.utcnow()
+
+    def to_dict(self):
+        return {'trained_at': self.trained_at.isoformat() + 'Z', 'samples': 0}
+
+
+def predict_topic(messages, topics, model=None):
+    """(tema o None para 'Otro', confianza) combinando keywords y modelo."""
+    by_id = {t.id: t for t in topics}
+    matched = keyword_topics(messages, topics)
+    if len(matched) > 1:
+        return None, 0.5  # Varias keywords de temas distintos: que decida la IA
+
+    if isinstance(model, TopicModel):
+        label, prob = model.predict(session_text(messages))
+        predicted = by_id.get(label)
+        if matched:
+            if predicted is matched[0]:
+                return predicted, max(prob, KEYWORD_CONFIDENCE)
+            return matched[0], min(prob, 0.5)  # Keywords y modelo no coinciden
+        if label != OTHER_LABEL and predicted is None:
+            return None, 0.0  # Tema borrado después de entrenar
+        return predicted, prob
+
+    if matched:
+        return matched[0], KEYWORD_CONFIDENCE
+    return None, 0.0  # Sin keyword ni modelo no hay evidencia del tema: que decida la IA
+
+
+def classify(messages, topics, model=None, threshold=None):
+    """
+    Resultado con el mismo formato que la respuesta de la IA (ver store_categorization),
+    o None si la sesión tiene que ir a la IA.
+    """
+    threshold = Config.LOCAL_CLASSIFIER_THRESHOLD if threshold is None else threshold
+    if not is_trivial(messages):
+        return None
+    topic, confidence = predict_topic(messages, topics, model)
+    if confidence < threshold:
+        return None
+    return {
+        'topic': topic.name if topic else 'Otro',
+        'rating': 'neutral',
+        'summary': LOCAL_SUMMARY,
+        'has_unanswered_questions': False,
+        'needs_human_assistance': False,
+        'confidence': round(confidence, 3),
+    }
+
+
+def record(decision, reason=None):
+    """Cuenta una decisión: 'local' o 'remote' (con el motivo: not_trivial, low_confidence, rules_pending)."""
+    with _stats_lock:
+        _stats[decision] += 1
+        if reason:
+            _stats[f"remote_{reason}"] += 1
+
+
+def decide(messages, topics, rules_pending=False):
+    """
+    classify() con el modelo actual y contadores. None → va a la IA.
+    rules_pending: la sesión lleva preguntas del auto tagger (pasada combinada), la llamada hace falta igual.
+    """
+    if not Config.LOCAL_CLASSIFIER_ENABLED:
+        return None
+    if rules_pending:
+        record('remote', 'rules_pending')
+        return None
+    result = classify(messages, topics, _model)
+    if result is None:
+        record('remote', 'not_trivial' if not is_trivial(messages) else 'low_confidence')
+    else:
+        record('local')
+    return result
+
+
+def get_stats():
+    with _stats_lock:
+        counters = dict(_stats)
+    local, remote = counters.get('local', 0), counters.get('remote', 0)
+    return {
+        'enabled': Config.LOCAL_CLASSIFIER_ENABLED,
+        'threshold': Config.LOCAL_CLASSIFIER_THRESHOLD,
+        'model': _model.to_dict() if _model is not None else None,
+        'local': local,
+        'remote': remote,
+        'local_ratio': round(local / (local + remote), 3) if local + remote else None,
+        'remote_reasons': {k[len('remote_'):]: v for k, v in counters.items() if k.startswith('remote_')},
+    }
+
+
+def evaluate(conn, limit=1000, thresholds=(0.7, 0.8, 0.85, 0.9, 0.95)):
+    """
+    Evaluación offline: entrena con las sesiones corregidas y clasifica las últimas `limit`
+    sesiones que etiquetó la IA. Por umbral: cobertura (sesiones resueltas localmente) y
+    coincidencia con la IA en tema, rating y flags sobre esas sesiones.
+    """
+    topics = conn.execute(text("SELECT id, name, keywords FROM conversation_topics")).fetchall()
+    model = train(conn)
+    sessions = load_sessions(conn, manual=False, limit=limit, exclude_summaries=(LOCAL_SUMMARY, FALLBACK_SUMMARY))
+
+    scored = []  # (confianza, coincide tema, coincide rating, coinciden flags)
+    trivial = 0
+    for session, msgs in sessions:
+        if not is_trivial(msgs):
+            continue
+        trivial += 1
+        topic, confidence = predict_topic(msgs, topics, model)
+        scored.append((
+            confidence,
+            (topic.id if topic else None) == session.topic_id,
+            session.rating == 'neutral',
+            not session.has_unanswered_questions and not session.escalated_to_human,
+        ))
+
+    report = {
+        'evaluated_sessions': len(sessions),
+        'trivial_sessions': trivial,
+        'model': model.to_dict() if model else None,
+        'thresholds': [],
+    }
+    for threshold in thresholds:
+        kept = [s for s in scored if s[0] >= threshold]
+        n = len(kept)
+        report['thresholds'].append({
+            'threshold': threshold,
+            'local': n,
+            'coverage': round(n / len(sessions), 3) if sessions else None,
+            'topic_agreement': round(sum(s[1] for s in kept) / n, 3) if n else None,
+            'rating_agreement': round(sum(s[2] for s in kept) / n, 3) if n else None,
+            'flags_agreement': round(sum(s[3] for s in kept) / n, 3) if n else None,
+            'full_agreement': round(sum(s[1] and s[2] and s[3] for s in kept) / n, 3) if n else None,
+        })
+    return report
@@ -0,0 +1,111 @@
+"""
+Media Pipeline
+Descarga en background de los archivos multimedia entrantes.
+
+El mensaje se guarda enseguida con media_status='pending'. Un pool acotado de
+workers (MEDIA_DOWNLOAD_WORKERS) baja el binario de la Graph API en streaming
+directo a MinIO (ver WhatsAppAPI.download_media) y al terminar completa
+media_url y media_status ('ready' o 'failed').
+Si el proceso se reinicia con descargas a medio camino, requeue_stale_media
+(llamado desde el scheduler) las vuelve a encolar.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+STALE_MINUTES = 10
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=Config.MEDIA_DOWNLOAD_WORKERS,
+                thread_name_prefix='media-download'
+            )
+        return _executor
+
+
+def enqueue_media_download(wa_message_id, media_id, on_done=None):
+    """
+    Encola la descarga de un media entrante.
+    on_done(media_url) se llama al terminar (media_url=None si falló).
+    Retorna False si ese mensaje ya estaba en curso en este proceso.
+    """
+    with _in_flight_lock:
+        if wa_message_id in _in_flight:
+            return False
+        _in_flight.add(wa_message_id)
+
+    from app import app
+    _get_executor().submit(_download_job, app, wa_message_id, media_id, on_done)
+    return True
+
+
+def _download_job(app, wa_message_id, media_id, on_done):
+    from models import db, Message
+    from whatsapp_service import whatsapp_api
+
+    media_url = None
+    try:
+        media_url = whatsapp_api.download_media(media_id)
+
+        with app.app_context():
+            message = Message.query.filter_by(wa_message_id=wa_message_id).first()
+            if message:
+                message.media_url = media_url
+                message.media_status = 'ready' if media_url else 'failed'
+                db.session.commit()
+        logger.info(f"📎 [MEDIA] {wa_message_id}: {'listo → ' + media_url if media_url else 'falló'}")
+    except Exception as e:
+        logger.error(f"❌ [MEDIA] Error procesando media de {wa_message_id}: {e}", exc_info=True)
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(wa_message_id)
+
+    if on_done:
+        try:
+            on_done(media_url)
+        except Exception as e:
+            logger.error(f"❌ [MEDIA] Error en callback post-descarga de {wa_message_id}: {e}", exc_info=True)
+
+
+def requeue_stale_media(app_context):
+    """
+    Re-encola mensajes que siguen en 'pending' hace más de STALE_MINUTES (ej: worker reiniciado).
+    Si el mensaje todavía espera su adjunto en n8n_outbox, la descarga re-encolada
+    completa la reserva igual que la original (n8n_forwarder.resolve).
+    """
+    with app_context:
+        from models import db, Message, N8nOutbox
+
+        cutoff = datetime.utcnow() - timedelta(minutes=STALE_MINUTES)
+        forward_pending = db.session.query(N8nOutbox.id).filter(
+            N8nOutbox.message_id == Message.wa_message_id,
+            N8nOutbox.pending.is_(True)
+        ).exists()
+        stale = db.session.query(Message.wa_message_id, Message.media_id, forward_pending).filter(
+            Message.media_status == 'pending',
+            Message.timestamp < cutoff,
+            Message.media_id.isnot(None)
+        ).limit(100).all()
+
+    from n8n_forwarder import resolve
+    requeued = 0
+    for wa_id, media_id, forward in stale:
+        on_done = (lambda url, wa_id=wa_id: resolve(wa_id, url)) if forward else None
+        if enqueue_media_download(wa_id, media_id, on_done=on_done):
+            requeued += 1
+    if requeued:
+        logger.info(f"🔁 [MEDIA] {requeued} descarga(s) pendiente(s) re-encolada(s)")
@@ -0,0 +1,96 @@
+"""
+Message Search
+Búsqueda de mensajes y contactos apoyada en índices (ver migrate_message_search.py):
+
+- whatsapp_messages.content: GIN sobre to_tsvector('spanish', ...) para búsqueda por
+  palabras (con stemming: "pedidos" encuentra "pedido") y GIN trigram para substrings
+  ("ped" dentro de "pedido", números de pedido, etc.).
+- whatsapp_contacts: GIN trigram sobre name, phone_number y contact_id.
+
+Los predicados de este módulo están escritos para que Postgres use esos índices
+(BitmapOr entre FTS y trigram), así la latencia no crece con el historial.
+Los snippets se resaltan con <mark> y el resto del texto sale escapado.
+"""
+import html
+import re
+
+TS_CONFIG = 'spanish'
+MIN_TRGM_CHARS = 3  # pg_trgm no puede usar el índice con patrones de menos de 3 caracteres
+
+# Marcadores que no aparecen en texto normal; se reemplazan por <mark> después de escapar
+_SEL_START = '⟦'
+_SEL_STOP = '⟧'
+HEADLINE_OPTIONS = f"StartSel={_SEL_START}, StopSel={_SEL_STOP}, MaxWords=24, MinWords=8, ShortWord=2, MaxFragments=1"
+
+SNIPPET_CONTEXT_CHARS = 60
+
+TSVECTOR_SQL = f"to_tsvector('{TS_CONFIG}', coalesce({{col}}, ''))"
+TSQUERY_SQL = f"websearch_to_tsquery('{TS_CONFIG}', :q)"
+
+
+def normalize_term(term):
+    """Recorta y colapsa espacios del término de búsqueda."""
+    return re.sub(r'\s+', ' ', (term or '').strip())
+
+
+def like_pattern(term):
+    """Patrón ILIKE con los comodines del usuario escapados."""
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def search_params(term):
+    return {'q': term, 'pattern': like_pattern(term)}
+
+
+def message_match_sql(term, alias='m'):
+    """
+    Predicado indexable "el mensaje coincide con :q / :pattern".
+    Con términos cortos solo se usa FTS (el trigram haría seq scan).
+    """
+    fts = f"{TSVECTOR_SQL.format(col=f'{alias}.content')} @@ {TSQUERY_SQL}"
+    if len(term) < MIN_TRGM_CHARS:
+        return f"({fts})"
+    return f"({fts} OR {alias}.content ILIKE :pattern)"
+
+
+def contact_match_sql(alias='c'):
+    """Predicado indexable (trigram) sobre nombre, teléfono e ID externo del contacto."""
+    return (f"({alias}.name ILIKE :pattern OR {alias}.phone_number ILIKE :pattern "
+            f"OR {alias}.contact_id ILIKE :pattern)")
+
+
+def rank_sql(alias='m'):
+    """Ranking: relevancia FTS + bonus si el substring exacto aparece."""
+    return (f"(ts_rank_cd({TSVECTOR_SQL.format(col=f'{alias}.content')}, {TSQUERY_SQL}) "
+            f"+ CASE WHEN {alias}.content ILIKE :pattern THEN 0.1 ELSE 0 END)")
+
+
+def headline_sql(alias='m'):
+    return f"ts_headline('{TS_CONFIG}', coalesce({alias}.content, ''), {TSQUERY_SQL}, '{HEADLINE_OPTIONS}')"
+
+
+def highlight(content, headline, term):
+    """
+    Snippet HTML seguro con las coincidencias en <mark>.
+    Usa el headline de Postgres si resaltó algo (coincidencia por palabra/stem);
+    si no (coincidencia solo por substring), recorta alrededor del substring.
+    """
+    if headline and _SEL_START in headline:
+        return (html.escape(headline)
+                .replace(_SEL_START, '<mark>')
+                .replace(_SEL_STOP, '</mark>'))
+
+    text = content or ''
+    idx = text.lower().find(term.lower()) if term else -1
+    if idx < 0:
+        snippet = text[:SNIPPET_CONTEXT_CHARS * 2]
+        return html.escape(snippet) + ('...' if len(text) > len(snippet) else '')
+
+    start = max(0, idx - SNIPPET_CONTEXT_CHARS)
+    end = min(len(text), idx + len(term) + SNIPPET_CONTEXT_CHARS)
+    return (('...' if start > 0 else '')
+            + html.escape(text[start:idx])
+            + '<mark>' + html.escape(text[idx:idx + len(term)]) + '</mark>'
+            + html.escape(text[idx + len(term):end])
+            + ('...' if end < len(text) else ''))
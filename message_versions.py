@@ -0,0 +1,68 @@
+"""
+Message Versions
+Versión monótona por fila de whatsapp_messages para la carga incremental del chat.
+
+Cada INSERT / UPDATE de un mensaje (estado de entrega, media lista, marcado como
+leído, etc.) toma una versión nueva en un trigger BEFORE, sin importar desde dónde
+se escriba (ORM, SQL crudo, lotes).
+
+La versión es txid_current() * VERSIONS_PER_XID + un contador de la secuencia
+whatsapp_messages_row_version_seq: queda ordenada por transacción y no por el
+momento del nextval. Las transacciones con xid menor al xmin del snapshot ya
+terminaron, así que todo row_version <= settled_version() es definitivo: lo que
+todavía no commiteó (o commitee después) va a tener una versión mayor. Con eso los
+watermarks avanzan hasta settled_version() sin márgenes de re-lectura.
+
+Así /api/messages/<phone> puede:
+- decidir si el chat cambió: alguna fila del teléfono con row_version mayor a la
+  versión asentada que ya tiene el cliente (índice phone_number, row_version);
+- devolver solo lo que cambió desde esa versión.
+Las filas previas a la instalación quedan con row_version NULL (equivale a versión 0).
+
+Columna, índices y trigger se instalan con `python migrate_message_versions.py`.
+"""
+import logging
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 71004
+
+VERSIONS_PER_XID = 1048576  # 2^20 versiones por transacción antes de pisar a la siguiente
+
+# Función y trigger (la columna y los índices los crea migrate_message_versions.py)
+SCHEMA_SQL = f"""
+CREATE SEQUENCE IF NOT EXISTS whatsapp_messages_row_version_seq;
+
+CREATE OR REPLACE FUNCTION messages_bump_row_version() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.row_version := txid_current() * {VERSIONS_PER_XID}
+        + nextval('whatsapp_messages_row_version_seq') % {VERSIONS_PER_XID};
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_messages_row_version ON whatsapp_messages;
+CREATE TRIGGER trg_messages_row_version
+    BEFORE INSERT OR UPDATE ON whatsapp_messages
+    FOR EACH ROW EXECUTE PROCEDURE messages_bump_row_version();
+"""
+
+# Mayor versión que ya no puede cambiar (ver settled_version)
+SETTLED_VERSION_EXPR = f"(txid_snapshot_xmin(txid_current_snapshot()) * {VERSIONS_PER_XID} - 1)"
+
+
+def install(cursor):
+    """Instala secuencia, función y trigger usando un cursor DBAPI."""
+    cursor.execute(f"SELECT pg_advisory_xact_lock({LOCK_KEY})")
+    cursor.execute(SCHEMA_SQL)
+
+
+def settled_version(conn):
+    """
+    Mayor row_version definitivo: ninguna transacción en curso (ni futura) puede
+    escribir una versión menor o igual. Tomarlo ANTES de leer las filas.
+    Acepta una Connection o una Session de SQLAlchemy.
+    """
+    return conn.execute(text(f"SELECT {SETTLED_VERSION_EXPR}")).scalar()
@@ -0,0 +1,22 @@
+"""
+Migración: crm_users.auth_version (contador que invalida el cache de usuarios/permisos, ver auth_cache.py)
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+cur = conn.cursor()
+
+print("Agregando columna auth_version a crm_users...")
+cur.execute("ALTER TABLE crm_users ADD COLUMN IF NOT EXISTS auth_version INTEGER NOT NULL DEFAULT 0;")
+conn.commit()
+print("✅ Columna creada.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
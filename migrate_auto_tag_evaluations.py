@@ -0,0 +1,65 @@
+"""
+Migración: decisiones del auto tagger en su propia tabla (ver auto_tagger.py)
+- Tabla auto_tag_evaluations + índice único (rule_id, phone_number, message_id)
+  e índice por evaluated_at para la purga por retención
+- Copia las decisiones guardadas como filas 'auto_tag_{regla}_{teléfono}_{mensaje}'
+  de chatbot_config y después las borra
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Creando tabla auto_tag_evaluations...")
+cur.execute("""
+    CREATE TABLE IF NOT EXISTS auto_tag_evaluations (
+        id BIGSERIAL PRIMARY KEY,
+        rule_id INTEGER NOT NULL REFERENCES auto_tag_rules(id) ON DELETE CASCADE,
+        phone_number VARCHAR(20) NOT NULL,
+        message_id INTEGER NOT NULL,
+        result BOOLEAN NOT NULL,
+        evaluated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+""")
+print("✅ Tabla creada.")
+
+print("Creando índices...")
+cur.execute("""
+    CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_auto_tag_evaluations_key
+    ON auto_tag_evaluations(rule_id, phone_number, message_id);
+""")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_auto_tag_evaluations_evaluated
+    ON auto_tag_evaluations(evaluated_at);
+""")
+print("✅ Índices creados.")
+
+print("Copiando decisiones desde chatbot_config...")
+cur.execute("BEGIN")
+cur.execute(r"""
+    INSERT INTO auto_tag_evaluations (rule_id, phone_number, message_id, result, evaluated_at)
+    SELECT split_part(c.key, '_', 3)::int,
+           split_part(c.key, '_', 4),
+           split_part(c.key, '_', 5)::int,
+           c.value = 'True',
+           COALESCE(c.updated_at, CURRENT_TIMESTAMP)
+    FROM chatbot_config c
+    WHERE c.key ~ '^auto_tag_[0-9]+_[^_]+_[0-9]+$'
+      AND EXISTS (SELECT 1 FROM auto_tag_rules r WHERE r.id = split_part(c.key, '_', 3)::int)
+    ON CONFLICT (rule_id, phone_number, message_id) DO NOTHING
+""")
+print(f"✅ {cur.rowcount} decisión(es) copiadas.")
+cur.execute(r"DELETE FROM chatbot_config WHERE key ~ '^auto_tag_[0-9]+_[^_]+_[0-9]+$'")
+print(f"✅ {cur.rowcount} fila(s) borradas de chatbot_config.")
+cur.execute("COMMIT")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,30 @@
+"""
+Migración: contadores por campaña `campaign_counters` + triggers que los mantienen.
+También sirve como comando de reconstrucción: es idempotente.
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+from campaign_counters import install, REBUILD_SQL
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+cur = conn.cursor()
+
+print("Instalando tabla campaign_counters, función y triggers...")
+install(cur, rebuild=False)
+print("✅ Esquema instalado.")
+
+print("Reconstruyendo contadores desde whatsapp_campaign_logs...")
+cur.execute(REBUILD_SQL)
+cur.execute("SELECT count(*) FROM campaign_counters")
+print(f"✅ {cur.fetchone()[0]} campañas cargadas.")
+
+conn.commit()
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,38 @@
+"""
+Migración: claim de logs de campaña con lease (envío multi-worker, ver campaign_sender.py)
+- Columnas claimed_by / lease_expires_at en whatsapp_campaign_logs
+- Columnas next_attempt_at / retry_count: backoff por destinatario ante throttling
+- Índice parcial idx_campaign_logs_pending para reclamar tramos con SKIP LOCKED
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Agregando columnas de lease a whatsapp_campaign_logs...")
+cur.execute("""
+    ALTER TABLE whatsapp_campaign_logs
+        ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(100),
+        ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS retry_count INTEGER NOT NULL DEFAULT 0;
+""")
+print("✅ Columnas creadas.")
+
+print("Creando índice idx_campaign_logs_pending...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_campaign_logs_pending
+    ON whatsapp_campaign_logs(campaign_id, id) WHERE status = 'pending';
+""")
+print("✅ Índice creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,51 @@
+"""
+Migración: atribución de respuestas a campañas materializada (ver campaign_metrics.py)
+- Columnas response_count / first_response_at en whatsapp_campaign_logs
+- Índice (contact_phone, created_at) para encontrar los logs alcanzados por un mensaje entrante
+- Tabla campaign_response_metrics
+El cálculo inicial lo hace el scheduler en su primera corrida (no hay watermark todavía).
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Agregando columnas de respuestas a whatsapp_campaign_logs...")
+cur.execute("""
+    ALTER TABLE whatsapp_campaign_logs
+        ADD COLUMN IF NOT EXISTS response_count INTEGER NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS first_response_at TIMESTAMP;
+""")
+print("✅ Columnas creadas.")
+
+print("Creando índice idx_campaign_logs_phone_created...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_campaign_logs_phone_created
+    ON whatsapp_campaign_logs(contact_phone, created_at);
+""")
+print("✅ Índice creado.")
+
+print("Creando tabla campaign_response_metrics...")
+cur.execute("""
+    CREATE TABLE IF NOT EXISTS campaign_response_metrics (
+        campaign_id INTEGER PRIMARY KEY REFERENCES whatsapp_campaigns(id) ON DELETE CASCADE,
+        responders INTEGER NOT NULL DEFAULT 0,
+        total_responses INTEGER NOT NULL DEFAULT 0,
+        latency_p50_seconds DOUBLE PRECISION,
+        latency_p90_seconds DOUBLE PRECISION,
+        latency_buckets JSON,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+""")
+print("✅ Tabla creada.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,57 @@
+"""
+Migración: categorizador incremental (ver conversation_categorizer.py)
+- Tabla categorizer_state (último mensaje visto y sesión abierta por teléfono)
+- Índice parcial para encontrar las sesiones abiertas con mensajes sin categorizar
+- Tabla categorizer_pending_ranges (sesiones cerradas que se reintentan)
+El estado inicial lo arma el scheduler en su primera corrida (no hay watermark todavía).
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Creando tabla categorizer_state...")
+cur.execute("""
+    CREATE TABLE IF NOT EXISTS categorizer_state (
+        phone_number VARCHAR(20) PRIMARY KEY,
+        last_message_id INTEGER NOT NULL,
+        last_message_at TIMESTAMP NOT NULL,
+        last_direction VARCHAR(10),
+        last_message_type VARCHAR(20),
+        tail_started_at TIMESTAMP,
+        tail_dirty BOOLEAN NOT NULL DEFAULT TRUE,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+""")
+print("✅ Tabla creada.")
+
+print("Creando índice idx_categorizer_state_dirty...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_categorizer_state_dirty
+    ON categorizer_state(last_message_at) WHERE tail_dirty;
+""")
+print("✅ Índice creado.")
+
+print("Creando tabla categorizer_pending_ranges...")
+cur.execute("""
+    CREATE TABLE IF NOT EXISTS categorizer_pending_ranges (
+        phone_number VARCHAR(20) NOT NULL,
+        started_at TIMESTAMP NOT NULL,
+        ended_at TIMESTAMP NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (phone_number, started_at)
+    );
+""")
+print("✅ Tabla creada.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,31 @@
+"""
+Migración: tabla resumen `conversations` + triggers que la mantienen.
+También sirve como comando de backfill / reconstrucción: es idempotente.
+La app no instala los triggers al arrancar: correr este script en cada deploy que los cambie.
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+from conversations import install, REBUILD_SQL
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+cur = conn.cursor()
+
+print("Instalando tabla conversations, funciones y triggers...")
+install(cur, rebuild=False)
+print("✅ Esquema instalado.")
+
+print("Reconstruyendo resumen de conversaciones (backfill)...")
+cur.execute(REBUILD_SQL)
+cur.execute("SELECT count(*) FROM conversations")
+print(f"✅ {cur.fetchone()[0]} conversaciones cargadas.")
+
+conn.commit()
+cur.close()
+conn.close()
+print("✅ Migración completada.")
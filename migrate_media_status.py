@@ -0,0 +1,33 @@
+"""
+Migración: agrega columna media_status a whatsapp_messages (media pipeline)
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.autocommit = True
+cur = conn.cursor()
+
+print("Agregando columna media_status...")
+cur.execute("""
+    ALTER TABLE whatsapp_messages
+    ADD COLUMN IF NOT EXISTS media_status VARCHAR(10) DEFAULT NULL;
+""")
+print("✅ Columna media_status agregada.")
+
+print("Creando índice parcial de media pendiente...")
+conn.set_isolation_level(0)  # AUTOCOMMIT a nivel de conexión para CONCURRENTLY
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_media_pending
+    ON whatsapp_messages(timestamp) WHERE media_status = 'pending';
+""")
+print("✅ Índice creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,44 @@
+"""
+Migración: índices de búsqueda (FTS en español + trigram) para mensajes y contactos.
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.autocommit = True
+cur = conn.cursor()
+
+print("Habilitando extensión pg_trgm...")
+cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+print("✅ pg_trgm habilitada.")
+
+conn.set_isolation_level(0)  # AUTOCOMMIT a nivel de conexión para CONCURRENTLY
+
+INDEXES = [
+    ("idx_messages_content_fts",
+     "whatsapp_messages USING GIN (to_tsvector('spanish', coalesce(content, '')))"),
+    ("idx_messages_content_trgm",
+     "whatsapp_messages USING GIN (content gin_trgm_ops)"),
+    ("idx_contacts_name_trgm",
+     "whatsapp_contacts USING GIN (name gin_trgm_ops)"),
+    ("idx_contacts_phone_trgm",
+     "whatsapp_contacts USING GIN (phone_number gin_trgm_ops)"),
+    ("idx_contacts_contact_id_trgm",
+     "whatsapp_contacts USING GIN (contact_id gin_trgm_ops)"),
+    ("idx_conversations_phone_trgm",
+     "conversations USING GIN (phone_number gin_trgm_ops)"),
+]
+
+for name, definition in INDEXES:
+    print(f"Creando índice {name} (puede tardar en tablas grandes)...")
+    cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition};")
+    print(f"✅ {name} creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,75 @@
+"""
+Migración: último estado de entrega desnormalizado en whatsapp_messages
+- Columnas status, sent_at, delivered_at, read_at_recipient, failed_code
+  (las mantiene save_statuses al ingerir estados; ver event_handlers.py)
+- Backfill desde whatsapp_message_statuses, en lotes por id
+- Índice parcial idx_messages_failed para el listado de mensajes fallidos
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+BATCH_SIZE = 5000
+
+# Mismo orden que event_handlers.STATUS_RANK_SQL
+RANK_SQL = "(CASE {col} WHEN 'sent' THEN 1 WHEN 'failed' THEN 2 WHEN 'delivered' THEN 3 WHEN 'read' THEN 4 ELSE 0 END)"
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT: cada lote se confirma solo y CREATE INDEX CONCURRENTLY lo requiere
+cur = conn.cursor()
+
+print("Agregando columnas de estado a whatsapp_messages...")
+cur.execute("""
+    ALTER TABLE whatsapp_messages
+        ADD COLUMN IF NOT EXISTS status VARCHAR(20),
+        ADD COLUMN IF NOT EXISTS sent_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS read_at_recipient TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS failed_code VARCHAR(50);
+""")
+print("✅ Columnas creadas.")
+
+cur.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM whatsapp_messages")
+min_id, max_id = cur.fetchone()
+
+print(f"Backfill de estados (ids {min_id}..{max_id}, lotes de {BATCH_SIZE})...")
+total = 0
+for start in range(min_id, max_id + 1, BATCH_SIZE):
+    cur.execute(f"""
+        UPDATE whatsapp_messages m
+        SET status = v.status,
+            sent_at = v.sent_at,
+            delivered_at = v.delivered_at,
+            read_at_recipient = v.read_at,
+            failed_code = CASE WHEN v.status = 'failed' THEN v.failed_code END
+        FROM (
+            SELECT s.wa_message_id,
+                   (array_agg(s.status ORDER BY {RANK_SQL.format(col='s.status')} DESC, s.timestamp DESC))[1] AS status,
+                   MIN(s.timestamp) FILTER (WHERE s.status = 'sent') AS sent_at,
+                   MIN(s.timestamp) FILTER (WHERE s.status = 'delivered') AS delivered_at,
+                   MIN(s.timestamp) FILTER (WHERE s.status = 'read') AS read_at,
+                   (array_agg(s.error_code ORDER BY s.timestamp DESC) FILTER (WHERE s.status = 'failed'))[1] AS failed_code
+            FROM whatsapp_messages mm
+            JOIN whatsapp_message_statuses s ON s.wa_message_id = mm.wa_message_id
+            WHERE mm.id >= %s AND mm.id < %s
+            GROUP BY s.wa_message_id
+        ) v
+        WHERE m.wa_message_id = v.wa_message_id
+          AND {RANK_SQL.format(col='v.status')} > 0
+    """, (start, start + BATCH_SIZE))
+    total += cur.rowcount
+print(f"✅ {total} mensaje(s) actualizados.")
+
+print("Creando índice idx_messages_failed...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_failed
+    ON whatsapp_messages(timestamp) WHERE status = 'failed';
+""")
+print("✅ Índice creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,74 @@
+"""
+Migración: template_name / template_language en whatsapp_messages
+- Columnas que se completan al enviar (campañas, seguimientos, send-template, Chatwoot)
+- Backfill de los mensajes salientes históricos con el matcher precompilado
+  (template_matcher.py), en lotes por id. Solo toca filas con template_name NULL,
+  así que se puede volver a correr (p. ej. después de recuperar templates borrados)
+- Índice parcial idx_messages_template para las estadísticas de /analytics
+"""
+import psycopg2
+import psycopg2.extras
+import os
+from dotenv import load_dotenv
+
+from template_matcher import get_matcher
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+BATCH_SIZE = 5000
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT: cada lote se confirma solo y CREATE INDEX CONCURRENTLY lo requiere
+cur = conn.cursor()
+
+print("Agregando columnas template_name / template_language...")
+cur.execute("""
+    ALTER TABLE whatsapp_messages
+        ADD COLUMN IF NOT EXISTS template_name VARCHAR(100),
+        ADD COLUMN IF NOT EXISTS template_language VARCHAR(10);
+""")
+print("✅ Columnas creadas.")
+
+print("Obteniendo templates de la cuenta de WhatsApp...")
+matcher = get_matcher()
+
+cur.execute("""
+    SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0)
+    FROM whatsapp_messages WHERE direction = 'outbound' AND template_name IS NULL
+""")
+min_id, max_id = cur.fetchone()
+
+print(f"Backfill de templates (ids {min_id}..{max_id}, lotes de {BATCH_SIZE})...")
+total = 0
+for start in range(min_id, max_id + 1, BATCH_SIZE):
+    cur.execute("""
+        SELECT id, content FROM whatsapp_messages
+        WHERE id >= %s AND id < %s
+          AND direction = 'outbound' AND template_name IS NULL AND content IS NOT NULL
+    """, (start, start + BATCH_SIZE))
+    matches = []
+    for msg_id, content in cur.fetchall():
+        name, language = matcher.match(content)
+        if name:
+            matches.append((msg_id, name[:100], language))
+    if matches:
+        psycopg2.extras.execute_values(cur, """
+            UPDATE whatsapp_messages m
+            SET template_name = v.name, template_language = v.language
+            FROM (VALUES %s) AS v(id, name, language)
+            WHERE m.id = v.id
+        """, matches, template="(%s, %s, %s::varchar)")
+        total += len(matches)
+print(f"✅ {total} mensaje(s) clasificados.")
+
+print("Creando índice idx_messages_template...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_template
+    ON whatsapp_messages(template_name, timestamp) WHERE template_name IS NOT NULL;
+""")
+print("✅ Índice creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,53 @@
+"""
+Migración: row_version en whatsapp_messages (carga incremental del chat, ver message_versions.py)
+- Columna row_version e índices (phone_number, row_version) y (row_version) creados
+  CONCURRENTLY antes de instalar el trigger, para no bloquear escrituras en tablas grandes.
+  El índice por row_version lo usan los watermarks (analytics_rollups, campaign_metrics,
+  conversation_categorizer)
+- Secuencia, función y trigger BEFORE INSERT/UPDATE (re-ejecutar para actualizar la función)
+
+La app ya no instala nada de esto al arrancar: correr este script en cada deploy que lo cambie.
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+from message_versions import install
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Agregando columna row_version...")
+cur.execute("SET lock_timeout = '5s';")  # No encolar escrituras detrás del ALTER si hay una transacción larga
+cur.execute("ALTER TABLE whatsapp_messages ADD COLUMN IF NOT EXISTS row_version BIGINT;")
+cur.execute("RESET lock_timeout;")
+print("✅ Columna creada.")
+
+print("Creando índice idx_messages_phone_row_version...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_phone_row_version
+    ON whatsapp_messages(phone_number, row_version);
+""")
+print("✅ Índice creado.")
+
+print("Creando índice idx_messages_row_version...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_row_version
+    ON whatsapp_messages(row_version);
+""")
+print("✅ Índice creado.")
+
+print("Instalando secuencia, función y trigger...")
+conn.set_isolation_level(1)
+install(cur)
+conn.commit()
+print("✅ Trigger instalado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,43 @@
+"""
+Migración: tabla n8n_outbox (buffer de debounce hacia n8n persistido, ver n8n_forwarder.py)
+- Tabla con message_id único (deduplica re-entregas) e índice por lease_expires_at
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Creando tabla n8n_outbox...")
+cur.execute("""
+    CREATE TABLE IF NOT EXISTS n8n_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        phone_number VARCHAR(20) NOT NULL,
+        message_id VARCHAR(100) UNIQUE,
+        item JSON NOT NULL,
+        wa_name VARCHAR(200),
+        pending BOOLEAN NOT NULL DEFAULT FALSE,
+        media_url TEXT,
+        claimed_by VARCHAR(100),
+        lease_expires_at TIMESTAMP NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+""")
+print("✅ Tabla creada.")
+
+print("Creando índice idx_n8n_outbox_lease...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_n8n_outbox_lease
+    ON n8n_outbox(lease_expires_at);
+""")
+print("✅ Índice creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
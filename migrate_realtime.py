@@ -0,0 +1,41 @@
+"""
+Migración: tabla `realtime_events` + funciones y triggers que la llenan (ver realtime.py).
+- Columna xid (transacción que escribió el evento) e índice (xid, id) CONCURRENTLY
+- Funciones y triggers (re-ejecutar para actualizarlos): la app ya no los instala al arrancar
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+from realtime import install
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+cur = conn.cursor()
+
+print("Instalando tabla realtime_events, funciones y triggers...")
+install(cur)
+conn.commit()
+print("✅ Esquema instalado.")
+
+print("Agregando columna xid...")
+# Sin default en el ADD COLUMN (no reescribe la tabla); los eventos previos quedan con NULL
+cur.execute("ALTER TABLE realtime_events ADD COLUMN IF NOT EXISTS xid BIGINT;")
+cur.execute("ALTER TABLE realtime_events ALTER COLUMN xid SET DEFAULT txid_current();")
+conn.commit()
+print("✅ Columna creada.")
+
+print("Creando índice idx_realtime_events_xid...")
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_realtime_events_xid
+    ON realtime_events(xid, id);
+""")
+print("✅ Índice creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,34 @@
+"""
+Migración: índices para la ingesta en lote de estados (save_statuses)
+- whatsapp_campaign_logs(message_id): UPDATE ... FROM de logs de campaña por wa_message_id
+- whatsapp_message_statuses(wa_message_id, status): descarte de estados re-enviados por Meta
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+conn.set_isolation_level(0)  # AUTOCOMMIT para CREATE INDEX CONCURRENTLY
+cur = conn.cursor()
+
+print("Creando índice idx_campaign_logs_message_id...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_campaign_logs_message_id
+    ON whatsapp_campaign_logs(message_id);
+""")
+print("✅ Índice creado.")
+
+print("Creando índice idx_statuses_wa_id_status...")
+cur.execute("""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_statuses_wa_id_status
+    ON whatsapp_message_statuses(wa_message_id, status);
+""")
+print("✅ Índice creado.")
+
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -0,0 +1,31 @@
+"""
+Migración: índice de visibilidad `phone_visibility` + triggers que lo mantienen.
+También sirve como comando de backfill / reconstrucción: es idempotente.
+La app no instala los triggers al arrancar: correr este script en cada deploy que los cambie.
+"""
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+from visibility import install, REBUILD_SQL
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+conn = psycopg2.connect(DATABASE_URL)
+cur = conn.cursor()
+
+print("Instalando tabla phone_visibility, funciones y triggers...")
+install(cur, rebuild=False)
+print("✅ Esquema instalado.")
+
+print("Reconstruyendo índice de visibilidad (backfill)...")
+cur.execute(REBUILD_SQL)
+cur.execute("SELECT count(*) FROM phone_visibility")
+print(f"✅ {cur.fetchone()[0]} teléfonos cargados.")
+
+conn.commit()
+cur.close()
+conn.close()
+print("✅ Migración completada.")
@@ -21,6 +21,7 @@ class CrmUser(db.Model):
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
     is_active = db.Column(db.Boolean, default=True, nullable=False)
     can_see_untagged = db.Column(db.Boolean, default=False, nullable=False)
+    auth_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # +1 al cambiar permisos/visibilidad (invalida auth_cache)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     permissions   = db.relationship('CrmUserPermission',    backref='user',     lazy='joined', cascade='all, delete-orphan')
@@ -81,25 +82,41 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=True)
     media_id = db.Column(db.String(100), nullable=True)
     media_url = db.Column(db.String(255), nullable=True)
+    media_status = db.Column(db.String(10), nullable=True)  # NULL=sin media, 'pending', 'ready', 'failed'
     caption = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     sent_by = db.Column(db.String(100), nullable=True)  # NULL=entrante, 'bot'=chatbot, username=agente
     read_at = db.Column(db.DateTime, nullable=True)  # NULL=no leído, fecha=leído por agente humano
-    # Relación con estados — lazy='joined' carga statuses en un solo JOIN al traer mensajes
-    statuses = db.relationship('MessageStatus', backref='message', lazy='joined', order_by='MessageStatus.timestamp')
+    # Último estado de entrega (desnormalizado desde whatsapp_message_statuses por save_statuses).
+    # Se actualiza de forma monótona: un 'delivered' que llega después del 'read' no lo pisa.
+    status = db.Column(db.String(20), nullable=True)  # NULL, sent, failed, delivered, read
+    sent_at = db.Column(db.DateTime, nullable=True)
+    delivered_at = db.Column(db.DateTime, nullable=True)
+    read_at_recipient = db.Column(db.DateTime, nullable=True)  # Leído por el destinatario (no confundir con read_at)
+    failed_code = db.Column(db.String(50), nullable=True)
+    # Template que generó el mensaje (se guarda al enviar; el histórico lo completa migrate_message_template.py)
+    template_name = db.Column(db.String(100), nullable=True)
+    template_language = db.Column(db.String(10), nullable=True)
+    # Versión por fila (secuencia + trigger en message_versions.py): carga incremental del chat
+    row_version = db.Column(db.BigInteger, nullable=True)
+    # Historial completo de estados — solo se carga bajo demanda (el último estado está en `status`)
+    statuses = db.relationship('MessageStatus', backref='message', lazy='select', order_by='MessageStatus.timestamp')
 
     # Índices para optimización de queries del dashboard
     __table_args__ = (
         db.Index('ix_messages_phone_ts', 'phone_number', 'timestamp'),
         db.Index('idx_messages_timestamp', 'timestamp'),
+        db.Index('idx_messages_media_pending', 'timestamp', postgresql_where=db.text("media_status = 'pending'")),
+        db.Index('idx_messages_failed', 'timestamp', postgresql_where=db.text("status = 'failed'")),
+        db.Index('idx_messages_phone_row_version', 'phone_number', 'row_version'),
+        db.Index('idx_messages_row_version', 'row_version'),  # Rollups de analytics por watermark
+        db.Index('idx_messages_template', 'template_name', 'timestamp', postgresql_where=db.text("template_name IS NOT NULL")),
     )
     
     @property
     def latest_status(self):
-        """Obtiene el último estado del mensaje."""
-        if self.statuses:
-            return self.statuses[-1].status
-        return None
+        """Obtiene el último estado del mensaje (columna desnormalizada, sin consultar statuses)."""
+        return self.status
     
     def to_dict(self):
         return {
@@ -110,9 +127,10 @@ class Message(db.Model):
             'message_type': self.message_type,
             'content': self.content,
             'media_url': self.media_url,
+            'media_status': self.media_status,
             'caption': self.caption,
             'timestamp': self.timestamp.isoformat() if self.timestamp else None,
-            'latest_status': self.statuses[-1].status if self.statuses else None,
+            'latest_status': self.status,
             'sent_by': self.sent_by
         }
 
@@ -128,6 +146,10 @@ class MessageStatus(db.Model):
     error_code = db.Column(db.String(50), nullable=True)
     error_title = db.Column(db.String(200), nullable=True)
     error_details = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (
+        db.Index('idx_statuses_wa_id_status', 'wa_message_id', 'status'),  # Deduplicación de re-envíos de Meta
+    )
     
     def to_dict(self):
         return {
@@ -228,7 +250,7 @@ class Campaign(db.Model):
     template_name = db.Column(db.String(100), nullable=False)
     template_language = db.Column(db.String(10), default='es_AR')
     tag_id = db.Column(db.Integer, db.ForeignKey('whatsapp_tags.id'), nullable=True)  # legacy, nullable tras migración
-    status = db.Column(db.String(20), default='draft')  # draft, sending, completed, failed
+    status = db.Column(db.String(20), default='draft')  # draft, scheduled, sending, paused, cancelled, completed, failed
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     started_at = db.Column(db.DateTime, nullable=True)
     completed_at = db.Column(db.DateTime, nullable=True)
@@ -264,20 +286,63 @@ class CampaignLog(db.Model):
     contact_id = db.Column(db.Integer, db.ForeignKey('whatsapp_contacts.id'), nullable=True)  # Nuevo: referencia por ID
     contact_phone = db.Column(db.String(20), nullable=False)  # Mantener para histórico
     message_id = db.Column(db.String(100), nullable=True)
-    status = db.Column(db.String(20), default='pending')  # pending, sent, failed, delivered, read
+    status = db.Column(db.String(20), default='pending')  # pending, sent, failed, delivered, read, cancelled
     error_detail = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Respuestas del contacto dentro de la ventana de la campaña (ver campaign_metrics.py)
+    response_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    first_response_at = db.Column(db.DateTime, nullable=True)
+    # Lease del worker que tiene tomado el log mientras lo envía (ver campaign_sender.py)
+    claimed_by = db.Column(db.String(100), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    # Reintentos por throttling; ante 131056 el destinatario espera hasta next_attempt_at
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    retry_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Restricción única e índices para evitar duplicados y optimizar queries
     __table_args__ = (
         db.UniqueConstraint('campaign_id', 'contact_id', name='uq_campaign_contact_log'),
         db.Index('idx_campaign_logs_campaign_status', 'campaign_id', 'status'),
         db.Index('idx_campaign_logs_campaign_contact', 'campaign_id', 'contact_id'),
+        db.Index('idx_campaign_logs_message_id', 'message_id'),  # Lookup de estados entrantes por wa_message_id
+        db.Index('idx_campaign_logs_phone_created', 'contact_phone', 'created_at'),  # Atribución de respuestas
+        db.Index('idx_campaign_logs_pending', 'campaign_id', 'id', postgresql_where=db.text("status = 'pending'")),  # Claim de tramos
     )
 
     contact = db.relationship('Contact', backref='campaign_logs', foreign_keys=[contact_id])
 
 
+class CampaignCounters(db.Model):
+    """
+    Contadores de logs por estado de una campaña. Los mantienen triggers sobre
+    whatsapp_campaign_logs y los corrige el scheduler (ver campaign_counters.py).
+    """
+    __tablename__ = 'campaign_counters'
+
+    campaign_id = db.Column(db.Integer, db.ForeignKey('whatsapp_campaigns.id', ondelete='CASCADE'), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    pending = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)  # Solo 'sent' (sin delivered / read)
+    delivered = db.Column(db.Integer, nullable=False, default=0)
+    read = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    status_xid = db.Column(db.BigInteger, nullable=True)  # Último xid que cambió logs exitosos (ver campaign_metrics.py)
+
+
+class CampaignResponseMetrics(db.Model):
+    """Respuestas agregadas por campaña. Las mantiene el scheduler (ver campaign_metrics.py)."""
+    __tablename__ = 'campaign_response_metrics'
+
+    campaign_id = db.Column(db.Integer, db.ForeignKey('whatsapp_campaigns.id', ondelete='CASCADE'), primary_key=True)
+    responders = db.Column(db.Integer, nullable=False, default=0)
+    total_responses = db.Column(db.Integer, nullable=False, default=0)
+    latency_p50_seconds = db.Column(db.Float, nullable=True)  # Latencia de la primera respuesta
+    latency_p90_seconds = db.Column(db.Float, nullable=True)
+    latency_buckets = db.Column(db.JSON, nullable=True)  # {"<1h": n, "1-6h": n, "6-24h": n, "24-48h": n}
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
 # ==========================================
 # CONVERSATION CATEGORIZATION
 # ==========================================
@@ -306,6 +371,38 @@ class ConversationTopic(db.Model):
         }
 
 
+class CategorizerState(db.Model):
+    """
+    Estado incremental del categorizador por teléfono: último mensaje visto y
+    comienzo de la sesión abierta (ver conversation_categorizer.py).
+    """
+    __tablename__ = 'categorizer_state'
+
+    phone_number = db.Column(db.String(20), primary_key=True)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_message_at = db.Column(db.DateTime, nullable=False)
+    last_direction = db.Column(db.String(10), nullable=True)
+    last_message_type = db.Column(db.String(20), nullable=True)
+    tail_started_at = db.Column(db.DateTime, nullable=True)  # Inicio de la sesión abierta
+    tail_dirty = db.Column(db.Boolean, nullable=False, default=True)  # La sesión abierta tiene mensajes sin categorizar
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_categorizer_state_dirty', 'last_message_at', postgresql_where=db.text('tail_dirty')),
+    )
+
+
+class CategorizerPendingRange(db.Model):
+    """Sesión cerrada que quedó sin categorizar (respuesta vacía): se reintenta cada ciclo."""
+    __tablename__ = 'categorizer_pending_ranges'
+
+    phone_number = db.Column(db.String(20), primary_key=True)
+    started_at = db.Column(db.DateTime, primary_key=True)
+    ended_at = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
 class ConversationSession(db.Model):
     """Sesiones de conversación categorizadas automáticamente."""
     __tablename__ = 'conversation_sessions'
@@ -467,6 +564,27 @@ class AutoTagRule(db.Model):
 # AUTO TAG LOG
 # ==========================================
 
+class AutoTagEvaluation(db.Model):
+    """
+    Decisión del auto tagger por (regla, teléfono, último mensaje entrante): la regla
+    no se vuelve a evaluar para ese teléfono hasta que llegue otro mensaje.
+    Se purga a los AUTO_TAG_EVALUATION_RETENTION_DAYS días.
+    """
+    __tablename__ = 'auto_tag_evaluations'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    rule_id = db.Column(db.Integer, db.ForeignKey('auto_tag_rules.id', ondelete='CASCADE'), nullable=False)
+    phone_number = db.Column(db.String(20), nullable=False)
+    message_id = db.Column(db.Integer, nullable=False)  # Último mensaje entrante al evaluar
+    result = db.Column(db.Boolean, nullable=False)
+    evaluated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_auto_tag_evaluations_key', 'rule_id', 'phone_number', 'message_id', unique=True),
+        db.Index('idx_auto_tag_evaluations_evaluated', 'evaluated_at'),
+    )
+
+
 class AutoTagLog(db.Model):
     """Log de cada análisis del auto-tagger."""
     __tablename__ = 'auto_tag_logs'
@@ -936,3 +1054,167 @@ class PushSubscription(db.Model):
     auth = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+
+
+# ==========================================
+# WEBHOOK INBOX (cola durable de eventos de Meta)
+# ==========================================
+
+class WebhookInbox(db.Model):
+    """Payloads crudos del webhook de Meta, pendientes de procesar por los consumidores."""
+    __tablename__ = 'webhook_inbox'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    partition = db.Column(db.Integer, nullable=False)  # hash(teléfono) % WEBHOOK_INBOX_PARTITIONS
+    phone_number = db.Column(db.String(20), nullable=True)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, done, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('idx_webhook_inbox_partition_status', 'partition', 'status', 'id'),
+        db.Index('idx_webhook_inbox_processed', 'processed_at'),
+    )
+
+
+class N8nDeadLetter(db.Model):
+    """Payloads que no se pudieron entregar al webhook del chatbot en n8n."""
+    __tablename__ = 'n8n_dead_letters'
+
+    id = db.Column(db.Integer, primary_key=True)
+    phone_number = db.Column(db.String(20), nullable=False, index=True)
+    payload = db.Column(db.JSON, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'phone_number': self.phone_number,
+            'payload': self.payload,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class N8nOutbox(db.Model):
+    """
+    Mensajes entrantes en el buffer de debounce hacia n8n, con lease del proceso que
+    los tiene en memoria (ver n8n_forwarder.py). Se borran al entregarse a n8n.
+    """
+    __tablename__ = 'n8n_outbox'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    phone_number = db.Column(db.String(20), nullable=False)
+    message_id = db.Column(db.String(100), nullable=True, unique=True)  # wa_message_id (deduplica re-entregas)
+    item = db.Column(db.JSON, nullable=False)  # Mensaje normalizado (texto + adjunto)
+    wa_name = db.Column(db.String(200), nullable=True)
+    pending = db.Column(db.Boolean, nullable=False, default=False)  # Adjunto todavía descargándose
+    media_url = db.Column(db.Text, nullable=True)  # URL del adjunto al terminar la descarga
+    claimed_by = db.Column(db.String(100), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_n8n_outbox_lease', 'lease_expires_at'),
+    )
+
+
+class Conversation(db.Model):
+    """
+    Resumen por teléfono para la bandeja del dashboard.
+    Lo mantienen triggers de Postgres (ver conversations.py); no escribir desde la app.
+    """
+    __tablename__ = 'conversations'
+
+    phone_number = db.Column(db.String(20), primary_key=True)
+    contact_id = db.Column(db.Integer, nullable=True)
+    last_message = db.Column(db.Text, nullable=True)  # preview (primeros 200 caracteres)
+    last_direction = db.Column(db.String(10), nullable=True)
+    last_timestamp = db.Column(db.DateTime, nullable=True)
+    last_inbound_at = db.Column(db.DateTime, nullable=True)  # para la ventana de 24h
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    has_human = db.Column(db.Boolean, default=False, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_conversations_inbox', 'has_human', 'last_timestamp', 'phone_number'),  # se recorre hacia atrás
+        db.Index('idx_conversations_contact', 'contact_id'),
+    )
+
+
+class RealtimeEvent(db.Model):
+    """
+    Log de eventos en tiempo real (SSE). Lo escriben triggers de Postgres (ver realtime.py);
+    el id sirve como Last-Event-ID para que el cliente retome al reconectar.
+    """
+    __tablename__ = 'realtime_events'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    event_type = db.Column(db.String(30), nullable=False)  # message, status, tag, human_escalation, order
+    phone_number = db.Column(db.String(20), nullable=True)
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.text("(now() AT TIME ZONE 'utc')"))
+    xid = db.Column(db.BigInteger, nullable=True, server_default=db.text("txid_current()"))  # Transacción que lo escribió
+
+    __table_args__ = (
+        db.Index('idx_realtime_events_created', 'created_at'),
+        db.Index('idx_realtime_events_xid', 'xid', 'id'),
+    )
+
+
+class PhoneVisibility(db.Model):
+    """
+    Índice de visibilidad por teléfono: unión de las etiquetas de sus contactos.
+    Lo mantienen triggers de Postgres (ver visibility.py); no escribir desde la app.
+    """
+    __tablename__ = 'phone_visibility'
+
+    phone_number = db.Column(db.String(20), primary_key=True)
+    tag_ids = db.Column(db.ARRAY(db.Integer), nullable=False, default=list)
+    untagged = db.Column(db.Boolean, default=True, nullable=False)  # algún contacto del teléfono sin etiquetas
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_phone_visibility_tags', 'tag_ids', postgresql_using='gin'),
+    )
+
+
+class MessageRollupHourly(db.Model):
+    """
+    Mensajes agregados por hora local (Argentina), dirección, tipo y último estado.
+    Lo mantiene el scheduler (ver analytics_rollups.py); /analytics lee de acá.
+    """
+    __tablename__ = 'message_rollup_hourly'
+
+    bucket = db.Column(db.DateTime, primary_key=True)  # hora local truncada (sin tz)
+    direction = db.Column(db.String(10), primary_key=True)
+    message_type = db.Column(db.String(20), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True, default='')  # '' = sin estado
+    messages = db.Column(db.Integer, nullable=False, default=0)
+    sent_count = db.Column(db.Integer, nullable=False, default=0)
+    delivered_count = db.Column(db.Integer, nullable=False, default=0)
+    read_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class MessageRollupPhone(db.Model):
+    """Total de mensajes por teléfono (top contactos de /analytics). Ver analytics_rollups.py."""
+    __tablename__ = 'message_rollup_phone'
+
+    phone_number = db.Column(db.String(20), primary_key=True)
+    messages = db.Column(db.Integer, nullable=False, default=0, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class RollupWatermark(db.Model):
+    """Último row_version de whatsapp_messages aplicado a cada rollup."""
+    __tablename__ = 'rollup_watermarks'
+
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
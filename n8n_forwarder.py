@@ -0,0 +1,455 @@
+"""
+n8n Forwarder
+Reenvío asíncrono y con debounce de los mensajes entrantes al webhook del chatbot en n8n.
+
+Los usuarios suelen mandar 3-5 mensajes cortos seguidos. En vez de disparar el
+workflow de n8n una vez por fragmento, los mensajes de un mismo teléfono que
+llegan dentro de la ventana N8N_DEBOUNCE_SECONDS se juntan en un solo payload
+(user_message combinado + lista de adjuntos). La ventana se extiende con cada
+mensaje nuevo, hasta un máximo de N8N_DEBOUNCE_MAX_SECONDS desde el primero.
+
+Los payloads listos van a una cola acotada que drenan N8N_FORWARD_WORKERS threads
+con una sesión HTTP keep-alive compartida. Los fallos se reintentan con backoff
+exponencial y, agotados los reintentos (o con la cola llena), quedan en la tabla
+n8n_dead_letters para revisión / reenvío manual.
+
+Los mensajes con adjunto reservan su lugar en el buffer apenas llegan (reserve) y
+se completan cuando el media pipeline termina la descarga (resolve). Mientras haya
+un adjunto pendiente el buffer no se envía, así n8n recibe los mensajes en el orden
+en que los mandó el usuario; pasado N8N_MEDIA_HOLD_SECONDS se envía lo que esté
+listo antes del adjunto demorado.
+
+Como la inbox del webhook asigna cada teléfono a un único consumidor, todos los
+mensajes de una conversación pasan por el mismo proceso y el debounce en memoria
+alcanza. El buffer igual se persiste en `n8n_outbox` (una fila por mensaje, con
+lease del proceso que lo tiene): la fila se borra recién cuando n8n aceptó el
+payload (o al pasar a dead-letter). El dispatcher renueva los leases de su proceso;
+si el proceso muere, recover_outbox (scheduler) toma las filas con lease vencido
+y las vuelve a armar en memoria. Un mensaje re-entregado que ya está en la tabla
+no se agrega de nuevo.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPES = {'image', 'audio', 'video', 'document', 'sticker'}
+
+# Mapeo de content-type y extensión según tipo
+CONTENT_TYPE_MAP = {
+    'image': 'image/jpeg', 'audio': 'audio/ogg',
+    'video': 'video/mp4', 'document': 'application/octet-stream', 'sticker': 'image/webp'
+}
+EXT_MAP = {'image': 'jpg', 'audio': 'ogg', 'video': 'mp4', 'sticker': 'webp'}
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+OUTBOX_LEASE_SECONDS = 120      # sin renovar durante este tiempo, otro proceso retoma las filas
+OUTBOX_RENEW_SECONDS = 30
+OUTBOX_RECOVER_LIMIT = 500
+
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(Config.N8N_FORWARD_WORKERS, 2)))
+_http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max(Config.N8N_FORWARD_WORKERS, 2)))
+
+_cond = threading.Condition()
+_buffers = {}       # phone -> {'items': [...], 'first_at': float, 'deadline': float}
+_retry_heap = []    # (due, seq, job)
+_seq = itertools.count()
+_send_queue = queue.Queue(maxsize=Config.N8N_FORWARD_QUEUE_SIZE)
+_started = False
+
+# Métricas simples del proceso
+stats = {'messages_in': 0, 'invocations': 0, 'retries': 0, 'dead_letters': 0}
+
+
+def submit(user_number, user_message, msg_type, media_url=None, media_data=None, message_id=None, wa_name=None):
+    """Agrega un mensaje al buffer del teléfono y (re)programa su envío."""
+    item = _build_item(user_message, msg_type, media_url, media_data, message_id)
+    _add(user_number, item, wa_name)
+
+
+def reserve(user_number, user_message, msg_type, media_data=None, message_id=None, wa_name=None):
+    """Reserva el lugar de un mensaje con adjunto cuya URL todavía se está descargando."""
+    item = _build_item(user_message, msg_type, None, media_data, message_id)
+    item['pending'] = True
+    _add(user_number, item, wa_name)
+
+
+def resolve(message_id, media_url):
+    """Completa la URL de un adjunto reservado (media_url=None si la descarga falló)."""
+    try:
+        _outbox_execute(
+            "UPDATE n8n_outbox SET pending = FALSE, media_url = :url WHERE message_id = :mid",
+            {'url': media_url, 'mid': message_id}
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ [N8N] No se pudo actualizar el adjunto {message_id} en n8n_outbox: {e}")
+    with _cond:
+        for buf in _buffers.values():
+            for item in buf['items']:
+                if item.get('pending') and item['message_id'] == message_id:
+                    item['pending'] = False
+                    if item['attachment']:
+                        item['attachment']['url'] = _absolute_url(media_url)
+                    _cond.notify()
+                    return True
+    return False
+
+
+def _add(user_number, item, wa_name, persist=True):
+    _ensure_started()
+    if persist:
+        try:
+            item['outbox_id'] = _persist(user_number, item, wa_name)
+        except Exception as e:
+            # Sin la tabla el mensaje igual se reenvía, solo que sin respaldo ante un reinicio
+            logger.warning(f"⚠️ [N8N] No se pudo persistir el mensaje {item['message_id']} en n8n_outbox: {e}")
+            item['outbox_id'] = None
+        else:
+            if item['outbox_id'] is None:
+                logger.info(f"🔁 [N8N] Mensaje {item['message_id']} ya estaba en n8n_outbox, no se reenvía")
+                return
+    now = time.monotonic()
+    with _cond:
+        buf = _buffers.get(user_number)
+        if buf is None:
+            buf = {'items': [], 'first_at': now, 'wa_name': wa_name}
+            _buffers[user_number] = buf
+        buf['items'].append(item)
+        buf['wa_name'] = wa_name or buf.get('wa_name')
+        buf['deadline'] = min(now + Config.N8N_DEBOUNCE_SECONDS,
+                              buf['first_at'] + Config.N8N_DEBOUNCE_MAX_SECONDS)
+        stats['messages_in'] += 1
+        _cond.notify()
+
+
+def _outbox_execute(sql, params):
+    """Ejecuta una sentencia sobre n8n_outbox en su propia transacción (filas si hay RETURNING)."""
+    from app import app
+    from models import db
+    from sqlalchemy import text
+
+    with app.app_context():
+        try:
+            result = db.session.execute(text(sql), params)
+            rows = result.fetchall() if result.returns_rows else result.rowcount
+            db.session.commit()
+            return rows
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def _persist(user_number, item, wa_name):
+    """Guarda el mensaje en n8n_outbox con lease de este proceso. None si ya estaba (re-entrega)."""
+    stored = {k: v for k, v in item.items() if k != 'outbox_id'}
+    rows = _outbox_execute("""
+        INSERT INTO n8n_outbox (phone_number, message_id, item, wa_name, pending, claimed_by, lease_expires_at, created_at)
+        VALUES (:phone, :mid, CAST(:item AS json), :wa_name, :pending, :worker, :lease, :now)
+        ON CONFLICT (message_id) DO NOTHING
+        RETURNING id
+    """, {
+        'phone': user_number, 'mid': item['message_id'] or None, 'item': json.dumps(stored),
+        'wa_name': wa_name, 'pending': bool(item.get('pending')), 'worker': WORKER_ID,
+        'lease': datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS), 'now': datetime.utcnow(),
+    })
+    return rows[0][0] if rows else None
+
+
+def _release(job):
+    """Borra de n8n_outbox las filas de un payload ya entregado (o descartado)."""
+    ids = [i for i in job.get('outbox_ids', []) if i is not None]
+    if not ids:
+        return
+    try:
+        _outbox_execute("DELETE FROM n8n_outbox WHERE id = ANY(:ids)", {'ids': ids})
+    except Exception as e:
+        logger.warning(f"⚠️ [N8N] No se pudieron borrar {len(ids)} fila(s) de n8n_outbox: {e}")
+
+
+def _renew_leases():
+    try:
+        _outbox_execute(
+            "UPDATE n8n_outbox SET lease_expires_at = :lease WHERE claimed_by = :worker",
+            {'lease': datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS), 'worker': WORKER_ID}
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ [N8N] No se pudieron renovar los leases de n8n_outbox: {e}")
+
+
+def recover_outbox(app_context):
+    """
+    Toma las filas de n8n_outbox con lease vencido (proceso caído o reiniciado) y las
+    vuelve a armar en el buffer de este proceso, en orden de llegada (llamado desde el scheduler).
+    """
+    from models import db
+    from sqlalchemy import text
+
+    with app_context:
+        now = datetime.utcnow()
+        try:
+            rows = db.session.execute(text("""
+                UPDATE n8n_outbox o
+                SET claimed_by = :worker, lease_expires_at = :lease
+                WHERE o.id IN (
+                    SELECT id FROM n8n_outbox
+                    WHERE lease_expires_at < :now
+                    ORDER BY id
+                    LIMIT :lim
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING o.id, o.phone_number, o.item, o.wa_name, o.pending, o.media_url
+            """), {'worker': WORKER_ID, 'lease': now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+                   'now': now, 'lim': OUTBOX_RECOVER_LIMIT}).fetchall()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"No se pudo recuperar n8n_outbox: {e}")
+            return
+
+    for row in sorted(rows, key=lambda r: r.id):
+        item = row.item if isinstance(row.item, dict) else json.loads(row.item)
+        item['outbox_id'] = row.id
+        item['pending'] = bool(row.pending)
+        if item.get('attachment') and row.media_url:
+            item['attachment']['url'] = _absolute_url(row.media_url)
+        _add(row.phone_number, item, row.wa_name, persist=False)
+    if rows:
+        logger.info(f"🔁 [N8N] {len(rows)} mensaje(s) recuperados de n8n_outbox")
+
+
+def _absolute_url(media_url):
+    return Config.FLASK_BASE_URL.rstrip('/') + media_url if media_url and media_url.startswith('/') else media_url or ""
+
+
+def _build_item(user_message, msg_type, media_url, media_data, message_id):
+    """Normaliza un mensaje individual (texto + adjunto opcional)."""
+    attachment = None
+    if msg_type in MEDIA_TYPES:
+        content_type = CONTENT_TYPE_MAP.get(msg_type, '')
+        extension = EXT_MAP.get(msg_type, '')
+
+        # Para documentos intentar extraer extensión del filename
+        if msg_type == 'document' and media_data:
+            filename = media_data.get('filename', '')
+            if '.' in filename:
+                extension = filename.rsplit('.', 1)[-1].lower()
+                if extension == 'pdf':
+                    content_type = 'application/pdf'
+
+        attachment = {
+            'type': msg_type,
+            'url': _absolute_url(media_url),
+            'content_type': content_type,
+            'extension': extension,
+            'message_id': message_id or "",
+        }
+    return {'text': user_message or "", 'message_id': message_id or "", 'attachment': attachment, 'pending': False}
+
+
+def build_payload(user_number, items, wa_name=None):
+    """
+    Arma el payload para n8n a partir de uno o más mensajes.
+    Mantiene los campos históricos (attachment_* del primer adjunto) y agrega
+    `attachments`, `message_ids` y `merged_count` para los mensajes combinados.
+    """
+    attachments = [i['attachment'] for i in items if i['attachment']]
+    first = attachments[0] if attachments else None
+    texts = [i['text'] for i in items if i['text']]
+    return {
+        "user_number": user_number,
+        "message_type": 0,
+        "user_message": "\n".join(texts),
+        "has_attachments": bool(attachments),
+        "attachment_type": first['type'] if first else "none",
+        "attachment_url": first['url'] if first else "",
+        "attachment_content_type": first['content_type'] if first else "",
+        "attachment_extension": first['extension'] if first else "",
+        "attachments": attachments,
+        "message_id": items[-1]['message_id'],
+        "message_ids": [i['message_id'] for i in items],
+        "merged_count": len(items),
+        "updated_at": datetime.utcnow().isoformat(),
+        "user_name": wa_name or ""
+    }
+
+
+def _ensure_started():
+    global _started
+    with _cond:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_dispatcher_loop, name='n8n-dispatcher', daemon=True).start()
+    for i in range(Config.N8N_FORWARD_WORKERS):
+        threading.Thread(target=_sender_loop, name=f'n8n-sender-{i}', daemon=True).start()
+    logger.info(f"🤖 [N8N] Forwarder iniciado (debounce {Config.N8N_DEBOUNCE_SECONDS}s, {Config.N8N_FORWARD_WORKERS} worker(s))")
+
+
+def _take_ready(buf, now):
+    """
+    Saca del buffer los mensajes listos para enviar.
+    Con adjuntos pendientes se espera, salvo que se supere N8N_MEDIA_HOLD_SECONDS:
+    en ese caso sale solo lo anterior al primer pendiente.
+    """
+    items = buf['items']
+    pending_idx = next((i for i, it in enumerate(items) if it.get('pending')), None)
+    if pending_idx is None:
+        buf['items'] = []
+        return items
+    if now - buf['first_at'] < Config.N8N_MEDIA_HOLD_SECONDS:
+        return []
+    if pending_idx == 0:
+        # El adjunto más viejo no llegó a tiempo: se envía sin URL para no trabar la conversación
+        items[0]['pending'] = False
+        logger.warning(f"⚠️ [N8N] Adjunto {items[0]['message_id']} demorado más de {Config.N8N_MEDIA_HOLD_SECONDS}s, se envía sin URL")
+        pending_idx = next((i for i, it in enumerate(items) if it.get('pending')), len(items))
+    ready, buf['items'] = items[:pending_idx], items[pending_idx:]
+    buf['first_at'] = now
+    return ready
+
+
+def _dispatcher_loop():
+    """Mueve a la cola de envío los buffers vencidos y los reintentos que ya tocan."""
+    last_renew = time.monotonic()
+    while True:
+        if time.monotonic() - last_renew >= OUTBOX_RENEW_SECONDS:
+            _renew_leases()
+            last_renew = time.monotonic()
+
+        due_jobs = []
+        with _cond:
+            now = time.monotonic()
+            for phone, buf in list(_buffers.items()):
+                if buf['deadline'] > now:
+                    continue
+                ready = _take_ready(buf, now)
+                if not buf['items']:
+                    del _buffers[phone]
+                if ready:
+                    due_jobs.append({
+                        'phone': phone,
+                        'payload': build_payload(phone, ready, buf.get('wa_name')),
+                        'outbox_ids': [i.get('outbox_id') for i in ready],
+                        'attempts': 0,
+                    })
+            while _retry_heap and _retry_heap[0][0] <= now:
+                due_jobs.append(heapq.heappop(_retry_heap)[2])
+
+            if not due_jobs:
+                # Próximo vencimiento (los buffers trabados por un adjunto se revisan cada 1s)
+                deadlines = [b['deadline'] if b['deadline'] > now else now + 1 for b in _buffers.values()]
+                if _retry_heap:
+                    deadlines.append(_retry_heap[0][0])
+                # Despertar igual para renovar los leases de n8n_outbox
+                deadlines.append(now + OUTBOX_RENEW_SECONDS)
+                timeout = max(min(deadlines) - now, 0.05)
+                _cond.wait(timeout)
+                continue
+
+        for job in due_jobs:
+            try:
+                _send_queue.put_nowait(job)
+            except queue.Full:
+                _dead_letter(job, "Cola de envío llena")
+
+
+def _sender_loop():
+    while True:
+        job = _send_queue.get()
+        try:
+            _send(job)
+        except Exception as e:
+            logger.error(f"❌ [N8N] Error inesperado enviando a n8n: {e}", exc_info=True)
+        finally:
+            _send_queue.task_done()
+
+
+def _send(job):
+    if not Config.N8N_CHATBOT_WEBHOOK_URL:
+        logger.warning("N8N_CHATBOT_WEBHOOK_URL no está configurada. No se enviará el mensaje al chatbot.")
+        _release(job)
+        return
+
+    error = None
+    try:
+        response = _http.post(
+            Config.N8N_CHATBOT_WEBHOOK_URL,
+            json=job['payload'],
+            headers={"Content-Type": "application/json"},
+            timeout=10
+        )
+        if response.status_code in (200, 202):
+            stats['invocations'] += 1
+            merged = job['payload'].get('merged_count', 1)
+            logger.info(f"✅ Mensaje enviado a n8n para {job['phone']} ({merged} mensaje(s) combinados)")
+            _release(job)
+            return
+        error = f"{response.status_code} - {response.text[:500]}"
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            # Error del lado del payload: reintentar no lo arregla
+            _dead_letter(job, error)
+            return
+    except Exception as e:
+        error = str(e)
+
+    job['attempts'] += 1
+    if job['attempts'] >= Config.N8N_FORWARD_MAX_RETRIES:
+        _dead_letter(job, error)
+        return
+
+    delay = min(2 ** job['attempts'], 60)
+    stats['retries'] += 1
+    logger.warning(f"⚠️ [N8N] Falló el envío para {job['phone']} ({error}) — reintento {job['attempts']} en {delay}s")
+    with _cond:
+        heapq.heappush(_retry_heap, (time.monotonic() + delay, next(_seq), job))
+        _cond.notify()
+
+
+def _dead_letter(job, error):
+    """Persiste un payload que no se pudo entregar a n8n."""
+    from app import app
+    from models import db, N8nDeadLetter
+
+    stats['dead_letters'] += 1
+    logger.error(f"❌ [N8N] Payload para {job['phone']} enviado a dead-letter: {error}")
+    try:
+        with app.app_context():
+            db.session.add(N8nDeadLetter(
+                phone_number=job['phone'],
+                payload=job['payload'],
+                attempts=job['attempts'],
+                last_error=(error or '')[:2000]
+            ))
+            db.session.commit()
+    except Exception as e:
+        logger.error(f"No se pudo guardar dead-letter de n8n: {e}")
+        return
+    _release(job)
+
+
+def replay_dead_letter(dead_letter):
+    """
+    Re-encola un dead-letter (se borra de la tabla al encolarlo).
+    Se llama dentro de un app context (POST /api/admin/n8n/dead-letters/<id>/replay).
+    Lanza queue.Full si la cola de envío está llena.
+    """
+    from models import db
+    _ensure_started()
+    job = {'phone': dead_letter.phone_number, 'payload': dead_letter.payload, 'attempts': 0}
+    _send_queue.put_nowait(job)
+    db.session.delete(dead_letter)
+    db.session.commit()
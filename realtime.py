@@ -0,0 +1,396 @@
+"""
+Realtime
+Canal de eventos en tiempo real para el CRM (Server-Sent Events en /api/events/stream).
+
+Reemplaza el polling de /api/inbox-pulse, /api/unread-counts y los contadores de órdenes:
+
+1. Triggers de Postgres escriben cada cambio relevante en `realtime_events`
+   (log con id creciente) y hacen NOTIFY crm_events. Así cubren todos los caminos
+   de escritura, igual que la tabla resumen de conversaciones.
+   Tipos: message, status, tag, human_escalation, order.
+2. Cada proceso de gunicorn tiene UN thread que hace LISTEN crm_events y, al
+   despertar, lee los eventos nuevos y los reparte a las colas de las conexiones
+   SSE abiertas en ese proceso (fan-out entre workers vía Postgres).
+3. El cliente reconecta con Last-Event-ID y recibe lo que se perdió desde la
+   tabla. Si esa posición ya se purgó, recibe un evento `reset` y recarga todo.
+
+Los ids de BIGSERIAL no se commitean en orden. Cada evento guarda el xid de la
+transacción que lo escribió; el listener lee por (xid, id) y solo da por asentados
+los eventos con xid menor al xmin del snapshot (esas transacciones ya terminaron,
+lo que falta commitear va a quedar después). Los eventos más nuevos se reparten
+igual y se releen hasta asentarse, descartando los ids ya repartidos.
+
+El id SSE de cada evento es "<xid>.<id>:<event_id>": la posición (xid, id) asentada
+hasta ese evento inclusive (todo lo anterior ya se repartió) y el id propio del
+evento. Al reconectar se reenvía todo lo posterior a esa posición, así que pueden
+llegar eventos ya vistos: el cliente los descarta por event_id. Nunca se reanuda
+por id solo (un id menor puede commitearse después de uno mayor).
+
+Tabla, funciones y triggers se instalan con `python migrate_realtime.py`.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'crm_events'
+LOCK_KEY = 71003
+HUMAN_TAG = 'Asistencia Humana'
+
+FETCH_LIMIT = 500
+FALLBACK_POLL_SECONDS = 5       # por si se pierde un NOTIFY (reconexión del listener)
+SUBSCRIBER_QUEUE_SIZE = 1000
+REPLAY_LIMIT = 1000
+RETENTION_HOURS = 24
+
+# Sin parámetros ni '%': se ejecuta tal cual con cursor psycopg2
+SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS realtime_events (
+    id BIGSERIAL PRIMARY KEY,
+    event_type VARCHAR(30) NOT NULL,
+    phone_number VARCHAR(20),
+    payload JSON NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    xid BIGINT DEFAULT txid_current()
+);
+
+CREATE INDEX IF NOT EXISTS idx_realtime_events_created ON realtime_events(created_at);
+
+CREATE OR REPLACE FUNCTION realtime_on_messages_insert() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO realtime_events (event_type, phone_number, payload)
+    SELECT 'message', n.phone_number, json_build_object(
+        'id', n.id, 'wa_message_id', n.wa_message_id, 'phone_number', n.phone_number,
+        'direction', n.direction, 'message_type', n.message_type,
+        'preview', LEFT(n.content, 100))
+    FROM new_rows n
+    WHERE n.phone_number NOT IN ('unknown', 'outbound', '');
+    IF FOUND THEN
+        PERFORM pg_notify('{CHANNEL}', '');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Un evento por teléfono y statement (los lotes de estados llegan de a muchos)
+CREATE OR REPLACE FUNCTION realtime_on_statuses_insert() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO realtime_events (event_type, phone_number, payload)
+    SELECT 'status', m.phone_number, json_build_object(
+        'phone_number', m.phone_number,
+        'statuses', json_agg(json_build_object('wa_message_id', n.wa_message_id, 'status', n.status)))
+    FROM new_rows n
+    JOIN whatsapp_messages m ON m.wa_message_id = n.wa_message_id
+    WHERE m.phone_number NOT IN ('unknown', 'outbound', '')
+    GROUP BY m.phone_number;
+    IF FOUND THEN
+        PERFORM pg_notify('{CHANNEL}', '');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION realtime_on_contact_tags_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO realtime_events (event_type, phone_number, payload)
+        SELECT CASE WHEN t.name = '{HUMAN_TAG}' THEN 'human_escalation' ELSE 'tag' END,
+               c.phone_number,
+               json_build_object('phone_number', c.phone_number, 'contact_id', c.id,
+                                 'tag', t.name, 'action', 'added')
+        FROM new_rows r
+        JOIN whatsapp_contacts c ON c.id = r.contact_id
+        JOIN whatsapp_tags t ON t.id = r.tag_id;
+    ELSE
+        INSERT INTO realtime_events (event_type, phone_number, payload)
+        SELECT 'tag', c.phone_number,
+               json_build_object('phone_number', c.phone_number, 'contact_id', c.id,
+                                 'tag', t.name, 'action', 'removed')
+        FROM old_rows r
+        JOIN whatsapp_contacts c ON c.id = r.contact_id
+        JOIN whatsapp_tags t ON t.id = r.tag_id;
+    END IF;
+    IF FOUND THEN
+        PERFORM pg_notify('{CHANNEL}', '');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION realtime_on_orders_change() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO realtime_events (event_type, phone_number, payload)
+    VALUES ('order', NEW.phone_number, json_build_object(
+        'id', NEW.id, 'order_number', NEW.order_number, 'phone_number', NEW.phone_number,
+        'source', NEW.source, 'status', NEW.status, 'seen', NEW.seen_at IS NOT NULL,
+        'action', CASE WHEN TG_OP = 'INSERT' THEN 'created' ELSE 'updated' END));
+    PERFORM pg_notify('{CHANNEL}', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_realtime_messages_insert ON whatsapp_messages;
+CREATE TRIGGER trg_realtime_messages_insert
+    AFTER INSERT ON whatsapp_messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE realtime_on_messages_insert();
+
+DROP TRIGGER IF EXISTS trg_realtime_statuses_insert ON whatsapp_message_statuses;
+CREATE TRIGGER trg_realtime_statuses_insert
+    AFTER INSERT ON whatsapp_message_statuses
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE realtime_on_statuses_insert();
+
+DROP TRIGGER IF EXISTS trg_realtime_contact_tags_insert ON whatsapp_contact_tags;
+CREATE TRIGGER trg_realtime_contact_tags_insert
+    AFTER INSERT ON whatsapp_contact_tags
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE realtime_on_contact_tags_change();
+
+DROP TRIGGER IF EXISTS trg_realtime_contact_tags_delete ON whatsapp_contact_tags;
+CREATE TRIGGER trg_realtime_contact_tags_delete
+    AFTER DELETE ON whatsapp_contact_tags
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE realtime_on_contact_tags_change();
+
+DROP TRIGGER IF EXISTS trg_realtime_orders ON orders;
+CREATE TRIGGER trg_realtime_orders
+    AFTER INSERT OR UPDATE OF seen_at, status ON orders
+    FOR EACH ROW EXECUTE PROCEDURE realtime_on_orders_change();
+"""
+
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+_listener_started = False
+_listener_lock = threading.Lock()
+_listener_ready = threading.Event()  # LISTEN activo y posición inicial tomada
+LISTENER_READY_TIMEOUT = 5
+
+
+def install(cursor):
+    """Instala tabla, funciones y triggers usando un cursor DBAPI."""
+    cursor.execute(f"SELECT pg_advisory_xact_lock({LOCK_KEY})")
+    cursor.execute(SCHEMA_SQL)
+
+
+# ==========================================
+# SUSCRIPTORES (una cola por conexión SSE)
+# ==========================================
+
+class Subscriber:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Cliente demasiado lento: se corta y al reconectar retoma por Last-Event-ID
+            self.overflowed = True
+
+
+def subscribe():
+    _ensure_listener()
+    # El replay (después de suscribirse) tiene que leer después de que el listener tomó
+    # su posición inicial: lo anterior a esa posición solo llega por replay
+    _listener_ready.wait(LISTENER_READY_TIMEOUT)
+    sub = Subscriber()
+    with _subscribers_lock:
+        _subscribers.add(sub)
+    return sub
+
+
+def unsubscribe(sub):
+    with _subscribers_lock:
+        _subscribers.discard(sub)
+
+
+def subscriber_count():
+    with _subscribers_lock:
+        return len(_subscribers)
+
+
+def _broadcast(events):
+    with _subscribers_lock:
+        # Los que desbordaron ya cortaron su stream (o nunca lo empezaron): sacarlos
+        for sub in [s for s in _subscribers if s.overflowed]:
+            _subscribers.discard(sub)
+        subs = list(_subscribers)
+    for sub in subs:
+        for ev in events:
+            sub.push(ev)
+
+
+# ==========================================
+# LISTENER (LISTEN/NOTIFY → fan-out local)
+# ==========================================
+
+def _ensure_listener():
+    global _listener_started
+    with _listener_lock:
+        if _listener_started:
+            return
+        _listener_started = True
+    t = threading.Thread(target=_listener_loop, name='realtime-listener', daemon=True)
+    t.start()
+
+
+def _row_to_event(row, position):
+    """Evento para repartir; position: (xid, id) asentada hasta este evento inclusive."""
+    event_id, event_type, phone, payload, created_at = row
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+    return {'id': event_id, 'type': event_type, 'phone_number': phone, 'data': payload,
+            'token': f"{position[0]}.{position[1]}:{event_id}"}
+
+
+def parse_token(value):
+    """Posición (xid, id) de un Last-Event-ID ("<xid>.<id>:<event_id>"), o None si no es válido."""
+    try:
+        position = str(value).split(':', 1)[0]
+        xid, event_id = position.split('.', 1)
+        return int(xid), int(event_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _horizon(cur):
+    """xmin del snapshot: las transacciones con xid menor ya terminaron."""
+    cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    return cur.fetchone()[0]
+
+
+def _listener_loop():
+    """Conexión psycopg2 propia (fuera del pool): LISTEN es de larga duración."""
+    import psycopg2
+    from config import Config
+
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(Config.DATABASE_URL)
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {CHANNEL}")
+
+            # Posición (xid, id) hasta la que todo está repartido y asentado
+            settled = (_horizon(cur), 0)
+            seen = set()
+            _listener_ready.set()
+            logger.info(f"📡 [REALTIME] Escuchando {CHANNEL} desde el xid {settled[0]}")
+
+            while True:
+                if select.select([conn], [], [], FALLBACK_POLL_SECONDS) != ([], [], []):
+                    conn.poll()
+                    conn.notifies.clear()
+
+                # Tomado antes de leer: todo evento con xid menor ya es visible
+                horizon = _horizon(cur)
+                if not subscriber_count():
+                    # Nadie conectado en este proceso: solo avanzar la posición
+                    settled = max(settled, (horizon, 0))
+                    seen.clear()
+                    continue
+
+                position, blocked = settled, False
+                while True:
+                    cur.execute("""
+                        SELECT id, event_type, phone_number, payload, created_at, xid
+                        FROM realtime_events WHERE (xid, id) > (%s, %s)
+                        ORDER BY xid, id LIMIT %s
+                    """, (position[0], position[1], FETCH_LIMIT))
+                    rows = cur.fetchall()
+
+                    # Ordenados por xid: los asentados (xid < horizon) vienen primero. Cada evento
+                    # lleva la posición asentada hasta él (para reanudar sin perder nada)
+                    fresh = []
+                    for r in rows:
+                        if blocked or r[5] >= horizon:
+                            blocked = True
+                        else:
+                            settled = (r[5], r[0])
+                        if (r[5], r[0]) not in seen:
+                            fresh.append(_row_to_event(r[:5], settled))
+                            seen.add((r[5], r[0]))
+                    if fresh:
+                        _broadcast(fresh)
+                    if len(rows) < FETCH_LIMIT:
+                        if not blocked:
+                            settled = max(settled, (horizon, 0))
+                        break
+                    position = (rows[-1][5], rows[-1][0])
+
+                seen = {k for k in seen if k > settled}
+        except Exception as e:
+            _listener_ready.clear()
+            logger.error(f"❌ [REALTIME] Listener caído: {e}", exc_info=True)
+            time.sleep(FALLBACK_POLL_SECONDS)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+
+# ==========================================
+# REPLAY Y FORMATO SSE
+# ==========================================
+
+def replay_since(position):
+    """
+    Eventos posteriores a la posición (xid, id) de un Last-Event-ID (reconexión del cliente).
+    Retorna (events, reset): reset=True si esa posición ya se purgó y el cliente debe recargar.
+    Incluye eventos que el cliente quizás ya vio en vivo: los descarta él por event_id.
+    """
+    from models import db
+    from sqlalchemy import text
+
+    min_xid = db.session.execute(text("SELECT MIN(xid) FROM realtime_events")).scalar()
+    if min_xid is not None and position[0] < min_xid:
+        return [], True
+
+    # Tomado antes de leer, como en el listener: solo lo anterior al horizonte está asentado
+    horizon = db.session.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+    rows = db.session.execute(text("""
+        SELECT id, event_type, phone_number, payload, created_at, xid
+        FROM realtime_events WHERE (xid, id) > (:xid, :id) ORDER BY xid, id LIMIT :lim
+    """), {'xid': position[0], 'id': position[1], 'lim': REPLAY_LIMIT + 1}).fetchall()
+    if len(rows) > REPLAY_LIMIT:
+        return [], True
+
+    events, settled, blocked = [], position, False
+    for r in rows:
+        if blocked or r.xid >= horizon:
+            blocked = True  # Desde el primer evento sin asentar la posición queda fija
+        else:
+            settled = (r.xid, r.id)
+        events.append(_row_to_event(tuple(r)[:5], settled))
+    return events, False
+
+
+def format_sse(event):
+    return f"id: {event['token']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], default=str)}\n\n"
+
+
+def purge_old_events(app_context):
+    """Borra eventos más viejos que la retención (llamado desde el scheduler)."""
+    from models import db
+    from sqlalchemy import text
+
+    with app_context:
+        try:
+            cutoff = datetime.utcnow() - timedelta(hours=RETENTION_HOURS)
+            result = db.session.execute(text("DELETE FROM realtime_events WHERE created_at < :cutoff"), {'cutoff': cutoff})
+            db.session.commit()
+            if result.rowcount:
+                logger.info(f"🧹 [REALTIME] {result.rowcount} evento(s) purgados")
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"No se pudo purgar realtime_events: {e}")
@@ -0,0 +1,254 @@
+"""
+Scheduler
+Jobs periódicos (campañas programadas, categorizador, auto tagger, follow-ups,
+rollups, etc.) con un solo líder entre todos los procesos.
+
+Elección de líder:
+- Cada proceso con SCHEDULER_ENABLED compite por el advisory lock de sesión
+  LOCK_KEY en una conexión psycopg2 propia (fuera del pool de SQLAlchemy: el lock
+  nunca vuelve al pool con otra sesión). El que lo obtiene es el líder y es el
+  único que corre jobs; los demás reintentan cada SCHEDULER_STANDBY_SECONDS.
+- El líder hace heartbeat cada SCHEDULER_HEARTBEAT_SECONDS verificando en pg_locks
+  que su backend todavía tiene el lock. Si la conexión se cae o el lock ya no está
+  deja de ser líder; al dejarlo hace pg_advisory_unlock y cierra la conexión. Si el
+  proceso muere, Postgres libera el lock y otro proceso toma el relevo (failover).
+
+Jobs:
+- Cada job tiene su propio thread, intervalo y jitter: un categorizador lento no
+  atrasa los follow-ups ni las campañas programadas.
+- Un job nunca se solapa consigo mismo en el proceso (un thread por job). Si una
+  corrida dura más que el intervalo, la siguiente arranca al terminar (overrun).
+  En un failover la corrida en curso del líder anterior puede seguir: los jobs
+  mantienen sus propios locks (advisory / FOR UPDATE SKIP LOCKED / _running_lock).
+- Métricas por job (corridas, fallas, duración última/promedio/máxima, último
+  error) en get_status(), expuestas en /api/admin/scheduler.
+"""
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 71009
+
+# El lock de un bigint aparece en pg_locks como classid = 32 bits altos, objid = bajos, objsubid = 1
+LOCK_HELD_SQL = """
+    SELECT EXISTS (
+        SELECT 1 FROM pg_locks
+        WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND granted
+          AND classid = 0 AND objid = %s AND objsubid = 1
+    )
+"""
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_leader = threading.Event()
+_started = False
+_start_lock = threading.Lock()
+_leader_since = None
+
+
+class Job:
+    """Job periódico: corre func() cada `interval` segundos (± jitter) mientras este proceso sea líder."""
+
+    def __init__(self, name, func, interval, jitter=None, enabled=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = Config.SCHEDULER_JITTER_SECONDS if jitter is None else jitter
+        self.enabled = enabled  # callable opcional: False → se salta la corrida
+        self._metrics_lock = threading.Lock()
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = None
+        self.last_started_at = None
+        self.last_finished_at = None
+        self.last_error = None
+        self.next_run_at = None
+
+    def _delay(self):
+        return max(0.0, self.interval + random.uniform(-self.jitter, self.jitter))
+
+    def loop(self):
+        # Primer arranque escalonado: no todos los jobs a la vez al ganar el liderazgo
+        next_run = None
+        while True:
+            if not _leader.is_set():
+                next_run = None
+                self.next_run_at = None
+                _leader.wait()
+                continue
+
+            if next_run is None:
+                next_run = time.monotonic() + random.uniform(0, max(self.jitter, 1.0))
+            wait = next_run - time.monotonic()
+            self.next_run_at = datetime.utcnow() + timedelta(seconds=max(wait, 0))
+            if wait > 0:
+                time.sleep(min(wait, Config.SCHEDULER_HEARTBEAT_SECONDS))
+                continue  # Re-chequear liderazgo antes de correr
+
+            self.run_once()
+            next_run += self._delay()
+            if next_run <= time.monotonic():
+                self.overruns += 1
+                next_run = time.monotonic()
+
+    def run_once(self):
+        try:
+            if self.enabled is not None and not self.enabled():
+                self.skipped += 1
+                return
+        except Exception as e:
+            logger.error(f"❌ [SCHEDULER] {self.name}: error evaluando si está habilitado: {e}")
+            self.skipped += 1
+            return
+
+        started = time.monotonic()
+        self.running = True
+        self.last_started_at = datetime.utcnow()
+        error = None
+        try:
+            self.func()
+        except Exception as e:
+            error = e
+            logger.error(f"❌ [SCHEDULER] Error en {self.name}: {e}", exc_info=True)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._metrics_lock:
+                self.running = False
+                self.runs += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+                self.last_seconds = elapsed
+                self.last_finished_at = datetime.utcnow()
+                if error is not None:
+                    self.failures += 1
+                    self.last_error = str(error)[:500]
+        if elapsed > self.interval:
+            logger.warning(f"🐢 [SCHEDULER] {self.name} tardó {elapsed:.1f}s (intervalo {self.interval}s)")
+
+    def to_dict(self):
+        with self._metrics_lock:
+            return {
+                'name': self.name,
+                'interval_seconds': self.interval,
+                'jitter_seconds': self.jitter,
+                'running': self.running,
+                'runs': self.runs,
+                'failures': self.failures,
+                'skipped': self.skipped,
+                'overruns': self.overruns,
+                'last_seconds': round(self.last_seconds, 3) if self.last_seconds is not None else None,
+                'avg_seconds': round(self.total_seconds / self.runs, 3) if self.runs else None,
+                'max_seconds': round(self.max_seconds, 3),
+                'last_started_at': self.last_started_at.isoformat() + 'Z' if self.last_started_at else None,
+                'last_finished_at': self.last_finished_at.isoformat() + 'Z' if self.last_finished_at else None,
+                'next_run_at': self.next_run_at.isoformat() + 'Z' if self.next_run_at else None,
+                'last_error': self.last_error,
+            }
+
+
+def register_job(name, func, interval, jitter=None, enabled=None):
+    """Registra un job antes de start_scheduler. func() no recibe argumentos."""
+    job = Job(name, func, interval, jitter=jitter, enabled=enabled)
+    with _jobs_lock:
+        if name in _jobs:
+            raise ValueError(f"Job duplicado: {name}")
+        _jobs[name] = job
+    return job
+
+
+def start_scheduler(app):
+    """Lanza el elector de líder y un thread por job (idempotente por proceso)."""
+    global _started
+    if not Config.SCHEDULER_ENABLED:
+        logger.info("⏸️ [SCHEDULER] Desactivado en este proceso (SCHEDULER_ENABLED=false)")
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    threading.Thread(target=_leader_loop, args=(app,), name='scheduler-leader', daemon=True).start()
+    with _jobs_lock:
+        jobs = list(_jobs.values())
+    for job in jobs:
+        threading.Thread(target=job.loop, name=f"scheduler-{job.name}", daemon=True).start()
+    logger.info(f"🗓️ [SCHEDULER] {len(jobs)} job(s) registrados, compitiendo por el liderazgo")
+
+
+def is_leader():
+    return _leader.is_set()
+
+
+def _leader_loop(app):
+    """Intenta tomar el advisory lock; mientras lo tenga, verifica que lo sigue teniendo."""
+    global _leader_since
+    import psycopg2
+
+    while True:
+        lock_conn = None
+        try:
+            # Conexión propia: el advisory lock vive mientras esta conexión siga abierta
+            lock_conn = psycopg2.connect(Config.DATABASE_URL)
+            lock_conn.autocommit = True
+            cur = lock_conn.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_KEY,))
+            acquired = cur.fetchone()[0]
+
+            if not acquired:
+                lock_conn.close()
+                lock_conn = None
+                time.sleep(Config.SCHEDULER_STANDBY_SECONDS)
+                continue
+
+            _leader_since = datetime.utcnow()
+            _leader.set()
+            logger.info("👑 [SCHEDULER] Este proceso es el líder del scheduler")
+            while True:
+                time.sleep(Config.SCHEDULER_HEARTBEAT_SECONDS)
+                # Heartbeat del lock: si la conexión murió o el lock ya no es nuestro → volver a competir
+                cur.execute(LOCK_HELD_SQL, (LOCK_KEY,))
+                if not cur.fetchone()[0]:
+                    raise RuntimeError(f"el advisory lock {LOCK_KEY} ya no está tomado por esta conexión")
+        except Exception as e:
+            if _leader.is_set():
+                logger.error(f"❌ [SCHEDULER] Liderazgo perdido: {e}", exc_info=True)
+            else:
+                logger.error(f"❌ [SCHEDULER] Error compitiendo por el liderazgo: {e}")
+        finally:
+            _leader.clear()
+            _leader_since = None
+            if lock_conn is not None:
+                try:
+                    if not lock_conn.closed:
+                        lock_conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+                except Exception:
+                    pass
+                try:
+                    lock_conn.close()  # Cerrar la conexión también libera el advisory lock
+                except Exception:
+                    pass
+        # Solo se llega acá por un error: esperar ya sin lock ni conexión
+        time.sleep(Config.SCHEDULER_STANDBY_SECONDS)
+
+
+def get_status():
+    """Estado del scheduler en este proceso (liderazgo + métricas por job)."""
+    with _jobs_lock:
+        jobs = list(_jobs.values())
+    return {
+        'enabled': Config.SCHEDULER_ENABLED,
+        'is_leader': _leader.is_set(),
+        'leader_since': _leader_since.isoformat() + 'Z' if _leader_since else None,
+        'jobs': [job.to_dict() for job in jobs],
+    }
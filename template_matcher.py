@@ -0,0 +1,97 @@
+"""
+Template Matcher
+Identifica qué template de WhatsApp generó el texto de un mensaje saliente.
+
+Los envíos nuevos (campañas, seguimientos, /api/whatsapp/send-template) guardan
+template_name / template_language en whatsapp_messages al momento de enviar. Esto
+solo se usa donde no se conoce el template: mensajes que llegan por Chatwoot y el
+backfill de mensajes históricos (migrate_message_template.py).
+
+Solo se consideran los templates APPROVED. Cada body se compila una sola vez a un
+regex que debe cubrir el texto completo (fullmatch) y antes del regex se exige que
+el fragmento literal más largo del body esté en el texto, así la mayoría de los
+templates se descartan con un `in`.
+"""
+import re
+
+_TEMPLATE_MARKER = re.compile(r'^\[Template: ([^\]]+)\]')
+_VARIABLE = re.compile(r'\{\{[^}]+\}\}')
+_WHITESPACE = re.compile(r'\s+')
+
+
+class TemplateMatcher:
+    """Matcher precompilado para una lista de templates (la de whatsapp_api.get_templates())."""
+
+    def __init__(self, templates):
+        self._entries = []
+        for t in templates:
+            if t.get("status") != "APPROVED":
+                continue
+            body = next((c.get("text", "") for c in t.get("components", []) if c.get("type") == "BODY"), "")
+            body = body.strip()
+            if not body:
+                continue
+            literals = [_WHITESPACE.sub(' ', p).strip() for p in _VARIABLE.split(body)]
+            literals = [p for p in literals if p]
+            if not literals:
+                continue  # Body compuesto solo por variables: no se puede identificar
+            # Literales separados por variables; cualquier espacio / salto de línea equivale a otro
+            pattern = r'.*?'.join(
+                r'\s+'.join(re.escape(word) for word in literal.split(' ')) for literal in literals
+            )
+            self._entries.append((
+                t.get("name"),
+                t.get("language"),
+                max(literals, key=len).lower(),
+                re.compile(pattern, re.DOTALL | re.IGNORECASE),
+            ))
+        # Los bodies más largos primero: son los más específicos
+        self._entries.sort(key=lambda e: len(e[2]), reverse=True)
+
+    def match(self, content):
+        """(template_name, template_language) del texto, o (None, None) si no coincide con ninguno."""
+        content = (content or "").strip()
+        if not content:
+            return None, None
+
+        # 1. Mensajes marcados con [Template: nombre]
+        marker = _TEMPLATE_MARKER.match(content)
+        if marker:
+            return marker.group(1), None
+
+        # 2. Coincidencia con el body completo
+        normalized = _WHITESPACE.sub(' ', content).lower()
+        for name, language, literal, regex in self._entries:
+            if literal in normalized and regex.fullmatch(content):
+                return name, language
+        return None, None
+
+
+def _templates_key(templates):
+    """Identidad de la lista de templates: solo cambia si cambia algo que afecta el match."""
+    return tuple(
+        (t.get("name"), t.get("language"), t.get("status"),
+         tuple((c.get("type"), c.get("text")) for c in t.get("components", [])))
+        for t in templates
+    )
+
+
+_current = {'key': None, 'matcher': None}
+
+
+def get_matcher():
+    """
+    Matcher con los templates actuales de la cuenta. Se recompila solo si cambia la
+    lista de templates; si get_templates() falla se sigue usando el último matcher
+    (o uno vacío, que también queda cacheado hasta que la API responda).
+    """
+    from whatsapp_service import whatsapp_api
+    result = whatsapp_api.get_templates()
+    if result.get("error") and _current['matcher'] is not None:
+        return _current['matcher']
+    templates = result.get("templates", [])
+    key = _templates_key(templates)
+    if _current['matcher'] is None or _current['key'] != key:
+        _current['matcher'] = TemplateMatcher(templates)
+        _current['key'] = key
+    return _current['matcher']
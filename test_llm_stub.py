@@ -0,0 +1,124 @@
+"""
+Script de prueba para llm_client contra un servidor local compatible con la API
+de OpenAI (sin gastar tokens ni necesitar la base de datos).
+
+El stub responde /v1/chat/completions con un JSON fijo después de una latencia
+simulada, y devuelve 429 (con Retry-After) o 500 en una fracción de los pedidos
+para ejercitar los reintentos.
+
+Uso:
+    python test_llm_stub.py [llamadas] [concurrencia]
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_PORT = 8765
+LATENCY_SECONDS = (0.2, 0.6)
+RATE_LIMIT_RATIO = 0.15
+SERVER_ERROR_RATIO = 0.05
+
+CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+CONCURRENCY = sys.argv[2] if len(sys.argv) > 2 else "8"
+
+# Configurar antes de importar llm_client (Config lee el entorno al importarse)
+os.environ["OPENAI_API_KEY"] = "sk-stub"
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{STUB_PORT}/v1"
+os.environ["LLM_MAX_CONCURRENCY"] = CONCURRENCY
+os.environ.setdefault("LLM_RPM", "600")
+
+_in_flight = 0
+_max_in_flight = 0
+_counter_lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        global _in_flight, _max_in_flight
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/v1/chat/completions":
+            return self._reply(404, {"error": {"message": "not found"}})
+
+        with _counter_lock:
+            _in_flight += 1
+            _max_in_flight = max(_max_in_flight, _in_flight)
+        try:
+            time.sleep(random.uniform(*LATENCY_SECONDS))
+            roll = random.random()
+            if roll < RATE_LIMIT_RATIO:
+                return self._reply(429, {"error": {"message": "rate limited", "type": "rate_limit"}}, {"Retry-After": "1"})
+            if roll < RATE_LIMIT_RATIO + SERVER_ERROR_RATIO:
+                return self._reply(500, {"error": {"message": "stub server error"}})
+
+            prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+            content = json.dumps({"topic": "Otro", "rating": "neutral", "summary": "stub",
+                                  "has_unanswered_questions": False, "needs_human_assistance": False})
+            self._reply(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": prompt_chars // 4, "completion_tokens": 30,
+                          "total_tokens": prompt_chars // 4 + 30},
+            })
+        finally:
+            with _counter_lock:
+                _in_flight -= 1
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", STUB_PORT), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    import llm_client
+
+    print("=" * 60)
+    print(f"🧪 {CALLS} llamadas contra el stub (concurrencia {CONCURRENCY})")
+    print("=" * 60)
+
+    def call(i):
+        messages = [
+            {"role": "system", "content": "Respondé en JSON."},
+            {"role": "user", "content": f"Conversación de prueba #{i} " + "hola " * 50},
+        ]
+        response = llm_client.chat("stub", messages, model="stub-model", max_tokens=100,
+                                   response_format={"type": "json_object"})
+        return json.loads(response.choices[0].message.content)
+
+    started = time.monotonic()
+    ok = failed = 0
+    for item, result, error in llm_client.run_parallel(call, range(CALLS)):
+        if error is None:
+            ok += 1
+        else:
+            failed += 1
+            print(f"❌ Llamada #{item}: {type(error).__name__}: {error}")
+    elapsed = time.monotonic() - started
+
+    print(f"\n✅ OK: {ok} | ❌ Fallidas: {failed} | ⏱️ {elapsed:.1f}s")
+    print(f"🔀 Máximo de pedidos simultáneos en el stub: {_max_in_flight}")
+    print(json.dumps(llm_client.get_metrics(), indent=2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -99,7 +99,7 @@ if no_encontradas:
 
 # Limpiar el cache para que las conversaciones sean re-analizadas
 print("\nLimpiando cache del auto-tagger...")
-cur.execute("DELETE FROM chatbot_config WHERE key LIKE 'auto_tag_%'")
+cur.execute("DELETE FROM auto_tag_evaluations")
 print("✅ Cache limpiado — las conversaciones serán re-analizadas en el próximo ciclo.")
 
 cur.close()
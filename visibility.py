@@ -0,0 +1,198 @@
+"""
+Visibility
+Índice de visibilidad por teléfono para los agentes con etiquetas restringidas.
+
+La tabla `phone_visibility` guarda, por teléfono, la unión de las etiquetas de
+sus contactos (tag_ids) y si alguno de esos contactos no tiene etiquetas
+(untagged). La mantienen triggers sobre whatsapp_contact_tags y whatsapp_contacts,
+así cualquier alta / baja de etiqueta (UI, reglas de auto-tag, importaciones,
+n8n) queda reflejada en la misma transacción.
+
+Con eso el filtro de visibilidad pasa de 2-3 EXISTS correlacionados sobre
+contactos y etiquetas a una búsqueda por PK con un `&&` entre arrays, y
+can_access_phone() responde desde un cache en memoria con TTL corto
+(Config.VISIBILITY_CACHE_TTL) para los checks repetidos al abrir un chat,
+enviar texto, templates o media.
+
+Un teléfono sin fila en phone_visibility no tiene contacto: cuenta como "sin etiquetas".
+
+Tabla, funciones y triggers se instalan con `python migrate_visibility.py`
+(también reconstruye el índice); la app no toca el esquema al arrancar.
+"""
+import logging
+import threading
+import time
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 71005
+
+# Sin parámetros ni '%': se ejecuta tal cual con exec_driver_sql / cursor psycopg2
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS phone_visibility (
+    phone_number VARCHAR(20) PRIMARY KEY,
+    tag_ids INTEGER[] NOT NULL DEFAULT '{}',
+    untagged BOOLEAN NOT NULL DEFAULT TRUE,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_phone_visibility_tags ON phone_visibility USING GIN (tag_ids);
+
+-- Recalcula las filas de los teléfonos indicados
+CREATE OR REPLACE FUNCTION phone_visibility_refresh(p_phones TEXT[]) RETURNS VOID AS $$
+BEGIN
+    DELETE FROM phone_visibility pv
+    WHERE pv.phone_number = ANY(p_phones)
+      AND NOT EXISTS (SELECT 1 FROM whatsapp_contacts c WHERE c.phone_number = pv.phone_number);
+
+    INSERT INTO phone_visibility (phone_number, tag_ids, untagged, updated_at)
+    SELECT c.phone_number,
+           COALESCE(array_agg(DISTINCT ct.tag_id ORDER BY ct.tag_id) FILTER (WHERE ct.tag_id IS NOT NULL), '{}'),
+           bool_or(ct.tag_id IS NULL),
+           (now() AT TIME ZONE 'utc')
+    FROM whatsapp_contacts c
+    LEFT JOIN whatsapp_contact_tags ct ON ct.contact_id = c.id
+    WHERE c.phone_number = ANY(p_phones)
+    GROUP BY c.phone_number
+    ON CONFLICT (phone_number) DO UPDATE SET
+        tag_ids = EXCLUDED.tag_ids,
+        untagged = EXCLUDED.untagged,
+        updated_at = EXCLUDED.updated_at
+    WHERE phone_visibility.tag_ids IS DISTINCT FROM EXCLUDED.tag_ids
+       OR phone_visibility.untagged IS DISTINCT FROM EXCLUDED.untagged;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION phone_visibility_on_contact_tags_change() RETURNS TRIGGER AS $$
+DECLARE
+    phones TEXT[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT c.phone_number) INTO phones
+        FROM new_rows r JOIN whatsapp_contacts c ON c.id = r.contact_id;
+    ELSE
+        SELECT array_agg(DISTINCT c.phone_number) INTO phones
+        FROM old_rows r JOIN whatsapp_contacts c ON c.id = r.contact_id;
+    END IF;
+    IF phones IS NOT NULL THEN
+        PERFORM phone_visibility_refresh(phones);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION phone_visibility_on_contacts_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM phone_visibility_refresh(ARRAY[OLD.phone_number::TEXT]);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM phone_visibility_refresh(ARRAY[NEW.phone_number::TEXT]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_phone_visibility_contact_tags_insert ON whatsapp_contact_tags;
+CREATE TRIGGER trg_phone_visibility_contact_tags_insert
+    AFTER INSERT ON whatsapp_contact_tags
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE phone_visibility_on_contact_tags_change();
+
+DROP TRIGGER IF EXISTS trg_phone_visibility_contact_tags_delete ON whatsapp_contact_tags;
+CREATE TRIGGER trg_phone_visibility_contact_tags_delete
+    AFTER DELETE ON whatsapp_contact_tags
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE phone_visibility_on_contact_tags_change();
+
+DROP TRIGGER IF EXISTS trg_phone_visibility_contacts ON whatsapp_contacts;
+CREATE TRIGGER trg_phone_visibility_contacts
+    AFTER INSERT OR DELETE OR UPDATE OF phone_number ON whatsapp_contacts
+    FOR EACH ROW EXECUTE PROCEDURE phone_visibility_on_contacts_change();
+"""
+
+# Reconstrucción completa (backfill). Idempotente: se puede correr con la app andando.
+REBUILD_SQL = """
+DELETE FROM phone_visibility pv
+WHERE NOT EXISTS (SELECT 1 FROM whatsapp_contacts c WHERE c.phone_number = pv.phone_number);
+
+INSERT INTO phone_visibility (phone_number, tag_ids, untagged, updated_at)
+SELECT c.phone_number,
+       COALESCE(array_agg(DISTINCT ct.tag_id ORDER BY ct.tag_id) FILTER (WHERE ct.tag_id IS NOT NULL), '{}'),
+       bool_or(ct.tag_id IS NULL),
+       (now() AT TIME ZONE 'utc')
+FROM whatsapp_contacts c
+LEFT JOIN whatsapp_contact_tags ct ON ct.contact_id = c.id
+GROUP BY c.phone_number
+ON CONFLICT (phone_number) DO UPDATE SET
+    tag_ids = EXCLUDED.tag_ids,
+    untagged = EXCLUDED.untagged,
+    updated_at = EXCLUDED.updated_at;
+"""
+
+def install(cursor, rebuild=True):
+    """Instala tabla, funciones y triggers (y reconstruye) usando un cursor DBAPI."""
+    cursor.execute(f"SELECT pg_advisory_xact_lock({LOCK_KEY})")
+    cursor.execute(SCHEMA_SQL)
+    if rebuild:
+        cursor.execute(REBUILD_SQL)
+
+
+def visibility_predicate(phone_alias, ids_param='_vis_ids', untagged_param='_vis_untagged'):
+    """
+    Predicado SQL "el teléfono es visible": una búsqueda por PK en phone_visibility.
+    Sin fila (teléfono sin contacto) cuenta como sin etiquetas.
+    """
+    return (f"COALESCE((SELECT _pv.tag_ids && CAST(:{ids_param} AS INTEGER[]) "
+            f"OR (_pv.untagged AND :{untagged_param}) "
+            f"FROM phone_visibility _pv WHERE _pv.phone_number = {phone_alias}), :{untagged_param})")
+
+
+# ── Cache en memoria de "teléfonos que este usuario puede ver" ─────────────
+
+_cache_lock = threading.Lock()
+_cache = {}  # (user_id, tag_ids, untagged) -> {phone: (visible, expires_at)}
+_MAX_PHONES_PER_USER = 5000
+
+
+def can_access_phone(user_id, tag_ids, can_see_untagged, phone):
+    """
+    ¿Un usuario con estas etiquetas visibles puede ver este teléfono?
+    La clave incluye las etiquetas del usuario, así un cambio de permisos no
+    reutiliza resultados viejos; los cambios de etiquetas del contacto se ven
+    al vencer el TTL (o antes con invalidate_phone en este proceso).
+    """
+    from models import db
+    from sqlalchemy import text
+
+    key = (user_id, tuple(sorted(tag_ids)), bool(can_see_untagged))
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key, {}).get(phone)
+    if hit and hit[1] > now:
+        return hit[0]
+
+    row = db.session.execute(
+        text("SELECT tag_ids, untagged FROM phone_visibility WHERE phone_number = :phone"),
+        {'phone': phone}
+    ).first()
+    if row is None:
+        visible = bool(can_see_untagged)
+    else:
+        visible = bool(set(row.tag_ids or []) & set(tag_ids)) or (bool(can_see_untagged) and row.untagged)
+
+    with _cache_lock:
+        phones = _cache.setdefault(key, {})
+        if len(phones) >= _MAX_PHONES_PER_USER:
+            phones.clear()
+        phones[phone] = (visible, now + Config.VISIBILITY_CACHE_TTL)
+    return visible
+
+
+def invalidate_phone(phone):
+    """Descarta el resultado cacheado de un teléfono (p. ej. al cambiarle etiquetas)."""
+    with _cache_lock:
+        for phones in _cache.values():
+            phones.pop(phone, None)
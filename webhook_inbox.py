@@ -0,0 +1,323 @@
+"""
+Webhook Inbox
+Cola durable para los eventos que llegan a /webhook.
+
+El handler HTTP solo inserta el payload crudo (un INSERT) y responde 200 a Meta.
+Un pool de consumidores en background drena la tabla `webhook_inbox` y llama a
+`event_handlers.process_event`.
+
+Orden y paralelismo:
+- Cada payload se parte por teléfono (remitente o destinatario) y se asigna a una
+  partición = crc32(teléfono) % WEBHOOK_INBOX_PARTITIONS.
+- Cada partición tiene UN solo consumidor activo entre todos los procesos: el que
+  tiene el advisory lock de Postgres de esa partición, tomado en una conexión
+  psycopg2 propia (fuera del pool de SQLAlchemy, así el lock nunca vuelve al pool
+  con otra sesión). Así una conversación se procesa en orden y teléfonos
+  distintos se procesan en paralelo.
+- Una fila recién se marca 'done' después de procesarse. Si el worker de gunicorn
+  muere, Postgres libera el lock junto con la conexión y otro consumidor (en otro
+  worker o en el worker reiniciado) retoma la partición desde la primera fila
+  pendiente. Entrega at-least-once: save_message ya deduplica por wa_message_id.
+"""
+import logging
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Namespace del advisory lock (pg_try_advisory_lock(int, int) → (namespace, partición))
+LOCK_NAMESPACE = 71001
+STANDBY_RETRY_SECONDS = 5
+
+# El lock de dos int aparece en pg_locks como classid = namespace, objid = partición, objsubid = 2
+LOCK_HELD_SQL = """
+    SELECT EXISTS (
+        SELECT 1 FROM pg_locks
+        WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND granted
+          AND classid = %s AND objid = %s AND objsubid = 2
+    )
+"""
+
+_wakeups = {}
+_started = False
+_start_lock = threading.Lock()
+
+
+def partition_for(phone):
+    """Partición estable para un teléfono (None → partición 0)."""
+    if not phone:
+        return 0
+    return zlib.crc32(phone.encode('utf-8')) % Config.WEBHOOK_INBOX_PARTITIONS
+
+
+def split_payload(data):
+    """
+    Parte un payload de Meta en sub-payloads de un solo teléfono.
+    Retorna lista de (phone, payload) manteniendo el orden original de los eventos.
+    Los changes sin mensajes ni estados (ej: template status updates) van sin teléfono.
+    """
+    parts = []
+    for entry in data.get("entry", []) or []:
+        for change in entry.get("changes", []) or []:
+            value = change.get("value", {}) or {}
+            messages = value.get("messages") or []
+            statuses = value.get("statuses") or []
+            base_value = {k: v for k, v in value.items() if k not in ("messages", "statuses")}
+
+            if not messages and not statuses:
+                parts.append((None, _wrap(data, entry, change, value)))
+                continue
+
+            # Agrupar por teléfono respetando el orden de primera aparición
+            grouped = {}
+            for msg in messages:
+                grouped.setdefault(msg.get("from"), {"messages": [], "statuses": []})["messages"].append(msg)
+            for st in statuses:
+                grouped.setdefault(st.get("recipient_id"), {"messages": [], "statuses": []})["statuses"].append(st)
+
+            for phone, events in grouped.items():
+                sub_value = dict(base_value)
+                if events["messages"]:
+                    sub_value["messages"] = events["messages"]
+                if events["statuses"]:
+                    sub_value["statuses"] = events["statuses"]
+                parts.append((phone, _wrap(data, entry, change, sub_value)))
+    return parts
+
+
+def _wrap(data, entry, change, value):
+    """Reconstruye la envoltura object/entry/changes alrededor de un value."""
+    return {
+        "object": data.get("object"),
+        "entry": [{
+            "id": entry.get("id"),
+            "changes": [{"field": change.get("field"), "value": value}]
+        }]
+    }
+
+
+def enqueue(data):
+    """
+    Persiste el payload del webhook en la inbox (un solo INSERT multi-fila + commit).
+    Retorna la cantidad de filas encoladas.
+    """
+    from models import db, WebhookInbox
+
+    parts = split_payload(data)
+    if not parts:
+        return 0
+
+    now = datetime.utcnow()
+    rows = [{
+        'partition': partition_for(phone),
+        'phone_number': phone,
+        'payload': payload,
+        'status': 'pending',
+        'attempts': 0,
+        'received_at': now,
+    } for phone, payload in parts]
+
+    db.session.execute(WebhookInbox.__table__.insert(), rows)
+    db.session.commit()
+
+    # Despertar a los consumidores locales de esas particiones (los de otros procesos hacen polling)
+    for r in rows:
+        ev = _wakeups.get(r['partition'])
+        if ev:
+            ev.set()
+    return len(rows)
+
+
+def start_inbox_consumers(app):
+    """Lanza un thread consumidor por partición (idempotente por proceso)."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    for p in range(Config.WEBHOOK_INBOX_PARTITIONS):
+        _wakeups[p] = threading.Event()
+        t = threading.Thread(target=_consumer_loop, args=(app, p), name=f"webhook-inbox-{p}")
+        t.daemon = True
+        t.start()
+    logger.info(f"📥 [INBOX] {Config.WEBHOOK_INBOX_PARTITIONS} consumidor(es) iniciados")
+
+
+def _consumer_loop(app, partition):
+    """Intenta ser el dueño de la partición; mientras lo sea, drena sus filas pendientes."""
+    import psycopg2
+
+    while True:
+        lock_conn = None
+        try:
+            # Conexión propia: el advisory lock vive mientras esta conexión siga abierta
+            lock_conn = psycopg2.connect(Config.DATABASE_URL)
+            lock_conn.autocommit = True
+            cur = lock_conn.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (LOCK_NAMESPACE, partition))
+            acquired = cur.fetchone()[0]
+
+            if not acquired:
+                lock_conn.close()
+                lock_conn = None
+                time.sleep(STANDBY_RETRY_SECONDS)
+                continue
+
+            logger.info(f"📥 [INBOX] Partición {partition} tomada por este proceso")
+            _drain_forever(app, partition, cur)
+        except Exception as e:
+            logger.error(f"❌ [INBOX] Consumidor partición {partition} caído: {e}", exc_info=True)
+        finally:
+            if lock_conn is not None:
+                try:
+                    if not lock_conn.closed:
+                        lock_conn.cursor().execute("SELECT pg_advisory_unlock(%s, %s)", (LOCK_NAMESPACE, partition))
+                except Exception:
+                    pass
+                try:
+                    lock_conn.close()  # Cerrar la conexión también libera el advisory lock
+                except Exception:
+                    pass
+        # Solo se llega acá por un error: esperar ya sin lock ni conexión
+        time.sleep(STANDBY_RETRY_SECONDS)
+
+
+def _drain_forever(app, partition, lock_cur):
+    from models import db
+
+    wakeup = _wakeups[partition]
+    while True:
+        with app.app_context():
+            processed = _process_batch(db, partition)
+
+        if processed:
+            continue  # Hay backlog: seguir drenando sin esperar
+
+        wakeup.wait(Config.WEBHOOK_INBOX_POLL_SECONDS)
+        wakeup.clear()
+
+        # Heartbeat del lock: si la conexión murió o el lock ya no es nuestro → volver a competir
+        lock_cur.execute(LOCK_HELD_SQL, (LOCK_NAMESPACE, partition))
+        if not lock_cur.fetchone()[0]:
+            raise RuntimeError(f"el advisory lock ({LOCK_NAMESPACE}, {partition}) ya no está tomado por esta conexión")
+
+
+def _is_status_only(payload):
+    """True si el payload solo trae estados (sin mensajes entrantes)."""
+    for entry in payload.get("entry", []) or []:
+        for change in entry.get("changes", []) or []:
+            value = change.get("value", {}) or {}
+            if value.get("messages") or not value.get("statuses"):
+                return False
+    return True
+
+
+def _process_batch(db, partition):
+    """Procesa en orden las filas pendientes de la partición. Retorna cuántas se cerraron."""
+    from models import WebhookInbox
+    from event_handlers import process_event, extract_statuses, save_statuses
+
+    rows = WebhookInbox.query.filter(
+        WebhookInbox.partition == partition,
+        WebhookInbox.status == 'pending'
+    ).order_by(WebhookInbox.id).limit(Config.WEBHOOK_INBOX_BATCH).all()
+
+    done = 0
+    # Filas consecutivas de solo-estados se ingieren juntas en un único lote set-based
+    status_rows = []
+
+    def flush_statuses():
+        nonlocal done
+        if not status_rows:
+            return True
+        statuses = []
+        for r in status_rows:
+            statuses.extend(extract_statuses(r.payload))
+        try:
+            save_statuses(statuses)
+        except Exception as e:
+            # Reintentar fila por fila para aislar el evento problemático
+            logger.warning(f"⚠️ [INBOX] Lote de {len(status_rows)} evento(s) de estado falló: {e} — procesando individualmente")
+            for r in list(status_rows):
+                if not _process_row(db, r, process_event):
+                    status_rows.clear()
+                    return False
+                done += 1
+            status_rows.clear()
+            return True
+        now = datetime.utcnow()
+        for r in status_rows:
+            r.status = 'done'
+            r.processed_at = now
+        db.session.commit()
+        done += len(status_rows)
+        status_rows.clear()
+        return True
+
+    for row in rows:
+        if _is_status_only(row.payload):
+            status_rows.append(row)
+            continue
+        if not flush_statuses():
+            return done
+        if not _process_row(db, row, process_event):
+            return done
+        done += 1
+
+    flush_statuses()
+    return done
+
+
+def _process_row(db, row, process_event):
+    """Procesa una fila. Retorna False si quedó pendiente de reintento (la partición debe esperar)."""
+    try:
+        process_event(row.payload)
+        row.status = 'done'
+        row.processed_at = datetime.utcnow()
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        row.attempts += 1
+        row.last_error = str(e)[:2000]
+        if row.attempts >= Config.WEBHOOK_INBOX_MAX_ATTEMPTS:
+            # Evento venenoso: apartarlo para no bloquear la partición
+            row.status = 'failed'
+            row.processed_at = datetime.utcnow()
+            logger.error(f"❌ [INBOX] Evento {row.id} descartado tras {row.attempts} intentos: {e}")
+            db.session.commit()
+            return True
+        db.session.commit()
+        logger.warning(f"⚠️ [INBOX] Evento {row.id} falló (intento {row.attempts}): {e} — se reintenta")
+        return False  # No saltear: el resto de la partición espera para conservar el orden
+
+
+def purge_processed(app_context):
+    """
+    Borra los eventos de todas las particiones más viejos que la retención:
+    'done' tras WEBHOOK_INBOX_RETENTION_DAYS y 'failed' (descartados) tras
+    WEBHOOK_INBOX_FAILED_RETENTION_DAYS. Llamado desde el scheduler.
+    """
+    from models import db, WebhookInbox
+    from sqlalchemy import and_, or_
+
+    with app_context:
+        now = datetime.utcnow()
+        try:
+            deleted = WebhookInbox.query.filter(or_(
+                and_(WebhookInbox.status == 'done',
+                     WebhookInbox.processed_at < now - timedelta(days=Config.WEBHOOK_INBOX_RETENTION_DAYS)),
+                and_(WebhookInbox.status == 'failed',
+                     WebhookInbox.processed_at < now - timedelta(days=Config.WEBHOOK_INBOX_FAILED_RETENTION_DAYS)),
+            )).delete(synchronize_session=False)
+            db.session.commit()
+            if deleted:
+                logger.info(f"🧹 [INBOX] {deleted} evento(s) procesados o descartados purgados")
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"No se pudo purgar webhook_inbox: {e}")
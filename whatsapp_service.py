@@ -2,12 +2,14 @@
 Servicio para interactuar con la API de WhatsApp Business.
 """
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 import json
 import time
 import os
 import mimetypes
 import urllib3
+import http.client
 import boto3
 from botocore.client import Config as BotoConfig
 from botocore.exceptions import ClientError
@@ -134,6 +136,61 @@ def init_all_buckets():
     logger.info("✅ Buckets inicializados")
 
 
+# Sesión HTTP compartida (keep-alive + pool) para descargas de media
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=max(Config.MEDIA_DOWNLOAD_WORKERS * 2, 10)
+))
+
+# Sesión HTTP para envíos de templates: los workers de campañas comparten el pool
+_send_http = requests.Session()
+_send_http.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=max(Config.CAMPAIGN_SEND_WORKERS * 2, 10)
+))
+
+_MEDIA_CHUNK_SIZE = Config.MEDIA_CHUNK_SIZE_MB * 1024 * 1024
+_TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+# Cortes de red: al conectar / pedir la URL o a mitad del streaming (leyendo response.raw
+# directo aparecen las excepciones de urllib3 sin envolver en las de requests)
+_TRANSIENT_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.ReadTimeoutError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.IncompleteRead,
+    http.client.IncompleteRead,
+)
+
+
+class _TransientMediaError(Exception):
+    """Error de descarga que vale la pena reintentar (red, timeout, 429, 5xx)."""
+
+
+class _CountingReader:
+    """Envuelve un stream de lectura y cuenta los bytes leídos."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def _media_transfer_config():
+    """Multipart de a un chunk por vez: memoria acotada a ~MEDIA_CHUNK_SIZE_MB por descarga."""
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=_MEDIA_CHUNK_SIZE,
+        multipart_chunksize=_MEDIA_CHUNK_SIZE,
+        max_concurrency=1,
+        use_threads=False
+    )
+
+
 def get_minio_public_url(filename):
     """
     Genera la URL para un archivo en MinIO.
@@ -162,101 +219,145 @@ class WhatsAppAPI:
 
     def download_media(self, media_id):
         """
-        Descarga un archivo multimedia de WhatsApp y lo sube a MinIO.
+        Descarga un archivo multimedia de WhatsApp y lo sube a MinIO en streaming.
+        El binario nunca se carga entero en memoria: se lee por chunks y se sube con
+        multipart upload, así el consumo es constante sin importar el tamaño.
+        Reintenta ante errores transitorios (red, timeouts, 429, 5xx).
         Retorna la URL pública del archivo en MinIO o None si falla.
         """
-        try:
-            if not self.is_configured():
-                logger.error("API no configurada para descargar media")
-                return None
+        if not self.is_configured():
+            logger.error("API no configurada para descargar media")
+            return None
 
-            logger.info(f"⬇️ Iniciando descarga media_id: {media_id}")
+        max_retries = Config.MEDIA_DOWNLOAD_MAX_RETRIES
+        for attempt in range(1, max_retries + 1):
+            try:
+                return self._download_media_once(media_id)
+            except _TransientMediaError as e:
+                if attempt >= max_retries:
+                    logger.error(f"❌ Media {media_id}: se agotaron los {max_retries} intentos ({e})")
+                    return None
+                wait = min(2 ** attempt, 30)
+                logger.warning(f"⚠️ Media {media_id}: error transitorio ({e}) — reintento {attempt}/{max_retries} en {wait}s")
+                time.sleep(wait)
+            except Exception as e:
+                logger.error(f"EXCEPTION descargando media {media_id}: {str(e)}")
+                import traceback
+                logger.error(traceback.format_exc())
+                return None
+        return None
 
-            # 1. Obtener URL de descarga desde WhatsApp
-            url_info = f"{BASE_URL}/{media_id}"
-            res_info = requests.get(url_info, headers=self.headers, timeout=10)
+    def _download_media_once(self, media_id):
+        """Un intento de descarga. Lanza _TransientMediaError si vale la pena reintentar."""
+        logger.info(f"⬇️ Iniciando descarga media_id: {media_id}")
 
-            if res_info.status_code != 200:
-                logger.error(f"Error info media {media_id}: {res_info.status_code} - {res_info.text}")
-                return None
+        # 1. Obtener URL de descarga desde WhatsApp (expira a los pocos minutos: se pide en cada intento)
+        url_info = f"{BASE_URL}/{media_id}"
+        try:
+            res_info = _http.get(url_info, headers=self.headers, timeout=10)
+        except _TRANSIENT_EXCEPTIONS as e:
+            raise _TransientMediaError(str(e))
+
+        if res_info.status_code in _TRANSIENT_STATUS:
+            raise _TransientMediaError(f"info HTTP {res_info.status_code}")
+        if res_info.status_code != 200:
+            logger.error(f"Error info media {media_id}: {res_info.status_code} - {res_info.text}")
+            return None
 
-            data = res_info.json()
-            media_url = data.get("url")
-            mime_type = data.get("mime_type", "application/octet-stream")
+        data = res_info.json()
+        media_url = data.get("url")
+        mime_type = data.get("mime_type", "application/octet-stream")
 
-            logger.info(f"Media info OK. Mime: {mime_type}, URL: {media_url}")
+        logger.info(f"Media info OK. Mime: {mime_type}, URL: {media_url}")
 
-            if not media_url:
-                logger.error("No URL found in media info")
-                return None
+        if not media_url:
+            logger.error("No URL found in media info")
+            return None
 
-            # 2. Determinar extensión (normalizar para consistencia)
-            ext = mimetypes.guess_extension(mime_type)
+        # 2. Determinar extensión (normalizar para consistencia)
+        ext = mimetypes.guess_extension(mime_type)
 
-            # Normalizar extensiones de audio a .ogg (mimetypes puede retornar .oga en algunos sistemas)
-            if ext in ['.oga', '.opus']:
-                ext = '.ogg'
+        # Normalizar extensiones de audio a .ogg (mimetypes puede retornar .oga en algunos sistemas)
+        if ext in ['.oga', '.opus']:
+            ext = '.ogg'
 
-            # Fallbacks si mimetypes no reconoce el tipo
-            if not ext:
-                if 'audio' in mime_type: ext = '.ogg'
-                elif 'image' in mime_type: ext = '.jpg'
-                elif 'video' in mime_type: ext = '.mp4'
-                elif 'pdf' in mime_type: ext = '.pdf'
-                else: ext = '.bin'
+        # Fallbacks si mimetypes no reconoce el tipo
+        if not ext:
+            if 'audio' in mime_type: ext = '.ogg'
+            elif 'image' in mime_type: ext = '.jpg'
+            elif 'video' in mime_type: ext = '.mp4'
+            elif 'pdf' in mime_type: ext = '.pdf'
+            else: ext = '.bin'
 
-            filename = f"{media_id}{ext}"
+        filename = f"{media_id}{ext}"
 
-            # 3. Descargar contenido de WhatsApp
-            logger.info(f"Descargando contenido de WhatsApp...")
-            res_media = requests.get(media_url, headers=self.headers, timeout=30)
+        # 3. Descargar de WhatsApp y subir a MinIO en streaming
+        try:
+            s3 = get_s3_client()
+            bucket = Config.MINIO_BUCKET
+            ensure_bucket_exists()
 
-            if res_media.status_code != 200:
-                logger.error(f"Error descargando binario: {res_media.status_code}")
+            res_media = self._open_media_stream(media_url)
+            if res_media is None:
                 return None
+            with res_media:
+                counter = _CountingReader(res_media.raw)
+                s3.upload_fileobj(
+                    counter,
+                    bucket,
+                    filename,
+                    ExtraArgs={'ContentType': mime_type},
+                    Config=_media_transfer_config()
+                )
 
-            if len(res_media.content) == 0:
+            if counter.bytes_read == 0:
                 logger.error(f"Error: Archivo descargado tiene 0 bytes")
                 return None
 
-            # 4. Subir a MinIO
-            try:
-                s3 = get_s3_client()
-                bucket = Config.MINIO_BUCKET
-
-                # Asegurar que el bucket existe
-                ensure_bucket_exists()
-
-                s3.put_object(
-                    Bucket=bucket,
-                    Key=filename,
-                    Body=res_media.content,
-                    ContentType=mime_type
-                )
-
-                public_url = get_minio_public_url(filename)
-                logger.info(f"✅ Media subido a MinIO: {public_url} ({len(res_media.content)} bytes)")
-
-                return public_url
-
-            except Exception as e:
-                logger.error(f"Error subiendo a MinIO: {str(e)}")
-                # Fallback: guardar localmente si MinIO falla
-                base_dir = os.path.dirname(os.path.abspath(__file__))
-                local_dir = os.path.join(base_dir, "static", "media")
-                if not os.path.exists(local_dir):
-                    os.makedirs(local_dir)
-                local_path = os.path.join(local_dir, filename)
-                with open(local_path, 'wb') as f:
-                    f.write(res_media.content)
-                logger.warning(f"⚠️ Fallback a almacenamiento local: {local_path}")
-                return f"static/media/{filename}"
+            public_url = get_minio_public_url(filename)
+            logger.info(f"✅ Media subido a MinIO: {public_url} ({counter.bytes_read} bytes)")
+            return public_url
 
+        except _TransientMediaError:
+            raise
+        except (requests.exceptions.RequestException,) + _TRANSIENT_EXCEPTIONS as e:
+            raise _TransientMediaError(str(e))
         except Exception as e:
-            logger.error(f"EXCEPTION descargando media {media_id}: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.error(f"Error subiendo a MinIO: {str(e)}")
+
+        # Fallback: guardar localmente si MinIO falla (también en streaming)
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        local_dir = os.path.join(base_dir, "static", "media")
+        os.makedirs(local_dir, exist_ok=True)
+        local_path = os.path.join(local_dir, filename)
+        try:
+            res_media = self._open_media_stream(media_url)
+            if res_media is None:
+                return None
+            with res_media, open(local_path, 'wb') as f:
+                for chunk in res_media.iter_content(chunk_size=_MEDIA_CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+        except (requests.exceptions.RequestException,) + _TRANSIENT_EXCEPTIONS as e:
+            raise _TransientMediaError(str(e))
+        logger.warning(f"⚠️ Fallback a almacenamiento local: {local_path}")
+        return f"static/media/{filename}"
+
+    def _open_media_stream(self, media_url):
+        """GET en streaming del binario; valida el status antes de empezar a leer (None si falla)."""
+        logger.info(f"Descargando contenido de WhatsApp...")
+        try:
+            res_media = _http.get(media_url, headers=self.headers, timeout=(10, 60), stream=True)
+        except _TRANSIENT_EXCEPTIONS as e:
+            raise _TransientMediaError(str(e))
+        if res_media.status_code != 200:
+            res_media.close()
+            if res_media.status_code in _TRANSIENT_STATUS:
+                raise _TransientMediaError(f"binario HTTP {res_media.status_code}")
+            logger.error(f"Error descargando binario: {res_media.status_code}")
             return None
+        res_media.raw.decode_content = True
+        return res_media
     
     def get_templates(self):
         """Obtiene las plantillas de mensajes de la cuenta (con cache de 5 min)."""
@@ -371,7 +472,7 @@ class WhatsAppAPI:
         
         try:
             logger.info(f"📤 Enviando template '{template_name}' a {to_phone} con components: {json.dumps(components) if components else 'None'}")
-            response = requests.post(url, headers=self.headers, json=payload, timeout=10)
+            response = _send_http.post(url, headers=self.headers, json=payload, timeout=10)
             response.raise_for_status()
             data = response.json()
 
@@ -392,7 +493,9 @@ class WhatsAppAPI:
                 error_detail = e.response.text if e.response else str(e)
                 logger.error(f"📛 Respuesta de Meta: {error_detail}")
             logger.error(f"📦 Payload enviado: {json.dumps(payload)}")
-            return {"error": str(e), "detail": error_detail}
+            # Código de error de Meta (ej. 130429 / 131056 = throttling): lo usa el sender de campañas
+            code = (error_detail.get("error") or {}).get("code") if isinstance(error_detail, dict) else None
+            return {"error": str(e), "detail": error_detail, "code": code}
         except requests.exceptions.RequestException as e:
             logger.error(f"Error enviando template '{template_name}' a {to_phone}: {e}")
             logger.error(f"📦 Payload enviado: {json.dumps(payload)}")